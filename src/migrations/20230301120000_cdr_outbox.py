@@ -0,0 +1,12 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used by the dispatcher to claim the CDRs ready to be sent
+        self.db.wstore_cdr_outbox.create_index([('state', ASCENDING), ('next_attempt', ASCENDING)])
+        self.db.wstore_cdr_outbox.create_index([('batch', ASCENDING)], sparse=True)
+
+    def downgrade(self):
+        self.db.wstore_cdr_outbox.drop()
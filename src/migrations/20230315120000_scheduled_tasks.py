@@ -0,0 +1,11 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used by the scheduler to claim the due tasks
+        self.db.wstore_scheduled_task.create_index([('state', ASCENDING), ('due', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_scheduled_task.drop()
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+def get_next_due(contract, order_date):
+    if contract.get('terminated', False):
+        return None
+
+    pricing_model = contract.get('pricing_model', {})
+    due_dates = [subs['renovation_date'] for subs in pricing_model.get('subscription', []) if 'renovation_date' in subs]
+
+    if 'pay_per_use' in pricing_model:
+        last_charge = order_date
+        for charge in reversed(contract.get('charges', None) or []):
+            if charge['concept'] == 'usage':
+                last_charge = charge['date']
+                break
+
+        due_dates.append(last_charge + timedelta(days=30))
+
+    return min(due_dates) if len(due_dates) else None
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Calculate the next due date of existing contracts
+        for order in self.db.wstore_order.find():
+            for contract in order['contracts']:
+                contract['next_due'] = get_next_due(contract, order['date'])
+
+            self.db.wstore_order.update_one({'_id': order['_id']}, {'$set': {'contracts': order['contracts']}})
+
+        self.db.wstore_order.create_index([('contracts.next_due', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_order.drop_index([('contracts.next_due', ASCENDING)])
+        self.db.wstore_order.update_many({}, {'$unset': {'contracts.$[].next_due': ''}})
+        self.db.wstore_checkpoint.delete_many({'_id': 'pending_charges_daemon'})
@@ -0,0 +1,11 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used to find the charged usage documents that have not been rated yet
+        self.db.wstore_usage_rating.create_index([('product_id', ASCENDING), ('state', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_usage_rating.drop()
@@ -0,0 +1,13 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Indexes used to find orders by their ID and by the products of their contracts
+        self.db.wstore_order.create_index([('order_id', ASCENDING)])
+        self.db.wstore_order.create_index([('contracts.product_id', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_order.drop_index([('order_id', ASCENDING)])
+        self.db.wstore_order.drop_index([('contracts.product_id', ASCENDING)])
@@ -0,0 +1,37 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Charges are moved from the contracts to their own collection
+        self.db.wstore_charge.create_index([
+            ('order', ASCENDING), ('item_id', ASCENDING), ('concept', ASCENDING), ('date', ASCENDING)])
+
+        for order in self.db.wstore_order.find():
+            for contract in order['contracts']:
+                charges = contract.get('charges', None) or []
+
+                if len(charges):
+                    self.db.wstore_charge.insert_many([
+                        dict(charge, order=order['_id'], item_id=contract['item_id']) for charge in charges])
+
+                # Charges are sorted by date, so the last one of each concept is kept
+                contract['last_charges'] = {charge['concept']: charge for charge in charges}
+                contract['charges'] = []
+
+            self.db.wstore_order.update_one({'_id': order['_id']}, {'$set': {'contracts': order['contracts']}})
+
+    def downgrade(self):
+        for order in self.db.wstore_order.find():
+            for contract in order['contracts']:
+                contract['charges'] = [{
+                    field: charge[field] for field in ('concept', 'date', 'cost', 'duty_free', 'currency', 'invoice')
+                } for charge in self.db.wstore_charge.find(
+                    {'order': order['_id'], 'item_id': contract['item_id']}).sort('date', ASCENDING)]
+
+                contract.pop('last_charges', None)
+
+            self.db.wstore_order.update_one({'_id': order['_id']}, {'$set': {'contracts': order['contracts']}})
+
+        self.db.wstore_charge.drop()
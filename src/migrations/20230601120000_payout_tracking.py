@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from bson import ObjectId
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+PENDING_PAYOUT_STATUSES = ['NEW', 'PENDING', 'PROCESSING']
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used to find the batches notified by PayPal
+        self.db.wstore_reportspayout.create_index([('payout_id', ASCENDING)])
+
+        # Batches watched in memory before are resumed as scheduled checks
+        now = datetime.utcnow()
+        for payout in self.db.wstore_reportspayout.find({'status': {'$in': PENDING_PAYOUT_STATUSES}}):
+            # Checks receive their own task ID, so superseded checks can be discarded
+            task_id = ObjectId()
+            self.db.wstore_scheduled_task.insert_one({
+                '_id': task_id,
+                'handler': 'wstore.charging_engine.payout_engine.check_payout',
+                'args': {'payout_id': payout['payout_id'], 'check_id': str(task_id)},
+                'state': 'scheduled',
+                'attempts': 0,
+                'created': now,
+                'due': now
+            })
+
+            self.db.wstore_reportspayout.update_one({'_id': payout['_id']}, {
+                '$set': {'checks': 0, 'next_check': now, 'task_id': str(task_id)}
+            })
+
+    def downgrade(self):
+        self.db.wstore_reportspayout.drop_index([('payout_id', ASCENDING)])
+        self.db.wstore_scheduled_task.delete_many({'handler': 'wstore.charging_engine.payout_engine.check_payout'})
+        self.db.wstore_reportspayout.update_many({}, {'$unset': {'checks': '', 'next_check': '', 'task_id': ''}})
@@ -0,0 +1,11 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used to update the semi paid reports of a payout batch
+        self.db.wstore_reportsemipaid.create_index([('report', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_reportsemipaid.drop_index([('report', ASCENDING)])
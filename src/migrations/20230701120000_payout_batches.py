@@ -0,0 +1,11 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Index used to submit again the payout batches that failed
+        self.db.wstore_reportspayout.create_index([('sender_batch_id', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_reportspayout.drop_index([('sender_batch_id', ASCENDING)])
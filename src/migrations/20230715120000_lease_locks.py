@@ -0,0 +1,28 @@
+from mongodb_migrations.base import BaseMigration
+
+
+# Boolean locks are replaced by leases, locks left by crashed processes are released
+LEGACY_LOCKS = [
+    ('wstore_order', '_lock'),
+    ('wstore_payout', '_lock'),
+    ('wstore_resource', '_lock_asset'),
+    ('wstore_context', '_lock_ctx')
+]
+
+LEASE_LOCKS = [
+    ('wstore_order', '_lock_payment'),
+    ('wstore_payout', '_lock_payout'),
+    ('wstore_resource', '_lock_asset'),
+    ('wstore_context', '_lock_ctx')
+]
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        for collection, field in LEGACY_LOCKS:
+            self.db[collection].update_many({field: {'$type': 'bool'}}, {'$unset': {field: ''}})
+
+    def downgrade(self):
+        # Previous versions consider any lease as a held lock
+        for collection, field in LEASE_LOCKS:
+            self.db[collection].update_many({field: {'$type': 'object'}}, {'$unset': {field: ''}})
@@ -0,0 +1,31 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Usage documents are moved out of the rating jobs, so large charges do not exceed the document size limit
+        self.db.wstore_usage_rating_item.create_index([('job_id', ASCENDING), ('state', ASCENDING), ('_id', ASCENDING)])
+        self.db.wstore_usage_rating_item.create_index([('product_id', ASCENDING), ('state', ASCENDING)])
+
+        for job in self.db.wstore_usage_rating.find({'items': {'$exists': True}}):
+            items = [dict(item, job_id=job['_id'], product_id=job['product_id']) for item in job['items']]
+
+            if len(items):
+                self.db.wstore_usage_rating_item.insert_many(items)
+
+            self.db.wstore_usage_rating.update_one({'_id': job['_id']}, {'$unset': {'items': ''}})
+
+    def downgrade(self):
+        for job in self.db.wstore_usage_rating.find():
+            items = [{
+                'usage_id': item['usage_id'],
+                'duty_free': item['duty_free'],
+                'price': item['price'],
+                'tax_rate': item['tax_rate'],
+                'state': item['state']
+            } for item in self.db.wstore_usage_rating_item.find({'job_id': job['_id']}).sort('_id', ASCENDING)]
+
+            self.db.wstore_usage_rating.update_one({'_id': job['_id']}, {'$set': {'items': items}})
+
+        self.db.wstore_usage_rating_item.drop()
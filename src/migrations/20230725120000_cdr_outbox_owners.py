@@ -0,0 +1,20 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING, UpdateOne
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # CDRs are claimed by owner organization in correlation number order
+        self.db.wstore_cdr_outbox.create_index([('owner', ASCENDING), ('state', ASCENDING), ('correlation', ASCENDING)])
+
+        updates = [UpdateOne({'_id': entry['_id']}, {
+            '$set': {'owner': entry['cdr']['provider'], 'correlation': int(entry['cdr']['correlation'])}
+        }) for entry in self.db.wstore_cdr_outbox.find({'owner': {'$exists': False}}, {'cdr': 1})]
+
+        if len(updates):
+            self.db.wstore_cdr_outbox.bulk_write(updates, ordered=False)
+
+    def downgrade(self):
+        self.db.wstore_cdr_outbox.drop_index([('owner', ASCENDING), ('state', ASCENDING), ('correlation', ASCENDING)])
+        self.db.wstore_cdr_outbox.update_many({}, {'$unset': {'owner': '', 'correlation': ''}})
+        self.db.wstore_cdr_outbox_owner.drop()
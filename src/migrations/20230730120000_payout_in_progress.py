@@ -0,0 +1,13 @@
+from mongodb_migrations.base import BaseMigration
+from pymongo import ASCENDING
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        # Indexes used to find the payments whose batches are pending or still being processed
+        self.db.wstore_reportspayout.create_index([('status', ASCENDING)])
+        self.db.wstore_reportspayout.create_index([('next_check', ASCENDING)])
+
+    def downgrade(self):
+        self.db.wstore_reportspayout.drop_index([('status', ASCENDING)])
+        self.db.wstore_reportspayout.drop_index([('next_check', ASCENDING)])
@@ -39,7 +39,9 @@ DATABASES = {
         'CLIENT': {
             'host': 'localhost',
             #'username': 'mongoadmin',
-            #'password': 'mongopass'
+            #'password': 'mongopass',
+            #'maxPoolSize': 100,
+            #'serverSelectionTimeoutMS': 30000
         }
     }
 }
@@ -159,7 +161,8 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'wstore.store_commons.middleware.AuthenticationMiddleware'
+    'wstore.store_commons.middleware.AuthenticationMiddleware',
+    'wstore.store_commons.middleware.IdentityMapMiddleware'
 ]
 
 ROOT_URLCONF = 'urls'
@@ -184,6 +187,78 @@ CRONJOBS = [
     ('0 4 * * *', 'django.core.management.call_command', ['resend_upgrade'])
 ]
 
+# HTTP connections to the upstream APIs, sessions are shared per host
+HTTP_POOL_SIZE = 20  # Alive connections kept per host
+HTTP_MAX_CONCURRENCY = 20  # Concurrent requests allowed per host
+HTTP_CONNECT_TIMEOUT = 5  # Seconds
+HTTP_READ_TIMEOUT = 60  # Seconds
+HTTP_RETRIES = 3  # Only idempotent requests are retried
+HTTP_BACKOFF_FACTOR = 0.5
+
+# Catalog documents cache, expired documents are revalidated using their ETag
+CATALOG_CACHE_SIZE = 1000
+CATALOG_CACHE_TTL = 60  # Seconds
+
+# Validation info of the contracts receiving SDRs, it is invalidated when the order is saved
+SDR_CONTEXT_CACHE_SIZE = 1000
+SDR_CONTEXT_CACHE_TTL = 30  # Seconds
+
+# Emails of the providers and stakeholders of the settlement reports being paid
+USER_EMAIL_CACHE_SIZE = 10000
+USER_EMAIL_CACHE_TTL = 60  # Seconds
+
+# Maximum number of SDRs included in a batch, and concurrent updates of their usage documents
+SDR_BATCH_MAX_SIZE = 1000
+SDR_BATCH_WORKERS = 10
+
+# Usage documents retrieved per request to the usage API
+USAGE_PAGE_SIZE = 100
+
+# Concurrent requests used to rate the usage documents of a charge
+USAGE_RATING_WORKERS = 10
+USAGE_RATING_CHUNK_SIZE = 500  # Usage documents rated between saves of the progress
+
+# Concurrent conversions of invoices to PDF per process, invoices are generated in background
+INVOICE_WORKERS = 2
+
+# Concurrent downloads of the offerings and billing info of an order
+ORDERING_WORKERS = 10
+
+# Status checks of the payout batches sent to PayPal, the interval is doubled while the batch is pending
+PAYOUT_POLL_INTERVAL = 10  # Seconds
+PAYOUT_POLL_MAX_INTERVAL = 3600  # Seconds
+PAYOUT_MAX_CHECKS = 200  # The batch is no longer tracked after this number of checks
+
+# Payouts are split in batches, PayPal does not accept more than 15000 items in a batch
+PAYOUT_BATCH_SIZE = 1000
+
+# Max number of payout batches submitted concurrently
+PAYOUT_WORKERS = 4
+
+# Locks of the documents modified concurrently, leases are renewed while the lock is held
+DOCUMENT_LOCK_LEASE = 60  # Seconds a lock is kept if its owner stops renewing it
+DOCUMENT_LOCK_MAX_WAIT = 2  # Seconds
+
+# Persistent scheduler used for delayed tasks, such as payment timeouts
+SCHEDULER_WORKERS = 4
+SCHEDULER_POLL_INTERVAL = 1  # Seconds
+SCHEDULER_TASK_LEASE = 300  # Seconds a task can be running before being executed again
+SCHEDULER_MAX_ATTEMPTS = 5
+SCHEDULER_RETRY_DELAY = 30  # Seconds, multiplied by the number of attempts
+
+# Pending charges daemon, orders are processed in pages by a pool of workers
+PENDING_CHARGES_WORKERS = 4
+PENDING_CHARGES_PAGE_SIZE = 200
+
+# CDRs are stored in an outbox and sent to the RSS in batches
+CDR_OUTBOX_WORKERS = 4
+CDR_OUTBOX_BATCH_SIZE = 100
+CDR_OUTBOX_MAX_ATTEMPTS = 10
+CDR_OUTBOX_RETRY_DELAY = 10  # Seconds, doubled on every failed attempt
+CDR_OUTBOX_MAX_RETRY_DELAY = 3600
+CDR_OUTBOX_LEASE = 300  # Seconds a batch can be sending before being retried
+CDR_OUTBOX_POLL_INTERVAL = 10
+
 CLIENTS = {
     'paypal': 'wstore.charging_engine.payment_client.paypal_client.PayPalClient',
     'fipay': 'wstore.charging_engine.payment_client.fipay_client.FiPayClient',
@@ -222,6 +297,18 @@ env_port = environ.get('BAE_CB_MONGO_PORT', None)
 if env_port is not None:
     DATABASES['default']['CLIENT']['port'] = int(env_port)
 
+env_pool_size = environ.get('BAE_CB_MONGO_MAX_POOL_SIZE', None)
+if env_pool_size is not None:
+    DATABASES['default']['CLIENT']['maxPoolSize'] = int(env_pool_size)
+
+env_connect_timeout = environ.get('BAE_CB_MONGO_CONNECT_TIMEOUT', None)
+if env_connect_timeout is not None:
+    DATABASES['default']['CLIENT']['connectTimeoutMS'] = int(env_connect_timeout)
+
+env_selection_timeout = environ.get('BAE_CB_MONGO_SERVER_SELECTION_TIMEOUT', None)
+if env_selection_timeout is not None:
+    DATABASES['default']['CLIENT']['serverSelectionTimeoutMS'] = int(env_selection_timeout)
+
 
 DATA_UPLOAD_MAX_MEMORY_SIZE=int(environ.get('BAE_CB_MAX_UPLOAD_SIZE', DATA_UPLOAD_MAX_MEMORY_SIZE))
 
@@ -257,6 +344,30 @@ AUTHORIZE_SERVICE = environ.get('BAE_CB_AUTHORIZE_SERVICE', AUTHORIZE_SERVICE)
 
 PAYMENT_CLIENT = CLIENTS[PAYMENT_METHOD]
 
+HTTP_POOL_SIZE = int(environ.get('BAE_CB_HTTP_POOL_SIZE', HTTP_POOL_SIZE))
+HTTP_MAX_CONCURRENCY = int(environ.get('BAE_CB_HTTP_MAX_CONCURRENCY', HTTP_MAX_CONCURRENCY))
+HTTP_CONNECT_TIMEOUT = float(environ.get('BAE_CB_HTTP_CONNECT_TIMEOUT', HTTP_CONNECT_TIMEOUT))
+HTTP_READ_TIMEOUT = float(environ.get('BAE_CB_HTTP_READ_TIMEOUT', HTTP_READ_TIMEOUT))
+HTTP_RETRIES = int(environ.get('BAE_CB_HTTP_RETRIES', HTTP_RETRIES))
+
+CATALOG_CACHE_TTL = int(environ.get('BAE_CB_CATALOG_CACHE_TTL', CATALOG_CACHE_TTL))
+
+SDR_CONTEXT_CACHE_TTL = int(environ.get('BAE_CB_SDR_CONTEXT_CACHE_TTL', SDR_CONTEXT_CACHE_TTL))
+
+USER_EMAIL_CACHE_TTL = int(environ.get('BAE_CB_USER_EMAIL_CACHE_TTL', USER_EMAIL_CACHE_TTL))
+
+CDR_OUTBOX_WORKERS = int(environ.get('BAE_CB_CDR_WORKERS', CDR_OUTBOX_WORKERS))
+CDR_OUTBOX_BATCH_SIZE = int(environ.get('BAE_CB_CDR_BATCH_SIZE', CDR_OUTBOX_BATCH_SIZE))
+
+INVOICE_WORKERS = int(environ.get('BAE_CB_INVOICE_WORKERS', INVOICE_WORKERS))
+
+PAYOUT_POLL_INTERVAL = int(environ.get('BAE_CB_PAYOUT_POLL_INTERVAL', PAYOUT_POLL_INTERVAL))
+PAYOUT_POLL_MAX_INTERVAL = int(environ.get('BAE_CB_PAYOUT_POLL_MAX_INTERVAL', PAYOUT_POLL_MAX_INTERVAL))
+PAYOUT_MAX_CHECKS = int(environ.get('BAE_CB_PAYOUT_MAX_CHECKS', PAYOUT_MAX_CHECKS))
+PAYOUT_BATCH_SIZE = int(environ.get('BAE_CB_PAYOUT_BATCH_SIZE', PAYOUT_BATCH_SIZE))
+PAYOUT_WORKERS = int(environ.get('BAE_CB_PAYOUT_WORKERS', PAYOUT_WORKERS))
+DOCUMENT_LOCK_LEASE = int(environ.get('BAE_CB_DOCUMENT_LOCK_LEASE', DOCUMENT_LOCK_LEASE))
+
 PROPAGATE_TOKEN = environ.get('BAE_CB_PROPAGATE_TOKEN', PROPAGATE_TOKEN)
 if isinstance(PROPAGATE_TOKEN, str):
     PROPAGATE_TOKEN = PROPAGATE_TOKEN == 'True'
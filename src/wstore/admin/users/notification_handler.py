@@ -21,7 +21,6 @@
 
 import os
 import smtplib
-from bson.objectid import ObjectId
 
 from email import encoders
 from email.mime.text import MIMEText
@@ -31,7 +30,9 @@ from urllib.parse import urljoin
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from wstore.ordering.charge_history import INVOICE_FAILED, get_charges
 from wstore.ordering.models import Offering
+from wstore.store_commons.cache import get_instance
 
 from wstore.models import User
 
@@ -87,9 +88,14 @@ class NotificationsHandler:
 
         self._send_email(recipients, msg)
 
+    def _get_bill_path(self, charge):
+        return charge.invoice[10:] if charge.invoice.startswith("/charging/") else charge.invoice
+
+    def _has_bill(self, charge):
+        return charge is not None and bool(charge.invoice) and charge.invoice_status != INVOICE_FAILED
+
     def extract_bills_paths(self, order):
-        return [charge.invoice[10:] if charge.invoice.startswith("/charging/") else charge.invoice
-                for contract in order.get_contracts() for charge in contract.charges]
+        return [self._get_bill_path(charge) for charge in get_charges(order) if self._has_bill(charge)]
 
     def send_acquired_notification(self, order):
         org = order.owner_organization
@@ -102,7 +108,7 @@ class NotificationsHandler:
         text = 'We have received the payment of your order with reference ' + str(order.pk) + '\n'
         text += 'containing the following product offerings: \n\n'
         for cont in order.get_contracts():
-            offering = Offering.objects.get(pk=ObjectId(cont.offering))
+            offering = get_instance(Offering, cont.offering)
             text += offering.name + ' with id ' + offering.off_id + '\n\n'
 
         text += 'You can review your orders at: \n' + order_url + '\n'
@@ -126,7 +132,7 @@ class NotificationsHandler:
 
     def send_provider_notification(self, order, contract):
         # Get destination email
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_instance(Offering, contract.offering)
         org = offering.owner_organization
         recipients = [User.objects.get(pk=pk).email for pk in org.managers]
         domain = settings.SITE
@@ -146,7 +152,7 @@ class NotificationsHandler:
         domain = settings.SITE
         url = urljoin(domain, '/#/inventory/order/' + order.order_id)
 
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_instance(Offering, contract.offering)
 
         text = 'Your subscription belonging to the product offering ' + offering.name + ' has expired.\n'
         text += 'You can renovate all your pending subscriptions of the order with reference ' + str(order.pk) + '\n'
@@ -162,7 +168,7 @@ class NotificationsHandler:
         domain = settings.SITE
         url = urljoin(domain, '/#/inventory/order/' + order.order_id)
 
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_instance(Offering, contract.offering)
 
         text = 'Your subscription belonging to the product offering ' + offering.name + '\n'
         text += 'is going to expire in ' + str(days) + ' days. \n\n'
@@ -184,18 +190,22 @@ class NotificationsHandler:
         text += 'acquired in the order with reference ' + str(order.pk) + '\n'
 
         text += 'The following product offerings have been renovated: \n\n'
+        bills = []
         for t in transactions:
             cont = order.get_item_contract(t['item'])
-            offering = Offering.objects.get(pk=ObjectId(cont.offering))
+            offering = get_instance(Offering, cont.offering)
 
             text += offering.name + ' with id ' + offering.off_id + '\n\n'
 
+            # The bill of the renovation is the one of the last charge of the contract
+            last_charge = cont.get_last_charge()
+            if self._has_bill(last_charge):
+                bills.append(self._get_bill_path(last_charge))
+
         text += 'You can review your orders at: \n' + order_url + '\n'
         text += 'and your acquired products at: \n' + product_url + '\n'
 
-        bills = self.extract_bills_paths(order)
-
-        self._send_multipart_email(text, recipients, 'Product order accepted', bills[-len(transactions):])
+        self._send_multipart_email(text, recipients, 'Product order accepted', bills)
 
     def send_payout_error(self, recipient, error_msg):
         recipients = [recipient]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from mock import MagicMock
+
+from django.test import TestCase
+
+from wstore.admin.users import notification_handler
+
+
+class BillsTestCase(TestCase):
+    tags = ('notifications', 'bills')
+
+    def setUp(self):
+        self._get_charges = notification_handler.get_charges
+        notification_handler.get_charges = MagicMock()
+
+        self._order = MagicMock()
+
+    def tearDown(self):
+        notification_handler.get_charges = self._get_charges
+
+    def test_extract_bills_paths(self):
+        notification_handler.get_charges.return_value = [
+            MagicMock(invoice='/charging/media/bills/bill1.pdf', invoice_status='generated'),
+            MagicMock(invoice='media/bills/bill2.pdf', invoice_status='generated')
+        ]
+
+        handler = notification_handler.NotificationsHandler()
+        bills = handler.extract_bills_paths(self._order)
+
+        # The charges are loaded from the charge history
+        notification_handler.get_charges.assert_called_once_with(self._order)
+        self.assertEquals(['media/bills/bill1.pdf', 'media/bills/bill2.pdf'], bills)
+
+    def test_extract_bills_paths_no_charges(self):
+        notification_handler.get_charges.return_value = []
+
+        handler = notification_handler.NotificationsHandler()
+
+        self.assertEquals([], handler.extract_bills_paths(self._order))
+
+    def test_extract_bills_paths_status(self):
+        notification_handler.get_charges.return_value = [
+            MagicMock(invoice='/charging/media/bills/bill1.pdf', invoice_status='generated'),
+            MagicMock(invoice='/charging/media/bills/bill2.pdf', invoice_status='failed'),
+            MagicMock(invoice='', invoice_status='failed'),
+            MagicMock(invoice='/charging/media/bills/bill3.pdf', invoice_status='pending')
+        ]
+
+        handler = notification_handler.NotificationsHandler()
+        bills = handler.extract_bills_paths(self._order)
+
+        # Invoices that could not be generated are not attached
+        self.assertEquals(['media/bills/bill1.pdf', 'media/bills/bill3.pdf'], bills)
@@ -50,12 +50,13 @@ class NotificationsTestCase(TestCase):
         # Mock charges
         charge1 = MagicMock()
         charge1.invoice = '/charging/media/bills/bill1.pdf'
+        charge1.invoice_status = 'generated'
 
         # Mock contracts
         contract1 = MagicMock()
         contract1.product_id = '11'
         contract1.offering = '61004aba5e05acc115f022f0'
-        contract1.charges = [charge1]
+        contract1.get_last_charge.return_value = charge1
 
         offering1 = MagicMock()
         offering1.name = 'Offering1'
@@ -64,7 +65,8 @@ class NotificationsTestCase(TestCase):
 
         contract2 = MagicMock()
         contract2.offering = '61004aba5e05acc115f022f1'
-        contract2.charges = []
+
+        notification_handler.get_charges = MagicMock(return_value=[charge1])
 
         offering2 = MagicMock()
         offering2.name = 'Offering2'
@@ -200,6 +202,7 @@ class NotificationsTestCase(TestCase):
 
         # Validate calls
         self._validate_user_call()
+        notification_handler.get_charges.assert_called_once_with(self._order)
 
         notification_handler.MIMEMultipart.assert_called_once_with()
 
@@ -231,6 +234,7 @@ class NotificationsTestCase(TestCase):
 
         self._validate_user_call()
         self._order.get_item_contract.assert_called_once_with('0')
+        self.assertEquals(0, notification_handler.get_charges.call_count)
 
         text = 'We have received your recurring payment for renovating products offerings\n'
         text += 'acquired in the order with reference 61004aba5e05acc115f022f0\n'
@@ -5,9 +5,12 @@ from django.apps import AppConfig
 
 def register_signals():
     from django.dispatch import receiver
-    from django.db.models.signals import post_save
+    from django.db.models.signals import post_delete, post_save
     from django.contrib.auth.models import User
 
+    from wstore.charging_engine.accounting.sdr_manager import invalidate_sdr_context
+    from wstore.ordering.models import Offering, Order
+    from wstore.store_commons.cache import invalidate_catalog_document, invalidate_instance
 
     @receiver(post_save, sender=User, dispatch_uid="user_profile")
     def create_user_profile(sender, instance, created, **kwargs):
@@ -29,6 +32,19 @@ def register_signals():
                 profile.complete_name = instance.first_name + ' ' + instance.last_name
                 profile.save()
 
+    @receiver(post_save, sender=Offering, dispatch_uid="offering_cache")
+    @receiver(post_delete, sender=Offering, dispatch_uid="offering_cache")
+    def invalidate_offering(sender, instance, **kwargs):
+        invalidate_instance(Offering, instance.pk)
+
+        if instance.off_id is not None:
+            invalidate_catalog_document('productOffering', instance.off_id)
+
+    @receiver(post_save, sender=Order, dispatch_uid="sdr_context_cache")
+    @receiver(post_delete, sender=Order, dispatch_uid="sdr_context_cache")
+    def invalidate_order(sender, instance, **kwargs):
+        invalidate_sdr_context(instance.order_id)
+
 
 class WstoreConfig(AppConfig):
     name = 'wstore'
@@ -44,6 +60,8 @@ class WstoreConfig(AppConfig):
         from wstore.store_commons.utils.url import is_valid_url
         from wstore.ordering.inventory_client import InventoryClient
         from wstore.rss_adaptor.rss_manager import ProviderManager
+        from wstore.rss_adaptor.cdr_outbox import get_dispatcher
+        from wstore.store_commons.scheduler import get_scheduler
 
         # Creates a new user profile when an user is created
         # post_save.connect(create_user_profile, sender=User)
@@ -65,6 +83,12 @@ class WstoreConfig(AppConfig):
             inventory = InventoryClient()
             inventory.create_inventory_subscription()
 
+            # Send the CDRs queued before the last shutdown
+            get_dispatcher().start()
+
+            # Process the scheduled tasks, including the ones scheduled before the last shutdown
+            get_scheduler().start()
+
             # Create RSS default aggregator and provider
             credentials = {
                 'user': settings.STORE_NAME,
@@ -21,7 +21,6 @@
 
 import base64
 import os
-import threading
 import json
 from urllib.parse import urljoin
 
@@ -32,6 +31,7 @@ from wstore.models import Resource, ResourceVersion, ResourcePlugin
 from wstore.store_commons.database import DocumentLock
 from wstore.store_commons.errors import ConflictError
 from wstore.store_commons.rollback import rollback, downgrade_asset_pa, downgrade_asset
+from wstore.store_commons.scheduler import schedule_task
 from wstore.store_commons.utils.name import is_valid_file
 from wstore.store_commons.utils.url import is_valid_url, url_fix
 
@@ -234,18 +234,14 @@ class AssetManager:
 
         asset.save()
 
-    def _upgrade_timer(self):
-        lock = DocumentLock('wstore_resource', self._to_downgrade.pk, 'asset')
-        lock.wait_document()
-
-        # Refresh asset info
-        asset = Resource.objects.get(pk=self._to_downgrade.pk)
-
-        # If the asset is in upgrading state when the timer ends, rollback is called
-        if asset.state == 'upgrading':
-            downgrade_asset(asset)
+    def _upgrade_timer(self, asset_id):
+        with DocumentLock('wstore_resource', asset_id, 'asset'):
+            # Refresh asset info
+            asset = Resource.objects.get(pk=asset_id)
 
-        lock.unlock_document()
+            # If the asset is in upgrading state when the timer ends, rollback is called
+            if asset.state == 'upgrading':
+                downgrade_asset(asset)
 
     @rollback(downgrade_asset_pa)
     def upgrade_asset(self, asset_id, provider, data, file_=None):
@@ -288,8 +284,7 @@ class AssetManager:
 
         # If the upgrading process is not completed in 15 seconds the upgrade is canceled
         # in order to avoid an inconsistent state
-        t = threading.Timer(15, self._upgrade_timer)
-        t.start()
+        schedule_task('wstore.asset_manager.asset_manager.process_upgrade_timeout', 15, asset_id=asset.pk)
 
         return asset
 
@@ -340,3 +335,10 @@ class AssetManager:
             response.append(self.get_resource_info(res))
 
         return response
+
+
+def process_upgrade_timeout(asset_id):
+    """
+    Scheduled task that downgrades an asset if its upgrade has not been completed in time
+    """
+    AssetManager()._upgrade_timer(asset_id)
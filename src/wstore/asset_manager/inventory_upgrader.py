@@ -19,7 +19,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
-import requests
 from requests.exceptions import HTTPError
 from threading import Thread
 
@@ -30,6 +29,7 @@ from wstore.models import Context, Resource
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.ordering.models import Order, Offering
 from wstore.store_commons.database import DocumentLock
+from wstore.store_commons.cache import download_catalog_document
 
 
 PAGE_LEN = 100.0
@@ -47,10 +47,7 @@ class InventoryUpgrader(Thread):
             prod_url = '{}/api/catalogManagement/v2/productSpecification/{}?fields=name'\
                 .format(settings.CATALOG, self._asset.product_id)
 
-            resp = requests.get(prod_url)
-            resp.raise_for_status()
-
-            self._product_name = resp.json()['name']
+            self._product_name = download_catalog_document(prod_url)['name']
         except HTTPError:
             self._product_name = None
 
@@ -59,19 +56,15 @@ class InventoryUpgrader(Thread):
         # In this case context must be accessed as a shared resource
         context_id = Context.objects.all()[0].pk
 
-        lock = DocumentLock('wstore_context', context_id, 'ctx')
-        lock.wait_document()
-
-        # At this point only the current thread can modify the list of pending upgrades
-        context = Context.objects.all()[0]
-        context.failed_upgrades.append({
-            'asset_id': self._asset.pk,
-            'pending_offerings': pending_off,
-            'pending_products': pending_products
-        })
-        context.save()
-
-        lock.unlock_document()
+        with DocumentLock('wstore_context', context_id, 'ctx'):
+            # At this point only the current thread can modify the list of pending upgrades
+            context = Context.objects.all()[0]
+            context.failed_upgrades.append({
+                'asset_id': self._asset.pk,
+                'pending_offerings': pending_off,
+                'pending_products': pending_products
+            })
+            context.save()
 
     def _notify_user(self, patched_product):
         if self._product_name is not None:
@@ -19,14 +19,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import requests
 
 from decimal import Decimal
+from requests.exceptions import HTTPError
 
 from wstore.asset_manager.catalog_validator import CatalogValidator
 from wstore.asset_manager.models import Resource
 from wstore.asset_manager.resource_plugins.decorators import on_product_offering_validation
 from wstore.ordering.models import Offering
+from wstore.store_commons.cache import download_catalog_document, invalidate_catalog_document
 from wstore.store_commons.utils.units import ChargePeriod, CurrencyCode
 
 
@@ -68,6 +69,36 @@ class OfferingValidator(CatalogValidator):
         asset.is_public = is_open
         asset.save()
 
+    def _validate_price_tiers(self, price_model):
+        if price_model['priceType'] != 'usage':
+            raise ValueError('Price tiers can only be included in usage prices')
+
+        if price_model.get('priceTierType') not in ['tiered', 'volume', 'block']:
+            raise ValueError('Invalid priceTierType, it must be tiered, volume, or block')
+
+        tiers = price_model['priceTier']
+        if not isinstance(tiers, list) or not len(tiers):
+            raise ValueError('priceTier must be a non empty list')
+
+        last_limit = Decimal('0')
+        for i, tier in enumerate(tiers):
+            if 'taxIncludedAmount' not in tier or 'dutyFreeAmount' not in tier:
+                raise ValueError('Missing required field taxIncludedAmount or dutyFreeAmount in priceTier')
+
+            if Decimal(tier['taxIncludedAmount']) < Decimal('0') or Decimal(tier['dutyFreeAmount']) < Decimal('0'):
+                raise ValueError('Invalid price tier, prices cannot be negative')
+
+            # Only the last tier is unbounded, so all the usage is rated
+            if i == len(tiers) - 1:
+                if 'upTo' in tier:
+                    raise ValueError('The last price tier cannot include upTo')
+
+            elif 'upTo' not in tier or Decimal(tier['upTo']) <= last_limit:
+                raise ValueError('Invalid price tiers, upTo values must be increasing and greater than zero')
+
+            else:
+                last_limit = Decimal(tier['upTo'])
+
     @on_product_offering_validation
     def _validate_offering_pricing(self, provider, product_offering, bundled_offerings):
         is_open = False
@@ -117,19 +148,20 @@ class OfferingValidator(CatalogValidator):
                 if Decimal(price_model['price']['taxIncludedAmount']) <= Decimal("0"):
                     raise ValueError('Invalid price, it must be greater than zero.')
 
+                if 'priceTier' in price_model:
+                    self._validate_price_tiers(price_model)
+
             if is_open and len(names) > 1:
                 raise ValueError('Open offerings cannot include price plans')
 
         return is_open
 
     def _download(self, url):
-        r = requests.get(url)
-
-        if r.status_code != 200:
+        try:
+            return download_catalog_document(url)
+        except HTTPError:
             raise ValueError('There has been a problem accessing the product spec included in the offering')
 
-        return r.json()
-
     def _get_offering_asset(self, product_offering, bundled_offerings):
         asset = None
         # Check if the offering is a bundle
@@ -215,6 +247,9 @@ class OfferingValidator(CatalogValidator):
 
         asset, is_digital = self._validate_offering_model(product_offering, bundled_offerings, is_open)
 
+        # The cached versions of the offering are outdated once updated
+        invalidate_catalog_document('productOffering', product_offering['id'])
+
         # Open products can only be included in a single offering
         if is_open and self._count_resource_offerings(asset) > 1:
             raise ValueError('Assets of open offerings cannot be monetized in other offerings')
@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from bson import ObjectId
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
@@ -201,38 +202,33 @@ class ProductValidator(CatalogValidator):
         asset.state = 'attached'
         asset.save()
 
+    @contextmanager
     def _get_upgrading_asset(self, asset_t, url, product_id):
         asset_type, assets = self._get_asset_resouces(asset_t, url)
 
         if not len(assets):
             raise ProductError('The URL specified in the location characteristic does not point to a valid digital asset')
 
-        asset = assets[0]
-        # Lock the access to the asset
-        lock = DocumentLock('wstore_resource', asset.pk, 'asset')
-        lock.wait_document()
+        # Lock the access to the asset, it is released even if the validation fails
+        with DocumentLock('wstore_resource', assets[0].pk, 'asset'):
+            asset = Resource.objects.get(pk=assets[0].pk)
 
-        asset = Resource.objects.get(pk=asset.pk)
+            # Check that the asset is in upgrading state
+            if asset.state != 'upgrading':
+                raise ProductError('There is not a new version of the specified digital asset')
 
-        # Check that the asset is in upgrading state
-        if asset.state != 'upgrading':
-            raise ProductError('There is not a new version of the specified digital asset')
+            if asset.product_id != product_id:
+                raise ProductError('The specified digital asset is included in other product spec')
 
-        if asset.product_id != product_id:
-            raise ProductError('The specified digital asset is included in other product spec')
-
-        return asset, lock
+            yield asset
 
     def attach_upgrade(self, provider, product_spec):
         asset_t, media_type, url, asset_id = self.parse_characteristics(product_spec)
         is_digital = asset_t is not None and media_type is not None and url is not None
 
         if is_digital:
-            asset, lock = self._get_upgrading_asset(asset_t, url, product_spec['id'])
-            self._notify_product_upgrade(asset, asset_t, product_spec)
-
-            # Release asset lock
-            lock.unlock_document()
+            with self._get_upgrading_asset(asset_t, url, product_spec['id']) as asset:
+                self._notify_product_upgrade(asset, asset_t, product_spec)
 
     @rollback(downgrade_asset_pa)
     def validate_upgrade(self, provider, product_spec):
@@ -243,25 +239,21 @@ class ProductValidator(CatalogValidator):
             is_digital = asset_t is not None and media_type is not None and url is not None
 
             if is_digital:
-                asset, lock = self._get_upgrading_asset(asset_t, url, product_spec['id'])
-
-                self._to_downgrade = asset
-
-                self._validate_product_characteristics(asset, provider, asset_t, media_type)
+                with self._get_upgrading_asset(asset_t, url, product_spec['id']) as asset:
+                    self._to_downgrade = asset
 
-                # Check product version
-                if not is_valid_version(product_spec['version']):
-                    raise ProductError('The field version does not have a valid format')
+                    self._validate_product_characteristics(asset, provider, asset_t, media_type)
 
-                if not is_lower_version(asset.old_versions[-1].version, product_spec['version']):
-                    raise ProductError('The provided version is not higher that the previous one')
+                    # Check product version
+                    if not is_valid_version(product_spec['version']):
+                        raise ProductError('The field version does not have a valid format')
 
-                # Attach new info
-                asset.version = product_spec['version']
-                asset.save()
+                    if not is_lower_version(asset.old_versions[-1].version, product_spec['version']):
+                        raise ProductError('The provided version is not higher that the previous one')
 
-                # Release asset lock
-                lock.unlock_document()
+                    # Attach new info
+                    asset.version = product_spec['version']
+                    asset.save()
 
     def _rollback_handler(self, provider, product_spec, rollback_method):
         asset_t, media_type, url, asset_id = self.parse_characteristics(product_spec)
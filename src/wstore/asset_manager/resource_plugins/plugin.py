@@ -183,8 +183,8 @@ class Plugin(object):
             usage_client.update_usage_state(usage_doc['id'], 'Guided')
 
             contract.correlation_number += 1
-            order.save()
+            order.save_changes()
 
         if last_usage is not None:
             contract.last_usage = last_usage
-            order.save()
+            order.save_changes()
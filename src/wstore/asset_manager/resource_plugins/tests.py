@@ -531,7 +531,7 @@ class PluginTestCase(TestCase):
 
             self.assertEquals(1, contract.correlation_number)
             self.assertEquals(usages[1], contract.last_usage)
-            self.assertEquals([call(), call()], order.save.call_args_list)
+            self.assertEquals([call(), call()], order.save_changes.call_args_list)
 
     def test_usage_refresh_error(self):
         plugin_handler = plugin.Plugin(self._model)
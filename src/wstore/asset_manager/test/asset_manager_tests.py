@@ -471,11 +471,7 @@ class UploadAssetTestCase(TestCase):
         self.assertEquals(err_msg, str(error))
 
     def _mock_timer(self):
-        timer = MagicMock()
-        asset_manager.threading = MagicMock()
-        asset_manager.threading.Timer = MagicMock(return_value=timer)
-
-        return timer
+        asset_manager.schedule_task = MagicMock()
 
     @override_settings(MEDIA_ROOT='/home/test/media')
     def test_upgrade_asset(self):
@@ -499,7 +495,7 @@ class UploadAssetTestCase(TestCase):
 
         asset_manager.Resource.objects.filter.return_value = [asset]
 
-        timer = self._mock_timer()
+        self._mock_timer()
 
         am = asset_manager.AssetManager()
         am.rollback_logger = {
@@ -538,8 +534,8 @@ class UploadAssetTestCase(TestCase):
         self.assertEquals(prev_type, old_version['content_type'])
         self.assertEquals(prev_version, old_version['version'])
 
-        asset_manager.threading.Timer.assert_called_once_with(15, am._upgrade_timer)
-        timer.start.assert_called_once_with()
+        asset_manager.schedule_task.assert_called_once_with(
+            'wstore.asset_manager.asset_manager.process_upgrade_timeout', 15, asset_id=asset.pk)
 
     def _asset_empty(self):
         return []
@@ -595,14 +591,11 @@ class UploadAssetTestCase(TestCase):
         asset_manager.Resource.objects.get.return_value = asset
         asset_manager.downgrade_asset = MagicMock()
 
-        am = asset_manager.AssetManager()
-        am._to_downgrade = MagicMock(pk=asset_pk)
-
-        am._upgrade_timer()
+        asset_manager.process_upgrade_timeout(asset_pk)
 
         asset_manager.DocumentLock.assert_called_once_with('wstore_resource', asset_pk, 'asset')
-        lock.wait_document.assert_called_once_with()
-        lock.unlock_document.assert_called_once_with()
+        lock.__enter__.assert_called_once_with()
+        lock.__exit__.assert_called_once_with(None, None, None)
 
         asset_manager.Resource.objects.get.assert_called_once_with(pk=asset_pk)
 
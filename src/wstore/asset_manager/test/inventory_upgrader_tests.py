@@ -285,12 +285,9 @@ class InventoryUpgraderTestCase(TestCase):
         self._lock_inst = MagicMock()
         inventory_upgrader.DocumentLock = MagicMock(return_value=self._lock_inst)
 
-        inventory_upgrader.requests = MagicMock()
-        self._resp = MagicMock()
-        self._resp.json.return_value = {
+        inventory_upgrader.download_catalog_document = MagicMock(return_value={
             'name': self._product_spec_name
-        }
-        inventory_upgrader.requests.get.return_value = self._resp
+        })
 
         inventory_upgrader.PAGE_LEN = 2.0
 
@@ -317,9 +314,7 @@ class InventoryUpgraderTestCase(TestCase):
         inventory_upgrader.settings.CATALOG = self._cat_url
 
     def _check_product_spec_retrieved(self):
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
-        self._resp.raise_for_status.assert_called_once_with()
-        self._resp.json.assert_called_once_with()
+        inventory_upgrader.download_catalog_document.assert_called_once_with(self._product_spec_url)
 
     def _check_single_get_call(self):
         self._client_instance.get_products.assert_called_once_with(query={
@@ -573,8 +568,8 @@ class InventoryUpgraderTestCase(TestCase):
         self._ctx_instance.save.assert_called_once_with()
 
         inventory_upgrader.DocumentLock.assert_called_once_with('wstore_context', self._ctx_pk, 'ctx')
-        self._lock_inst.wait_document.assert_called_once_with()
-        self._lock_inst.unlock_document.assert_called_once_with()
+        self._lock_inst.__enter__.assert_called_once_with()
+        self._lock_inst.__exit__.assert_called_once_with(None, None, None)
 
         self.assertEquals([
             call(query={
@@ -630,7 +625,7 @@ class InventoryUpgraderTestCase(TestCase):
 
         self._client_instance.patch_product.side_effect = [None, HTTPError()]
 
-        inventory_upgrader.requests.get.side_effect = HTTPError()
+        inventory_upgrader.download_catalog_document.side_effect = HTTPError()
 
         # Execute the tested method
         upgrader = inventory_upgrader.InventoryUpgrader(self._asset)
@@ -645,8 +640,8 @@ class InventoryUpgraderTestCase(TestCase):
         self._ctx_instance.save.assert_called_once_with()
 
         inventory_upgrader.DocumentLock.assert_called_once_with('wstore_context', self._ctx_pk, 'ctx')
-        self._lock_inst.wait_document.assert_called_once_with()
-        self._lock_inst.unlock_document.assert_called_once_with()
+        self._lock_inst.__enter__.assert_called_once_with()
+        self._lock_inst.__exit__.assert_called_once_with(None, None, None)
 
         self.assertEquals([
             call(query={
@@ -668,8 +663,6 @@ class InventoryUpgraderTestCase(TestCase):
             })
         ], self._client_instance.patch_product.call_args_list)
 
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
-        self.assertEquals(0, self._resp.raise_for_status.call_count)
-        self.assertEquals(0, self._resp.json.call_count)
+        inventory_upgrader.download_catalog_document.assert_called_once_with(self._product_spec_url)
 
         self.assertEquals(0, inventory_upgrader.NotificationsHandler.call_count)
@@ -1174,6 +1174,37 @@ BASIC_OFFERING = {
     }]
 }
 
+TIERED_OFFERING = {
+    "id": "3",
+    "href": "http://catalog.com/offerin3",
+    "isBundle": False,
+    "name": "TestOffering",
+    "version": "1.0",
+    "productSpecification": {
+        "id": "20",
+        "href": "http://catalog.com/products/20"
+    },
+    "productOfferingPrice": [{
+        "name": "plan",
+        "priceType": "usage",
+        "unitOfMeasure": "call",
+        "price": {
+            "currencyCode": "EUR",
+            "taxIncludedAmount": "1.20",
+            "dutyFreeAmount": "1.00"
+        },
+        "priceTierType": "tiered",
+        "priceTier": [{
+            "upTo": "100",
+            "taxIncludedAmount": "1.20",
+            "dutyFreeAmount": "1.00"
+        }, {
+            "taxIncludedAmount": "0.60",
+            "dutyFreeAmount": "0.50"
+        }]
+    }]
+}
+
 OPEN_OFFERING = {
     "id": "3",
     "href": "http://catalog.com/offerin3",
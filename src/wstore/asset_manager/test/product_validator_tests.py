@@ -21,9 +21,11 @@
 
 
 from bson import ObjectId
+from copy import deepcopy
 from importlib import reload
 from mock import MagicMock, call
 from parameterized import parameterized
+from requests.exceptions import HTTPError
 
 from django.core.exceptions import PermissionDenied
 from django.test.testcases import TestCase
@@ -34,6 +36,12 @@ from wstore.asset_manager.test.product_validator_test_data import *
 from wstore.store_commons.errors import ConflictError
 
 
+def _tiered_offering(**fields):
+    offering = deepcopy(TIERED_OFFERING)
+    offering['productOfferingPrice'][0].update(fields)
+    return offering
+
+
 class ValidatorTestCase(TestCase):
 
     tags = ('product-validator', )
@@ -180,7 +188,7 @@ class ValidatorTestCase(TestCase):
     ])
     def test_validate_error(self, name, data, side_effect, err_type, err_msg):
         self._mock_validator_imports(product_validator)
-        self._mock_document_lock()
+        doc_lock = self._mock_document_lock()
 
         if side_effect is not None:
             side_effect(self)
@@ -195,6 +203,11 @@ class ValidatorTestCase(TestCase):
         self.assertTrue(isinstance(error, err_type))
         self.assertEquals(err_msg, str(error))
 
+        # The asset lock is released when the upgrade is not valid
+        if name in ('upgrade_attached_asset', 'upgrade_invalid_product_id', 'upgrade_asset_inv_version', 'upgrade_low_version'):
+            doc_lock.__enter__.assert_called_once_with()
+            self.assertEquals(1, doc_lock.__exit__.call_count)
+
     def _mock_upgrading_asset(self, version):
         self._asset_instance.state = 'upgrading'
         self._asset_instance.product_id = UPGRADE_PRODUCT['product']['id']
@@ -221,8 +234,8 @@ class ValidatorTestCase(TestCase):
         self._asset_instance.save.assert_called_once_with()
 
         product_validator.DocumentLock.assert_called_once_with('wstore_resource', self._asset_instance.pk, 'asset')
-        doc_lock.wait_document.assert_called_once_with()
-        doc_lock.unlock_document.assert_called_once_with()
+        doc_lock.__enter__.assert_called_once_with()
+        doc_lock.__exit__.assert_called_once_with(None, None, None)
 
     def test_attach_upgrade(self):
         self._mock_validator_imports(product_validator)
@@ -244,8 +257,8 @@ class ValidatorTestCase(TestCase):
         self._asset_instance.save.assert_called_once_with()
 
         product_validator.DocumentLock.assert_called_once_with('wstore_resource', self._asset_instance.pk, 'asset')
-        doc_lock.wait_document.assert_called_once_with()
-        doc_lock.unlock_document.assert_called_once_with()
+        doc_lock.__enter__.assert_called_once_with()
+        doc_lock.__exit__.assert_called_once_with(None, None, None)
 
     def test_attach_upgrade_non_digital(self):
         self._mock_validator_imports(product_validator)
@@ -479,13 +492,10 @@ class ValidatorTestCase(TestCase):
         self._validate_bundle_offering_calls(offering, True, is_open=True)
 
     def _mock_product_request(self):
-        offering_validator.requests = MagicMock()
         product = deepcopy(BASIC_PRODUCT['product'])
         product['id'] = '20'
-        resp = MagicMock()
-        offering_validator.requests.get.return_value = resp
-        resp.json.return_value = product
-        resp.status_code = 200
+        offering_validator.download_catalog_document = MagicMock(return_value=product)
+        offering_validator.invalidate_catalog_document = MagicMock()
 
     def _mock_offering_bundle(self, offering, is_digital=True):
         offering_validator.Offering = MagicMock()
@@ -519,7 +529,7 @@ class ValidatorTestCase(TestCase):
                                                                   [MagicMock(id='7', is_digital=False)]]
 
     def _catalog_api_error(self):
-        offering_validator.requests.get().status_code = 500
+        offering_validator.download_catalog_document.side_effect = HTTPError()
 
     def _non_open_bundled(self):
         for bundle_resp in self._bundles:
@@ -550,7 +560,22 @@ class ValidatorTestCase(TestCase):
         ('open_mixed', OPEN_MIXED, None, None, 'Open offerings cannot include price plans'),
         ('open_multiple_offers', OPEN_OFFERING, None, _open_existing, 'Assets of open offerings cannot be monetized in other offerings'),
         ('open_non_digital', OPEN_OFFERING, None, _non_digital_offering, 'Non digital products cannot be open'),
-        ('open_bundle_mixed', OPEN_BUNDLE, None, _non_open_bundled, 'If a bundle is open all the bundled offerings must be open')
+        ('open_bundle_mixed', OPEN_BUNDLE, None, _non_open_bundled, 'If a bundle is open all the bundled offerings must be open'),
+        ('tiered_offering', TIERED_OFFERING, _validate_single_offering_calls, None),
+        ('tiers_non_usage', _tiered_offering(priceType='one time'), None, None, 'Price tiers can only be included in usage prices'),
+        ('tiers_invalid_type', _tiered_offering(priceTierType='invalid'), None, None, 'Invalid priceTierType, it must be tiered, volume, or block'),
+        ('tiers_empty', _tiered_offering(priceTier=[]), None, None, 'priceTier must be a non empty list'),
+        ('tiers_missing_amount', _tiered_offering(priceTier=[{'taxIncludedAmount': '1.20'}]), None, None,
+         'Missing required field taxIncludedAmount or dutyFreeAmount in priceTier'),
+        ('tiers_negative', _tiered_offering(priceTier=[{'taxIncludedAmount': '-1.20', 'dutyFreeAmount': '1.00'}]), None, None,
+         'Invalid price tier, prices cannot be negative'),
+        ('tiers_bounded', _tiered_offering(priceTier=[{'upTo': '10', 'taxIncludedAmount': '1.20', 'dutyFreeAmount': '1.00'}]), None, None,
+         'The last price tier cannot include upTo'),
+        ('tiers_unsorted', _tiered_offering(priceTier=[
+            {'upTo': '10', 'taxIncludedAmount': '1.20', 'dutyFreeAmount': '1.00'},
+            {'upTo': '5', 'taxIncludedAmount': '0.60', 'dutyFreeAmount': '0.50'},
+            {'taxIncludedAmount': '0.12', 'dutyFreeAmount': '0.10'}
+        ]), None, None, 'Invalid price tiers, upTo values must be increasing and greater than zero')
     ])
     def test_create_offering_validation(self, name, offering, checker, side_effect, msg=None):
 
@@ -681,6 +706,7 @@ class ValidatorTestCase(TestCase):
         validator.validate('update', self._provider, BASIC_OFFERING)
 
         # Validate calls
+        offering_validator.invalidate_catalog_document.assert_called_once_with('productOffering', '3')
         self.assertEquals(0, offering_validator.Offering.objects.filter.call_count)
         self.assertFalse(self._asset_instance.is_public)
         self._asset_instance.save.assert_called_once_with()
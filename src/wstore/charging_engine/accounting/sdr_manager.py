@@ -19,20 +19,40 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from datetime import datetime
+from collections import OrderedDict
 
+from bson import ObjectId
+
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import User
 
 from wstore.models import Organization
 from wstore.ordering.models import Order
+from wstore.store_commons.cache import TTLCache
+from wstore.store_commons.concurrency import process_local
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.utils.dates import parse_timestamp
+
+
+@process_local
+def _get_contexts_cache():
+    return TTLCache(settings.SDR_CONTEXT_CACHE_SIZE, settings.SDR_CONTEXT_CACHE_TTL)
+
+
+def invalidate_sdr_context(order_id):
+    """
+    Removes the cached validation contexts of the contracts of an order
+    """
+    _get_contexts_cache().invalidate_matching(lambda key: key[0] == order_id)
 
 
 class SDRManager(object):
 
     def __init__(self):
-        self._order = None
-        self._contract = None
+        self._order_id = None
+        self._product_id = None
+        self._context = None
         self._time_stamp = None
 
     def _get_order_contract(self, order_id, product_id):
@@ -52,29 +72,6 @@ class SDRManager(object):
 
         return order, contract
 
-    def _get_datetime(self, raw_time):
-        try:
-            if '+' in raw_time:
-                # Time with offset, remove it from the string
-                time = raw_time.split('+')[0] + '.0'
-            else:
-                sp_time = raw_time.split('.')
-                milis = sp_time[1]
-
-                if len(milis) > 3:
-                    milis = milis[:3]
-
-                time = sp_time[0] + '.' + milis
-
-            try:
-                time_stamp = datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f')
-            except:
-                time_stamp = datetime.strptime(time, '%Y-%m-%d %H:%M:%S.%f')
-        except:
-            raise ValueError('Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm')
-
-        return time_stamp
-
     def get_sdr_values(self, sdr):
         expected_fields = ['orderid', 'productid', 'correlationnumber', 'unit', 'value']
         values = {}
@@ -94,30 +91,48 @@ class SDRManager(object):
 
         return values
 
-    def validate_sdr(self, sdr):
-        if sdr['status'].lower() != 'received':
-            raise ValueError('Invalid initial status, must be Received')
-
-        sdr_values = self.get_sdr_values(sdr)
-        self._order, self._contract = self._get_order_contract(sdr_values['orderid'], sdr_values['productid'])
+    def _load_context(self, order_id, product_id):
+        order, contract = self._get_order_contract(order_id, product_id)
 
-        if self._order is None:
+        if order is None:
             raise ValueError('Invalid orderId, the order does not exists')
 
-        if self._contract is None:
+        if contract is None:
             raise ValueError('Invalid productId, the contract does not exist')
 
-        # Check that the value field is a valid number
-        try:
-            float(sdr_values['value'])
-        except:
-            raise ValueError('The provided value is not a valid number')
+        context = {
+            'order_pk': str(order.pk),
+            'owner_organization': order.owner_organization.pk,
+            'pay_per_use': 'pay_per_use' in contract.pricing_model,
+            'units': set([comp['unit'].lower() for comp in contract.pricing_model.get('pay_per_use', [])]),
+            'correlation_number': contract.correlation_number,
+            'last_usage': contract.last_usage,
+            'customers': set()
+        }
 
+        _get_contexts_cache().set((order_id, product_id), context)
+        return context
+
+    def _get_context(self, order_id, product_id):
+        # Validation info of the contract, SDRs are usually received in bursts for the same contract
+        context = _get_contexts_cache().get((order_id, product_id))
+
+        if context is None:
+            context = self._load_context(order_id, product_id)
+
+        return context
+
+    def _validate_customer(self, sdr, context):
         if 'relatedParty' not in sdr:
             raise ValueError('Missing required field relatedParty')
 
-        # Check that the customer exist
         customer_name = sdr['relatedParty'][0]['id']
+
+        # The membership of the customer is only checked the first time
+        if customer_name in context['customers']:
+            return
+
+        # Check that the customer exist
         customer = Organization.objects.filter(name=customer_name)
 
         if not len(customer):
@@ -127,35 +142,251 @@ class SDRManager(object):
         user = User.objects.get(username=customer_name)
 
         for org in user.userprofile.organizations:
-            if org['organization'] == self._order.owner_organization.pk:
+            if org['organization'] == context['owner_organization']:
                 break
         else:
             raise PermissionDenied("You don't belong to the customer organization")
 
+        context['customers'].add(customer_name)
+
+    def _get_sdr_values(self, sdr):
+        if sdr['status'].lower() != 'received':
+            raise ValueError('Invalid initial status, must be Received')
+
+        return self.get_sdr_values(sdr)
+
+    def _check_sdr(self, sdr, sdr_values, context):
+        # Check that the value field is a valid number
+        try:
+            float(sdr_values['value'])
+        except:
+            raise ValueError('The provided value is not a valid number')
+
+        self._validate_customer(sdr, context)
+
         # Validate that the price mode included in the contract correspond to the one specified in the SDR
-        price_model = self._contract.pricing_model
-        if 'pay_per_use' not in price_model:
+        if not context['pay_per_use']:
             raise ValueError('The pricing model of the offering does not define pay-per-use components')
 
         # Check the correlation number and timestamp
-        if int(sdr_values['correlationnumber']) != self._contract.correlation_number:
-            raise ValueError('Invalid correlation number, expected: ' + str(self._contract.correlation_number))
+        try:
+            correlation_number = int(sdr_values['correlationnumber'])
+        except (TypeError, ValueError):
+            correlation_number = None
+
+        if correlation_number != context['correlation_number']:
+            raise ValueError('Invalid correlation number, expected: ' + str(context['correlation_number']))
 
         # Truncate ms to 3 decimals (database supported)
-        self._time_stamp = self._get_datetime(sdr['date'])
+        time_stamp = parse_timestamp(sdr['date'])
 
-        if self._contract.last_usage is not None and self._contract.last_usage > self._time_stamp:
+        if context['last_usage'] is not None and context['last_usage'] > time_stamp:
             raise ValueError('The provided timestamp specifies a lower timing than the last SDR received')
 
         # Check that the pricing model contains the specified unit
-        for comp in price_model['pay_per_use']:
-            if sdr_values['unit'].lower() == comp['unit'].lower():
-                break
-        else:
+        if sdr_values['unit'].lower() not in context['units']:
             raise ValueError('The specified unit is not included in the pricing model')
 
+        return time_stamp
+
+    def _get_current_context(self, order_id, product_id, correlation_number):
+        context = self._get_context(order_id, product_id)
+
+        # The cached correlation number may be outdated
+        if str(correlation_number) != str(context['correlation_number']):
+            context = self._load_context(order_id, product_id)
+
+        return context
+
+    def validate_sdr(self, sdr):
+        sdr_values = self._get_sdr_values(sdr)
+
+        self._order_id, self._product_id = sdr_values['orderid'], sdr_values['productid']
+        self._context = self._get_current_context(self._order_id, self._product_id, sdr_values['correlationnumber'])
+
+        self._time_stamp = self._check_sdr(sdr, sdr_values, self._context)
+
+    def _update_contracts(self, order_pk, contracts):
+        """
+        Atomically saves the new usage information of some contracts of an order, the update
+        is only made if none of the contracts has received usage since it was validated
+        :param contracts: List of tuples with the product id, the expected correlation number,
+        the number of SDRs accepted, the first timestamp and the last timestamp
+        :return: True if the contracts have been updated
+        """
+        conditions = []
+        new_values = {
+            '$set': {},
+            '$inc': {}
+        }
+        array_filters = []
+
+        for ix, (product_id, correlation_number, accepted, first_usage, last_usage) in enumerate(contracts):
+            conditions.append({
+                'contracts': {
+                    '$elemMatch': {
+                        'product_id': product_id,
+                        'correlation_number': correlation_number,
+                        '$or': [{'last_usage': None}, {'last_usage': {'$lte': first_usage}}]
+                    }
+                }
+            })
+
+            identifier = 'c{}'.format(ix)
+            new_values['$set']['contracts.$[{}].last_usage'.format(identifier)] = last_usage
+            new_values['$inc']['contracts.$[{}].correlation_number'.format(identifier)] = accepted
+            array_filters.append({identifier + '.product_id': product_id})
+
+        result = get_database_connection().wstore_order.update_one({
+            '_id': ObjectId(order_pk),
+            '$and': conditions
+        }, new_values, array_filters=array_filters)
+
+        return result.matched_count > 0
+
     def update_usage(self):
-        # Save new usage information
-        self._contract.last_usage = self._time_stamp
-        self._contract.correlation_number += 1
-        self._order.save()
+        """
+        Saves the new usage information of the validated SDR. Only the contract is updated, and only
+        if no other SDR has been accepted since the validation, so concurrent SDRs cannot be duplicated
+        """
+        correlation_number = self._context['correlation_number']
+
+        if not self._update_contracts(self._context['order_pk'], [
+                (self._product_id, correlation_number, 1, self._time_stamp, self._time_stamp)]):
+
+            invalidate_sdr_context(self._order_id)
+            raise ValueError('Invalid correlation number, the usage of the contract has been updated')
+
+        self._previous_usage = self._context['last_usage']
+        self._context['correlation_number'] = correlation_number + 1
+        self._context['last_usage'] = self._time_stamp
+
+    def revert_usage(self):
+        """
+        Reverts the usage information saved for the SDR, so the same SDR can be sent again. The
+        contract is only updated if no other SDR has been accepted after this one
+        :return: True if the usage information has been reverted
+        """
+        result = get_database_connection().wstore_order.update_one({
+            '_id': ObjectId(self._context['order_pk']),
+            'contracts': {
+                '$elemMatch': {
+                    'product_id': self._product_id,
+                    'correlation_number': self._context['correlation_number'],
+                    'last_usage': self._time_stamp
+                }
+            }
+        }, {
+            '$set': {'contracts.$[c0].last_usage': self._previous_usage},
+            '$inc': {'contracts.$[c0].correlation_number': -1}
+        }, array_filters=[{'c0.product_id': self._product_id}])
+
+        invalidate_sdr_context(self._order_id)
+        return result.matched_count > 0
+
+    def _build_result(self, sdr, code, message):
+        return {
+            'id': sdr.get('id') if isinstance(sdr, dict) else None,
+            'status': 'Guided' if code == 200 else 'Rejected',
+            'code': code,
+            'message': message
+        }
+
+    def _build_error_result(self, sdr, error):
+        if isinstance(error, PermissionDenied):
+            return self._build_result(sdr, 403, str(error))
+
+        if isinstance(error, ValueError):
+            return self._build_result(sdr, 422, str(error))
+
+        return self._build_result(sdr, 500, 'The SDR document could not be processed due to an unexpected error')
+
+    def _validate_contract_batch(self, order_id, product_id, records, results):
+        # SDRs are validated in the order of their correlation numbers, so the ones generated
+        # concurrently by the same agent are accepted even if received out of order
+        def _correlation_number(record):
+            try:
+                return int(record[2]['correlationnumber'])
+            except (TypeError, ValueError, KeyError):
+                return -1
+
+        records = sorted(records, key=_correlation_number)
+
+        try:
+            context = self._get_current_context(order_id, product_id, records[0][2]['correlationnumber'])
+        except Exception as e:
+            for ix, sdr, sdr_values in records:
+                results[ix] = self._build_error_result(sdr, e)
+            return None
+
+        # The SDRs are validated with a copy of the context, as they are not accepted until saved
+        initial_correlation = context['correlation_number']
+        context = dict(context)
+        accepted = []
+        first_usage = None
+
+        for ix, sdr, sdr_values in records:
+            try:
+                time_stamp = self._check_sdr(sdr, sdr_values, context)
+            except Exception as e:
+                results[ix] = self._build_error_result(sdr, e)
+                continue
+
+            context['correlation_number'] += 1
+            context['last_usage'] = time_stamp
+            first_usage = first_usage or time_stamp
+
+            accepted.append(ix)
+            results[ix] = self._build_result(sdr, 200, 'OK')
+
+        if not len(accepted):
+            return None
+
+        return context['order_pk'], (product_id, initial_correlation, len(accepted), first_usage, context['last_usage']), accepted
+
+    def process_batch(self, sdrs):
+        """
+        Validates a batch of SDRs and saves the usage information of the accepted ones, making
+        a single update per order. SDRs are sequenced per contract using their correlation numbers
+        :param sdrs: List of SDR documents
+        :return: List with the result of each SDR, including its id, its new state, and a status code
+        """
+        results = [None] * len(sdrs)
+        contracts = OrderedDict()
+
+        for ix, sdr in enumerate(sdrs):
+            try:
+                sdr_values = self._get_sdr_values(sdr)
+            except Exception as e:
+                results[ix] = self._build_error_result(sdr, e)
+                continue
+
+            contracts.setdefault((sdr_values['orderid'], sdr_values['productid']), []).append((ix, sdr, sdr_values))
+
+        orders = OrderedDict()
+        for (order_id, product_id), records in contracts.items():
+            validated = self._validate_contract_batch(order_id, product_id, records, results)
+
+            if validated is not None:
+                order_pk, contract_update, accepted = validated
+                order = orders.setdefault(order_id, {'order_pk': order_pk, 'contracts': [], 'accepted': []})
+                order['contracts'].append(contract_update)
+                order['accepted'].extend(accepted)
+
+        for order_id, order in orders.items():
+            if self._update_contracts(order['order_pk'], order['contracts']):
+                # Keep the cached contexts up to date for the next SDRs
+                for product_id, correlation_number, accepted, first_usage, last_usage in order['contracts']:
+                    context = _get_contexts_cache().get((order_id, product_id))
+
+                    if context is not None and context['correlation_number'] == correlation_number:
+                        context['correlation_number'] = correlation_number + accepted
+                        context['last_usage'] = last_usage
+            else:
+                invalidate_sdr_context(order_id)
+
+                for ix in order['accepted']:
+                    results[ix] = self._build_result(
+                        sdrs[ix], 422, 'Invalid correlation number, the usage of the contract has been updated')
+
+        return results
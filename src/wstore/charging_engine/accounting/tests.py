@@ -25,14 +25,16 @@ import json
 from importlib import reload
 from copy import deepcopy
 from datetime import datetime
-from mock import MagicMock
+from bson import ObjectId
+from mock import MagicMock, call
 from parameterized import parameterized
 
 from django.test import TestCase
 from django.core.exceptions import PermissionDenied
+from django.test.utils import override_settings
 
 from wstore.charging_engine.accounting import sdr_manager
-from wstore.charging_engine.accounting import usage_client
+from wstore.charging_engine.accounting import usage_client, usage_rating
 from wstore.charging_engine.accounting.errors import UsageError
 from wstore.charging_engine.accounting import views
 
@@ -73,6 +75,7 @@ class SDRManagerTestCase(TestCase):
 
         # Create Order mock
         self._order = MagicMock()
+        self._order.pk = '61004aba5e05acc115f022f0'
         self._order.owner_organization = org
 
         self._contract = MagicMock()
@@ -96,6 +99,12 @@ class SDRManagerTestCase(TestCase):
         sdr_manager.User = MagicMock()
         sdr_manager.User.objects.get.return_value = self._user
 
+        self._db = MagicMock()
+        self._db.wstore_order.update_one.return_value.matched_count = 1
+        sdr_manager.get_database_connection = MagicMock(return_value=self._db)
+
+        sdr_manager._get_contexts_cache().clear()
+
         self._timestamp = datetime.strptime('2015-10-20 17:31:57.100', '%Y-%m-%d %H:%M:%S.%f')
 
     def _side_cust_not_exists(self):
@@ -202,8 +211,15 @@ class SDRManagerTestCase(TestCase):
             sdr_manager.Order.objects.get.assert_called_once_with(order_id='1')
             self._order.get_product_contract.assert_called_once_with('2')
 
-            self.assertEquals(self._contract, sdr_mng._contract)
-            self.assertEquals(self._order, sdr_mng._order)
+            self.assertEquals({
+                'order_pk': '61004aba5e05acc115f022f0',
+                'owner_organization': '1111',
+                'pay_per_use': True,
+                'units': set(['invocation']),
+                'correlation_number': 1,
+                'last_usage': None,
+                'customers': set(['test_user'])
+            }, sdr_mng._context)
             self.assertEquals(self._timestamp, sdr_mng._time_stamp)
 
             sdr_manager.User.objects.get.assert_called_once_with(username='test_user')
@@ -211,19 +227,226 @@ class SDRManagerTestCase(TestCase):
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(str(error), err_msg)
 
-    def test_update_usage(self):
+    def _validate_sdr(self, sdr):
         sdr_mng = sdr_manager.SDRManager()
-        sdr_mng._contract = self._contract
-        sdr_mng._order = self._order
-        sdr_mng._time_stamp = self._timestamp
+        sdr_mng.validate_sdr(sdr)
+        return sdr_mng
+
+    def test_sdr_context_cached(self):
+        self._validate_sdr(deepcopy(BASIC_SDR)).update_usage()
+
+        sdr = deepcopy(BASIC_SDR)
+        self._mod_inc_corr(sdr)
+        self._validate_sdr(sdr)
+
+        # The order and the customer are only loaded for the first SDR
+        sdr_manager.Order.objects.get.assert_called_once_with(order_id='1')
+        sdr_manager.Organization.objects.filter.assert_called_once_with(name='test_user')
+        sdr_manager.User.objects.get.assert_called_once_with(username='test_user')
+
+    def test_sdr_context_outdated(self):
+        self._validate_sdr(deepcopy(BASIC_SDR))
+
+        # The usage of the contract is updated by other process
+        self._contract.correlation_number = 2
+
+        sdr = deepcopy(BASIC_SDR)
+        self._mod_inc_corr(sdr)
+        sdr_mng = self._validate_sdr(sdr)
+
+        self.assertEquals(2, sdr_mng._context['correlation_number'])
+        self.assertEquals(2, sdr_manager.Order.objects.get.call_count)
+
+    def test_invalidate_sdr_context(self):
+        self._validate_sdr(deepcopy(BASIC_SDR))
+        sdr_manager.invalidate_sdr_context('1')
+        self._validate_sdr(deepcopy(BASIC_SDR))
+
+        self.assertEquals(2, sdr_manager.Order.objects.get.call_count)
+
+    def test_update_usage(self):
+        sdr_mng = self._validate_sdr(deepcopy(BASIC_SDR))
+        sdr_mng.update_usage()
+
+        self._db.wstore_order.update_one.assert_called_once_with({
+            '_id': ObjectId('61004aba5e05acc115f022f0'),
+            '$and': [{
+                'contracts': {
+                    '$elemMatch': {
+                        'product_id': '2',
+                        'correlation_number': 1,
+                        '$or': [{'last_usage': None}, {'last_usage': {'$lte': self._timestamp}}]
+                    }
+                }
+            }]
+        }, {
+            '$set': {'contracts.$[c0].last_usage': self._timestamp},
+            '$inc': {'contracts.$[c0].correlation_number': 1}
+        }, array_filters=[{'c0.product_id': '2'}])
+
+        self.assertEquals(2, sdr_mng._context['correlation_number'])
+        self.assertEquals(self._timestamp, sdr_mng._context['last_usage'])
+        self.assertEquals(0, self._order.save.call_count)
+        self.assertEquals(0, self._order.save_changes.call_count)
+
+    def test_update_usage_conflict(self):
+        sdr_mng = self._validate_sdr(deepcopy(BASIC_SDR))
+        self._db.wstore_order.update_one.return_value.matched_count = 0
+
+        with self.assertRaises(ValueError) as e:
+            sdr_mng.update_usage()
+
+        self.assertEquals('Invalid correlation number, the usage of the contract has been updated', str(e.exception))
+
+        # The context is loaded again for the next SDR
+        self._validate_sdr(deepcopy(BASIC_SDR))
+        self.assertEquals(2, sdr_manager.Order.objects.get.call_count)
 
+    @parameterized.expand([
+        ('reverted', 1, True),
+        ('accepted_after', 0, False)
+    ])
+    def test_revert_usage(self, name, matched, exp_reverted):
+        sdr_mng = self._validate_sdr(deepcopy(BASIC_SDR))
+        previous_usage = sdr_mng._context['last_usage']
         sdr_mng.update_usage()
 
-        self.assertEquals(2, self._contract.correlation_number)
+        self._db.wstore_order.update_one.reset_mock()
+        self._db.wstore_order.update_one.return_value.matched_count = matched
+
+        self.assertEquals(exp_reverted, sdr_mng.revert_usage())
+
+        # The correlation number is only decremented if no other SDR has been accepted
+        self._db.wstore_order.update_one.assert_called_once_with({
+            '_id': ObjectId('61004aba5e05acc115f022f0'),
+            'contracts': {
+                '$elemMatch': {
+                    'product_id': '2',
+                    'correlation_number': 2,
+                    'last_usage': self._timestamp
+                }
+            }
+        }, {
+            '$set': {'contracts.$[c0].last_usage': previous_usage},
+            '$inc': {'contracts.$[c0].correlation_number': -1}
+        }, array_filters=[{'c0.product_id': '2'}])
+
+        # The context is loaded again for the next SDR
+        self._validate_sdr(deepcopy(BASIC_SDR))
+        self.assertEquals(2, sdr_manager.Order.objects.get.call_count)
+
+    def _build_batch_sdr(self, id_, correlation, date, product='2'):
+        sdr = deepcopy(BASIC_SDR)
+        sdr['id'] = id_
+        sdr['usageCharacteristic'][1]['value'] = product
+        sdr['usageCharacteristic'][2]['value'] = correlation
+        sdr['date'] = date
+        return sdr
+
+    def test_process_batch(self):
+        invalid = self._build_batch_sdr('3', '3', '2015-10-20 17:35:00.000')
+        invalid['status'] = 'Rated'
+
+        results = sdr_manager.SDRManager().process_batch([
+            self._build_batch_sdr('1', '2', '2015-10-20 17:33:00.000'),
+            self._build_batch_sdr('2', '1', '2015-10-20 17:31:57.100'),
+            invalid,
+            self._build_batch_sdr('4', '4', '2015-10-20 17:36:00.000')
+        ])
+
+        # SDRs are sequenced by its correlation number
+        self.assertEquals([
+            {'id': '1', 'status': 'Guided', 'code': 200, 'message': 'OK'},
+            {'id': '2', 'status': 'Guided', 'code': 200, 'message': 'OK'},
+            {'id': '3', 'status': 'Rejected', 'code': 422, 'message': 'Invalid initial status, must be Received'},
+            {'id': '4', 'status': 'Rejected', 'code': 422, 'message': 'Invalid correlation number, expected: 3'}
+        ], results)
+
+        last_usage = datetime(2015, 10, 20, 17, 33)
+        self._db.wstore_order.update_one.assert_called_once_with({
+            '_id': ObjectId('61004aba5e05acc115f022f0'),
+            '$and': [{
+                'contracts': {
+                    '$elemMatch': {
+                        'product_id': '2',
+                        'correlation_number': 1,
+                        '$or': [{'last_usage': None}, {'last_usage': {'$lte': self._timestamp}}]
+                    }
+                }
+            }]
+        }, {
+            '$set': {'contracts.$[c0].last_usage': last_usage},
+            '$inc': {'contracts.$[c0].correlation_number': 2}
+        }, array_filters=[{'c0.product_id': '2'}])
+
+        # The cached context is updated
+        sdr_mng = self._validate_sdr(self._build_batch_sdr('5', '3', '2015-10-20 17:37:00.000'))
+        self.assertEquals(1, sdr_manager.Order.objects.get.call_count)
+        self.assertEquals(3, sdr_mng._context['correlation_number'])
+
+    @parameterized.expand([
+        ('null', None),
+        ('invalid', 'invalid')
+    ])
+    def test_process_batch_invalid_correlation(self, name, correlation):
+        results = sdr_manager.SDRManager().process_batch([
+            self._build_batch_sdr('1', '1', '2015-10-20 17:31:57.100'),
+            self._build_batch_sdr('2', correlation, '2015-10-20 17:33:00.000')
+        ])
+
+        # The malformed SDR is rejected without affecting the rest of the batch
+        self.assertEquals([
+            {'id': '1', 'status': 'Guided', 'code': 200, 'message': 'OK'},
+            {'id': '2', 'status': 'Rejected', 'code': 422, 'message': 'Invalid correlation number, expected: 1'}
+        ], results)
+        self._db.wstore_order.update_one.assert_called_once()
+
+    def test_process_batch_multiple_contracts(self):
+        results = sdr_manager.SDRManager().process_batch([
+            self._build_batch_sdr('1', '1', '2015-10-20 17:31:57.100'),
+            self._build_batch_sdr('2', '1', '2015-10-20 17:31:57.100', product='3')
+        ])
+
+        self.assertEquals(['Guided', 'Guided'], [result['status'] for result in results])
+
+        # A single update is made per order
+        self._db.wstore_order.update_one.assert_called_once()
+        self.assertEquals({
+            '$set': {
+                'contracts.$[c0].last_usage': self._timestamp,
+                'contracts.$[c1].last_usage': self._timestamp
+            },
+            '$inc': {
+                'contracts.$[c0].correlation_number': 1,
+                'contracts.$[c1].correlation_number': 1
+            }
+        }, self._db.wstore_order.update_one.call_args[0][1])
         self.assertEquals(
-            self._timestamp, self._contract.last_usage)
+            [{'c0.product_id': '2'}, {'c1.product_id': '3'}], self._db.wstore_order.update_one.call_args[1]['array_filters'])
 
-        self._order.save.assert_called_once_with()
+    def test_process_batch_errors(self):
+        sdr_manager.Order.objects.get.side_effect = Exception()
+        results = sdr_manager.SDRManager().process_batch([
+            self._build_batch_sdr('1', '1', '2015-10-20 17:31:57.100'),
+            'invalid'
+        ])
+
+        self.assertEquals([
+            {'id': '1', 'status': 'Rejected', 'code': 422, 'message': 'Invalid orderId, the order does not exists'},
+            {'id': None, 'status': 'Rejected', 'code': 500, 'message': 'The SDR document could not be processed due to an unexpected error'}
+        ], results)
+        self.assertEquals(0, self._db.wstore_order.update_one.call_count)
+
+    def test_process_batch_conflict(self):
+        self._db.wstore_order.update_one.return_value.matched_count = 0
+        results = sdr_manager.SDRManager().process_batch([self._build_batch_sdr('1', '1', '2015-10-20 17:31:57.100')])
+
+        self.assertEquals([{
+            'id': '1',
+            'status': 'Rejected',
+            'code': 422,
+            'message': 'Invalid correlation number, the usage of the contract has been updated'
+        }], results)
 
 BASIC_USAGE = {
     'id': '3',
@@ -253,7 +476,7 @@ class UsageClientTestCase(TestCase):
 
     def setUp(self):
         usage_client.settings.USAGE = 'http://example.com/DSUsageManagement'
-        usage_client.requests = MagicMock()
+        usage_client.get_session = MagicMock()
         self._old_inv = usage_client.settings.INVENTORY
         usage_client.settings.INVENTORY = 'http://localhost:8080/DSProductInventory'
 
@@ -265,14 +488,15 @@ class UsageClientTestCase(TestCase):
 
     @parameterized.expand([
         ('all_usages', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE]),
-        ('filtered_by_state', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE], '&status=Guided', 'Guided'),
+        ('filtered_by_state', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE], {'status': 'Guided'}, 'Guided'),
         ('product_not_found', [NON_PRODUCT_USAGE], [])
     ])
-    def test_retrieve_usage(self, name, response, exp_resp, extra_query='', state=None):
+    @override_settings(USAGE_PAGE_SIZE=100)
+    def test_retrieve_usage(self, name, response, exp_resp, extra_query={}, state=None):
         # Create mocks
         mock_response = MagicMock()
         mock_response.json.return_value = response
-        usage_client.requests.get.return_value = mock_response
+        usage_client.get_session().get.return_value = mock_response
         client = usage_client.UsageClient()
 
         cust_usage = client.get_customer_usage(self._customer, self._product_id, state=state)
@@ -281,14 +505,67 @@ class UsageClientTestCase(TestCase):
         self.assertEquals(exp_resp, cust_usage)
 
         # Verify calls
-        usage_client.requests.get.assert_called_once_with(
-            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer + extra_query,
+        params = {
+            'relatedParty.id': self._customer,
+            'usageCharacteristic.value': self._product_id,
+            'offset': 0,
+            'size': 100
+        }
+        params.update(extra_query)
+
+        usage_client.get_session().get.assert_called_once_with(
+            usage_client.settings.USAGE + '/api/usageManagement/v2/usage',
+            params=params,
             headers={u'Accept': u'application/json'}
         )
 
         mock_response.raise_for_status.assert_called_once_with()
         mock_response.json.assert_called_once_with()
 
+    @override_settings(USAGE_PAGE_SIZE=2)
+    def test_iter_usage_pages(self):
+        pages = [[BASIC_USAGE, NON_PRODUCT_USAGE], [BASIC_USAGE, BASIC_USAGE], [BASIC_USAGE]]
+        requested = []
+
+        def get(url, params, headers):
+            requested.append((params['offset'], params['size']))
+            response = MagicMock()
+            response.json.return_value = pages[len(requested) - 1]
+            return response
+
+        usage_client.get_session().get.side_effect = get
+        client = usage_client.UsageClient()
+
+        usage = client.iter_customer_usage(self._customer, self._product_id, state='Guided')
+
+        # Pages are not requested until the usage is consumed
+        self.assertEquals([], requested)
+        self.assertEquals(BASIC_USAGE, next(usage))
+        self.assertEquals([(0, 2)], requested)
+
+        self.assertEquals([BASIC_USAGE] * 3, list(usage))
+        self.assertEquals([(0, 2), (2, 2), (4, 2)], requested)
+
+    @override_settings(USAGE_PAGE_SIZE=2)
+    def test_iter_usage_repeated_page(self):
+        other_usage = dict(BASIC_USAGE, id='2')
+        requested = []
+
+        def get(url, params, headers):
+            # The API ignores the offset and always returns the first page
+            requested.append((params['offset'], params['size']))
+            response = MagicMock()
+            response.json.return_value = [BASIC_USAGE, other_usage]
+            return response
+
+        usage_client.get_session().get.side_effect = get
+        client = usage_client.UsageClient()
+
+        usage = list(client.iter_customer_usage(self._customer, self._product_id, state='Guided'))
+
+        self.assertEquals([BASIC_USAGE, other_usage], usage)
+        self.assertEquals([(0, 2), (2, 2)], requested)
+
     def _test_invalid_state(self, method, args, kwargs):
         error = None
         try:
@@ -305,12 +582,12 @@ class UsageClientTestCase(TestCase):
 
     def _test_patch(self, expected_json, method, args):
         mock_response = MagicMock()
-        usage_client.requests.patch.return_value = mock_response
+        usage_client.get_session().patch.return_value = mock_response
 
         method(*args)
 
         # Verify calls
-        usage_client.requests.patch.assert_called_once_with(
+        usage_client.get_session().patch.assert_called_once_with(
             usage_client.settings.USAGE + '/api/usageManagement/v2/usage/' + BASIC_USAGE['id'],
             json=expected_json
         )
@@ -335,7 +612,7 @@ class UsageClientTestCase(TestCase):
         site = 'http://example.com/'
         usage_client.settings.SITE = site
 
-        timestamp = '2016-04-15'
+        timestamp = '2016-04-15 10:12:13.123456'
         duty_free = '10'
         price = '12'
         rate = '20'
@@ -345,7 +622,7 @@ class UsageClientTestCase(TestCase):
         expected_json = {
             'status': 'Rated',
             'ratedProductUsage': [{
-                'ratingDate': timestamp,
+                'ratingDate': '2016-04-15T10:12:13.123000Z',
                 'usageRatingTag': 'usage',
                 'isBilled': False,
                 'ratingAmountType': 'Total',
@@ -368,6 +645,226 @@ class UsageClientTestCase(TestCase):
         reload(usage_client)
 
 
+@override_settings(USAGE_RATING_WORKERS=2, USAGE_RATING_CHUNK_SIZE=2)
+class UsageRatingTestCase(TestCase):
+
+    tags = ('usage-rating',)
+
+    def setUp(self):
+        self._collection = MagicMock()
+        self._items_collection = MagicMock()
+        usage_rating.get_database_connection = MagicMock(return_value={
+            'wstore_usage_rating': self._collection,
+            'wstore_usage_rating_item': self._items_collection
+        })
+
+        usage_rating.schedule_task = MagicMock()
+        usage_rating.renew_task_lease = MagicMock(return_value=True)
+        usage_rating.UsageClient = MagicMock()
+
+        self._job_id = ObjectId('61004aba5e05acc115f022f0')
+
+    def _get_item(self, usage_id, state='pending'):
+        return {
+            'product_id': 'product1',
+            'usage_id': usage_id,
+            'value': '5',
+            'part': 0,
+            'duty_free': '10.00',
+            'price': '12.00',
+            'tax_rate': '20.00',
+            'state': state
+        }
+
+    def test_schedule_usage_rating(self):
+        self._collection.insert_one.return_value.inserted_id = self._job_id
+
+        contract = MagicMock(product_id='product1', last_charge=datetime(2016, 1, 20, 13, 12, 39))
+        transaction = {
+            'currency': 'EUR',
+            'applied_accounting': [{
+                'model': {'tax_rate': '20.00'},
+                'accounting': [{
+                    'usage_id': '1',
+                    'value': '5',
+                    'duty_free': '10.00',
+                    'price': '12.00'
+                }, {
+                    'usage_id': '2',
+                    'value': '5',
+                    'duty_free': '10.00',
+                    'price': '12.00'
+                }],
+                'price': '24.00',
+                'duty_free': '20.00'
+            }]
+        }
+
+        job_id = usage_rating.schedule_usage_rating(contract, transaction)
+
+        self.assertEquals(self._job_id, job_id)
+
+        job = self._collection.insert_one.call_args[0][0]
+        self.assertEquals('product1', job['product_id'])
+        self.assertEquals('2016-01-20 13:12:39', job['timestamp'])
+        self.assertEquals('EUR', job['currency'])
+        self.assertFalse('items' in job)
+        self.assertEquals([{'model': {'tax_rate': '20.00'}, 'price': '24.00', 'duty_free': '20.00'}], job['parts'])
+        self.assertEquals(2, job['total'])
+        self.assertEquals(0, job['rated'])
+        self.assertEquals('pending', job['state'])
+
+        # The usage documents are stored apart from the job
+        self._items_collection.insert_many.assert_called_once_with([
+            dict(self._get_item('1'), job_id=self._job_id),
+            dict(self._get_item('2'), job_id=self._job_id)
+        ])
+
+        usage_rating.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.accounting.usage_rating.process_usage_rating', 0, job_id=str(self._job_id))
+
+    def test_get_applied_accounting(self):
+        self._collection.find_one.return_value = {
+            '_id': self._job_id,
+            'parts': [{'model': {'unit': 'call'}, 'price': '24.00', 'duty_free': '20.00'}, {'model': {'unit': 'mb'}}]
+        }
+        self._items_collection.find.return_value.sort.return_value = [
+            dict(self._get_item('1'), _id=self._item_id('1'), job_id=self._job_id),
+            dict(self._get_item('2'), _id=self._item_id('2'), job_id=self._job_id)
+        ]
+
+        applied_accounting = usage_rating.get_applied_accounting(str(self._job_id))
+
+        self.assertEquals([{
+            'model': {'unit': 'call'},
+            'price': '24.00',
+            'duty_free': '20.00',
+            'accounting': [{
+                'usage_id': usage_id,
+                'value': '5',
+                'price': '12.00',
+                'duty_free': '10.00'
+            } for usage_id in ('1', '2')]
+        }, {
+            'model': {'unit': 'mb'},
+            'accounting': []
+        }], applied_accounting)
+
+        self._collection.find_one.assert_called_once_with({'_id': self._job_id}, {'parts': 1})
+        self._items_collection.find.assert_called_once_with(
+            {'job_id': self._job_id}, {'part': 1, 'usage_id': 1, 'value': 1, 'price': 1, 'duty_free': 1})
+        self._items_collection.find().sort.assert_called_once_with('_id', 1)
+
+    def test_get_applied_accounting_missing_job(self):
+        self._collection.find_one.return_value = None
+
+        with self.assertRaises(UsageError):
+            usage_rating.get_applied_accounting(str(self._job_id))
+
+    def test_get_pending_usage(self):
+        self._items_collection.find.return_value = [{'usage_id': '2'}, {'usage_id': '3'}]
+
+        self.assertEquals({'2', '3'}, usage_rating.get_pending_usage('product1'))
+        self._items_collection.find.assert_called_once_with({'product_id': 'product1', 'state': 'pending'}, {'usage_id': 1})
+
+    def _item_id(self, usage_id):
+        return ObjectId('61004aba5e05acc115f0230' + usage_id)
+
+    def _mock_job(self, chunks):
+        self._collection.find_one.return_value = {
+            '_id': self._job_id,
+            'product_id': 'product1',
+            'timestamp': '2016-01-20 13:12:39',
+            'currency': 'EUR',
+            'total': sum([len(chunk) for chunk in chunks]),
+            'state': 'pending'
+        }
+
+        # Pending usage documents are read in chunks, the last one is empty
+        cursor = self._items_collection.find.return_value.sort.return_value.limit
+        cursor.side_effect = [[
+            dict(self._get_item(usage_id), _id=self._item_id(usage_id)) for usage_id in chunk
+        ] for chunk in chunks + [[]]]
+
+    def test_process_usage_rating(self):
+        self._mock_job([['2', '3'], ['4']])
+
+        usage_rating.process_usage_rating(str(self._job_id))
+
+        self._collection.find_one.assert_called_once_with({'_id': self._job_id})
+        self.assertCountEqual([
+            call('2', '2016-01-20 13:12:39', '10.00', '12.00', '20.00', 'EUR', 'product1'),
+            call('3', '2016-01-20 13:12:39', '10.00', '12.00', '20.00', 'EUR', 'product1'),
+            call('4', '2016-01-20 13:12:39', '10.00', '12.00', '20.00', 'EUR', 'product1')
+        ], usage_rating.UsageClient().rate_usage.call_args_list)
+
+        # Chunks are read after the last processed usage document
+        self.assertEquals([
+            call({'job_id': self._job_id, 'state': 'pending'}),
+            call({'job_id': self._job_id, 'state': 'pending', '_id': {'$gt': self._item_id('3')}}),
+            call({'job_id': self._job_id, 'state': 'pending', '_id': {'$gt': self._item_id('4')}})
+        ], self._items_collection.find.call_args_list)
+        self._items_collection.find().sort.assert_called_with('_id', 1)
+        self._items_collection.find().sort().limit.assert_called_with(2)
+
+        # The progress is saved after each chunk
+        self.assertEquals([
+            call({'_id': {'$in': [self._item_id('2'), self._item_id('3')]}}, {'$set': {'state': 'rated'}}),
+            call({'_id': {'$in': [self._item_id('4')]}}, {'$set': {'state': 'rated'}})
+        ], self._items_collection.update_many.call_args_list)
+
+        self.assertEquals([
+            call({'_id': self._job_id}, {'$inc': {'rated': 2}}),
+            call({'_id': self._job_id}, {'$inc': {'rated': 1}}),
+            call({'_id': self._job_id}, {'$set': {'state': 'completed'}})
+        ], self._collection.update_one.call_args_list)
+
+        self.assertEquals(2, usage_rating.renew_task_lease.call_count)
+
+    def test_process_usage_rating_error(self):
+        self._mock_job([['1', '2']])
+
+        def rate_usage(usage_id, *args):
+            if usage_id == '2':
+                raise Exception('Connection error')
+
+        usage_rating.UsageClient().rate_usage.side_effect = rate_usage
+
+        error = None
+        try:
+            usage_rating.process_usage_rating(str(self._job_id))
+        except UsageError as e:
+            error = e
+
+        self.assertEquals('UsageError: The usage documents 2 could not be rated', str(error))
+        self._items_collection.update_many.assert_called_once_with(
+            {'_id': {'$in': [self._item_id('1')]}}, {'$set': {'state': 'rated'}})
+
+        self.assertEquals([
+            call({'_id': self._job_id}, {'$inc': {'rated': 1}, '$set': {'last_error': 'Connection error'}}),
+            call({'_id': self._job_id}, {'$set': {'state': 'pending'}})
+        ], self._collection.update_one.call_args_list)
+
+    def test_process_usage_rating_claimed_again(self):
+        self._mock_job([['1', '2'], ['3']])
+        usage_rating.renew_task_lease.return_value = False
+
+        usage_rating.process_usage_rating(str(self._job_id))
+
+        # The job stops once its lease has been lost, the new executor rates the rest
+        self.assertEquals(2, usage_rating.UsageClient().rate_usage.call_count)
+        self._collection.update_one.assert_called_once_with({'_id': self._job_id}, {'$inc': {'rated': 2}})
+
+    def test_process_usage_rating_completed(self):
+        self._mock_job([])
+        self._collection.find_one.return_value['state'] = 'completed'
+
+        usage_rating.process_usage_rating(str(self._job_id))
+
+        self.assertEquals(0, usage_rating.UsageClient().rate_usage.call_count)
+        self.assertEquals(0, self._collection.update_one.call_count)
+
+
 MANAGER_DENIED_RESP = {
     'result': 'error',
     'error': 'Permission denied'
@@ -393,6 +890,7 @@ class SDRCollectionTestCase(TestCase):
         usage_inst = MagicMock()
         views.UsageClient = MagicMock()
         views.UsageClient.return_value = usage_inst
+        views.schedule_task = MagicMock()
 
         self.request = MagicMock()
         self.request.user.is_anonymous.return_value = False
@@ -464,4 +962,109 @@ class SDRCollectionTestCase(TestCase):
                 self._manager_inst.update_usage.assert_called_once_with()
             else:
                 views.UsageClient().update_usage_state.assert_called_once_with('1', 'Rejected')
-                self.assertEquals(0, self._manager_inst.update_usage.call_count)
\ No newline at end of file
+                self.assertEquals(0, self._manager_inst.update_usage.call_count)
+
+    @parameterized.expand([
+        ('reverted', True, 500, {
+            'result': 'error',
+            'error': 'The state of the usage document could not be updated'
+        }),
+        ('accepted_after', False, 200, {
+            'result': 'correct',
+            'message': 'OK'
+        })
+    ])
+    @override_settings(SCHEDULER_RETRY_DELAY=30)
+    def test_feed_sdr_state_error(self, name, reverted, exp_code, exp_response):
+        data = deepcopy(BASIC_SDR)
+        data['id'] = '1'
+        self.request.body = json.dumps(data)
+
+        views.UsageClient().update_usage_state.side_effect = Exception('Usage API error')
+        self._manager_inst.revert_usage.return_value = reverted
+
+        collection = views.ServiceRecordCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, exp_code, exp_response)
+        self._manager_inst.revert_usage.assert_called_once_with()
+
+        # The state is updated later if the usage cannot be reverted
+        if reverted:
+            views.schedule_task.assert_not_called()
+        else:
+            views.schedule_task.assert_called_once_with(
+                'wstore.charging_engine.accounting.usage_client.retry_usage_state', 30, usage_id='1', state='Guided')
+
+    def _mock_batch_results(self):
+        self._manager_inst.process_batch.return_value = [
+            {'id': '1', 'status': 'Guided', 'code': 200, 'message': 'OK'},
+            {'id': '2', 'status': 'Rejected', 'code': 422, 'message': 'Value error'},
+            {'id': None, 'status': 'Rejected', 'code': 500, 'message': 'error'}
+        ]
+
+    @parameterized.expand([
+        ('json', 'application/json', json.dumps([{'id': '1'}, {'id': '2'}, {}])),
+        ('ndjson', 'application/x-ndjson', '{"id": "1"}\n{"id": "2"}\n\n{}\n')
+    ])
+    def test_feed_sdr_batch(self, name, content_type, data):
+        self._mock_batch_results()
+        self.request.META.get.return_value = content_type
+        self.request.body = data.encode('utf-8')
+
+        def _update_state(usage_id, state):
+            if usage_id != '2':
+                raise Exception('Usage API error')
+
+        views.UsageClient().update_usage_state.side_effect = _update_state
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        with override_settings(SCHEDULER_RETRY_DELAY=30):
+            response = collection.create(self.request)
+
+        # The usage of the accepted SDR has been saved, so its state is updated later
+        self._validate_response(response, 200, [
+            {'id': '1', 'status': 'Guided', 'code': 200, 'message': 'OK'},
+            {'id': '2', 'status': 'Rejected', 'code': 422, 'message': 'Value error'},
+            {'id': None, 'status': 'Rejected', 'code': 500, 'message': 'error'}
+        ])
+
+        self._manager_inst.process_batch.assert_called_once_with([{'id': '1'}, {'id': '2'}, {}])
+        self.assertEquals(
+            sorted([call('1', 'Guided'), call('2', 'Rejected')]), sorted(views.UsageClient().update_usage_state.call_args_list))
+        views.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.accounting.usage_client.retry_usage_state', 30, usage_id='1', state='Guided')
+
+    def test_feed_sdr_batch_state_error(self):
+        self._mock_batch_results()
+        self.request.body = json.dumps([{'id': '1'}, {'id': '2'}, {}]).encode('utf-8')
+
+        views.UsageClient().update_usage_state.side_effect = Exception('Usage API error')
+        views.schedule_task.side_effect = Exception('Database error')
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, 200, [
+            {'id': '1', 'status': 'Guided', 'code': 500, 'message': 'The state of the usage document could not be updated: Usage API error'},
+            {'id': '2', 'status': 'Rejected', 'code': 500, 'message': 'The state of the usage document could not be updated: Usage API error'},
+            {'id': None, 'status': 'Rejected', 'code': 500, 'message': 'error'}
+        ])
+
+    @parameterized.expand([
+        ('invalid_json', 'invalid', 400, 'The request does not contain a valid JSON list or NDJSON stream'),
+        ('not_list', json.dumps({'id': '1'}), 400, 'The request does not contain a valid JSON list or NDJSON stream'),
+        ('too_big', json.dumps([{'id': '1'}, {'id': '2'}]), 422, 'The batch cannot include more than 1 SDRs')
+    ])
+    @override_settings(SDR_BATCH_MAX_SIZE=1)
+    def test_feed_sdr_batch_error(self, name, data, exp_code, exp_error):
+        self.request.body = data
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        response = collection.create(self.request)
+
+        self._validate_response(response, exp_code, {
+            'result': 'error',
+            'error': exp_error
+        })
+        self.assertEquals(0, self._manager_inst.process_batch.call_count)
@@ -19,12 +19,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
 from urllib.parse import urljoin, urlparse
 
 from django.conf import settings
 
 from wstore.charging_engine.accounting.errors import UsageError
+from wstore.store_commons.http_session import get_session
+from wstore.store_commons.utils.dates import format_timestamp
 
 
 class UsageClient(object):
@@ -55,7 +56,7 @@ class UsageClient(object):
             'Host': urlparse(settings.SITE).netloc
         }
 
-        r = requests.post(url, headers=headers, json=usage_item)
+        r = get_session(url).post(url, headers=headers, json=usage_item)
         r.raise_for_status()
 
         return r.json()
@@ -90,40 +91,80 @@ class UsageClient(object):
         path = 'api/usageManagement/v2/usageSpecification/' + spec_id
         url = urljoin(self._usage_api, path)
 
-        r = requests.delete(url)
+        r = get_session(url).delete(url)
         r.raise_for_status()
 
-    def get_customer_usage(self, customer, product_id, state=None):
+    def iter_customer_usage(self, customer, product_id, state=None):
         """
-        Retrieves the usage made by a customer filtered by service and status
+        Iterates over the usage made by a customer filtered by service and status,
+        usage documents are retrieved in pages as they are consumed
         :param customer: username of the customer
         :param product_id: id of the acquired product being used
         :param state: state of the usage to be retrieved
-        :return: List of customer usages
+        :return: Generator of customer usages
         """
-        # Get customer usage filtered by state
+        if state is not None:
+            self._validate_state(state)
+
         path = 'api/usageManagement/v2/usage'
-        url = urljoin(self._usage_api, path) + '?relatedParty.id=' + customer
+        url = urljoin(self._usage_api, path)
+
+        # Get customer usage filtered by product and state
+        params = {
+            'relatedParty.id': customer,
+            'usageCharacteristic.value': product_id
+        }
 
         if state is not None:
-            self._validate_state(state)
-            url += '&status=' + state
+            params['status'] = state
 
-        r = requests.get(url, headers={
-            'Accept': 'application/json'
-        })
+        page_size = settings.USAGE_PAGE_SIZE
+        offset = 0
+        previous_ids = None
+        while True:
+            params['offset'] = offset
+            params['size'] = page_size
 
-        r.raise_for_status()
+            r = get_session(url).get(url, params=params, headers={
+                'Accept': 'application/json'
+            })
+
+            r.raise_for_status()
+            raw_usage = r.json()
+
+            # If the API ignores the offset, the same page is returned again, so the iteration is stopped
+            page_ids = [usage_doc.get('id') for usage_doc in raw_usage]
+            if page_ids == previous_ids:
+                break
+
+            previous_ids = page_ids
 
-        raw_usage = r.json()
-        # Filter only the usage belonging to the specified product
-        return [usage_doc for usage_doc in raw_usage if self._belongs_to_product(usage_doc, product_id)]
+            # The API filters by characteristic value, so check that the value is the product id
+            for usage_doc in raw_usage:
+                if self._belongs_to_product(usage_doc, product_id):
+                    yield usage_doc
+
+            # The last page is shorter than requested, while a larger one means that the API is not paginating
+            if len(raw_usage) != page_size:
+                break
+
+            offset += page_size
+
+    def get_customer_usage(self, customer, product_id, state=None):
+        """
+        Retrieves the usage made by a customer filtered by service and status
+        :param customer: username of the customer
+        :param product_id: id of the acquired product being used
+        :param state: state of the usage to be retrieved
+        :return: List of customer usages
+        """
+        return list(self.iter_customer_usage(customer, product_id, state=state))
 
     def _patch_usage(self, usage_id, patch):
         path = 'api/usageManagement/v2/usage/' + str(usage_id)
         url = urljoin(self._usage_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_session(url).patch(url, json=patch)
         r.raise_for_status()
 
     def update_usage_state(self, usage_id, state):
@@ -160,7 +201,7 @@ class UsageClient(object):
         patch = {
             'status': 'Rated',
             'ratedProductUsage': [{
-                'ratingDate': timestamp.replace(' ', 'T'),
+                'ratingDate': format_timestamp(timestamp),
                 'usageRatingTag': 'usage',
                 'isBilled': False,
                 'ratingAmountType': 'Total',
@@ -175,3 +216,10 @@ class UsageClient(object):
         }
 
         self._patch_usage(usage_id, patch)
+
+
+def retry_usage_state(usage_id, state):
+    """
+    Scheduled task that updates the state of a usage document whose previous update has failed
+    """
+    UsageClient().update_usage_state(usage_id, state)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from django.conf import settings
+
+from wstore.charging_engine.accounting.errors import UsageError
+from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.scheduler import renew_task_lease, schedule_task
+
+
+RATING_COLLECTION = 'wstore_usage_rating'
+
+# Usage documents of the jobs are stored apart, so large charges do not exceed the size limit of a document
+ITEMS_COLLECTION = 'wstore_usage_rating_item'
+
+PENDING = 'pending'
+RATED = 'rated'
+COMPLETED = 'completed'
+
+
+def _get_collection():
+    return get_database_connection()[RATING_COLLECTION]
+
+
+def _get_items_collection():
+    return get_database_connection()[ITEMS_COLLECTION]
+
+
+def schedule_usage_rating(contract, transaction):
+    """
+    Persists the rating of the usage documents charged in a transaction and
+    schedules it to be processed in background
+    :param contract: Contract whose usage has been charged
+    :param transaction: Transaction including the applied accounting
+    :return: ID of the rating job
+    """
+    items = [{
+        'product_id': contract.product_id,
+        'usage_id': sdr['usage_id'],
+        'value': sdr['value'],
+        'duty_free': sdr['duty_free'],
+        'price': sdr['price'],
+        'tax_rate': sdr_info['model']['tax_rate'],
+        'part': part,
+        'state': PENDING
+    } for part, sdr_info in enumerate(transaction['applied_accounting']) for sdr in sdr_info['accounting']]
+
+    # The applied price components are kept, so the invoice of the charge can be built from the job
+    parts = [{
+        'model': sdr_info['model'],
+        'price': sdr_info['price'],
+        'duty_free': sdr_info['duty_free']
+    } for sdr_info in transaction['applied_accounting']]
+
+    job_id = _get_collection().insert_one({
+        'product_id': contract.product_id,
+        'timestamp': str(contract.last_charge),
+        'currency': transaction['currency'],
+        'parts': parts,
+        'total': len(items),
+        'rated': 0,
+        'state': PENDING,
+        'created': datetime.utcnow()
+    }).inserted_id
+
+    if len(items):
+        for item in items:
+            item['job_id'] = job_id
+
+        _get_items_collection().insert_many(items)
+
+    schedule_task('wstore.charging_engine.accounting.usage_rating.process_usage_rating', 0, job_id=str(job_id))
+    return job_id
+
+
+def get_pending_usage(product_id):
+    """
+    Gets the IDs of the usage documents of a product that have been charged but not rated yet
+    """
+    return {
+        item['usage_id'] for item in _get_items_collection().find(
+            {'product_id': product_id, 'state': PENDING}, {'usage_id': 1})
+    }
+
+
+def get_applied_accounting(job_id):
+    """
+    Rebuilds the applied accounting of the transaction of a rating job
+    :param job_id: ID of the rating job
+    :return: List with the applied price components, including the usage documents charged by each one
+    """
+    job = _get_collection().find_one({'_id': ObjectId(job_id)}, {'parts': 1})
+
+    if job is None:
+        raise UsageError('The rating job {} does not exist'.format(job_id))
+
+    applied_accounting = [dict(part, accounting=[]) for part in job['parts']]
+
+    items = _get_items_collection().find(
+        {'job_id': ObjectId(job_id)}, {'part': 1, 'usage_id': 1, 'value': 1, 'price': 1, 'duty_free': 1})
+
+    for item in items.sort('_id', ASCENDING):
+        applied_accounting[item['part']]['accounting'].append({
+            'usage_id': item['usage_id'],
+            'value': item['value'],
+            'price': item['price'],
+            'duty_free': item['duty_free']
+        })
+
+    return applied_accounting
+
+
+def process_usage_rating(job_id):
+    """
+    Scheduled task that rates the pending usage documents of a rating job in chunks, using a bounded
+    pool of concurrent requests. The progress is saved after each chunk, so retries only include
+    the usage documents that have not been rated
+    """
+    collection = _get_collection()
+    items_collection = _get_items_collection()
+    job = collection.find_one({'_id': ObjectId(job_id)})
+
+    if job is None or job['state'] == COMPLETED:
+        return
+
+    usage_client = UsageClient()
+
+    def _rate(item):
+        try:
+            usage_client.rate_usage(
+                item['usage_id'],
+                job['timestamp'],
+                item['duty_free'],
+                item['price'],
+                item['tax_rate'],
+                job['currency'],
+                job['product_id']
+            )
+        except Exception as e:
+            return str(e)
+
+    failed = []
+    last_id = None
+    with ThreadPoolExecutor(max_workers=settings.USAGE_RATING_WORKERS) as executor:
+        while True:
+            query = {'job_id': job['_id'], 'state': PENDING}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+
+            chunk = list(items_collection.find(query).sort('_id', ASCENDING).limit(settings.USAGE_RATING_CHUNK_SIZE))
+
+            if not len(chunk):
+                break
+
+            last_id = chunk[-1]['_id']
+            errors = list(executor.map(_rate, chunk))
+
+            rated = [item['_id'] for item, error in zip(chunk, errors) if error is None]
+            update = {'$inc': {'rated': len(rated)}}
+
+            if len(rated):
+                items_collection.update_many({'_id': {'$in': rated}}, {'$set': {'state': RATED}})
+
+            if len(rated) < len(chunk):
+                failed.extend([item['usage_id'] for item, error in zip(chunk, errors) if error is not None])
+                update['$set'] = {'last_error': [error for error in errors if error is not None][-1]}
+
+            collection.update_one({'_id': job['_id']}, update)
+
+            # The job is stopped if it has been claimed again, so usage documents are not rated twice
+            if not renew_task_lease():
+                return
+
+    collection.update_one({'_id': job['_id']}, {'$set': {'state': COMPLETED if not len(failed) else PENDING}})
+
+    if len(failed):
+        # The task is retried by the scheduler
+        raise UsageError('The usage documents {} could not be rated'.format(', '.join(failed)))
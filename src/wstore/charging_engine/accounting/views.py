@@ -20,7 +20,9 @@
 
 
 import json
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
@@ -28,7 +30,14 @@ from wstore.charging_engine.accounting.usage_client import UsageClient
 from wstore.ordering.models import Order
 from wstore.asset_manager.resource_plugins.decorators import on_usage_refreshed
 from wstore.store_commons.resource import Resource
-from wstore.store_commons.utils.http import build_response, supported_request_mime_types
+from wstore.store_commons.scheduler import schedule_task
+from wstore.store_commons.utils.http import build_response, get_content_type, supported_request_mime_types, JsonResponse
+
+
+def _schedule_state_update(usage_id, state):
+    schedule_task(
+        'wstore.charging_engine.accounting.usage_client.retry_usage_state', settings.SCHEDULER_RETRY_DELAY,
+        usage_id=usage_id, state=state)
 
 
 class ServiceRecordCollection(Resource):
@@ -49,6 +58,9 @@ class ServiceRecordCollection(Resource):
         sdr_manager = SDRManager()
         try:
             sdr_manager.validate_sdr(data)
+
+            # The usage is saved atomically, so SDRs accepted concurrently are rejected
+            sdr_manager.update_usage()
         except PermissionDenied as e:
             response = build_response(request, 403, str(e))
         except ValueError as e:
@@ -62,14 +74,67 @@ class ServiceRecordCollection(Resource):
             usage_client.update_usage_state(data['id'], 'Rejected')
         else:
             # The usage document is valid, change its state to Guided
-            usage_client.update_usage_state(data['id'], 'Guided')
-            sdr_manager.update_usage()
+            try:
+                usage_client.update_usage_state(data['id'], 'Guided')
+            except Exception:
+                # The SDR is not accepted, so it can be sent again with the same correlation number
+                if sdr_manager.revert_usage():
+                    return build_response(request, 500, 'The state of the usage document could not be updated')
+
+                # Other SDRs have been accepted after this one, so the state is updated later
+                _schedule_state_update(data['id'], 'Guided')
+
             response = build_response(request, 200, 'OK')
 
         # Update usage document state
         return response
 
 
+class ServiceRecordBatchCollection(Resource):
+
+    def _parse_batch(self, request):
+        if get_content_type(request)[0] == 'application/x-ndjson':
+            return [json.loads(line) for line in request.body.decode('utf-8').splitlines() if line.strip()]
+
+        data = json.loads(request.body)
+        if not isinstance(data, list):
+            raise ValueError('The request does not contain a list')
+
+        return data
+
+    # This method is used to load batches of SDR documents, the
+    # result of each SDR is included in the response
+    @supported_request_mime_types(('application/json', 'application/x-ndjson'))
+    def create(self, request):
+        try:
+            sdrs = self._parse_batch(request)
+        except:
+            return build_response(request, 400, 'The request does not contain a valid JSON list or NDJSON stream')
+
+        if len(sdrs) > settings.SDR_BATCH_MAX_SIZE:
+            return build_response(request, 422, 'The batch cannot include more than {} SDRs'.format(settings.SDR_BATCH_MAX_SIZE))
+
+        results = SDRManager().process_batch(sdrs)
+        usage_client = UsageClient()
+
+        def _update_state(result):
+            try:
+                usage_client.update_usage_state(result['id'], result['status'])
+            except Exception as e:
+                # The usage of the accepted SDRs has been saved, so the state update is retried instead of failing
+                try:
+                    _schedule_state_update(result['id'], result['status'])
+                except Exception:
+                    result['code'] = 500
+                    result['message'] = 'The state of the usage document could not be updated: ' + str(e)
+
+        # The usage documents are updated concurrently, the ones without id cannot be updated
+        with ThreadPoolExecutor(max_workers=settings.SDR_BATCH_WORKERS) as executor:
+            list(executor.map(_update_state, [result for result in results if result['id'] is not None]))
+
+        return JsonResponse(200, results)
+
+
 class SDRRefreshCollection(Resource):
 
     @supported_request_mime_types(('application/json',))
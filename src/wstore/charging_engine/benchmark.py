@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import platform
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from django.conf import settings
+
+from wstore.charging_engine.charging.cdr_manager import CDRManager
+from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.charging_engine.invoice_builder import InvoiceBuilder
+from wstore.charging_engine.price_resolver import PriceResolver
+from wstore.store_commons.utils.dates import parse_timestamp
+
+
+SCALES = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000
+}
+
+UNITS = ['call', 'megabyte', 'second', 'request']
+
+# Timestamp formats sent by the accounting agents
+DATE_FORMATS = ['2015-10-20 17:{:02d}:57.{:06d}', '2015-10-20T17:{:02d}:57.{:03d}Z', '2015-10-20T17:{:02d}:57.{:03d}+02:00']
+
+# Usage documents are not modified while rated, so big sets reference a pool of
+# distinct documents in order to keep the memory used by the benchmark bounded
+POOL_SIZE = 10000
+
+
+def get_scale_size(scale):
+    return SCALES[scale] if scale in SCALES else int(scale)
+
+
+def build_pricing_model():
+    """
+    Builds a pricing model with linear and tiered pay-per-use components and a recurring alteration
+    """
+    return {
+        'general_currency': 'EUR',
+        'pay_per_use': [{
+            'value': '0.012',
+            'unit': 'call',
+            'tax_rate': '20.00',
+            'duty_free': '0.010'
+        }, {
+            'value': '1.20',
+            'unit': 'megabyte',
+            'tax_rate': '20.00',
+            'duty_free': '1.00'
+        }, {
+            'value': '0.06',
+            'unit': 'second',
+            'tax_rate': '20.00',
+            'duty_free': '0.05'
+        }, {
+            'value': '0.12',
+            'unit': 'request',
+            'tax_rate': '20.00',
+            'duty_free': '0.10',
+            'tier_type': 'tiered',
+            'tiers': [
+                {'up_to': '1000', 'value': '0.12', 'duty_free': '0.10'},
+                {'up_to': '100000', 'value': '0.06', 'duty_free': '0.05'},
+                {'up_to': None, 'value': '0.012', 'duty_free': '0.010'}
+            ]
+        }],
+        'alteration': {
+            'type': 'discount',
+            'period': 'recurring',
+            'value': '10',
+            'condition': {
+                'operation': 'gt',
+                'value': '300.00'
+            }
+        }
+    }
+
+
+def _build_pool(size, seed, builder):
+    rand = random.Random(seed)
+    pool = [builder(i, rand.choice(UNITS), str(rand.randint(1, 100))) for i in range(min(size, POOL_SIZE))]
+    return [pool[i % len(pool)] for i in range(size)]
+
+
+def build_accounting(size, seed=0):
+    """
+    Builds a list of parsed SDRs as received by the price resolver
+    """
+    return _build_pool(size, seed, lambda i, unit, value: {
+        'usage_id': str(i),
+        'unit': unit,
+        'value': value
+    })
+
+
+def build_usage(size, seed=0):
+    """
+    Builds a list of usage documents as returned by the usage API
+    """
+    return _build_pool(size, seed, lambda i, unit, value: {
+        'id': str(i),
+        'status': 'Guided',
+        'usageCharacteristic': [
+            {'name': 'orderId', 'value': '1'},
+            {'name': 'productId', 'value': '1'},
+            {'name': 'correlationNumber', 'value': str(i)},
+            {'name': 'unit', 'value': unit},
+            {'name': 'value', 'value': value}
+        ]
+    })
+
+
+def build_dates(size, seed=0):
+    """
+    Builds a list of SDR timestamps in the different supported formats
+    """
+    return _build_pool(size, seed, lambda i, unit, value: DATE_FORMATS[i % len(DATE_FORMATS)].format(i % 60, int(value)))
+
+
+def measure(func, repeat):
+    """
+    Executes a function the given number of times
+    :return: Dict with the min, median, and mean execution time in seconds
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings)
+    }
+
+
+def _build_fake_models(pricing_model):
+    # Plain objects with the fields read while rating, so no database is needed
+    provider = SimpleNamespace(pk='provider', name='provider')
+    offering = SimpleNamespace(off_id='1', name='Benchmark offering', version='1.0', owner_organization=provider)
+
+    order = SimpleNamespace(order_id='1', owner_organization=SimpleNamespace(pk='customer', name='customer'))
+    contract = SimpleNamespace(
+        pricing_model=pricing_model, revenue_class='benchmark', item_id='1', offering='1', product_id='1')
+
+    return offering, order, contract
+
+
+def _reserve_correlation_numbers(organization_pk, amount):
+    return iter(range(amount))
+
+
+def _discard_cdrs(cdrs):
+    pass
+
+
+def get_benchmarks(size, seed=0):
+    """
+    Builds the rating workloads for a number of SDRs
+    :return: List of tuples with the name of the benchmark and the function to be measured
+    """
+    pricing_model = build_pricing_model()
+    use_model = {
+        'pay_per_use': pricing_model['pay_per_use'],
+        'alteration': pricing_model['alteration']
+    }
+    accounting = build_accounting(size, seed)
+    usage = build_usage(size, seed)
+    dates = build_dates(size, seed)
+
+    # The applied SDRs are the input of the CDR and invoice generation
+    resolver = PriceResolver()
+    price, duty_free = resolver.resolve_price(use_model, accounting)
+    applied_sdrs = resolver.get_applied_sdr()
+
+    transaction = {
+        'price': price,
+        'duty_free': duty_free,
+        'currency': 'EUR',
+        'applied_accounting': applied_sdrs
+    }
+
+    offering, order, contract = _build_fake_models(pricing_model)
+
+    def _generate_cdr():
+        # The correlation numbers and the outbox are replaced, so only the generation of the CDRs is measured
+        cdr_manager = CDRManager(
+            order, contract, offering=offering, reserve_numbers=_reserve_correlation_numbers, enqueue=_discard_cdrs)
+        cdr_manager.generate_cdr({'accounting': applied_sdrs}, '2023-04-15T00:00:00Z')
+
+    def _build_invoice_context():
+        # The template is not loaded, so only the building of the context is measured
+        builder = InvoiceBuilder(order)
+        parts = {
+            'use_parts': [],
+            'alt_parts': [],
+            'use_subtotal': 0
+        }
+        builder._process_usage_parts(transaction['applied_accounting'], parts)
+        builder._fill_use_context({'cur': transaction['currency']}, parts)
+
+    return [
+        ('resolve_price', lambda: PriceResolver().resolve_price(use_model, accounting)),
+        ('pay_per_use_preprocesing', lambda: PriceResolver()._pay_per_use_preprocesing(use_model['pay_per_use'], accounting)),
+        ('parse_raw_accounting', lambda: ChargingEngine(order)._parse_raw_accounting(usage)),
+        ('parse_timestamp', lambda: [parse_timestamp(date) for date in dates]),
+        ('generate_cdr', _generate_cdr),
+        ('invoice_context', _build_invoice_context)
+    ]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASEDIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(scales, repeat=5, seed=0):
+    """
+    Measures the rating path with synthetic SDR sets
+    :param scales: List of scales, either names included in SCALES or number of SDRs
+    :param repeat: Number of times each benchmark is executed
+    :param seed: Seed used to generate the SDRs, so results are comparable across commits
+    :return: Dict with the environment info and the results of each benchmark
+    """
+    results = []
+    for scale in scales:
+        size = get_scale_size(scale)
+
+        for name, func in get_benchmarks(size, seed):
+            result = {
+                'benchmark': name,
+                'scale': scale,
+                'sdrs': size
+            }
+            result.update(measure(func, repeat))
+            result['sdrs_per_second'] = size / result['median'] if result['median'] > 0 else None
+
+            results.append(result)
+
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'repeat': repeat,
+        'seed': seed,
+        'results': results
+    }
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compares the median times of the results with a previous execution
+    :param threshold: Maximum relative slowdown allowed, e.g 0.1 for a 10%
+    :return: List of the benchmarks whose slowdown is greater than the threshold
+    """
+    baseline_medians = {(result['benchmark'], result['scale']): result['median'] for result in baseline['results']}
+    regressions = []
+
+    for result in results['results']:
+        base = baseline_medians.get((result['benchmark'], result['scale']))
+        if not base:
+            continue
+
+        result['baseline_median'] = base
+        result['change'] = (result['median'] - base) / base
+
+        if result['change'] > threshold:
+            regressions.append(result)
+
+    results['baseline_commit'] = baseline.get('commit')
+    return regressions
@@ -20,11 +20,14 @@
 
 
 from decimal import Decimal
-from requests import Session, Request
+from requests import Request
 from urllib.parse import urlparse, urljoin
 
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_session
+from wstore.store_commons.utils.dates import format_timestamp
+
 
 class BillingClient:
 
@@ -35,7 +38,7 @@ class BillingClient:
 
     def create_charge(self, charge_model, product_id, start_date=None, end_date=None):
 
-        str_time = charge_model['date'].isoformat() + 'Z'
+        str_time = format_timestamp(charge_model['date'])
         tax_rate = ((Decimal(charge_model['cost']) - Decimal(charge_model['duty_free'])) * Decimal('100') / Decimal(charge_model['cost']))
 
         domain = settings.SITE
@@ -60,8 +63,8 @@ class BillingClient:
         }
 
         if end_date is not None or start_date is not None:
-            start_period = start_date.isoformat() + 'Z' if start_date is not None else str_time
-            end_period = end_date.isoformat() + 'Z' if end_date is not None else str_time
+            start_period = format_timestamp(start_date) if start_date is not None else str_time
+            end_period = format_timestamp(end_date) if end_date is not None else str_time
 
             charge['period'] = [{
                 'startPeriod': start_period,
@@ -71,7 +74,7 @@ class BillingClient:
         url = self._billing_api + 'api/billingManagement/v2/appliedCustomerBillingCharge'
         req = Request('POST', url, json=charge)
 
-        session = Session()
+        session = get_session(url)
         prepped = session.prepare_request(req)
 
         # Override host header to avoid inconsistent hrefs in the API
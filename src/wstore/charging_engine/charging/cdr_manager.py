@@ -19,22 +19,48 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from bson import ObjectId
 from decimal import Decimal
 
 from django.conf import settings
 from wstore.ordering.models import Offering
 
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
+from wstore.rss_adaptor.cdr_outbox import enqueue_cdrs
+from wstore.store_commons.cache import get_instance
 from wstore.store_commons.database import get_database_connection
 
 
+def reserve_correlation_numbers(organization_pk, amount):
+    """
+    Reserves a block of consecutive correlation numbers for the given provider
+    :param organization_pk: pk of the provider organization
+    :param amount: Number of correlation numbers to reserve
+    :return: Iterator over the reserved correlation numbers
+    """
+    if amount < 1:
+        return iter([])
+
+    db = get_database_connection()
+
+    # Take and increment the correlation number using
+    # the mongoDB atomic access in order to avoid race
+    # problems, the whole block is reserved in a single operation
+    first = db.wstore_organization.find_and_modify(
+        query={'_id': organization_pk},
+        update={'$inc': {'correlation_number': amount}}
+    )['correlation_number']
+
+    return iter(range(first, first + amount))
+
+
 class CDRManager(object):
 
     _order = None
 
-    def __init__(self, order, contract):
-        self._offering = Offering.objects.get(pk=ObjectId(contract.offering))
+    def __init__(self, order, contract, offering=None, reserve_numbers=None, enqueue=None):
+        # Collaborators can be provided, so CDRs can be generated without accessing the database or the RSS
+        self._offering = offering if offering is not None else get_instance(Offering, contract.offering)
+        self._reserve_numbers = reserve_numbers or reserve_correlation_numbers
+        self._enqueue = enqueue or enqueue_cdrs
         self._init_cdr_info(order, contract)
 
     def _init_cdr_info(self, order, contract):
@@ -57,18 +83,7 @@ class CDRManager(object):
             'order': order.order_id + ' ' + contract.item_id
         }
 
-    def _generate_cdr_part(self, part, event, description):
-        # Create connection for raw database access
-        db = get_database_connection()
-
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
-        corr_number = db.wstore_organization.find_and_modify(
-            query={'_id': self._offering.owner_organization.pk},
-            update={'$inc': {'correlation_number': 1}}
-        )['correlation_number']
-
+    def _generate_cdr_part(self, corr_number, part, event, description):
         cdr_part = {
             'correlation': str(corr_number),
             'cost_value': str(part['value']),
@@ -80,9 +95,13 @@ class CDRManager(object):
         cdr_part.update(self._cdr_info)
         return cdr_part
 
+    def _generate_cdrs(self, parts):
+        correlation_numbers = self._reserve_numbers(self._offering.owner_organization.pk, len(parts))
+        return [self._generate_cdr_part(corr_number, *part) for corr_number, part in zip(correlation_numbers, parts)]
+
     def generate_cdr(self, applied_parts, time_stamp):
 
-        cdrs = []
+        parts = []
 
         self._cdr_info['time_stamp'] = time_stamp
         self._cdr_info['type'] = 'C'
@@ -93,7 +112,7 @@ class CDRManager(object):
             # A cdr is generated for every price part
             for part in applied_parts['single_payment']:
                 description = 'One time payment: ' + str(part['value']) + ' ' + self._cdr_info['cost_currency']
-                cdrs.append(self._generate_cdr_part(part, 'One time payment event', description))
+                parts.append((part, 'One time payment event', description))
 
         if 'subscription' in applied_parts:
 
@@ -102,7 +121,7 @@ class CDRManager(object):
                 description = 'Recurring payment: ' + str(part['value']) + ' ' + self._cdr_info['cost_currency'] \
                               + ' ' + part['unit']
 
-                cdrs.append(self._generate_cdr_part(part, 'Recurring payment event', description))
+                parts.append((part, 'Recurring payment event', description))
 
         if 'accounting' in applied_parts:
 
@@ -119,11 +138,13 @@ class CDRManager(object):
                     use += int(sdr['value'])
                     description = 'Fee per ' + part['model']['unit'] + ', Consumption: ' + str(use)
 
-                cdrs.append(self._generate_cdr_part(use_part, 'Pay per use event', description))
+                parts.append((use_part, 'Pay per use event', description))
+
+        # Correlation numbers for all the parts are reserved at once
+        cdrs = self._generate_cdrs(parts)
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        self._enqueue(cdrs)
 
     def refund_cdrs(self, price, duty_free, time_stamp):
         self._cdr_info['time_stamp'] = time_stamp
@@ -136,8 +157,7 @@ class CDRManager(object):
         }
 
         description = 'Refund event: ' + str(price) + ' ' + self._cdr_info['cost_currency']
-        cdrs = [self._generate_cdr_part(aggregated_part, 'Refund event', description)]
+        cdrs = self._generate_cdrs([(aggregated_part, 'Refund event', description)])
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        self._enqueue(cdrs)
@@ -84,7 +84,7 @@ class CDRGenerationTestCase(TestCase):
 
     def setUp(self):
         # Create Mocks
-        cdr_manager.RSSAdaptorThread = MagicMock()
+        cdr_manager.enqueue_cdrs = MagicMock()
 
         self._conn = MagicMock()
         cdr_manager.get_database_connection = MagicMock()
@@ -168,11 +168,75 @@ class CDRGenerationTestCase(TestCase):
             update={'$inc': {'correlation_number': 1}}
         )
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdrs)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdrs)
 
         cdr_manager.Offering.objects.get.assert_called_once_with(pk=ObjectId('61004aba5e05acc115f022f0'))
 
+    def test_cdr_generation_multiple_parts(self):
+        self._conn.wstore_organization.find_and_modify.side_effect = [{'correlation_number': 5}]
+
+        cdr_m = cdr_manager.CDRManager(self._order, self._contract)
+        cdr_m.generate_cdr({
+            'single_payment': [{
+                'value': Decimal('12'),
+                'unit': 'one time',
+                'tax_rate': Decimal('20'),
+                'duty_free': Decimal('10')
+            }],
+            'subscription': [{
+                'value': Decimal('12'),
+                'unit': 'monthly',
+                'tax_rate': Decimal('20'),
+                'duty_free': Decimal('10')
+            }, {
+                'value': Decimal('12'),
+                'unit': 'monthly',
+                'tax_rate': Decimal('20'),
+                'duty_free': Decimal('10')
+            }]
+        }, '2015-10-21 06:13:26.661650')
+
+        # The correlation numbers are reserved in a single operation
+        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
+            query={'_id': '61004aba5e05acc115f022f0'},
+            update={'$inc': {'correlation_number': 3}}
+        )
+
+        cdrs = cdr_manager.enqueue_cdrs.call_args[0][0]
+        self.assertEquals(['5', '6', '7'], [cdr['correlation'] for cdr in cdrs])
+        self.assertEquals(['One time payment event', 'Recurring payment event', 'Recurring payment event'], [cdr['event'] for cdr in cdrs])
+
+    def test_cdr_generation_no_parts(self):
+        cdr_m = cdr_manager.CDRManager(self._order, self._contract)
+        cdr_m.generate_cdr({}, '2015-10-21 06:13:26.661650')
+
+        self.assertEquals(0, self._conn.wstore_organization.find_and_modify.call_count)
+        cdr_manager.enqueue_cdrs.assert_called_once_with([])
+
+    def test_cdr_generation_injected_collaborators(self):
+        offering = cdr_manager.Offering.objects.get.return_value
+        reserve_numbers = MagicMock(return_value=iter([8]))
+        enqueue = MagicMock()
+
+        cdr_m = cdr_manager.CDRManager(
+            self._order, self._contract, offering=offering, reserve_numbers=reserve_numbers, enqueue=enqueue)
+        cdr_m.generate_cdr({
+            'single_payment': [{
+                'value': Decimal('12'),
+                'unit': 'one time',
+                'tax_rate': Decimal('20'),
+                'duty_free': Decimal('10')
+            }]
+        }, '2015-10-21 06:13:26.661650')
+
+        cdr_manager.Offering.objects.get.assert_not_called()
+        reserve_numbers.assert_called_once_with('61004aba5e05acc115f022f0', 1)
+        self.assertEquals(0, self._conn.wstore_organization.find_and_modify.call_count)
+        self.assertEquals(0, cdr_manager.enqueue_cdrs.call_count)
+
+        cdrs = enqueue.call_args[0][0]
+        self.assertEquals(['8'], [cdr['correlation'] for cdr in cdrs])
+
     def test_refund_cdr_generation(self):
         exp_cdr = [{
             'provider': 'provider',
@@ -199,8 +263,7 @@ class CDRGenerationTestCase(TestCase):
             update={'$inc': {'correlation_number': 1}}
         )
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdr)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdr)
 
 
 TIMESTAMP = datetime(2016, 6, 21, 10, 0, 0)
@@ -274,9 +337,9 @@ class BillingClientTestCase(TestCase):
         billing_client.settings.SITE = site
 
         billing_client.Request = MagicMock()
-        billing_client.Session = MagicMock()
+        billing_client.get_session = MagicMock()
         session = MagicMock()
-        billing_client.Session.return_value = session
+        billing_client.get_session.return_value = session
 
         preped = MagicMock()
         preped.headers = {}
@@ -293,7 +356,8 @@ class BillingClientTestCase(TestCase):
             json=exp_body
         )
 
-        billing_client.Session.assert_called_once_with()
+        billing_client.get_session.assert_called_once_with(
+            'http://billing.api.com/api/billingManagement/v2/appliedCustomerBillingCharge')
         session.prepare_request.assert_called_once_with(billing_client.Request())
 
         self.assertEquals(
@@ -20,24 +20,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading
 import importlib
-from bson import ObjectId
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from wstore.ordering.models import Offering
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.charging_engine.accounting.usage_rating import get_applied_accounting, get_pending_usage, \
+    schedule_usage_rating
 
 from wstore.charging_engine.price_resolver import PriceResolver
 from wstore.charging_engine.charging.cdr_manager import CDRManager
 from wstore.charging_engine.charging.billing_client import BillingClient
 from wstore.charging_engine.invoice_builder import InvoiceBuilder
-from wstore.ordering.errors import OrderingError
+from wstore.ordering.errors import OrderingError, PaymentError
+from wstore.ordering.charge_history import INVOICE_FAILED, INVOICE_GENERATED, INVOICE_PENDING, get_charge_documents, \
+    get_invoice_statuses, save_charge, set_invoice_status
 from wstore.ordering.models import Order, Charge, Payment
 from wstore.ordering.ordering_client import OrderingClient
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.cache import get_instance
+from wstore.store_commons.database import DocumentLock
+from wstore.store_commons.scheduler import schedule_task
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.store_commons.utils.units import ChargePeriod
 
@@ -72,25 +76,19 @@ class ChargingEngine:
         order.state = 'paid'
         order.pending_payment = None
 
-        order.save()
+        order.save_changes()
 
     def _timeout_handler(self):
+        lock = DocumentLock('wstore_order', self._order.pk, 'payment')
 
-        db = get_database_connection()
-
-        # Uses an atomic operation to get and set the _lock value in the purchase
-        # document
-        pre_value = db.wstore_order.find_one_and_update(
-            {'_id': self._order.pk},
-            {'$set': {'_lock': True}}
-        )
-
-        # If _lock not exists or is set to false means that this function has
-        # acquired the resource
-        if '_lock' not in pre_value or not pre_value['_lock']:
+        # If the lock is held the payment is being confirmed, the task is retried
+        # by the scheduler in case the confirmation does not finish
+        if lock.lock_document():
+            raise PaymentError('The payment of the order {} is being processed'.format(self._order.order_id))
 
+        try:
             # Only rollback if the state is pending
-            if pre_value['state'] == 'pending':
+            if lock.document['state'] == 'pending':
                 order = Order.objects.get(pk=self._order.pk)
                 timeout_processors = {
                     'initial': self._initial_charge_timeout,
@@ -98,11 +96,8 @@ class ChargingEngine:
                     'usage': self._renew_charge_timeout
                 }
                 timeout_processors[self._concept](order)
-
-            db.wstore_order.find_one_and_update(
-                {'_id': self._order.pk},
-                {'$set': {'_lock': False}}
-            )
+        finally:
+            lock.unlock_document()
 
     def _charge_client(self, transactions):
 
@@ -119,8 +114,9 @@ class ChargingEngine:
         checkout_url = client.get_checkout_url()
 
         # Set timeout for PayPal transaction to 5 minutes
-        t = threading.Timer(300, self._timeout_handler)
-        t.start()
+        schedule_task(
+            'wstore.charging_engine.charging_engine.process_payment_timeout', 300,
+            order_id=self._order.pk, concept=self._concept)
 
         return checkout_url
 
@@ -170,25 +166,14 @@ class ChargingEngine:
         return None, valid_to
 
     def _end_use_charge(self, contract, transaction):
-        # Change applied usage documents SDR Guided to Rated
-        usage_client = UsageClient()
-
-        for sdr_info in transaction['applied_accounting']:
-            for sdr in sdr_info['accounting']:
-
-                usage_client.rate_usage(
-                    sdr['usage_id'],
-                    str(contract.last_charge),
-                    sdr['duty_free'],
-                    sdr['price'],
-                    sdr_info['model']['tax_rate'],
-                    transaction['currency'],
-                    contract.product_id
-                )
+        # Change applied usage documents SDR Guided to Rated, this is done in background
+        # since a charge may include thousands of usage documents
+        transaction['rating_job'] = str(schedule_usage_rating(contract, transaction))
 
         transaction['related_model']['accounting'] = transaction['applied_accounting']
 
-        return contract.charges[-1].date if len(contract.charges) > 0 else self._order.date, None
+        last_charge = contract.get_last_charge()
+        return last_charge.date if last_charge is not None else self._order.date, None
 
     def _send_notification(self, concept, transactions):
         # TODO: Improve the rollback in case of unexpected exception
@@ -206,6 +191,13 @@ class ChargingEngine:
         except:
             pass
 
+    def _get_invoice_details(self, transaction):
+        # Usage charges may include thousands of SDRs, so their invoices are built from the rating job
+        if 'rating_job' in transaction:
+            return {'rating_job': transaction['rating_job']}
+
+        return {'related_model': transaction['related_model']}
+
     def end_charging(self, transactions, free_contracts, concept):
         """
         Process the second step of a payment once the customer has approved the charge
@@ -216,7 +208,7 @@ class ChargingEngine:
         # Update purchase state
         if self._order.state == 'pending':
             self._order.state = 'paid'
-            self._order.save()
+            self._order.save_changes()
 
         time_stamp = datetime.utcnow()
 
@@ -224,8 +216,8 @@ class ChargingEngine:
 
         invoice_builder = InvoiceBuilder(self._order)
         billing_client = BillingClient() if concept != 'initial' else None
+        invoices = []
 
-        updated_contracts = {}
         for transaction in transactions:
             contract = self._order.get_item_contract(transaction['item'])
             contract.last_charge = time_stamp
@@ -236,10 +228,10 @@ class ChargingEngine:
             cdr_manager = CDRManager(self._order, contract)
             cdr_manager.generate_cdr(transaction['related_model'], time_stamp.isoformat() + 'Z')
 
-            # Generate the invoice
+            # Reserve the invoice, it is generated in background once the charge is saved
             invoice_path = ''
             try:
-                invoice_path = invoice_builder.generate_invoice(contract, transaction, concept)
+                invoice_path = invoice_builder.reserve_invoice(contract)
             except:
                 pass
 
@@ -250,13 +242,17 @@ class ChargingEngine:
                 duty_free=transaction['duty_free'],
                 currency=transaction['currency'],
                 concept=concept,
-                invoice=invoice_path
+                invoice=invoice_path,
+                invoice_status=INVOICE_PENDING if invoice_path else INVOICE_FAILED
             )
-            if contract.charges is None:
-                contract.charges = []
+            charge_id = save_charge(self._order, contract, charge, details=self._get_invoice_details(transaction))
 
-            contract.charges.append(charge)
-            updated_contracts[transaction['item']] = contract
+            if invoice_path:
+                invoices.append({
+                    'charge': str(charge_id),
+                    'item': contract.item_id,
+                    'invoice': invoice_path
+                })
 
             # Send the charge to the billing API to allow user accesses
             if concept != 'initial':
@@ -266,19 +262,23 @@ class ChargingEngine:
         for free in free_contracts:
             self._order.owner_organization.acquired_offerings.append(free.offering)
 
-        # Update order contracts
-        new_contracts = []
-        for cont in self._order.get_contracts():
-            if cont.item_id not in updated_contracts:
-                new_contracts.append(cont)
-            else:
-                new_contracts.append(updated_contracts[cont.item_id])
+        # Update order contracts, the order returns the same contract instances updated above
+        contracts = self._order.get_contracts()
+        for cont in contracts:
+            cont.next_due = cont.get_next_due(self._order.date)
 
-        self._order.contracts = new_contracts
+        self._order.contracts = contracts
         self._order.owner_organization.save()
-        self._order.save()
-
-        self._send_notification(concept, transactions)
+        self._order.save_changes()
+
+        if len(invoices):
+            # Notifications include the invoices, so they are sent once generated. The task only includes
+            # the IDs of the charges, since the transactions of usage charges can be too large to be stored
+            schedule_task(
+                'wstore.charging_engine.charging_engine.process_invoices', 0, order_id=self._order.pk,
+                concept=concept, items=[transaction['item'] for transaction in transactions], invoices=invoices)
+        else:
+            self._send_notification(concept, transactions)
 
     def _save_pending_charge(self, transactions, free_contracts=[]):
         pending_payment = {  # Payment model
@@ -288,7 +288,7 @@ class ChargingEngine:
         }
 
         self._order.pending_payment = pending_payment
-        self._order.save()
+        self._order.save_changes()
 
     def _append_transaction(self, transactions, contract, related_model, accounting=None):
         # Call the price resolver
@@ -297,7 +297,7 @@ class ChargingEngine:
         if 'alteration' in related_model and not self._price_resolver.is_altered():
             del related_model['alteration']
 
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_instance(Offering, contract.offering)
         transaction = {
             'price': price,
             'duty_free': duty_free,
@@ -359,7 +359,7 @@ class ChargingEngine:
         else:
             # If it is not necessary to charge the customer, the state is set to paid
             self._order.state = 'paid'
-            self._order.save()
+            self._order.save_changes()
             raise OrderingError(err_msg)
 
         return redirect_url
@@ -434,8 +434,15 @@ class ChargingEngine:
                 'pay_per_use': contract.pricing_model['pay_per_use']
             }
 
-            accounting = self._parse_raw_accounting(usage_client.get_customer_usage(
-                self._order.owner_organization.name, contract.product_id, state='Guided'))
+            # Usage documents already charged remain Guided until rated, so they must be skipped
+            pending_usage = get_pending_usage(contract.product_id)
+
+            # Usage documents are parsed as they are downloaded, so only their SDR values are kept
+            accounting = self._parse_raw_accounting(
+                usage_doc for usage_doc in usage_client.iter_customer_usage(
+                    self._order.owner_organization.name, contract.product_id, state='Guided')
+                if usage_doc['id'] not in pending_usage
+            )
 
             if 'alteration' in contract.pricing_model and \
                contract.pricing_model['alteration'].get('period') == 'recurring':
@@ -469,3 +476,129 @@ class ChargingEngine:
             related_contracts = self._order.get_contracts()
 
         return self.charging_processors[type_](related_contracts)
+
+
+def process_payment_timeout(order_id, concept):
+    """
+    Scheduled task that cancels a payment if it has not been confirmed in time
+    """
+    orders = Order.objects.filter(pk=order_id)
+
+    # The order has been already removed
+    if not len(orders):
+        return
+
+    charging = ChargingEngine(orders[0])
+    charging._concept = concept
+    charging._timeout_handler()
+
+
+def _get_order(order_id):
+    orders = Order.objects.filter(pk=order_id)
+    return orders[0] if len(orders) else None
+
+
+def _get_invoice_transaction(charge):
+    """
+    Rebuilds the info of the transaction of a charge needed to generate its invoice
+    """
+    details = charge.get('details', {})
+    transaction = {
+        'price': charge['cost'],
+        'duty_free': charge['duty_free'],
+        'currency': charge['currency'],
+        'related_model': details.get('related_model', {})
+    }
+
+    if 'rating_job' in details:
+        transaction['applied_accounting'] = get_applied_accounting(details['rating_job'])
+
+    return transaction
+
+
+def _generate_invoices(order, concept, invoices):
+    """
+    Generates the invoices of a charge recording their status
+    :return: List of the invoices that could not be generated
+    """
+    invoice_builder = InvoiceBuilder(order)
+    charges = get_charge_documents([invoice['charge'] for invoice in invoices])
+
+    failed = []
+    for invoice in invoices:
+        contract = order.get_item_contract(invoice['item'])
+        try:
+            transaction = _get_invoice_transaction(charges[invoice['charge']])
+            invoice_builder.generate_invoice(contract, transaction, concept, invoice_url=invoice['invoice'])
+        except Exception:
+            failed.append(invoice)
+            status = INVOICE_FAILED
+        else:
+            status = INVOICE_GENERATED
+
+        set_invoice_status(order, invoice['item'], invoice['charge'], concept, invoice['invoice'], status)
+
+    return failed
+
+
+def _schedule_invoices_retry(order, concept, invoices, attempt):
+    schedule_task(
+        'wstore.charging_engine.charging_engine.retry_invoices', settings.SCHEDULER_RETRY_DELAY * attempt,
+        order_id=order.pk, concept=concept, invoices=invoices, attempt=attempt)
+
+
+def process_invoices(order_id, concept, items, invoices):
+    """
+    Scheduled task that generates the invoices of a charge and sends the related notifications.
+    Notifications include the invoices generated in the first attempt, failed ones are retried apart
+    :param items: List with the IDs of the charged items
+    :param invoices: List with the charge, item, and invoice URL of each invoice
+    """
+    order = _get_order(order_id)
+
+    # The order has been already removed
+    if order is None:
+        return
+
+    statuses = get_invoice_statuses([invoice['charge'] for invoice in invoices])
+
+    # Invoices processed in a previous execution of the task are not generated again
+    pending = [invoice for invoice in invoices if statuses.get(invoice['charge']) == INVOICE_PENDING]
+    failed = _generate_invoices(order, concept, pending)
+
+    if len(failed):
+        _schedule_invoices_retry(order, concept, failed, 1)
+
+    # The status of the invoices is only updated in the database, so the order is loaded again
+    # to not attach the files reserved for the invoices that failed
+    order = _get_order(order_id)
+
+    if order is not None:
+        ChargingEngine(order)._send_notification(concept, [{'item': item} for item in items])
+
+
+def retry_invoices(order_id, concept, invoices, attempt):
+    """
+    Scheduled task that generates again the invoices that could not be generated. When they
+    keep failing after SCHEDULER_MAX_ATTEMPTS, the files reserved for them are removed
+    """
+    order = _get_order(order_id)
+
+    if order is None:
+        return
+
+    statuses = get_invoice_statuses([invoice['charge'] for invoice in invoices])
+
+    pending = [invoice for invoice in invoices if statuses.get(invoice['charge']) != INVOICE_GENERATED]
+    failed = _generate_invoices(order, concept, pending)
+
+    if not len(failed):
+        return
+
+    if attempt < settings.SCHEDULER_MAX_ATTEMPTS:
+        _schedule_invoices_retry(order, concept, failed, attempt + 1)
+        return
+
+    invoice_builder = InvoiceBuilder(order)
+    for invoice in failed:
+        invoice_builder.discard_invoice(invoice['invoice'])
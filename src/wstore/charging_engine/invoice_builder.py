@@ -21,8 +21,10 @@
 
 import os
 import codecs
+import shutil
 import subprocess
-from bson.objectid import ObjectId
+import tempfile
+import threading
 from copy import deepcopy
 from datetime import datetime
 from decimal import Decimal
@@ -30,7 +32,15 @@ from decimal import Decimal
 from django.template import loader, Context
 from django.conf import settings
 
+from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Offering
+from wstore.store_commons.cache import get_instance
+from wstore.store_commons.concurrency import process_local
+
+
+@process_local
+def _get_conversion_slots():
+    return threading.BoundedSemaphore(settings.INVOICE_WORKERS)
 
 
 class InvoiceBuilder(object):
@@ -195,16 +205,71 @@ class InvoiceBuilder(object):
         new_name = name + '_' + str(ix) + '.pdf'
         path = os.path.join(settings.BILL_ROOT, new_name)
 
-        if os.path.exists(path):
+        try:
+            # The file is created atomically, so concurrent invoices cannot get the same name
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
             path, new_name = self._avoid_existing_name(name, ix + 1)
 
         return path, new_name
 
-    def generate_invoice(self, contract, transaction, type_):
+    def _get_date(self, contract):
+        if contract.last_charge is None:
+            # If last charge is None means that it is the invoice generation
+            # associated with a free offering
+            return str(datetime.utcnow()).split(' ')[0]
+
+        return str(contract.last_charge).split(' ')[0]
+
+    def reserve_invoice(self, contract):
+        """
+        Reserves the name of the invoice of a charge, so it can be referenced before being generated
+        :return: URL of the invoice
+        """
+        invoice_id = str(self._order.pk) + '_' + contract.item_id + '_' + self._get_date(contract)
+        invoice_path, invoice_name = self._avoid_existing_name(invoice_id, 0)
+
+        return os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name)
+
+    def discard_invoice(self, invoice_url):
+        """
+        Removes the file reserved for an invoice that could not be generated
+        """
+        try:
+            os.remove(os.path.join(settings.BILL_ROOT, invoice_url.split('/')[-1]))
+        except FileNotFoundError:
+            pass
+
+    def _convert_invoice(self, bill_code, invoice_path):
+        # Each conversion uses its own directory, so concurrent ones do not remove the files of others
+        temp_dir = tempfile.mkdtemp(dir=settings.BILL_ROOT)
+
+        try:
+            raw_invoice_path = os.path.join(temp_dir, 'invoice.html')
+            pdf_path = os.path.join(temp_dir, 'invoice.pdf')
+
+            with codecs.open(raw_invoice_path, 'wb', 'utf-8') as f:
+                f.write(bill_code)
+
+            # The conversion is the slowest step, so the number of concurrent ones is bounded
+            with _get_conversion_slots():
+                subprocess.call([settings.BASEDIR + '/create_invoice.sh', raw_invoice_path, pdf_path])
+
+            if not os.path.isfile(pdf_path):
+                raise OrderingError('The invoice could not be converted to PDF')
+
+            # The reserved file is replaced atomically, so it is never served half written
+            os.replace(pdf_path, invoice_path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def generate_invoice(self, contract, transaction, type_, invoice_url=None):
         """
         Create a PDF invoice based on the price components used to charge the user
         :param transaction: Total amount charged to the customer
         :param type_: Type of the charge, initial, renovation, pay-per-use
+        :param invoice_url: URL of the invoice reserved with reserve_invoice, a new one is reserved if None
+        :return: URL of the invoice
         """
 
         # Get invoice context parts and invoice template
@@ -213,18 +278,13 @@ class InvoiceBuilder(object):
         tax = self._order.tax_address
         customer_profile = self._order.customer.userprofile
 
-        if contract.last_charge is None:
-            # If last charge is None means that it is the invoice generation
-            # associated with a free offering
-            date = str(datetime.utcnow()).split(' ')[0]
-        else:
-            date = str(contract.last_charge).split(' ')[0]
+        date = self._get_date(contract)
 
         # Calculate total taxes applied
         tax_value = Decimal(transaction['price']) - Decimal(transaction['duty_free'])
 
         # Load pricing info into the context
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_instance(Offering, contract.offering)
         context = {
             'basedir': settings.BASEDIR,
             'offering_name': offering.name,
@@ -252,23 +312,9 @@ class InvoiceBuilder(object):
         # Render the invoice template
         bill_code = bill_template.render(Context(context))
 
-        # Create the bill code file
-        invoice_id = str(self._order.pk) + '_' + contract.item_id + '_' + date
-        raw_invoice_path = os.path.join(settings.BILL_ROOT, invoice_id + '.html')
-
-        f = codecs.open(raw_invoice_path, 'wb', 'utf-8')
-        f.write(bill_code)
-        f.close()
-
-        invoice_path, invoice_name = self._avoid_existing_name(invoice_id, 0)
-
-        # Compile the bill file
-        subprocess.call([settings.BASEDIR + '/create_invoice.sh', raw_invoice_path, invoice_path])
+        if invoice_url is None:
+            invoice_url = self.reserve_invoice(contract)
 
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
+        self._convert_invoice(bill_code, os.path.join(settings.BILL_ROOT, invoice_url.split('/')[-1]))
 
-            if not file_.endswith('.pdf'):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
-
-        return os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name)
+        return invoice_url
@@ -19,18 +19,37 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from pymongo import ASCENDING
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from wstore.ordering.models import Order
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.store_commons.database import get_database_connection
+
+
+CHECKPOINT_ID = 'pending_charges_daemon'
 
 
 class Command(BaseCommand):
 
+    help = 'Notifies customers about pending recurring and usage payments and suspends expired products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.PENDING_CHARGES_WORKERS,
+                            help='Number of orders processed concurrently')
+        parser.add_argument('--page-size', type=int, default=settings.PENDING_CHARGES_PAGE_SIZE,
+                            help='Number of orders loaded per page')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the progress saved by a previous unfinished execution')
+        parser.add_argument('--full', action='store_true',
+                            help='Check all the orders instead of only the ones with contracts about to expire')
+
     def _check_renovation_date(self, renovation_date, order, contract):
         now = datetime.utcnow()
 
@@ -63,35 +82,82 @@ class Command(BaseCommand):
     def _process_usage_item(self, order, contract):
         try:
             # Search last usage charge
-            last_charge = None
-            for charge in reversed(contract.charges):
-                if charge.concept == 'usage':
-                    last_charge = charge.date
-                    break
+            last_charge = contract.get_last_charge('usage')
 
             # No use charge has been applied yet
-            if last_charge is None:
-                last_charge = order.date
+            last_charge = last_charge.date if last_charge is not None else order.date
 
             # Usage payments are renovated every 30 days
             self._check_renovation_date(last_charge + timedelta(days=30), order, contract)
         except:
             pass
 
+    def _process_order(self, order):
+        for contract in order.get_contracts():
+            if contract.terminated:
+                continue
+
+            # Skip contracts that are not due within the checked window
+            if not self._full and (contract.next_due is None or contract.next_due > self._limit):
+                continue
+
+            if 'pay_per_use' in contract.pricing_model:
+                self._process_usage_item(order, contract)
+
+            if 'subscription' in contract.pricing_model:
+                # Validate renovation date
+                for item in contract.pricing_model['subscription']:
+                    self._process_subscription_item(order, contract, item)
+
+    def _get_page(self, last_id, page_size):
+        query = {} if self._full else {'contracts.next_due': {'$lte': self._limit}}
+
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+
+        return [order['_id'] for order in self._db.wstore_order.find(query, {'_id': 1}).sort('_id', ASCENDING).limit(page_size)]
+
+    def _load_checkpoint(self, restart):
+        if restart:
+            self._db.wstore_checkpoint.delete_one({'_id': CHECKPOINT_ID})
+            return None
+
+        checkpoint = self._db.wstore_checkpoint.find_one({'_id': CHECKPOINT_ID})
+        return checkpoint['last_id'] if checkpoint is not None else None
+
+    def _save_checkpoint(self, last_id):
+        self._db.wstore_checkpoint.update_one({'_id': CHECKPOINT_ID}, {
+            '$set': {
+                'last_id': last_id,
+                'updated': datetime.utcnow()
+            }
+        }, upsert=True)
+
     def handle(self, *args, **options):
         """
         Periodic task in charge of checking recurring and usage payments dates
         in order to notify customers and suspend services if needed
         :return:
         """
+        self._full = options.get('full', False)
+        self._limit = datetime.utcnow() + timedelta(days=7)
+        self._db = get_database_connection()
+
+        page_size = options.get('page_size', settings.PENDING_CHARGES_PAGE_SIZE)
+
+        # Resume from the last processed order if the previous execution did not finish
+        last_id = self._load_checkpoint(options.get('restart', False))
+
+        with ThreadPoolExecutor(max_workers=options.get('workers', settings.PENDING_CHARGES_WORKERS)) as executor:
+            page = self._get_page(last_id, page_size)
+
+            while len(page):
+                # Check contracts
+                list(executor.map(self._process_order, Order.objects.filter(pk__in=page)))
+
+                last_id = page[-1]
+                self._save_checkpoint(last_id)
 
-        # Check contracts
-        for order in Order.objects.all():
-            for contract in order.get_contracts():
-                if 'pay_per_use' in contract.pricing_model and not contract.terminated:
-                        self._process_usage_item(order, contract)
+                page = self._get_page(last_id, page_size)
 
-                if 'subscription' in contract.pricing_model and not contract.terminated:
-                    # Validate renovation date
-                    for item in contract.pricing_model['subscription']:
-                        self._process_subscription_item(order, contract, item)
+        self._db.wstore_checkpoint.delete_one({'_id': CHECKPOINT_ID})
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wstore.charging_engine.benchmark import compare_results, get_scale_size, run_benchmarks
+
+
+class Command(BaseCommand):
+
+    help = 'Measures the rating, CDR, and invoice generation path with synthetic SDR sets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', action='append', dest='scales',
+                            help='Number of SDRs to rate (1k, 100k, 1m, or a number), can be repeated. Default: 1k and 100k')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of times each benchmark is executed')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed used to generate the synthetic SDRs')
+        parser.add_argument('--output',
+                            help='File where the JSON results are saved')
+        parser.add_argument('--compare',
+                            help='JSON results of a previous execution used to detect regressions')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Maximum relative slowdown allowed when comparing results')
+
+    def handle(self, *args, **options):
+        scales = options['scales'] or ['1k', '100k']
+
+        try:
+            [get_scale_size(scale) for scale in scales]
+        except ValueError:
+            raise CommandError('Invalid scale, it must be 1k, 100k, 1m, or a number of SDRs')
+
+        results = run_benchmarks(scales, repeat=options['repeat'], seed=options['seed'])
+
+        regressions = []
+        if options['compare']:
+            with open(options['compare']) as f:
+                regressions = compare_results(results, json.load(f), options['threshold'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        self.stdout.write(output)
+
+        if len(regressions):
+            raise CommandError('Performance regression in: ' + ', '.join(
+                ['{} ({})'.format(result['benchmark'], result['scale']) for result in regressions]))
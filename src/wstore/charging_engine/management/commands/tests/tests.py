@@ -19,13 +19,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from datetime import datetime
+import json
+from datetime import datetime, timedelta
+from tempfile import NamedTemporaryFile
 
 from mock import MagicMock, call
 
+from django.core.management.base import CommandError
 from django.test import TestCase
 
-from wstore.charging_engine.management.commands import pending_charges_daemon
+from wstore.charging_engine import benchmark
+from wstore.charging_engine.management.commands import pending_charges_daemon, rating_benchmark
 
 
 class ChargesDaemonTestCase(TestCase):
@@ -46,13 +50,19 @@ class ChargesDaemonTestCase(TestCase):
         # Mock orders
         pending_charges_daemon.Order = MagicMock()
 
+        # Mock database
+        self._db = MagicMock()
+        self._db.wstore_checkpoint.find_one.return_value = None
+        pending_charges_daemon.get_database_connection = MagicMock(return_value=self._db)
+
         pending_charges_daemon.on_product_suspended = MagicMock()
 
-    def _build_contract(self, pricing, id_):
+    def _build_contract(self, pricing, id_, next_due):
         contract = MagicMock()
         contract.terminated = False
         contract.pricing_model = pricing
         contract.product_id = id_
+        contract.next_due = next_due
         return contract
 
     def _build_subscription_contract(self, date, id_):
@@ -60,24 +70,25 @@ class ChargesDaemonTestCase(TestCase):
             'subscription': [{
                 'renovation_date': date
             }]
-        }, id_)
+        }, id_, date)
 
     def _build_usage_contract(self, date, id_):
         contract = self._build_contract({
             'pay_per_use': []
-        }, id_)
-
-        charge1 = MagicMock()
-        charge1.concept = 'initial'
+        }, id_, date + timedelta(days=30))
 
-        charge2 = MagicMock()
-        charge2.concept = 'usage'
-        charge2.date = date
+        charge = MagicMock()
+        charge.concept = 'usage'
+        charge.date = date
 
-        contract.charges = [charge1, charge2, charge1]
+        contract.get_last_charge.return_value = charge
         return contract
 
-    def _test_charging_daemon(self, contracts):
+    def _mock_pages(self, pages):
+        cursor = self._db.wstore_order.find.return_value.sort.return_value
+        cursor.limit.side_effect = pages
+
+    def _test_charging_daemon(self, contracts, **options):
         # Not subscription
         contract1 = MagicMock()
         contract1.pricing_model = {
@@ -86,11 +97,13 @@ class ChargesDaemonTestCase(TestCase):
 
         order = MagicMock()
         order.get_contracts.return_value = [contract1] + contracts
-        pending_charges_daemon.Order.objects.all.return_value = [order]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+
+        self._mock_pages([[{'_id': 'order1'}], []])
 
         # Execute commands
         command = pending_charges_daemon.Command()
-        command.handle()
+        command.handle(**options)
 
         # Validate calls
         self.assertEquals([call(), call()], pending_charges_daemon.NotificationsHandler.call_args_list)
@@ -103,6 +116,17 @@ class ChargesDaemonTestCase(TestCase):
 
         pending_charges_daemon.on_product_suspended.assert_called_once_with(order, contracts[2])
 
+        pending_charges_daemon.Order.objects.filter.assert_called_once_with(pk__in=['order1'])
+
+        # Progress is saved after every page and cleared at the end
+        self._db.wstore_checkpoint.update_one.assert_called_once_with({'_id': 'pending_charges_daemon'}, {
+            '$set': {
+                'last_id': 'order1',
+                'updated': datetime(2016, 2, 8)
+            }
+        }, upsert=True)
+        self._db.wstore_checkpoint.delete_one.assert_called_once_with({'_id': 'pending_charges_daemon'})
+
     def test_subscription_renovation(self):
 
         # Not expired
@@ -129,3 +153,149 @@ class ChargesDaemonTestCase(TestCase):
 
         self._test_charging_daemon([contract1, contract2, contract3])
 
+        # Contracts not due are not processed
+        self.assertEquals(0, contract1.get_last_charge.call_count)
+        contract2.get_last_charge.assert_called_once_with('usage')
+        contract3.get_last_charge.assert_called_once_with('usage')
+
+    def test_only_due_orders_queried(self):
+        # Not expired
+        contract1 = self._build_subscription_contract(datetime(2016, 3, 1), '1')
+
+        # About to expire
+        contract2 = self._build_subscription_contract(datetime(2016, 2, 10), '2')
+
+        # Expired
+        contract3 = self._build_subscription_contract(datetime(2016, 1, 31), '3')
+
+        self._test_charging_daemon([contract1, contract2, contract3])
+
+        self.assertEquals([
+            call({'contracts.next_due': {'$lte': datetime(2016, 2, 15)}}, {'_id': 1}),
+            call({'contracts.next_due': {'$lte': datetime(2016, 2, 15)}, '_id': {'$gt': 'order1'}}, {'_id': 1})
+        ], self._db.wstore_order.find.call_args_list)
+
+    def test_full_scan(self):
+        # Not expired, not checked in incremental executions
+        contract1 = self._build_subscription_contract(datetime(2016, 3, 1), '1')
+        contract1.next_due = None
+
+        contract2 = self._build_subscription_contract(datetime(2016, 2, 10), '2')
+        contract3 = self._build_subscription_contract(datetime(2016, 1, 31), '3')
+
+        self._test_charging_daemon([contract1, contract2, contract3], full=True)
+
+        self.assertEquals([
+            call({}, {'_id': 1}),
+            call({'_id': {'$gt': 'order1'}}, {'_id': 1})
+        ], self._db.wstore_order.find.call_args_list)
+
+    def test_resume_from_checkpoint(self):
+        self._db.wstore_checkpoint.find_one.return_value = {'_id': 'pending_charges_daemon', 'last_id': 'order1'}
+        self._mock_pages([[]])
+
+        command = pending_charges_daemon.Command()
+        command.handle()
+
+        self._db.wstore_order.find.assert_called_once_with({
+            'contracts.next_due': {'$lte': datetime(2016, 2, 15)},
+            '_id': {'$gt': 'order1'}
+        }, {'_id': 1})
+        self.assertEquals(0, pending_charges_daemon.Order.objects.filter.call_count)
+
+    def test_restart(self):
+        self._db.wstore_checkpoint.find_one.return_value = {'_id': 'pending_charges_daemon', 'last_id': 'order1'}
+        self._mock_pages([[]])
+
+        command = pending_charges_daemon.Command()
+        command.handle(restart=True)
+
+        self._db.wstore_order.find.assert_called_once_with({
+            'contracts.next_due': {'$lte': datetime(2016, 2, 15)}
+        }, {'_id': 1})
+
+
+class RatingBenchmarkTestCase(TestCase):
+
+    tags = ('rating-benchmark', )
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(['10'], repeat=1)
+
+        self.assertEquals([
+            'resolve_price', 'pay_per_use_preprocesing', 'parse_raw_accounting', 'parse_timestamp', 'generate_cdr',
+            'invoice_context'
+        ], [result['benchmark'] for result in results['results']])
+
+        for result in results['results']:
+            self.assertEquals('10', result['scale'])
+            self.assertEquals(10, result['sdrs'])
+            self.assertTrue(result['min'] <= result['median'])
+
+    def test_synthetic_sdrs_reproducible(self):
+        self.assertEquals(benchmark.build_accounting(100, seed=3), benchmark.build_accounting(100, seed=3))
+        self.assertEquals(1000, len(benchmark.build_usage(1000)))
+
+    def _mock_results(self, median):
+        rating_benchmark.run_benchmarks = MagicMock(return_value={
+            'commit': 'abc',
+            'results': [{'benchmark': 'resolve_price', 'scale': '1k', 'sdrs': 1000, 'median': median}]
+        })
+
+    def test_benchmark_command(self):
+        self._mock_results(0.1)
+
+        command = rating_benchmark.Command()
+        command.stdout = MagicMock()
+        command.handle(scales=None, repeat=3, seed=0, output=None, compare=None, threshold=0.1)
+
+        rating_benchmark.run_benchmarks.assert_called_once_with(['1k', '100k'], repeat=3, seed=0)
+        self.assertEquals('abc', json.loads(command.stdout.write.call_args[0][0])['commit'])
+
+    def test_compare_results(self):
+        results = {
+            'results': [
+                {'benchmark': 'resolve_price', 'scale': '1k', 'median': 0.2},
+                {'benchmark': 'generate_cdr', 'scale': '1k', 'median': 0.1},
+                {'benchmark': 'invoice_context', 'scale': '1k', 'median': 0.1}
+            ]
+        }
+        baseline = {
+            'commit': 'def',
+            'results': [
+                {'benchmark': 'resolve_price', 'scale': '1k', 'median': 0.1},
+                {'benchmark': 'generate_cdr', 'scale': '1k', 'median': 0.1}
+            ]
+        }
+
+        regressions = benchmark.compare_results(results, baseline, 0.1)
+
+        self.assertEquals([results['results'][0]], regressions)
+        self.assertEquals(1.0, results['results'][0]['change'])
+        self.assertEquals(0.0, results['results'][1]['change'])
+        self.assertFalse('change' in results['results'][2])
+        self.assertEquals('def', results['baseline_commit'])
+
+    def test_benchmark_regression(self):
+        self._mock_results(0.2)
+
+        command = rating_benchmark.Command()
+        command.stdout = MagicMock()
+
+        with NamedTemporaryFile('w', suffix='.json') as baseline:
+            json.dump({
+                'commit': 'def',
+                'results': [{'benchmark': 'resolve_price', 'scale': '1k', 'sdrs': 1000, 'median': 0.1}]
+            }, baseline)
+            baseline.flush()
+
+            with self.assertRaises(CommandError) as e:
+                command.handle(scales=['1k'], repeat=1, seed=0, output=None, compare=baseline.name, threshold=0.1)
+
+        self.assertEquals('Performance regression in: resolve_price (1k)', str(e.exception))
+
+    def test_benchmark_invalid_scale(self):
+        command = rating_benchmark.Command()
+
+        with self.assertRaises(CommandError):
+            command.handle(scales=['invalid'], repeat=1, seed=0, output=None, compare=None, threshold=0.1)
@@ -28,6 +28,13 @@ class ReportsPayout(models.Model):
     reports = models.JSONField(default=[]) # List
     payout_id = models.CharField(max_length=15)
     status = models.CharField(max_length=15)
+    # Each batch includes a chunk of the payments, so failed submissions are retried by chunk
+    sender_batch_id = models.CharField(max_length=32, null=True)
+    items = models.JSONField(default=[]) # List
+    # Status checks of the batch, the next one is None once it is no longer tracked
+    checks = models.IntegerField(default=0)
+    next_check = models.DateTimeField(null=True)
+    task_id = models.CharField(max_length=24, null=True)
 
 
 class ReportSemiPaid(models.Model):
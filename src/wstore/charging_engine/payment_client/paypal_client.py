@@ -23,6 +23,8 @@ from decimal import Decimal
 import os
 import random
 import string
+from urllib.parse import urlparse
+
 import paypalrestsdk
 
 from django.conf import settings
@@ -33,6 +35,8 @@ from wstore.ordering.errors import PaymentError
 # Paypal credentials
 PAYPAL_CLIENT_ID = os.environ.get('BAE_CB_PAYPAL_CLIENT_ID', 'AVOLRuc4jN599UD5FMLHv07T7pnmh76zrllx60cQ-fPK39Bu4yR2iOCzNrzqou6XmAFbnuYhdMY4cExY')
 PAYPAL_CLIENT_SECRET = os.environ.get('BAE_CB_PAYPAL_CLIENT_SECRET', 'EAgeaOxAgJ5ZMMu9Tf4riICdT7Sz2y77PRBwUIYppNlf_xw2Q0WD1_jCG4YzSLNxQFevkNnFovtT02u7')
+# ID of the webhook registered in PayPal, notifications are rejected if not provided
+PAYPAL_WEBHOOK_ID = os.environ.get('BAE_CB_PAYPAL_WEBHOOK_ID')
 
 MODE = 'sandbox'  # sandbox or live
 
@@ -152,8 +156,11 @@ class PayPalClient(PaymentClient):
     def get_checkout_url(self):
         return self._checkout_url
 
-    def batch_payout(self, payouts):
-        sender_batch_id = ''.join(random.choice(string.ascii_uppercase) for i in range(12))
+    def batch_payout(self, payouts, sender_batch_id=None):
+        # PayPal rejects repeated sender batch IDs, so retrying with the same one does not duplicate payments
+        if sender_batch_id is None:
+            sender_batch_id = ''.join(random.choice(string.ascii_uppercase) for i in range(12))
+
         payout = paypalrestsdk.Payout({
             "sender_batch_header": {
                 "sender_batch_id": sender_batch_id,
@@ -164,3 +171,51 @@ class PayPalClient(PaymentClient):
 
         return payout, payout.create()
 
+    def get_existing_batch(self, payout):
+        """
+        Checks if a payout batch has been rejected because its sender batch ID was already used, which
+        happens when a submission accepted by PayPal is repeated, e.g. after a timeout
+        :param payout: Payout rejected by PayPal
+        :return: Tuple with True if the batch already exists, and the ID of the existing batch if provided
+        """
+        error = payout.error or {}
+        duplicated = any([
+            str(detail.get('field', '')).lower().endswith('sender_batch_id') for detail in error.get('details', [])
+        ])
+
+        if not duplicated:
+            return False, None
+
+        # The existing batch is referenced in the links of the error
+        for link in error.get('links', []):
+            if '/payments/payouts/' in link.get('href', ''):
+                return True, link['href'].rstrip('/').split('/')[-1]
+
+        return True, None
+
+    def verify_webhook(self, headers, body):
+        """
+        Verifies that a webhook notification has been signed by PayPal for the registered webhook
+        :param headers: Headers of the notification request
+        :param body: Raw body of the notification
+        :return: True if the signature is valid
+        """
+        if not PAYPAL_WEBHOOK_ID:
+            return False
+
+        # The signing certificate is downloaded, so only PayPal hosts are accepted
+        cert_url = urlparse(headers.get('PAYPAL-CERT-URL', ''))
+        if cert_url.scheme != 'https' or not (cert_url.hostname or '').endswith('.paypal.com'):
+            return False
+
+        try:
+            return paypalrestsdk.WebhookEvent.verify(
+                headers.get('PAYPAL-TRANSMISSION-ID'),
+                headers.get('PAYPAL-TRANSMISSION-TIME'),
+                PAYPAL_WEBHOOK_ID,
+                body,
+                cert_url.geturl(),
+                headers.get('PAYPAL-TRANSMISSION-SIG'),
+                headers.get('PAYPAL-AUTH-ALGO', 'sha256'))
+        except Exception:
+            return False
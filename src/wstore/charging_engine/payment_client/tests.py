@@ -23,6 +23,7 @@ import mock
 from mock import MagicMock
 
 from django.test import TestCase
+from parameterized import parameterized
 
 from wstore.charging_engine.payment_client import paypal_client
 
@@ -46,3 +47,69 @@ class PaypalTestCase(TestCase):
         })
 
         paypal_client.paypalrestsdk.Payout().create.assert_called_once_with()
+
+    def test_paypal_sender_batch_id(self):
+        paypal = paypal_client.PayPalClient(None)
+        paypal.batch_payout(['item1'], sender_batch_id='BATCHID')
+        paypal_client.paypalrestsdk.Payout.assert_called_once_with({
+            'sender_batch_header': {
+                'sender_batch_id': 'BATCHID',
+                'email_subject': "You have a payment"
+            },
+            'items': ['item1']
+        })
+
+    @parameterized.expand([
+        ('duplicated', {
+            'name': 'USER_BUSINESS_ERROR',
+            'details': [{'field': 'sender_batch_header.sender_batch_id', 'issue': 'Batch already exists'}],
+            'links': [{'href': 'https://api.sandbox.paypal.com/v1/payments/payouts/PAYOUTID', 'rel': 'self'}]
+        }, (True, 'PAYOUTID')),
+        ('duplicated_no_link', {
+            'name': 'USER_BUSINESS_ERROR',
+            'details': [{'field': 'SENDER_BATCH_ID', 'issue': 'Batch already exists'}]
+        }, (True, None)),
+        ('other_error', {
+            'name': 'VALIDATION_ERROR',
+            'details': [{'field': 'items[0].receiver', 'issue': 'Invalid receiver'}]
+        }, (False, None)),
+        ('no_error', None, (False, None))
+    ])
+    def test_get_existing_batch(self, name, error, expected):
+        paypal = paypal_client.PayPalClient(None)
+        self.assertEquals(expected, paypal.get_existing_batch(MagicMock(error=error)))
+
+    def _verify_webhook(self, cert_url='https://api.sandbox.paypal.com/v1/notifications/certs/CERT'):
+        headers = {
+            'PAYPAL-TRANSMISSION-ID': 'transmission',
+            'PAYPAL-TRANSMISSION-TIME': '2023-06-01T10:00:00Z',
+            'PAYPAL-CERT-URL': cert_url,
+            'PAYPAL-TRANSMISSION-SIG': 'signature',
+            'PAYPAL-AUTH-ALGO': 'SHA256withRSA'
+        }
+        return paypal_client.PayPalClient(None).verify_webhook(headers, '{"resource": {}}')
+
+    @mock.patch.object(paypal_client, 'PAYPAL_WEBHOOK_ID', 'webhook')
+    def test_verify_webhook(self):
+        paypal_client.paypalrestsdk.WebhookEvent.verify.return_value = True
+
+        self.assertTrue(self._verify_webhook())
+        paypal_client.paypalrestsdk.WebhookEvent.verify.assert_called_once_with(
+            'transmission', '2023-06-01T10:00:00Z', 'webhook', '{"resource": {}}',
+            'https://api.sandbox.paypal.com/v1/notifications/certs/CERT', 'signature', 'SHA256withRSA')
+
+    @parameterized.expand([
+        ('no_webhook', None, 'https://api.paypal.com/cert', True),
+        ('invalid_signature', 'webhook', 'https://api.paypal.com/cert', False),
+        ('http_cert', 'webhook', 'http://api.paypal.com/cert', True),
+        ('external_cert', 'webhook', 'https://api.paypal.com.example.org/cert', True),
+        ('error', 'webhook', 'https://api.paypal.com/cert', Exception('Certificate error'))
+    ])
+    def test_verify_webhook_invalid(self, name, webhook_id, cert_url, verified):
+        if isinstance(verified, Exception):
+            paypal_client.paypalrestsdk.WebhookEvent.verify.side_effect = verified
+        else:
+            paypal_client.paypalrestsdk.WebhookEvent.verify.return_value = verified
+
+        with mock.patch.object(paypal_client, 'PAYPAL_WEBHOOK_ID', webhook_id):
+            self.assertFalse(self._verify_webhook(cert_url))
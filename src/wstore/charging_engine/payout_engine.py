@@ -20,32 +20,98 @@
 
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from decimal import Decimal
-import time
-import threading
+import uuid
 
+from bson import ObjectId
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from paypalrestsdk import Payout
+from paypalrestsdk.exceptions import ConnectionError as PayPalConnectionError
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from requests.exceptions import RequestException
 
 from wstore.models import User, Context
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.charging_engine.models import ReportsPayout, ReportSemiPaid
 from wstore.charging_engine.payment_client.paypal_client import PayPalClient
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.cache import TTLCache
+from wstore.store_commons.concurrency import process_local
+from wstore.store_commons.database import DocumentLock, get_database_connection
+from wstore.store_commons.http_session import get_session
+from wstore.store_commons.scheduler import reschedule_task, schedule_task
 from wstore.ordering.errors import PayoutError
 
-import requests
 
+# Status of the payout batches that are still being processed by PayPal
+PENDING_PAYOUT_STATUSES = ('NEW', 'PENDING', 'PROCESSING')
 
-class PayoutWatcher(threading.Thread):
+# Status of the payout batches whose submission to PayPal has failed
+UNSUBMITTED = 'UNSUBMITTED'
 
-    def __init__(self, payouts, reports):
-        super().__init__()
-        self.payouts = payouts
+# Status of the payout batches created in PayPal whose ID is unknown, they must be reviewed manually
+UNTRACKED = 'UNTRACKED'
+
+# Errors checking a payout batch that may not happen again in the next check
+TRANSIENT_PAYOUT_ERRORS = (PayPalConnectionError, RequestException, ConnectionError)
+
+
+@process_local
+def _get_emails_cache():
+    return TTLCache(settings.USER_EMAIL_CACHE_SIZE, settings.USER_EMAIL_CACHE_TTL)
+
+
+def resolve_emails(usernames):
+    """
+    Gets the emails of a set of users using a single query, emails are cached for a short time
+    :param usernames: Iterable with the usernames
+    :return: Dict with the email of each username
+    """
+    cache = _get_emails_cache()
+    emails = {}
+    missing = []
+
+    for username in set(usernames):
+        email = cache.get(username)
+
+        if email is None:
+            missing.append(username)
+        else:
+            emails[username] = email
+
+    if len(missing):
+        for user in User.objects.filter(username__in=sorted(missing)):
+            emails[user.username] = user.email
+            cache.set(user.username, user.email)
+
+    not_found = [username for username in missing if username not in emails]
+    if len(not_found):
+        raise ObjectDoesNotExist('The users {} do not exist'.format(', '.join(sorted(not_found))))
+
+    return emails
+
+
+def _get_report_users(report):
+    return [report['ownerProviderId']] + [stake['stakeholderId'] for stake in report.get('stakeholders', [])]
+
+
+def _get_item_report(item):
+    return int(item['payout_item']['sender_item_id'].split('_')[0])
+
+
+class PayoutWatcher(object):
+
+    def __init__(self, reports):
         self.reports = reports
         self.notifications = NotificationsHandler()
 
+        # The first report is used if an ID is repeated
+        self._reports_by_id = {}
+        for report in reports:
+            self._reports_by_id.setdefault(report.get('id'), report)
+
     def _mark_as_paid(self, report, paid=True):
         headers = {
             'content-type': 'application/json',
@@ -67,7 +133,7 @@ class PayoutWatcher(threading.Thread):
 
         url += 'rss/settlement/reports/{}'.format(report)
 
-        response = requests.patch(url, json=data, headers=headers)
+        response = get_session(url).patch(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print("Error mark as paid report {}: {}".format(report, response.reason))
@@ -75,40 +141,22 @@ class PayoutWatcher(threading.Thread):
 
         return response.json()
 
-    def _update_status(self, payout):
-        rpayout = ReportsPayout.objects.get(payout_id=payout['batch_header']['payout_batch_id'])
-        rpayout.status = payout['batch_header']['batch_status']
-        rpayout.save()
-
-    def _safe_get_semi_paid(self, report_id):
-        try:
-            report = ReportSemiPaid.objects.get(report=report_id)
-            return report
-        except ObjectDoesNotExist:
-            r = ReportSemiPaid(report=report_id)
-            r.save()
-            return r
-
-    def _safe_get_semi_paid_from_item(self, item):
-        sender_id = item['payout_item']['sender_item_id']
-        report_id = sender_id.split('_')[0]
-        return self._safe_get_semi_paid(report_id)
-
-    def _analyze_item(self, item):
+    def _analyze_item(self, item, outcomes, recorded=()):
+        """
+        Records the outcome of a payout item, the last outcome of each receiver in a report is kept
+        :param outcomes: Dict with the error, or None if paid, of each receiver per report
+        :param recorded: IDs of the failed items already recorded, whose receivers have been notified
+        :return: True if the item has been paid
+        """
         status = item['transaction_status']
-        semipaid = self._safe_get_semi_paid_from_item(item)
         pitem = item['payout_item']
         mail = pitem['receiver']
+        report_id = _get_item_report(item)
 
         if status != 'SUCCESS':
             errors = item['errors']
 
-            if mail not in semipaid.failed:
-                semipaid.failed.append(mail)
-            if mail in semipaid.success:
-                semipaid.success.remove(mail)
-
-            semipaid.errors[mail.replace(".", "(dot)")] = {
+            outcomes[report_id][mail] = {
                 'error_message': errors['message'],
                 'error_name': errors['name'],
                 'item_id': item['payout_item_id'],
@@ -116,82 +164,222 @@ class PayoutWatcher(threading.Thread):
                 'transaction_status': status,
                 'transaction_id': item['transaction_id']
             }
-            semipaid.save()
 
             try:
                 # Only send the notification if it's an user error (DENIED and FAILED?)
-                if status in ['DENIED', 'PENDING', 'UNCLAIMED', 'RETURNED', 'ONHOLD', 'BLOCKED', 'FAILED']:
+                if status in ['DENIED', 'PENDING', 'UNCLAIMED', 'RETURNED', 'ONHOLD', 'BLOCKED', 'FAILED'] and \
+                        item['payout_item_id'] not in recorded:
                     self.notifications.send_payout_error(mail, errors['message'])
             except:
                 pass
 
             return False
 
-        if mail in semipaid.failed:
-            semipaid.failed.remove(mail)
-        if semipaid.errors.get(mail.replace(".", "(dot)")) is not None:
-            del semipaid.errors[mail.replace(".", "(dot)")]
-        if mail not in semipaid.success:
-            semipaid.success.append(mail)
-        semipaid.save()
-
+        outcomes[report_id][mail] = None
         return True
 
+    def _save_outcomes(self, outcomes):
+        """
+        Updates the semi paid reports with the outcomes of the payout items using a single bulk write
+        """
+        operations = []
+        for report_id, mails in outcomes.items():
+            success = [mail for mail, error in mails.items() if error is None]
+            failed = [mail for mail, error in mails.items() if error is not None]
+
+            update = {
+                '$addToSet': {
+                    'success': {'$each': success},
+                    'failed': {'$each': failed}
+                }
+            }
+
+            if len(failed):
+                update['$set'] = {'errors.' + mail.replace(".", "(dot)"): mails[mail] for mail in failed}
+
+            if len(success):
+                update['$unset'] = {'errors.' + mail.replace(".", "(dot)"): '' for mail in success}
+
+            # The same field cannot be added to and pulled from in a single update
+            operations.extend([
+                UpdateOne({'report': report_id}, {'$setOnInsert': {'failed': [], 'success': [], 'errors': {}}}, upsert=True),
+                UpdateOne({'report': report_id}, {'$pull': {'success': {'$in': failed}, 'failed': {'$in': success}}}),
+                UpdateOne({'report': report_id}, update)
+            ])
+
+        if len(operations):
+            get_database_connection().wstore_reportsemipaid.bulk_write(operations)
+
+    def _get_recorded_items(self, payout):
+        """
+        Gets the IDs of the failed items of a payout batch already recorded in the semi paid reports
+        """
+        reports_id = {_get_item_report(item) for item in payout['items']}
+        semipaids = get_database_connection().wstore_reportsemipaid.find(
+            {'report': {'$in': sorted(reports_id)}}, {'errors': 1})
+
+        return {error.get('item_id') for semipaid in semipaids for error in semipaid.get('errors', {}).values()}
+
     def _check_reports_payout(self, payout):
-        reports_id = {item['payout_item']['sender_item_id'].split('_')[0] for item in payout['items']}
-        for report_id in reports_id:
-            filtered = list(filter(lambda x: x.get('id') == int(report_id), self.reports))
-            if len(filtered) == 0:
-                continue
+        reports_id = {_get_item_report(item) for item in payout['items']}
+        reports = {report_id: self._reports_by_id[report_id] for report_id in reports_id if report_id in self._reports_by_id}
+
+        if not len(reports):
+            return
+
+        emails = resolve_emails([username for report in reports.values() for username in _get_report_users(report)])
+
+        collection = get_database_connection().wstore_reportsemipaid
+        semipaids = {semipaid['report']: semipaid for semipaid in collection.find({'report': {'$in': sorted(reports)}})}
 
-            report = filtered[0]
-            reportmails = [User.objects.get(username=report['ownerProviderId']).email]
-            reportmails.extend([User.objects.get(username=stake['stakeholderId']).email for stake in report.get('stakeholders', [])])
+        operations = []
+        for report_id, report in sorted(reports.items()):
+            reportmails = [emails[username] for username in _get_report_users(report)]
 
-            semipaid = self._safe_get_semi_paid(report_id)
-            semipaid.failed = [x for x in semipaid.failed if x in reportmails]  # Clean mails not in report
-            if len(semipaid.failed) == 0 and all([mail in semipaid.success for mail in reportmails]):
+            semipaid = semipaids.get(report_id, {})
+            failed = [x for x in semipaid.get('failed', []) if x in reportmails]  # Clean mails not in report
+            if len(failed) == 0 and all([mail in semipaid.get('success', []) for mail in reportmails]):
                 # Mark as paid in remote
-                self._mark_as_paid(report_id)
+                self._mark_as_paid(str(report_id))
                 # Remove semipaid
-                semipaid.delete()
+                operations.append(DeleteOne({'report': report_id}))
             else:
-                semipaid.save()
+                operations.append(UpdateOne({'report': report_id}, {'$pull': {'failed': {'$nin': reportmails}}}))
+
+        collection.bulk_write(operations)
 
     def _payout_success(self, payout):
+        # The batch may be processed again if a check fails, so receivers are only notified once
+        recorded = self._get_recorded_items(payout)
+
+        outcomes = defaultdict(dict)
         for item in payout['items']:
-            self._analyze_item(item)
+            self._analyze_item(item, outcomes, recorded)
+
+        self._save_outcomes(outcomes)
         self._check_reports_payout(payout)
 
-    def _check_payout(self, payout):
-        try:
-            pay = Payout.find(payout['batch_header']['payout_batch_id'])
-            status = pay['batch_header']['batch_status']
-            self._update_status(pay)
-            if status == 'DENIED':
-                return False
-            if status == 'SUCCESS':
-                self._payout_success(pay)
-                return False
-            if pay['batch_header']['batch_status'] in ['PENDING', 'PROCESSING']:
-                return True
-            return False
-        except Exception:
-            return False
+    def _check_payout(self, rpayout):
+        """
+        Retrieves the status of a payout batch from PayPal, processing its items once completed
+        :param rpayout: ReportsPayout model of the batch, its status is updated but not saved
+        :return: True if the batch is still pending
+        """
+        pay = Payout.find(rpayout.payout_id)
+        status = pay['batch_header']['batch_status']
+        rpayout.status = status
+
+        if status == 'SUCCESS':
+            self._payout_success(pay)
+
+        return status in PENDING_PAYOUT_STATUSES
+
+
+def _schedule_payout_check(rpayout, delay):
+    # The task receives its own ID, so checks superseded by a newer one are discarded
+    task_id = str(ObjectId())
+    rpayout.next_check = datetime.utcnow() + timedelta(seconds=delay)
+    rpayout.task_id = task_id
+    rpayout.save()
+
+    schedule_task(
+        'wstore.charging_engine.payout_engine.check_payout', delay,
+        task_id=task_id, payout_id=rpayout.payout_id, check_id=task_id)
+
+
+def _update_tracked_payout(payout_id, check_id, update):
+    """
+    Updates the tracking of a payout batch only if the given check is still the current one
+    :return: The updated tracking document, None if the check has been superseded
+    """
+    return get_database_connection().wstore_reportspayout.find_one_and_update(
+        {'payout_id': payout_id, 'task_id': check_id}, update, return_document=ReturnDocument.AFTER)
+
+
+def _get_tracked_payout(payout_id):
+    rpayouts = ReportsPayout.objects.filter(payout_id=payout_id)
+
+    # Payouts whose tracking has finished do not have a next check
+    if not len(rpayouts) or rpayouts[0].next_check is None:
+        return None
+
+    return rpayouts[0]
+
+
+def check_payout(payout_id, check_id):
+    """
+    Scheduled task that checks the status of a payout batch. While the batch is pending the check is
+    rescheduled with exponential backoff, so long running batches do not overload the PayPal API
+    """
+    rpayout = _get_tracked_payout(payout_id)
+
+    # Only the current check of the batch is executed, so a single chain of checks is running
+    if rpayout is None or rpayout.task_id != check_id:
+        return
+
+    try:
+        pending = PayoutWatcher(rpayout.reports)._check_payout(rpayout)
+    except TRANSIENT_PAYOUT_ERRORS as e:
+        # PayPal and connection errors do not stop the tracking, the batch is checked again later
+        print("Error checking payout {}: {}".format(payout_id, e))  # Log
+        pending = True
+    except Exception as e:
+        # Other errors would happen again in every check, so the batch is no longer tracked
+        print("Error processing payout {}: {}".format(payout_id, e))  # Log
+        pending = False
+
+    if not pending:
+        _update_tracked_payout(payout_id, check_id, {
+            '$set': {'status': rpayout.status, 'next_check': None, 'task_id': None}
+        })
+        return
+
+    # The counter is incremented atomically, so a backoff restarted meanwhile is preserved
+    task_id = str(ObjectId())
+    tracking = _update_tracked_payout(payout_id, check_id, {
+        '$set': {'status': rpayout.status, 'task_id': task_id},
+        '$inc': {'checks': 1}
+    })
+
+    if tracking is None:
+        return
+
+    if tracking['checks'] >= settings.PAYOUT_MAX_CHECKS:
+        print("Payout {} still pending after {} checks, it is no longer tracked".format(payout_id, tracking['checks']))  # Log
+        _update_tracked_payout(payout_id, task_id, {'$set': {'next_check': None, 'task_id': None}})
+        return
+
+    delay = min(settings.PAYOUT_POLL_INTERVAL * 2 ** tracking['checks'], settings.PAYOUT_POLL_MAX_INTERVAL)
+    _update_tracked_payout(payout_id, task_id, {
+        '$set': {'next_check': datetime.utcnow() + timedelta(seconds=delay)}
+    })
+
+    schedule_task(
+        'wstore.charging_engine.payout_engine.check_payout', delay,
+        task_id=task_id, payout_id=payout_id, check_id=task_id)
+
+
+def notify_payout(payout_id):
+    """
+    Checks a payout batch as soon as PayPal notifies a change on it. The content of the
+    notification is not trusted, the status of the batch is retrieved from PayPal
+    :return: True if the batch is being tracked
+    """
+    rpayout = _get_tracked_payout(payout_id)
+
+    if rpayout is None:
+        return False
+
+    # Checks due soon are not modified, so repeated notifications do not restart the backoff
+    now = datetime.utcnow()
+    if rpayout.next_check <= now + timedelta(seconds=settings.PAYOUT_POLL_INTERVAL):
+        return True
 
-    def _check_payouts(self):
-        new = []
-        for payout in self.payouts:
-            pending = self._check_payout(payout)
-            if pending:
-                # Still pending or processing
-                new.append(payout)
-        self.payouts = new
+    # The batch is progressing, so the backoff is restarted and the current check moved forward
+    if _update_tracked_payout(payout_id, rpayout.task_id, {'$set': {'checks': 0, 'next_check': now}}) is not None:
+        reschedule_task(rpayout.task_id, 0)
 
-    def run(self):
-        while len(self.payouts) != 0:
-            self._check_payouts()
-            time.sleep(1)
+    return True
 
 
 class PayoutEngine(object):
@@ -221,7 +409,7 @@ class PayoutEngine(object):
 
         url += 'rss/settlement/reports'
 
-        response = requests.get(url, params=data, headers=headers)
+        response = get_session(url).get(url, params=data, headers=headers)
 
         if response.status_code != 200:
             print("Error retrieving reports: {}".format(response.reason))
@@ -229,8 +417,30 @@ class PayoutEngine(object):
 
         return response.json()
 
+    def _get_payments_in_progress(self):
+        """
+        Gets the payments included in batches that are pending to be submitted or still being processed,
+        so they are not paid again while their batches are retried or tracked
+        :return: Set with the report ID and receiver of each payment
+        """
+        rpayouts = get_database_connection().wstore_reportspayout.find({
+            '$or': [
+                {'status': {'$in': [UNSUBMITTED, UNTRACKED] + list(PENDING_PAYOUT_STATUSES)}},
+                {'next_check': {'$ne': None}}
+            ]
+        }, {'items': 1})
+
+        return {
+            (int(item['sender_item_id'].split('_')[0]), item['receiver'])
+            for rpayout in rpayouts for item in rpayout.get('items', [])
+        }
+
     def _process_reports(self, reports):
         new_reports = defaultdict(lambda: defaultdict(list))
+        emails = resolve_emails([
+            username for report in reports if not report['paid'] for username in _get_report_users(report)])
+        in_progress = self._get_payments_in_progress()
+
         # Divide by currency
         for report in reports:
             if report['paid']:
@@ -242,49 +452,39 @@ class PayoutEngine(object):
                 pass
 
             currency = report['currency']
-            usermail = User.objects.get(username=report['ownerProviderId']).email
+            usermail = emails[report['ownerProviderId']]
 
-            if semipaid is None or usermail not in semipaid.success:
+            if (semipaid is None or usermail not in semipaid.success) and (report['id'], usermail) not in in_progress:
                 new_reports[currency][usermail].append((report['ownerValue'], report['id']))
 
             for stake in report['stakeholders']:
-                stakemail = User.objects.get(username=stake['stakeholderId']).email
+                stakemail = emails[stake['stakeholderId']]
 
-                if semipaid is None or stakemail not in semipaid.success:
+                if (semipaid is None or stakemail not in semipaid.success) and \
+                        (report['id'], stakemail) not in in_progress:
                     new_reports[currency][stakemail].append((stake['modelValue'], report['id']))
 
         return new_reports
 
     def _process_payouts(self, data):
-        db = get_database_connection()
-        reference = "__payout__engine__context__lock__"
-        # Uses an atomic operation to get and set the _lock value in the purchase
-        # document
-        pre_value = db.wstore_payout.find_one_and_update(
-            {'_id': reference},
-            {'$set': {'_lock': True}}
-        )
-
-        # If no reference exists, create it
-        if pre_value is None:
-            db.wstore_payout.insert_one({'_id': reference, '_lock': False})
-            pre_value = db.wstore_payout.find_one_and_update(
-                {'_id': reference},
-                {'$set': {'_lock': True}}
-            )
-
-        # If the value of _lock before setting it to true was true, means
-        # that the time out function has acquired it previously so the
-        # view ends
-        if '_lock' in pre_value and pre_value['_lock']:
+        # The lock document is created on the first payout
+        lock = DocumentLock('wstore_payout', '__payout__engine__context__lock__', 'payout', upsert=True)
+
+        if lock.lock_document():
             raise PayoutError('There is a payout running.')
 
+        try:
+            return self._build_payments(data)
+        finally:
+            lock.unlock_document()
+
+    def _build_payments(self, data):
         payments = []
         context = Context.objects.all()[0]
         current_id = context.payouts_n
 
         for currency, users in data.items():
-            payments.append([])
+            currency_payments = []
             for user, values in users.items():
                 for value, report in values:
                     sender_id = '{}_{}'.format(report, current_id)
@@ -298,40 +498,91 @@ class PayoutEngine(object):
                         'sender_item_id': sender_id
                     }
                     current_id += 1
-                    payments[-1].append(payment)
+                    currency_payments.append(payment)
+
+            # PayPal limits the number of items of a batch, and big batches are processed slowly
+            payments.extend([currency_payments[i:i + settings.PAYOUT_BATCH_SIZE]
+                             for i in range(0, len(currency_payments), settings.PAYOUT_BATCH_SIZE)])
 
         context.payouts_n = current_id
         context.save()
 
-        # _lock is set to false
-        db.wstore_payout.find_one_and_update(
-            {'_id': reference},
-            {'$set': {'_lock': False}}
-        )
+        return payments
+
+    def submit_batch(self, rpayout):
+        """
+        Submits a payout batch to PayPal and starts tracking it
+        :param rpayout: ReportsPayout model including the items of the batch
+        :return: True if the batch has been created
+        """
+        try:
+            payout, created = self.paypal.batch_payout(rpayout.items, sender_batch_id=rpayout.sender_batch_id)
+        except Exception as e:
+            # PayPal SDK raises on server and connection errors, the batch is submitted again later
+            print("Error submitting batch id {}: {}".format(rpayout.sender_batch_id, e))  # Log
+            return False
+
+        if not created:
+            duplicated, payout_id = self.paypal.get_existing_batch(payout)
+
+            if not duplicated:
+                # Full error, not even said the semipaid because it didn't failed some transaction
+                print("Error, batch id: {}".format(rpayout.sender_batch_id))  # Log
+                return False
+
+            # A previous submission was accepted, so the existing batch is tracked instead of submitted again
+            if payout_id is None:
+                print("Error, batch id {} already submitted, it must be reviewed".format(rpayout.sender_batch_id))  # Log
+                rpayout.status = UNTRACKED
+                rpayout.save()
+                return True
+
+            rpayout.payout_id = payout_id
+            rpayout.status = 'PENDING'
+            _schedule_payout_check(rpayout, 0)
+            return True
 
-        return [self.paypal.batch_payout(paybatch) for paybatch in payments]
+        rpayout.payout_id = payout['batch_header']['payout_batch_id']
+        rpayout.status = payout['batch_header']['batch_status']
+
+        # The batch is tracked by a persistent task, so it is resumed after restarts
+        _schedule_payout_check(rpayout, settings.PAYOUT_POLL_INTERVAL)
+        return True
 
     def process_reports(self, reports):
         processed = self._process_reports(reports)
-        payouts = self._process_payouts(processed)
-        to_watch = []
+        payments = self._process_payouts(processed)
 
-        for payout, created in payouts:
-            if not created:
-                # Full error, not even said the semipaid because it didn't failed some transaction
-                print("Error, batch id: {}".format(payout['sender_batch_header']['sender_batch_id']))  # Log
-                continue
-            payout_id = payout['batch_header']['payout_batch_id']
-            status = payout['batch_header']['batch_status']
-            rpayout = ReportsPayout(reports=reports, payout_id=payout_id, status=status)
+        # Batches are saved before being submitted, so failed ones can be submitted again
+        rpayouts = []
+        for items in payments:
+            rpayout = ReportsPayout(reports=reports, sender_batch_id=uuid.uuid4().hex, items=items, status=UNSUBMITTED)
             rpayout.save()
+            rpayouts.append(rpayout)
 
-            to_watch.append(payout)
+        with ThreadPoolExecutor(max_workers=settings.PAYOUT_WORKERS) as executor:
+            created = list(executor.map(self.submit_batch, rpayouts))
 
-        if len(to_watch) > 0:
-            watcher = PayoutWatcher(to_watch, reports)
-            watcher.start()
+        for rpayout, batch_created in zip(rpayouts, created):
+            if not batch_created:
+                schedule_task(
+                    'wstore.charging_engine.payout_engine.submit_payout', settings.SCHEDULER_RETRY_DELAY,
+                    sender_batch_id=rpayout.sender_batch_id)
 
     def process_unpaid(self):
         reports = self._get_reports()
         self.process_reports(reports)
+
+
+def submit_payout(sender_batch_id):
+    """
+    Scheduled task that submits again a payout batch whose submission has failed
+    """
+    rpayouts = ReportsPayout.objects.filter(sender_batch_id=sender_batch_id)
+
+    if not len(rpayouts) or rpayouts[0].status != UNSUBMITTED:
+        return
+
+    if not PayoutEngine().submit_batch(rpayouts[0]):
+        # The task is retried by the scheduler
+        raise PayoutError('The payout batch {} could not be submitted'.format(sender_batch_id))
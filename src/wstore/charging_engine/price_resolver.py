@@ -19,6 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from collections import defaultdict
 from decimal import Decimal
 
 
@@ -30,6 +31,82 @@ class PriceResolver:
         self._applied_sdrs = []
         self._alteration_applied = False
 
+    def _index_accounting(self, accounting_info):
+        # Group the SDRs by unit, keeping their order, so each component only processes its own SDRs
+        index = defaultdict(list)
+        for sdr in accounting_info:
+            index[sdr['unit'].lower()].append(sdr)
+
+        return index
+
+    def _rate_tiers(self, component, quantity):
+        """
+           Calculates the price of the aggregated usage of a tiered
+           component with a single pass over its sorted tiers
+       """
+        price = Decimal('0')
+        duty_free = Decimal('0')
+
+        if quantity <= Decimal('0'):
+            return price, duty_free
+
+        lower = Decimal('0')
+        for tier in component['tiers']:
+            upper = Decimal(tier['up_to']) if tier['up_to'] is not None else None
+            last_tier = upper is None or quantity <= upper
+
+            if component['tier_type'] == 'tiered':
+                # Each band of units is charged at the rate of its tier
+                units = (quantity if last_tier else upper) - lower
+                price += units * Decimal(tier['value'])
+                duty_free += units * Decimal(tier['duty_free'])
+
+            elif last_tier and component['tier_type'] == 'volume':
+                # All the units are charged at the rate of the tier reached
+                price = quantity * Decimal(tier['value'])
+                duty_free = quantity * Decimal(tier['duty_free'])
+
+            elif last_tier:
+                # Block tiers charge a flat amount for the whole block
+                price = Decimal(tier['value'])
+                duty_free = Decimal(tier['duty_free'])
+
+            if last_tier:
+                break
+
+            lower = upper
+
+        return price, duty_free
+
+    def _pay_per_use_tiers(self, component, sdrs):
+        quantity = sum([Decimal(sdr['value']) for sdr in sdrs], Decimal('0'))
+        price, duty_free = self._rate_tiers(component, quantity)
+
+        # The price is split between the SDRs in proportion to its usage
+        related_accounting = []
+        remaining_price, remaining_duty_free = price, duty_free
+
+        for i, sdr in enumerate(sdrs):
+            if i == len(sdrs) - 1:
+                sdr_price, sdr_duty_free = remaining_price, remaining_duty_free
+            elif quantity > Decimal('0'):
+                sdr_price = price * Decimal(sdr['value']) / quantity
+                sdr_duty_free = duty_free * Decimal(sdr['value']) / quantity
+            else:
+                sdr_price, sdr_duty_free = Decimal('0'), Decimal('0')
+
+            remaining_price -= sdr_price
+            remaining_duty_free -= sdr_duty_free
+
+            related_accounting.append({
+                'usage_id': sdr['usage_id'],
+                'value': sdr['value'],
+                'price': str(sdr_price),
+                'duty_free': str(sdr_duty_free)
+            })
+
+        return price, duty_free, related_accounting
+
     def _pay_per_use_preprocesing(self, use_models, accounting_info):
         """
            Process pay-per-use payments and call the corresponding
@@ -39,29 +116,57 @@ class PriceResolver:
         price = Decimal('0')
         duty_free = Decimal('0')
 
+        accounting_index = self._index_accounting(accounting_info)
+
         for component in use_models:
+            sdrs = accounting_index.get(component['unit'].lower(), [])
+
+            if 'tiers' in component:
+                partial_price, partial_duty_free, related_accounting = self._pay_per_use_tiers(component, sdrs)
+
+                self._applied_sdrs.append({
+                    'model': component,
+                    'accounting': related_accounting,
+                    'price': str(partial_price),
+                    'duty_free': str(partial_duty_free)
+                })
+
+                price += partial_price
+                duty_free += partial_duty_free
+                continue
+
             related_accounting = []
 
             # Get the related accounting info
             partial_price = Decimal('0')
             partial_duty_free = Decimal('0')
 
-            for sdr in accounting_info:
-                if sdr['unit'].lower() == component['unit'].lower():
-                    sdr_info = {
-                        'usage_id': sdr['usage_id'],
-                        'value': sdr['value']
-                    }
-                    comp_price = (Decimal(sdr['value']) * Decimal(component['value']))
-                    partial_price += comp_price
-                    sdr_info['price'] = str(comp_price)
-
-                    comp_duty_free = (Decimal(sdr['value']) * Decimal(component['duty_free']))
-                    partial_duty_free += comp_duty_free
-                    sdr_info['duty_free'] = str(comp_duty_free)
-
-                    # Save the information of the SDR document which is needed for further precessing
-                    related_accounting.append(sdr_info)
+            component_value = Decimal(component['value'])
+            component_duty_free = Decimal(component['duty_free'])
+
+            # SDRs usually repeat the same values, so the price of each value is calculated once
+            rated_values = {}
+
+            for sdr in sdrs:
+                if sdr['value'] not in rated_values:
+                    value = Decimal(sdr['value'])
+                    comp_price = value * component_value
+                    comp_duty_free = value * component_duty_free
+
+                    rated_values[sdr['value']] = (comp_price, str(comp_price), comp_duty_free, str(comp_duty_free))
+
+                comp_price, str_price, comp_duty_free, str_duty_free = rated_values[sdr['value']]
+
+                partial_price += comp_price
+                partial_duty_free += comp_duty_free
+
+                # Save the information of the SDR document which is needed for further precessing
+                related_accounting.append({
+                    'usage_id': sdr['usage_id'],
+                    'value': sdr['value'],
+                    'price': str_price,
+                    'duty_free': str_duty_free
+                })
 
             # Include the applied SDRs
             self._applied_sdrs.append({
@@ -30,10 +30,12 @@ from parameterized import parameterized
 
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
 import wstore.store_commons.utils.http
-from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Payment
+from wstore.ordering.errors import OrderingError, PaymentError
+from wstore.ordering.models import Charge, Payment
+from wstore.admin.users import notification_handler
 from wstore.charging_engine import charging_engine
 from wstore.charging_engine import views
 from wstore.store_commons.utils.testing import decorator_mock
@@ -51,6 +53,7 @@ def mock_payment_client(self, module):
     module.importlib.import_module.return_value = module_mock
 
 INVOICE_PATH = '/media/invoice/invoice1.pdf'
+CHARGE_ID = '61004aba5e05acc115f022f9'
 
 
 class ChargingEngineTestCase(TestCase):
@@ -67,14 +70,16 @@ class ChargingEngineTestCase(TestCase):
         mock_payment_client(self, charging_engine)
         self._payment_inst.get_checkout_url.return_value = self._paypal_url
 
-        # Mock threading
-        charging_engine.threading = MagicMock()
+        # Mock scheduler
+        charging_engine.schedule_task = MagicMock()
 
-        self._thread = MagicMock()
-        charging_engine.threading.Timer.return_value = self._thread
+        # Mock usage rating
+        charging_engine.schedule_usage_rating = MagicMock(return_value=ObjectId('61004aba5e05acc115f022f0'))
+        charging_engine.get_pending_usage = MagicMock(return_value=set())
 
         # Mock invoice builder
         charging_engine.InvoiceBuilder = MagicMock()
+        charging_engine.InvoiceBuilder.return_value.reserve_invoice.return_value = INVOICE_PATH
         charging_engine.InvoiceBuilder.return_value.generate_invoice.return_value = INVOICE_PATH
 
         # Mock CDR Manager
@@ -94,6 +99,7 @@ class ChargingEngineTestCase(TestCase):
 
         charging_engine.BillingClient = MagicMock()
         charging_engine.Offering = MagicMock()
+        charging_engine.save_charge = MagicMock(return_value=CHARGE_ID)
 
     def _get_single_payment(self):
         return {
@@ -136,7 +142,7 @@ class ChargingEngineTestCase(TestCase):
     def _mock_contract(self, info):
         contract = MagicMock()
         contract.item_id = info['item_id']
-        contract.charges = []
+        contract.get_last_charge.return_value = None
         contract.pricing_model = info['pricing']
         contract.product_id = info['product_id']
         contract.offering = info['offering_pk']
@@ -293,7 +299,7 @@ class ChargingEngineTestCase(TestCase):
 
         # Mock usage client
         charging_engine.UsageClient = MagicMock()
-        charging_engine.UsageClient().get_customer_usage.return_value = [{
+        charging_engine.UsageClient().iter_customer_usage.return_value = [{
             'id': '1'
         }, {
             'id': '2'
@@ -394,7 +400,7 @@ class ChargingEngineTestCase(TestCase):
 
         # Mock usage client
         charging_engine.UsageClient = MagicMock()
-        charging_engine.UsageClient().get_customer_usage.return_value = [{
+        charging_engine.UsageClient().iter_customer_usage.return_value = [{
             'id': '1'
         }, {
             'id': '2'
@@ -755,9 +761,10 @@ class ChargingEngineTestCase(TestCase):
         self._payment_class.assert_called_once_with(self._order)
         self._payment_inst.start_redirection_payment.assert_called_once_with(transactions)
 
-        # Check timer call
-        charging_engine.threading.Timer.assert_called_once_with(300, charging._timeout_handler)
-        self._thread.start.assert_called_once_with()
+        # Check timeout scheduling
+        charging_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.charging_engine.process_payment_timeout', 300,
+            order_id=self._order.pk, concept=name)
 
         # Check payment saving
         self.assertEquals({
@@ -766,7 +773,23 @@ class ChargingEngineTestCase(TestCase):
             'concept': name
         }, self._order.pending_payment)
         self.assertEquals('pending', self._order.state)
-        self._order.save.assert_called_once_with()
+        self._order.save_changes.assert_called_once_with()
+
+    def test_usage_payment_pending_rating(self):
+        self._order.state = 'pending'
+        self._set_usage_contracts()
+
+        # The usage document 2 has been already charged, but not rated yet
+        charging_engine.get_pending_usage.return_value = {'2'}
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging.resolve_charging('usage')
+
+        charging_engine.get_pending_usage.assert_called_once_with('product1')
+        self.assertEquals([
+            call({'id': '1'}),
+            call({'id': '3'})
+        ], charging_engine.SDRManager().get_sdr_values.call_args_list)
 
     def test_renovation_error(self):
         self._order.state = 'pending'
@@ -795,13 +818,18 @@ class ChargingEngineTestCase(TestCase):
 
         # Check invoice generation calls
         charging_engine.InvoiceBuilder.assert_called_once_with(self._order)
+        self.assertEquals(charging_engine.InvoiceBuilder().reserve_invoice.call_count, 0)
         self.assertEquals(charging_engine.InvoiceBuilder().generate_invoice.call_count, 0)
         self.assertEquals(charging_engine.BillingClient().create_charge.call_count, 0)
 
+        # There are no invoices, so notifications are sent directly
+        self.assertEquals(0, charging_engine.schedule_task.call_count)
+        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
+
         # Check order status
         self.assertEquals('paid', self._order.state)
         self.assertEquals(None, self._order.pending_payment)
-        self._order.save.assert_called_once_with()
+        self._order.save_changes.assert_called_once_with()
 
     def _validate_subscription_calls(self):
 
@@ -839,29 +867,26 @@ class ChargingEngineTestCase(TestCase):
             call(transactions[1]['related_model'], '2016-01-20T13:12:39Z')
         ], charging_engine.CDRManager().generate_cdr.call_args_list)
 
-        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
-
-        self.assertEquals([
-            call(self._order, self._order.get_contracts()[0]),
-            call(self._order, self._order.get_contracts()[1]),
-            call(self._order, self._order.get_contracts()[2])
-        ], charging_engine.NotificationsHandler().send_provider_notification.call_args_list)
-
         basic_charge_call = call(
             date=datetime(2016, 1, 20, 13, 12, 39),
             cost='12.00',
             currency='EUR',
             concept='initial',
             duty_free='10.00',
-            invoice=INVOICE_PATH
+            invoice=INVOICE_PATH,
+            invoice_status='pending'
         )
 
         self.assertEquals([
             basic_charge_call, basic_charge_call
         ], charging_engine.Charge.call_args_list)
 
-        self.assertEquals([self._charge], self._order.get_contracts()[0].charges)
-        self.assertEquals([self._charge], self._order.get_contracts()[1].charges)
+        self.assertEquals([
+            call(self._order, self._order.get_contracts()[0], self._charge,
+                 details={'related_model': transactions[0]['related_model']}),
+            call(self._order, self._order.get_contracts()[1], self._charge,
+                 details={'related_model': transactions[1]['related_model']})
+        ], charging_engine.save_charge.call_args_list)
 
         self.assertEquals(0, charging_engine.BillingClient.call_count)
 
@@ -895,13 +920,17 @@ class ChargingEngineTestCase(TestCase):
                         currency='EUR',
                         concept='initial',
                         duty_free=d,
-                        invoice=INVOICE_PATH)
+                        invoice=INVOICE_PATH,
+                        invoice_status='pending')
 
         self.assertEquals([
             charge_call('20.00', '20.00'), charge_call('15.00', '15.00'), charge_call('9.00', '9.00'), charge_call('10.00', '10.00'), charge_call('9.00', '9.00')
         ], charging_engine.Charge.call_args_list)
 
-        self.assertEquals([[self._charge] for x in range(len(self._order.get_contracts()))], [x.charges for x in self._order.get_contracts()])
+        self.assertEquals([
+            call(self._order, contract, self._charge, details={'related_model': trans['related_model']})
+            for contract, trans in zip(self._order.get_contracts(), transactions)
+        ], charging_engine.save_charge.call_args_list)
 
         self.assertEquals(0, charging_engine.BillingClient.call_count)
 
@@ -919,22 +948,19 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals(0, self._order.get_contracts()[0].call_count)
         self.assertEquals(0, self._order.get_contracts()[2].call_count)
 
-        self.assertEquals([], self._order.get_contracts()[0].charges)
-
-        charging_engine.NotificationsHandler().send_renovation_notification.assert_called_once_with(self._order, transactions)
-
         charging_engine.Charge.assert_called_once_with(
             date=datetime(2016, 1, 20, 13, 12, 39),
             cost='12.00',
             currency='EUR',
             concept='recurring',
             duty_free='10.00',
-            invoice=INVOICE_PATH
+            invoice=INVOICE_PATH,
+            invoice_status='pending'
         )
 
-        self.assertEquals([self._charge], self._order.get_contracts()[1].charges)
-
-        self.assertEquals([], self._order.get_contracts()[2].charges)
+        charging_engine.save_charge.assert_called_once_with(
+            self._order, self._order.get_contracts()[1], self._charge,
+            details={'related_model': transactions[0]['related_model']})
 
         charging_engine.BillingClient.assert_called_once_with()
         charging_engine.BillingClient().create_charge.assert_called_once_with(
@@ -960,13 +986,17 @@ class ChargingEngineTestCase(TestCase):
                         currency='EUR',
                         concept='recurring',
                         duty_free=d,
-                        invoice=INVOICE_PATH)
+                        invoice=INVOICE_PATH,
+                        invoice_status='pending')
 
         self.assertEquals([
             charge_call('20.00', '20.00'), charge_call('15.00', '15.00'), charge_call('9.00', '9.00'), charge_call('10.00', '10.00'), charge_call('10.00', '10.00')
         ], charging_engine.Charge.call_args_list)
 
-        self.assertEquals([[self._charge] for x in range(len(self._order.get_contracts()))], [x.charges for x in self._order.get_contracts()])
+        self.assertEquals([
+            call(self._order, contract, self._charge, details={'related_model': trans['related_model']})
+            for contract, trans in zip(self._order.get_contracts(), transactions)
+        ], charging_engine.save_charge.call_args_list)
 
         self.assertEquals(1, charging_engine.BillingClient.call_count)
 
@@ -991,12 +1021,14 @@ class ChargingEngineTestCase(TestCase):
              validate_sub('10.00', '10.00', 1, {'type': 'discount', 'period': 'one time', 'value': {'value': '1.00', 'duty_free': '1.00'}})], [x.pricing_model for x in self._order.get_contracts()])
 
     def _validate_end_usage_payment(self, transactions):
-        self.assertEquals([
-            call('1', str(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.get_contracts()[0].product_id),
-            call('3', str(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.get_contracts()[0].product_id)
-        ],
-            charging_engine.UsageClient().rate_usage.call_args_list
-        )
+        contract = self._order.get_contracts()[0]
+
+        self.assertEquals(datetime(2016, 1, 20, 13, 12, 39), contract.last_charge)
+        charging_engine.schedule_usage_rating.assert_called_once_with(contract, transactions[0])
+
+        # The invoice is built from the rating job, so the applied accounting is not stored with the charge
+        charging_engine.save_charge.assert_called_once_with(
+            self._order, contract, self._charge, details={'rating_job': '61004aba5e05acc115f022f0'})
 
         charging_engine.BillingClient.assert_called_once_with()
         charging_engine.BillingClient().create_charge.assert_called_once_with(
@@ -1016,16 +1048,31 @@ class ChargingEngineTestCase(TestCase):
         charging = charging_engine.ChargingEngine(self._order)
         charging.end_charging(transactions, free_contracts, name)
 
-        charging_engine.NotificationsHandler.assert_called_once_with()
         validator(self, transactions)
 
+        # Invoices are reserved, and generated in background
+        self.assertEquals([call(args[1]) for args, kwargs in charging_engine.save_charge.call_args_list],
+                          charging_engine.InvoiceBuilder().reserve_invoice.call_args_list)
+        self.assertEquals(0, charging_engine.InvoiceBuilder().generate_invoice.call_count)
+
+        charging_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.charging_engine.process_invoices', 0,
+            order_id=self._order.pk, concept=name, items=[trans['item'] for trans in transactions], invoices=[{
+                'charge': CHARGE_ID,
+                'item': args[1].item_id,
+                'invoice': INVOICE_PATH
+            } for args, kwargs in charging_engine.save_charge.call_args_list])
+
+        # Notifications are sent once the invoices are generated
+        self.assertEquals(0, charging_engine.NotificationsHandler.call_count)
+
         # Validate calls
         self.assertEquals('paid', self._order.state)
 
         self.assertEquals([
             call(),
             call()
-        ], self._order.save.call_args_list)
+        ], self._order.save_changes.call_args_list)
 
     def test_invalid_concept(self):
 
@@ -1040,6 +1087,326 @@ class ChargingEngineTestCase(TestCase):
         self.assertFalse(error is None)
         self.assertEquals('Invalid charge type, must be initial, recurring, or usage', str(error))
 
+@override_settings(SCHEDULER_RETRY_DELAY=30, SCHEDULER_MAX_ATTEMPTS=5)
+class ProcessInvoicesTestCase(TestCase):
+
+    tags = ('ordering', 'invoices')
+
+    def setUp(self):
+        self._order = MagicMock()
+        self._contracts = [MagicMock(item_id='1'), MagicMock(item_id='2')]
+        self._order.get_item_contract.side_effect = lambda item_id: self._contracts[int(item_id) - 1]
+        self._order.get_contracts.return_value = self._contracts
+
+        self._old_order = charging_engine.Order
+        self._old_get_statuses = charging_engine.get_invoice_statuses
+        self._old_get_charges = charging_engine.get_charge_documents
+        self._old_get_accounting = charging_engine.get_applied_accounting
+        self._old_set_status = charging_engine.set_invoice_status
+        self._old_schedule_task = charging_engine.schedule_task
+        self._old_get_instance = notification_handler.get_instance
+
+        charging_engine.Order = MagicMock()
+        charging_engine.Order.objects.filter.return_value = [self._order]
+
+        charging_engine.get_invoice_statuses = MagicMock(return_value={
+            'charge1': 'pending',
+            'charge2': 'pending'
+        })
+        self._related_model = {
+            'single_payment': [{
+                'value': '12',
+                'unit': 'one time',
+                'tax_rate': '20.00',
+                'duty_free': '10.00'
+            }]
+        }
+        charging_engine.get_charge_documents = MagicMock(return_value={
+            'charge{}'.format(ix): {
+                '_id': 'charge{}'.format(ix),
+                'cost': '12.00',
+                'duty_free': '10.00',
+                'currency': 'EUR',
+                'details': {'related_model': self._related_model}
+            } for ix in (1, 2)
+        })
+        charging_engine.get_applied_accounting = MagicMock()
+        charging_engine.set_invoice_status = MagicMock()
+        charging_engine.schedule_task = MagicMock()
+
+        charging_engine.InvoiceBuilder = MagicMock()
+        charging_engine.NotificationsHandler = MagicMock()
+
+        self._transaction = {
+            'price': '12.00',
+            'duty_free': '10.00',
+            'currency': 'EUR',
+            'related_model': self._related_model
+        }
+        self._invoices = [{
+            'charge': 'charge1',
+            'item': '1',
+            'invoice': '/charging/media/bills/invoice1.pdf'
+        }, {
+            'charge': 'charge2',
+            'item': '2',
+            'invoice': '/charging/media/bills/invoice2.pdf'
+        }]
+
+    def tearDown(self):
+        charging_engine.Order = self._old_order
+        charging_engine.get_invoice_statuses = self._old_get_statuses
+        charging_engine.get_charge_documents = self._old_get_charges
+        charging_engine.get_applied_accounting = self._old_get_accounting
+        charging_engine.set_invoice_status = self._old_set_status
+        charging_engine.schedule_task = self._old_schedule_task
+        notification_handler.get_instance = self._old_get_instance
+
+    def _process_invoices(self, concept):
+        charging_engine.process_invoices('order', concept, ['1', '2'], self._invoices)
+
+    def test_process_invoices_initial(self):
+        self._process_invoices('initial')
+
+        # The order is loaded again before sending the notifications
+        self.assertEquals([call(pk='order'), call(pk='order')], charging_engine.Order.objects.filter.call_args_list)
+        charging_engine.InvoiceBuilder.assert_called_once_with(self._order)
+        charging_engine.get_invoice_statuses.assert_called_once_with(['charge1', 'charge2'])
+        charging_engine.get_charge_documents.assert_called_once_with(['charge1', 'charge2'])
+
+        self.assertEquals([
+            call(self._contracts[0], self._transaction, 'initial', invoice_url='/charging/media/bills/invoice1.pdf'),
+            call(self._contracts[1], self._transaction, 'initial', invoice_url='/charging/media/bills/invoice2.pdf')
+        ], charging_engine.InvoiceBuilder().generate_invoice.call_args_list)
+        self.assertEquals(0, charging_engine.get_applied_accounting.call_count)
+
+        self.assertEquals([
+            call(self._order, '1', 'charge1', 'initial', '/charging/media/bills/invoice1.pdf', 'generated'),
+            call(self._order, '2', 'charge2', 'initial', '/charging/media/bills/invoice2.pdf', 'generated')
+        ], charging_engine.set_invoice_status.call_args_list)
+
+        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
+        self.assertEquals([
+            call(self._order, self._contracts[0]),
+            call(self._order, self._contracts[1])
+        ], charging_engine.NotificationsHandler().send_provider_notification.call_args_list)
+
+    def test_process_invoices_renovation(self):
+        self._process_invoices('recurring')
+
+        self.assertEquals(2, charging_engine.InvoiceBuilder().generate_invoice.call_count)
+        charging_engine.NotificationsHandler().send_renovation_notification.assert_called_once_with(
+            self._order, [{'item': '1'}, {'item': '2'}])
+
+    def test_process_invoices_usage(self):
+        usage_charge = charging_engine.get_charge_documents.return_value['charge1']
+        usage_charge['details'] = {'rating_job': 'job1'}
+        charging_engine.get_applied_accounting.return_value = [{'model': {'unit': 'call'}, 'accounting': []}]
+
+        self._process_invoices('usage')
+
+        # The applied accounting is loaded from the rating job
+        charging_engine.get_applied_accounting.assert_called_once_with('job1')
+        self.assertEquals([
+            call(self._contracts[0], {
+                'price': '12.00',
+                'duty_free': '10.00',
+                'currency': 'EUR',
+                'related_model': {},
+                'applied_accounting': [{'model': {'unit': 'call'}, 'accounting': []}]
+            }, 'usage', invoice_url='/charging/media/bills/invoice1.pdf'),
+            call(self._contracts[1], self._transaction, 'usage', invoice_url='/charging/media/bills/invoice2.pdf')
+        ], charging_engine.InvoiceBuilder().generate_invoice.call_args_list)
+
+    @parameterized.expand([
+        ('generated', 'generated'),
+        ('failed', 'failed')
+    ])
+    def test_process_invoices_processed(self, name, status):
+        # Invoices processed in a previous execution are not generated again
+        charging_engine.get_invoice_statuses.return_value = {
+            'charge1': status,
+            'charge2': 'pending'
+        }
+        self._process_invoices('initial')
+
+        charging_engine.InvoiceBuilder().generate_invoice.assert_called_once_with(
+            self._contracts[1], self._transaction, 'initial', invoice_url='/charging/media/bills/invoice2.pdf')
+        charging_engine.set_invoice_status.assert_called_once_with(
+            self._order, '2', 'charge2', 'initial', '/charging/media/bills/invoice2.pdf', 'generated')
+
+        charging_engine.schedule_task.assert_not_called()
+        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
+
+    def test_process_invoices_error(self):
+        charging_engine.InvoiceBuilder().generate_invoice.side_effect = [Exception('Conversion error'), None]
+
+        self._process_invoices('initial')
+
+        self.assertEquals([
+            call(self._order, '1', 'charge1', 'initial', '/charging/media/bills/invoice1.pdf', 'failed'),
+            call(self._order, '2', 'charge2', 'initial', '/charging/media/bills/invoice2.pdf', 'generated')
+        ], charging_engine.set_invoice_status.call_args_list)
+
+        # The failed invoice is retried apart, and notifications are sent with the generated ones
+        charging_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.charging_engine.retry_invoices', 30, order_id=self._order.pk,
+            concept='initial', invoices=[self._invoices[0]], attempt=1)
+
+        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
+
+    def test_process_invoices_missing_charge(self):
+        del charging_engine.get_charge_documents.return_value['charge1']
+
+        self._process_invoices('initial')
+
+        charging_engine.InvoiceBuilder().generate_invoice.assert_called_once_with(
+            self._contracts[1], self._transaction, 'initial', invoice_url='/charging/media/bills/invoice2.pdf')
+        charging_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.charging_engine.retry_invoices', 30, order_id=self._order.pk,
+            concept='initial', invoices=[self._invoices[0]], attempt=1)
+
+    def test_process_invoices_error_bills(self):
+        # The failed invoice is only marked in the database, so it is known by the order loaded again
+        charges = [
+            Charge(concept='recurring', invoice='/charging/media/bills/invoice1.pdf', invoice_status='failed'),
+            Charge(concept='recurring', invoice='/charging/media/bills/invoice2.pdf', invoice_status='generated')
+        ]
+        reloaded_order = MagicMock(pk='order')
+        reloaded_order.owner_organization.managers = []
+        reloaded_order.get_item_contract.side_effect = lambda item_id: MagicMock(
+            get_last_charge=MagicMock(return_value=charges[int(item_id) - 1]))
+
+        charging_engine.Order.objects.filter.side_effect = [[self._order], [reloaded_order]]
+        charging_engine.InvoiceBuilder().generate_invoice.side_effect = [Exception('Conversion error'), None]
+
+        with override_settings(WSTOREMAIL='wstore@email.com', WSTOREMAILPASS='passwd', WSTOREMAILUSER='wstore',
+                               SMTPSERVER='smtp.email.com', SMTPPORT=587):
+            handler = notification_handler.NotificationsHandler()
+
+        handler._send_multipart_email = MagicMock()
+        offering = MagicMock(off_id='1')
+        offering.name = 'offering'
+        notification_handler.get_instance = MagicMock(return_value=offering)
+        charging_engine.NotificationsHandler = MagicMock(return_value=handler)
+
+        self._process_invoices('recurring')
+
+        # Only the generated invoice is attached
+        self.assertEquals(['media/bills/invoice2.pdf'], handler._send_multipart_email.call_args[0][3])
+
+    def _retry_invoices(self, attempt):
+        charging_engine.get_invoice_statuses.return_value = {
+            'charge1': 'failed',
+            'charge2': 'generated'
+        }
+        charging_engine.retry_invoices('order', 'initial', self._invoices, attempt)
+
+    def test_retry_invoices(self):
+        self._retry_invoices(1)
+
+        charging_engine.InvoiceBuilder().generate_invoice.assert_called_once_with(
+            self._contracts[0], self._transaction, 'initial', invoice_url='/charging/media/bills/invoice1.pdf')
+        charging_engine.set_invoice_status.assert_called_once_with(
+            self._order, '1', 'charge1', 'initial', '/charging/media/bills/invoice1.pdf', 'generated')
+
+        # Notifications have been already sent
+        charging_engine.schedule_task.assert_not_called()
+        self.assertEquals(0, charging_engine.NotificationsHandler.call_count)
+
+    def test_retry_invoices_error(self):
+        charging_engine.InvoiceBuilder().generate_invoice.side_effect = Exception('Conversion error')
+
+        self._retry_invoices(2)
+
+        charging_engine.set_invoice_status.assert_called_once_with(
+            self._order, '1', 'charge1', 'initial', '/charging/media/bills/invoice1.pdf', 'failed')
+        charging_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.charging_engine.retry_invoices', 90, order_id=self._order.pk,
+            concept='initial', invoices=[self._invoices[0]], attempt=3)
+        charging_engine.InvoiceBuilder().discard_invoice.assert_not_called()
+
+    @override_settings(SCHEDULER_MAX_ATTEMPTS=3)
+    def test_retry_invoices_last_attempt(self):
+        charging_engine.InvoiceBuilder().generate_invoice.side_effect = Exception('Conversion error')
+
+        self._retry_invoices(3)
+
+        # The reserved file is removed when the invoice cannot be generated
+        charging_engine.schedule_task.assert_not_called()
+        charging_engine.InvoiceBuilder().discard_invoice.assert_called_once_with('/charging/media/bills/invoice1.pdf')
+
+    def test_process_invoices_removed_order(self):
+        charging_engine.Order.objects.filter.return_value = []
+        self._process_invoices('initial')
+
+        self.assertEquals(0, charging_engine.InvoiceBuilder.call_count)
+        self.assertEquals(0, charging_engine.set_invoice_status.call_count)
+
+
+class PaymentTimeoutTestCase(TestCase):
+
+    tags = ('ordering', 'payment-timeout')
+
+    def setUp(self):
+        self._order = MagicMock(pk='orderPk', order_id='1')
+
+        self._old_order = charging_engine.Order
+        self._old_lock = charging_engine.DocumentLock
+        self._old_ordering_client = charging_engine.OrderingClient
+
+        charging_engine.Order = MagicMock()
+        charging_engine.Order.objects.filter.return_value = [self._order]
+        charging_engine.Order.objects.get.return_value = self._order
+
+        self._lock_inst = MagicMock()
+        self._lock_inst.lock_document.return_value = False
+        self._lock_inst.document = {'state': 'pending'}
+        charging_engine.DocumentLock = MagicMock(return_value=self._lock_inst)
+
+        charging_engine.OrderingClient = MagicMock()
+
+    def tearDown(self):
+        charging_engine.Order = self._old_order
+        charging_engine.DocumentLock = self._old_lock
+        charging_engine.OrderingClient = self._old_ordering_client
+
+    def test_payment_timeout_initial(self):
+        charging_engine.process_payment_timeout('orderPk', 'initial')
+
+        charging_engine.DocumentLock.assert_called_once_with('wstore_order', 'orderPk', 'payment')
+        charging_engine.OrderingClient().update_items_state.assert_called_once_with(
+            charging_engine.OrderingClient().get_order(), 'Failed')
+        self._order.delete.assert_called_once_with()
+        self._lock_inst.unlock_document.assert_called_once_with()
+
+    def test_payment_timeout_recurring(self):
+        charging_engine.process_payment_timeout('orderPk', 'recurring')
+
+        self.assertEquals('paid', self._order.state)
+        self.assertIsNone(self._order.pending_payment)
+        self._order.save_changes.assert_called_once_with()
+        self._lock_inst.unlock_document.assert_called_once_with()
+
+    def test_payment_timeout_confirmed(self):
+        self._lock_inst.document = {'state': 'paid'}
+
+        charging_engine.process_payment_timeout('orderPk', 'initial')
+
+        self._order.delete.assert_not_called()
+        self._lock_inst.unlock_document.assert_called_once_with()
+
+    def test_payment_timeout_locked(self):
+        # The payment is being confirmed, so the task is retried
+        self._lock_inst.lock_document.return_value = True
+
+        with self.assertRaisesMessage(PaymentError, 'The payment of the order 1 is being processed'):
+            charging_engine.process_payment_timeout('orderPk', 'initial')
+
+        self._order.delete.assert_not_called()
+        self._lock_inst.unlock_document.assert_not_called()
+
+
 BASIC_PAYPAL = {
     'reference': '111111111111111111111111',
     'payerId': 'payer',
@@ -1104,14 +1471,13 @@ class PayPalConfirmationTestCase(TestCase):
         views.OrderingClient = MagicMock()
         views.OrderingClient.return_value = self._ordering_inst
 
-        # Mock database connection
-        views.get_database_connection = MagicMock()
-        self._connection_inst = MagicMock()
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': False,
+        # Mock order lock
+        self._lock_inst = MagicMock()
+        self._lock_inst.lock_document.return_value = False
+        self._lock_inst.document = {
             'state': 'pending'
         }
-        views.get_database_connection.return_value = self._connection_inst
+        views.DocumentLock = MagicMock(return_value=self._lock_inst)
 
         # Mock Order
         views.Order = MagicMock()
@@ -1164,13 +1530,10 @@ class PayPalConfirmationTestCase(TestCase):
         views.Order.objects.filter.return_value = []
 
     def _lock_closed(self):
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': True
-        }
+        self._lock_inst.lock_document.return_value = True
 
     def _timeout(self):
-        self._connection_inst.wstore_order.find_one_and_update.return_value = {
-            '_lock': False,
+        self._lock_inst.document = {
             'state': 'paid'
         }
 
@@ -1245,12 +1608,9 @@ class PayPalConfirmationTestCase(TestCase):
         views.OrderingClient.assert_called_once_with()
 
         if not error:
-            views.get_database_connection.assert_called_once_with()
-            self.assertEquals([
-                call({'_id': ObjectId('111111111111111111111111')}, {'$set': {'_lock': True}}),
-                call({'_id': ObjectId('111111111111111111111111')}, {'$set': {'_lock': False}})],
-                self._connection_inst.wstore_order.find_one_and_update.call_args_list
-            )
+            views.DocumentLock.assert_called_once_with('wstore_order', ObjectId('111111111111111111111111'), 'payment')
+            self._lock_inst.lock_document.assert_called_once_with()
+            self._lock_inst.unlock_document.assert_called_once_with()
 
             views.Order.objects.filter.assert_called_once_with(pk=ObjectId('111111111111111111111111'))
             views.Order.objects.get.assert_called_once_with(pk=ObjectId('111111111111111111111111'))
@@ -1278,6 +1638,13 @@ class PayPalConfirmationTestCase(TestCase):
             ], self._ordering_inst.update_items_state.call_args_list)
             self._order_inst.delete.assert_called_once_with()
 
+            # The lock is released once the order has been rolled back
+            self._lock_inst.unlock_document.assert_called_once_with()
+
+        elif name == 'lock_closed':
+            # The lock held by the timeout is not released
+            self._lock_inst.unlock_document.assert_not_called()
+
 
 MISSING_FIELD_RESP = {
     'result': 'error',
@@ -1356,10 +1723,10 @@ class PayPalRefundTestCase(TestCase):
         reload(views)
 
     @parameterized.expand([
-        ([], [MagicMock(charges=[])]),
-        ([1], [MagicMock(charges=[{'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}])]),
-        ([1, 2], [MagicMock(charges=[{'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}]), MagicMock(charges=[{'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}])]),
-        ([1, 2], [MagicMock(charges=[{'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}]), MagicMock(charges=[{'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}])], True)
+        ([], [MagicMock(**{'get_last_charge.return_value': None})]),
+        ([1], [MagicMock(**{'get_last_charge.return_value': {'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}})]),
+        ([1, 2], [MagicMock(**{'get_last_charge.return_value': {'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}}), MagicMock(**{'get_last_charge.return_value': {'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}})]),
+        ([1, 2], [MagicMock(**{'get_last_charge.return_value': {'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}}), MagicMock(**{'get_last_charge.return_value': {'cost': '10', 'duty_free': '8', 'date': datetime(2016, 10, 20)}})], True)
     ])
     def test_refund_sales(self, sales_ids, contracts, refund_fail=False):
 
@@ -1392,10 +1759,12 @@ class PayPalRefundTestCase(TestCase):
             calls = [call(sale_id) for sale_id in sales_ids]
             self.assertEquals(calls, self._payment_inst.refund.call_args_list)
 
-            cdr_manager_calls = [call(self._order_inst, contract) for contract in contracts if len(contract.charges) > 0]
+            cdr_manager_calls = [call(self._order_inst, contract) for contract in contracts if contract.get_last_charge() is not None]
             self.assertEquals(cdr_manager_calls, views.CDRManager.call_args_list)
 
-            cdr_refund_calls = [call(contract.charges[0]['cost'], contract.charges[0]['duty_free'], '2016-10-20T00:00:00Z') for contract in contracts if len(contract.charges) > 0]
+            cdr_refund_calls = [
+                call(contract.get_last_charge()['cost'], contract.get_last_charge()['duty_free'], '2016-10-20T00:00:00Z')
+                for contract in contracts if contract.get_last_charge() is not None]
             self.assertEquals(cdr_refund_calls, views.CDRManager().refund_cdrs.call_args_list)
 
         else:
@@ -18,6 +18,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import tempfile
 from bson.objectid import ObjectId
 
 from mock import MagicMock
@@ -26,6 +29,7 @@ from parameterized import parameterized
 from django.test import TestCase
 
 from wstore.charging_engine import invoice_builder
+from wstore.ordering.errors import OrderingError
 
 
 TEMPLATE = '<html></html>'
@@ -319,26 +323,49 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_builder.loader.get_template.return_value = self._template
 
         invoice_builder.Context = MagicMock()
-        invoice_builder.settings.BILL_ROOT = BILL_ROOT
+
+        self._old_bill_root = invoice_builder.settings.BILL_ROOT
+        self._bill_root = tempfile.mkdtemp()
+
+        invoice_builder.settings.BILL_ROOT = self._bill_root
         invoice_builder.settings.BASEDIR = BASEDIR
         invoice_builder.settings.MEDIA_URL = MEDIA_URL
 
         invoice_builder.codecs = MagicMock()
-        self._file_handler = MagicMock()
-        invoice_builder.codecs.open.return_value = self._file_handler
+        self._file_handler = invoice_builder.codecs.open.return_value.__enter__.return_value
 
-        self._old_exists = invoice_builder.os.path.exists
-        invoice_builder.os.path.exists = MagicMock()
+        # Existing invoices of the same date
+        for ix in range(2):
+            open(os.path.join(self._bill_root, '1111_2_2016-06-06_{}.pdf'.format(ix)), 'w').close()
 
-        invoice_builder.os.path.exists.side_effect = [True, True, False]
-        invoice_builder.os.listdir = MagicMock()
-        invoice_builder.os.listdir.return_value = ['file1.pdf', 'file1.html']
-        invoice_builder.os.remove = MagicMock()
+        def _convert(args):
+            with open(args[2], 'w') as f:
+                f.write('pdf')
 
         invoice_builder.subprocess = MagicMock()
+        invoice_builder.subprocess.call.side_effect = _convert
 
     def tearDown(self):
-        invoice_builder.os.path.exists = self._old_exists
+        invoice_builder.settings.BILL_ROOT = self._old_bill_root
+        shutil.rmtree(self._bill_root)
+
+    def _validate_conversion(self, invoice_name):
+        html_path, pdf_path = invoice_builder.subprocess.call.call_args[0][0][1:]
+
+        # The invoice is converted in its own directory, which is removed afterwards
+        self.assertEquals(os.path.dirname(html_path), os.path.dirname(pdf_path))
+        self.assertEquals(self._bill_root, os.path.dirname(os.path.dirname(html_path)))
+        self.assertFalse(os.path.exists(os.path.dirname(html_path)))
+
+        invoice_builder.codecs.open.assert_called_once_with(html_path, 'wb', 'utf-8')
+        self._file_handler.write.assert_called_once_with(TEMPLATE)
+
+        invoice_builder.subprocess.call.assert_called_once_with([BASEDIR + '/create_invoice.sh', html_path, pdf_path])
+
+        with open(os.path.join(self._bill_root, invoice_name)) as f:
+            self.assertEquals('pdf', f.read())
+
+        self.assertEquals(3, len(os.listdir(self._bill_root)))
 
     @parameterized.expand([
         ('initial_one_time', 'initial', SINGLE_PAYMENT_TRANS, SINGLE_PAYMENT_CONTEXT),
@@ -365,8 +392,6 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
 
         exp_path = MEDIA_URL + 'bills/' + invoice_name
-        html_path = BILL_ROOT + '/' + invoice_name.replace('_2.pdf', '.html')
-
         self.assertEquals(exp_path, invoice_path)
 
         # Validate calls
@@ -376,15 +401,60 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_builder.Context.assert_called_once_with(exp_context)
         self._template.render.assert_called_once_with(invoice_builder.Context())
 
-        invoice_builder.codecs.open.assert_called_once_with(html_path, 'wb', 'utf-8')
-        self._file_handler.write.assert_called_once_with(TEMPLATE)
-        self._file_handler.close.assert_called_once_with()
+        self._validate_conversion(invoice_name)
+
+    def test_reserved_invoice_generation(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+
+        invoice_path = builder.reserve_invoice(self._contract)
+
+        invoice_name = '1111_2_2016-06-06_2.pdf'
+        self.assertEquals(MEDIA_URL + 'bills/' + invoice_name, invoice_path)
+
+        # The name is reserved, so it is not reused by other invoices
+        self.assertTrue(os.path.exists(os.path.join(self._bill_root, invoice_name)))
+        self.assertEquals(MEDIA_URL + 'bills/1111_2_2016-06-06_3.pdf', builder.reserve_invoice(self._contract))
+        os.remove(os.path.join(self._bill_root, '1111_2_2016-06-06_3.pdf'))
+
+        self.assertEquals(0, invoice_builder.subprocess.call.call_count)
+
+        generated_path = builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, 'initial', invoice_url=invoice_path)
+
+        self.assertEquals(invoice_path, generated_path)
+        self._validate_conversion(invoice_name)
+
+    def test_invoice_conversion_error(self):
+        invoice_builder.subprocess.call.side_effect = None
+
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        invoice_path = builder.reserve_invoice(self._contract)
+
+        error = None
+        try:
+            builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, 'initial', invoice_url=invoice_path)
+        except OrderingError as e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEquals('OrderingError: The invoice could not be converted to PDF', str(error))
+
+        # Temporal files are removed and the reserved invoice is kept
+        self.assertEquals(sorted([
+            '1111_2_2016-06-06_0.pdf',
+            '1111_2_2016-06-06_1.pdf',
+            '1111_2_2016-06-06_2.pdf'
+        ]), sorted(os.listdir(self._bill_root)))
+
+    def test_discard_invoice(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        invoice_path = builder.reserve_invoice(self._contract)
+
+        builder.discard_invoice(invoice_path)
 
-        invoice_builder.subprocess.call.assert_called_once_with([
-            BASEDIR + '/create_invoice.sh',
-            html_path,
-            BILL_ROOT + '/' + invoice_name
-        ])
+        self.assertEquals(sorted([
+            '1111_2_2016-06-06_0.pdf',
+            '1111_2_2016-06-06_1.pdf'
+        ]), sorted(os.listdir(self._bill_root)))
 
-        invoice_builder.os.listdir.assert_called_once_with(BILL_ROOT)
-        invoice_builder.os.remove.assert_called_once_with(BILL_ROOT + '/file1.html')
+        # Discarding an already removed invoice does not fail
+        builder.discard_invoice(invoice_path)
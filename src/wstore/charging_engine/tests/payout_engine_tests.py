@@ -19,12 +19,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
 
 from mock import MagicMock, call
 from parameterized import parameterized
+from paypalrestsdk.exceptions import ServerError
+from pymongo import DeleteOne, UpdateOne
+from requests.exceptions import ConnectTimeout
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -47,15 +52,13 @@ class ReportSemiPaid:
         self.save = MagicMock()
         self.delete = MagicMock()
 
-ReportsPayout = namedtuple('ReportsPayout', ['reports', 'payout_id', 'status', 'save'])
-
 
 def createMail(i):
     return "user{}@email.com".format(i)
 
 
 def createUsers(*args):
-    return [namedtuple('User', ['email'])(createMail(x)) for x in args]
+    return [namedtuple('User', ['username', 'email'])(createMail(x), createMail(x)) for x in args]
 
 
 def createReport(ids, owner=1, stakeholders=None):
@@ -68,7 +71,7 @@ def createReport(ids, owner=1, stakeholders=None):
     }
 
 
-def createItem(status, receiver='user1@email.com', itemid='report1_123', payout='itemID0', batch='batchID0', transaction='transID0'):
+def createItem(status, receiver='user1@email.com', itemid='1_123', payout='itemID0', batch='batchID0', transaction='transID0'):
     return {
         'transaction_status': status,
         'payout_item': {
@@ -105,8 +108,7 @@ def RSSUrl():
 
 def setUp():
     # Libraries
-    payout_engine.threading = MagicMock()
-    payout_engine.requests = MagicMock()
+    payout_engine.get_session = MagicMock()
     payout_engine.Payout = MagicMock()
 
     # Models
@@ -118,7 +120,16 @@ def setUp():
     # Inner library
     payout_engine.NotificationsHandler = MagicMock()
     payout_engine.PayPalClient = MagicMock()
+    payout_engine.PayPalClient().get_existing_batch.return_value = (False, None)
     payout_engine.get_database_connection = MagicMock()
+    payout_engine.DocumentLock = MagicMock()
+    payout_engine.DocumentLock().lock_document.return_value = False
+    payout_engine.schedule_task = MagicMock(return_value='taskId')
+    payout_engine.reschedule_task = MagicMock()
+    payout_engine.ObjectId = MagicMock(return_value='taskId')
+
+    # Emails are cached between calls
+    payout_engine._get_emails_cache().clear()
 
 
 class PayoutWatcherTestCase(TestCase):
@@ -129,17 +140,17 @@ class PayoutWatcherTestCase(TestCase):
         setUp()
 
     def test_mark_as_paid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 200
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        watcher = payout_engine.PayoutWatcher([])
+        payout_engine.get_session().patch().status_code = 200
+        payout_engine.get_session().patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.get_session().patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.get_session().patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -148,22 +159,22 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': settings.ADMIN_ROLE,
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_called_once_with()
+        payout_engine.get_session().patch().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
     def test_mark_as_paid_error(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 404
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        watcher = payout_engine.PayoutWatcher([])
+        payout_engine.get_session().patch().status_code = 404
+        payout_engine.get_session().patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.get_session().patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.get_session().patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -172,232 +183,183 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': settings.ADMIN_ROLE,
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_not_called()
+        payout_engine.get_session().patch().json.assert_not_called()
 
         assert result == []
 
-    def test_update_status(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout = MagicMock()
-        watcher._update_status(payout)
-
-        payout.__getitem__.assert_has_calls([call('batch_header'), call('batch_header')], any_order=True)
-        payout['batch_header'].__getitem__.assert_has_calls([call('payout_batch_id'), call('batch_status')])
-
-    def test_get_semi_paid_correct(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.ReportSemiPaid.objects.get.return_value = 'reportobject'
-
-        report = watcher._safe_get_semi_paid('report1')
-
-        payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report="report1")
-        assert report == 'reportobject'
-
-    def test_get_semi_paid_not_exist(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-
-        watcher._safe_get_semi_paid('report1')
-
-        payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report='report1')
-        payout_engine.ReportSemiPaid.assert_called_once_with(report='report1')
-        payout_engine.ReportSemiPaid().save.assert_called_once_with()
-
-    def test_get_semi_paid_from_item(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.ReportSemiPaid.objects.get.return_value = 'reportobject'
-
-        report = watcher._safe_get_semi_paid_from_item({'payout_item': {'sender_item_id': 'report1_123'}})
-
-        payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report='report1')
-        assert report == 'reportobject'
-
-    def test_get_semi_paid_from_item_not_exist(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-
-        watcher._safe_get_semi_paid_from_item({'payout_item': {'sender_item_id': 'report1_123'}})
-
-        payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report='report1')
-        payout_engine.ReportSemiPaid.assert_called_once_with(report='report1')
-        payout_engine.ReportSemiPaid().save.assert_called_once_with()
-
-    def test_analyze_item_status_error_not_notify(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        semipaid = ReportSemiPaid()
-
-        payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
-
-        item = createItem('ERROR')
-        itemr = watcher._analyze_item(item)
-
-        assert not itemr
-        assert semipaid.failed == ['user1@email.com']
-        assert semipaid.success == []
-        assert semipaid.errors.get("user1@email(dot)com") == createErrorSaved('ERROR')
-        semipaid.save.assert_called_once_with()
-        watcher.notifications.send_payout_error.assert_not_called()
+    @parameterized.expand(['ERROR', 'DENIED', 'PENDING', 'UNCLAIMED', 'RETURNED', 'ONHOLD', 'BLOCKED', 'FAILED'])
+    def test_analyze_item_status_error(self, status):
+        watcher = payout_engine.PayoutWatcher([])
+        outcomes = defaultdict(dict)
 
-    def test_analyze_item_status_error_clean_semipaid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        semipaid = ReportSemiPaid(1, ['user1@email.com', 'user2@email.com'], ['user1@email.com', 'user3@email.com'], {'user1@email(dot)com': {}})
-
-        payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
-
-        item = createItem("ERROR")
-        itemr = watcher._analyze_item(item)
+        item = createItem(status)
+        itemr = watcher._analyze_item(item, outcomes)
 
         assert not itemr
-        assert semipaid.failed == ['user1@email.com', 'user2@email.com']
-        assert semipaid.success == ['user3@email.com']
-        assert semipaid.errors.get("user1@email(dot)com") == createErrorSaved("ERROR")
-        semipaid.save.assert_called_once_with()
+        assert outcomes == {1: {'user1@email.com': createErrorSaved(status)}}
 
-    @parameterized.expand(['DENIED', 'PENDING', 'UNCLAIMED', 'RETURNED', 'ONHOLD', 'BLOCKED', 'FAILED'])
-    def test_analyze_item_status_error_notify(self, status):
-        watcher = payout_engine.PayoutWatcher([], [])
-        semipaid = ReportSemiPaid()
+        if status != 'ERROR':
+            watcher.notifications.send_payout_error.assert_called_once_with('user1@email.com', 'An error')
+        else:
+            watcher.notifications.send_payout_error.assert_not_called()
 
-        payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
+    def test_analyze_item_recorded(self):
+        watcher = payout_engine.PayoutWatcher([])
+        outcomes = defaultdict(dict)
 
-        item = createItem(status)
-        itemr = watcher._analyze_item(item)
+        itemr = watcher._analyze_item(createItem('DENIED'), outcomes, {'itemID0'})
 
+        # The outcome is recorded again, but the receiver has been already notified
         assert not itemr
-        assert semipaid.failed == ['user1@email.com']
-        assert semipaid.success == []
-        assert semipaid.errors.get("user1@email(dot)com") == createErrorSaved(status)
-        semipaid.save.assert_called_once_with()
-        watcher.notifications.send_payout_error.assert_called_once_with('user1@email.com', 'An error')
+        assert outcomes == {1: {'user1@email.com': createErrorSaved('DENIED')}}
+        watcher.notifications.send_payout_error.assert_not_called()
 
     def test_analyze_item_correct(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        semipaid = ReportSemiPaid()
-        payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
+        watcher = payout_engine.PayoutWatcher([])
+        outcomes = defaultdict(dict)
 
-        item = createItem("SUCCESS")
-        itemr = watcher._analyze_item(item)
+        # The last outcome of the receiver is kept
+        watcher._analyze_item(createItem('ERROR'), outcomes)
+        itemr = watcher._analyze_item(createItem('SUCCESS'), outcomes)
+        watcher._analyze_item(createItem('SUCCESS', 'user2@email.com', '2_124'), outcomes)
 
         assert itemr
-        assert semipaid.failed == []
-        assert semipaid.success == ['user1@email.com']
-        assert semipaid.errors.get('user1@email(dot)com') is None
-        semipaid.save.assert_called_once_with()
+        assert outcomes == {1: {'user1@email.com': None}, 2: {'user2@email.com': None}}
+
+    def test_save_outcomes(self):
+        watcher = payout_engine.PayoutWatcher([])
+
+        watcher._save_outcomes({
+            1: {'user1@email.com': None, 'user2@email.com': createErrorSaved('DENIED')},
+            2: {'user3@email.com': None}
+        })
+
+        payout_engine.get_database_connection().wstore_reportsemipaid.bulk_write.assert_called_once_with([
+            UpdateOne({'report': 1}, {'$setOnInsert': {'failed': [], 'success': [], 'errors': {}}}, upsert=True),
+            UpdateOne({'report': 1}, {'$pull': {'success': {'$in': ['user2@email.com']}, 'failed': {'$in': ['user1@email.com']}}}),
+            UpdateOne({'report': 1}, {
+                '$addToSet': {
+                    'success': {'$each': ['user1@email.com']},
+                    'failed': {'$each': ['user2@email.com']}
+                },
+                '$set': {'errors.user2@email(dot)com': createErrorSaved('DENIED')},
+                '$unset': {'errors.user1@email(dot)com': ''}
+            }),
+            UpdateOne({'report': 2}, {'$setOnInsert': {'failed': [], 'success': [], 'errors': {}}}, upsert=True),
+            UpdateOne({'report': 2}, {'$pull': {'success': {'$in': []}, 'failed': {'$in': ['user3@email.com']}}}),
+            UpdateOne({'report': 2}, {
+                '$addToSet': {
+                    'success': {'$each': ['user3@email.com']},
+                    'failed': {'$each': []}
+                },
+                '$unset': {'errors.user3@email(dot)com': ''}
+            })
+        ])
+
+    def test_save_outcomes_empty(self):
+        watcher = payout_engine.PayoutWatcher([])
+        watcher._save_outcomes({})
+
+        payout_engine.get_database_connection().wstore_reportsemipaid.bulk_write.assert_not_called()
+
+    def _check_reports_payout(self, reports, semipaids, users):
+        payout = {'items': [{'payout_item': {'sender_item_id': '9_123'}}, {'payout_item': {'sender_item_id': '9_124'}}]}
+        watcher = payout_engine.PayoutWatcher(reports)
+        watcher._mark_as_paid = MagicMock()
 
-    def test_analyze_item_correct_fix_semipaid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        semipaid = ReportSemiPaid(1, ['user1@email.com', 'user2@email.com'], ['user1@email.com', 'user3@email.com'], {'user1@email(dot)com': {}, 'user2@email(dot)com': {}})
-        payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
+        collection = payout_engine.get_database_connection().wstore_reportsemipaid
+        collection.find.return_value = semipaids
+        payout_engine.User.objects.filter.return_value = createUsers(*users)
 
-        item = createItem("SUCCESS")
-        itemr = watcher._analyze_item(item)
+        watcher._check_reports_payout(payout)
 
-        assert itemr
-        assert semipaid.failed == ['user2@email.com']
-        assert semipaid.success == ['user1@email.com', 'user3@email.com']
-        assert semipaid.errors.get('user1@email(dot)com') is None
-        assert semipaid.errors.get('user2@email(dot)com') == {}
-        semipaid.save.assert_called_once_with()
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(x) for x in users])
+        collection.find.assert_called_once_with({'report': {'$in': [9]}})
+        return watcher, collection
 
     def test_check_reports_payout_not_finished(self):
-        payout = {'items': [{'payout_item': {'sender_item_id': '9_123'}}]}
         reports = [createReport(9), createReport(10, 2)]
-        watcher = payout_engine.PayoutWatcher([], reports)
-        watcher._safe_get_semi_paid = MagicMock()
-        semipaid = ReportSemiPaid(1, ['user1@email.com', 'user2@email.com'])
-        watcher._safe_get_semi_paid.return_value = semipaid
-        watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
-
-        watcher._check_reports_payout(payout)
-
-        payout_engine.User.objects.get.assert_called_once_with(username='user1@email.com')
-        watcher._safe_get_semi_paid.assert_called_once_with('9')
+        watcher, collection = self._check_reports_payout(
+            reports, [{'report': 9, 'failed': ['user1@email.com', 'user2@email.com'], 'success': []}], [1])
 
-        assert semipaid.failed == ['user1@email.com']  # Bad emails cleaned
         watcher._mark_as_paid.assert_not_called()
-        semipaid.delete.assert_not_called()
-        semipaid.save.assert_called_once_with()
+
+        # Bad emails cleaned
+        collection.bulk_write.assert_called_once_with([
+            UpdateOne({'report': 9}, {'$pull': {'failed': {'$nin': ['user1@email.com']}}})
+        ])
 
     def test_check_reports_payout_finished(self):
         # Only owner and it is in the report in success, so it is full paid
-        payout = {'items': [{'payout_item': {'sender_item_id': '9_123'}}]}
         reports = [createReport(9), createReport(10, 2)]
-        watcher = payout_engine.PayoutWatcher([], reports)
-
-        watcher._safe_get_semi_paid = MagicMock()
-        semipaid = ReportSemiPaid(1, ['user2@email.com'], ['user1@email.com'])
-        watcher._safe_get_semi_paid.return_value = semipaid
-
-        watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        watcher, collection = self._check_reports_payout(
+            reports, [{'report': 9, 'failed': ['user2@email.com'], 'success': ['user1@email.com']}], [1])
 
-        watcher._check_reports_payout(payout)
-
-        payout_engine.User.objects.get.assert_called_once_with(username='user1@email.com')
-        watcher._safe_get_semi_paid.assert_called_once_with('9')
-
-        assert semipaid.failed == []  # Bad emails cleaned
         watcher._mark_as_paid.assert_called_once_with('9')
-        semipaid.delete.assert_called_once_with()
-        semipaid.save.assert_not_called()
+        collection.bulk_write.assert_called_once_with([DeleteOne({'report': 9})])
 
     def test_check_reports_payout_not_finished_stakeholders(self):
         # Owner success, but not stakeholders
-        payout = {'items': [{'payout_item': {'sender_item_id': '9_123'}}]}
         reports = [createReport(9, 1, [2, 3]), createReport(10, 4)]
-        watcher = payout_engine.PayoutWatcher([], reports)
+        watcher, collection = self._check_reports_payout(reports, [{
+            'report': 9,
+            'failed': ['user2@email.com', 'user3@email.com', 'notexist@email.com'],
+            'success': ['user1@email.com']
+        }], [1, 2, 3])
 
-        semipaid = ReportSemiPaid(1, ['user2@email.com', 'user3@email.com', 'notexist@email.com'], ['user1@email.com'])
-        watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
-
-        watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
-
-        watcher._check_reports_payout(payout)
-
-        payout_engine.User.objects.get.assert_has_calls([call(username='user1@email.com'), call(username='user2@email.com'), call(username='user3@email.com')])
-        watcher._safe_get_semi_paid.assert_called_once_with('9')
-
-        assert semipaid.failed == ['user2@email.com', 'user3@email.com']  # Bad emails cleaned
         watcher._mark_as_paid.assert_not_called()
-        semipaid.delete.assert_not_called()
-        semipaid.save.assert_called_once_with()
+        collection.bulk_write.assert_called_once_with([
+            UpdateOne({'report': 9}, {'$pull': {'failed': {'$nin': ['user1@email.com', 'user2@email.com', 'user3@email.com']}}})
+        ])
 
     def test_check_reports_payout_successs_stakeholders(self):
-        # Owner success, but not stakeholders
-        payout = {'items': [{'payout_item': {'sender_item_id': '9_123'}}]}
         reports = [createReport(9, 1, [2, 3]), createReport(10, 4)]
-        watcher = payout_engine.PayoutWatcher([], reports)
+        watcher, collection = self._check_reports_payout(reports, [{
+            'report': 9,
+            'failed': ['notexist@email.com'],
+            'success': [createMail(1), createMail(2), createMail(3)]
+        }], [1, 2, 3])
 
-        semipaid = ReportSemiPaid(1, ['notexist@email.com'], [createMail(1), createMail(2), createMail(3)])
-        watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
+        watcher._mark_as_paid.assert_called_once_with('9')
+        collection.bulk_write.assert_called_once_with([DeleteOne({'report': 9})])
 
-        watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+    def test_check_reports_payout_unknown_reports(self):
+        payout = {'items': [{'payout_item': {'sender_item_id': '11_123'}}]}
+        watcher = payout_engine.PayoutWatcher([createReport(9)])
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_has_calls([call(username='user1@email.com'), call(username='user2@email.com'), call(username='user3@email.com')])
-        watcher._safe_get_semi_paid.assert_called_once_with('9')
-
-        assert semipaid.failed == []  # Bad emails cleaned
-        watcher._mark_as_paid.assert_called_once_with('9')
-        semipaid.delete.assert_called_once_with()
-        semipaid.save.assert_not_called()
+        payout_engine.User.objects.filter.assert_not_called()
+        payout_engine.get_database_connection().wstore_reportsemipaid.bulk_write.assert_not_called()
 
     def test_payout_success(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         watcher._analyze_item = MagicMock()
+        watcher._save_outcomes = MagicMock()
         watcher._check_reports_payout = MagicMock()
+        watcher._get_recorded_items = MagicMock(return_value={'itemID0'})
 
         payout = {'items': ['item1', 'item2', 'item3', 'otheritem']}
 
         watcher._payout_success(payout)
 
-        watcher._analyze_item.assert_has_calls([call(x) for x in payout['items']])
+        outcomes = watcher._save_outcomes.call_args[0][0]
+        watcher._get_recorded_items.assert_called_once_with(payout)
+        watcher._analyze_item.assert_has_calls([call(x, outcomes, {'itemID0'}) for x in payout['items']])
         watcher._check_reports_payout.assert_called_once_with(payout)
 
+    def test_get_recorded_items(self):
+        watcher = payout_engine.PayoutWatcher([])
+        collection = payout_engine.get_database_connection().wstore_reportsemipaid
+        collection.find.return_value = [{
+            'errors': {'user1@email(dot)com': createErrorSaved('DENIED'), 'user2@email(dot)com': createErrorSaved('FAILED', item='itemID1')}
+        }, {}]
+
+        recorded = watcher._get_recorded_items({'items': [createItem('DENIED'), createItem('FAILED', itemid='2_124')]})
+
+        self.assertEquals({'itemID0', 'itemID1'}, recorded)
+        collection.find.assert_called_once_with({'report': {'$in': [1, 2]}}, {'errors': 1})
+
     @parameterized.expand([
         ('DENIED', False, False),
         ('UNKNOWN', False, False),
@@ -405,38 +367,225 @@ class PayoutWatcherTestCase(TestCase):
         ('PROCESSING', True, False),
         ('SUCCESS', False, True)])
     def test_check_payout_denied(self, status, must_cont, success):
-        watcher = payout_engine.PayoutWatcher([], [])
-        watcher._update_status = MagicMock()
+        watcher = payout_engine.PayoutWatcher([])
         watcher._payout_success = MagicMock()
 
         pay = {'batch_header': {'batch_status': status}}
         payout_engine.Payout.find.return_value = pay
-        payout = {'batch_header': {'payout_batch_id': 'batchID0'}}
-        cont = watcher._check_payout(payout)
+        rpayout = MagicMock(payout_id='batchID0')
+        cont = watcher._check_payout(rpayout)
 
         assert cont == must_cont
+        assert rpayout.status == status
         payout_engine.Payout.find.assert_called_once_with('batchID0')
-        watcher._update_status.assert_called_once_with(pay)
         if success:
             watcher._payout_success.assert_called_once_with(pay)
         else:
             watcher._payout_success.assert_not_called()
 
-    def test_check_payouts(self):
-        watcher = payout_engine.PayoutWatcher(['payout1', 'payout2', 'payout3', 'payout4'], [])
-        watcher._check_payout = MagicMock()
-        # Keep watching first and third
-        watcher._check_payout.side_effect = [True, False, True, False]
 
-        assert watcher.payouts == ['payout1', 'payout2', 'payout3', 'payout4']
-        watcher._check_payouts()
-        watcher._check_payout.assert_has_calls([call('payout1'), call('payout2'), call('payout3'), call('payout4')])
-        assert watcher.payouts == ['payout1', 'payout3']
+class ResolveEmailsTestCase(TestCase):
+
+    tags = ('payout', 'payout-emails')
+
+    def setUp(self):
+        setUp()
+
+    def test_resolve_emails(self):
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2)
+
+        emails = payout_engine.resolve_emails([createMail(2), createMail(1), createMail(2)])
+
+        self.assertEquals({createMail(1): createMail(1), createMail(2): createMail(2)}, emails)
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1), createMail(2)])
+
+        # Cached emails are not retrieved again
+        payout_engine.User.objects.filter.return_value = createUsers(3)
+
+        emails = payout_engine.resolve_emails([createMail(1), createMail(3)])
+
+        self.assertEquals({createMail(1): createMail(1), createMail(3): createMail(3)}, emails)
+        payout_engine.User.objects.filter.assert_called_with(username__in=[createMail(3)])
 
-        watcher._check_payout.side_effect = [False, False]
-        watcher._check_payouts()
-        watcher._check_payout.assert_has_calls([call('payout1'), call('payout3')])
-        assert watcher.payouts == []
+    def test_resolve_emails_empty(self):
+        self.assertEquals({}, payout_engine.resolve_emails([]))
+        payout_engine.User.objects.filter.assert_not_called()
+
+    def test_resolve_emails_not_found(self):
+        payout_engine.User.objects.filter.return_value = createUsers(1)
+
+        error = None
+        try:
+            payout_engine.resolve_emails([createMail(1), createMail(2)])
+        except ObjectDoesNotExist as e:
+            error = e
+
+        self.assertFalse(error is None)
+        self.assertEquals('The users user2@email.com do not exist', str(error))
+
+
+class PayoutTrackingTestCase(TestCase):
+
+    tags = ('payout', 'payout-tracking')
+
+    def setUp(self):
+        setUp()
+        self.oldPayoutWatcher = payout_engine.PayoutWatcher
+        payout_engine.PayoutWatcher = MagicMock()
+
+        self.rpayout = MagicMock(payout_id='batchID0', reports=['report1'], checks=2, task_id='oldTaskId')
+        payout_engine.ReportsPayout.objects.filter.return_value = [self.rpayout]
+
+        payout_engine.datetime = MagicMock()
+        payout_engine.datetime.utcnow.return_value = datetime(2023, 6, 1, 10, 0, 0)
+
+        payout_engine.settings.PAYOUT_POLL_INTERVAL = 10
+        payout_engine.settings.PAYOUT_POLL_MAX_INTERVAL = 3600
+        payout_engine.settings.PAYOUT_MAX_CHECKS = 200
+
+    def tearDown(self):
+        payout_engine.PayoutWatcher = self.oldPayoutWatcher
+        payout_engine.datetime = datetime
+
+    def _validate_update(self, check_id, update):
+        return call({'payout_id': 'batchID0', 'task_id': check_id}, update, return_document=payout_engine.ReturnDocument.AFTER)
+
+    @parameterized.expand([
+        ('pending', True, None, 3, 80),
+        ('paypal_error', None, ServerError(MagicMock(status_code=500)), 3, 80),
+        ('connection_error', None, ConnectTimeout('Timeout'), 3, 80),
+        ('max_interval', True, None, 20, 3600)
+    ])
+    def test_check_payout_pending(self, name, pending, error, exp_checks, exp_delay):
+        self.rpayout.status = 'PENDING'
+        payout_engine.PayoutWatcher()._check_payout.return_value = pending
+        payout_engine.PayoutWatcher()._check_payout.side_effect = error
+        collection = payout_engine.get_database_connection().wstore_reportspayout
+        collection.find_one_and_update.return_value = {'checks': exp_checks}
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        payout_engine.ReportsPayout.objects.filter.assert_called_once_with(payout_id='batchID0')
+        payout_engine.PayoutWatcher.assert_called_with(['report1'])
+        payout_engine.PayoutWatcher()._check_payout.assert_called_once_with(self.rpayout)
+
+        # The next check replaces the current one and its delay depends on the stored counter
+        self.assertEquals([
+            self._validate_update('oldTaskId', {'$set': {'status': 'PENDING', 'task_id': 'taskId'}, '$inc': {'checks': 1}}),
+            self._validate_update('taskId', {'$set': {'next_check': datetime(2023, 6, 1, 10, 0, 0) + timedelta(seconds=exp_delay)}})
+        ], collection.find_one_and_update.call_args_list)
+
+        payout_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.payout_engine.check_payout', exp_delay,
+            task_id='taskId', payout_id='batchID0', check_id='taskId')
+
+    def test_check_payout_processing_error(self):
+        # Errors that are not caused by PayPal or the connection would happen in every check
+        self.rpayout.status = 'SUCCESS'
+        payout_engine.PayoutWatcher()._check_payout.side_effect = ObjectDoesNotExist('The users user2 do not exist')
+        collection = payout_engine.get_database_connection().wstore_reportspayout
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        collection.find_one_and_update.assert_called_once_with(
+            {'payout_id': 'batchID0', 'task_id': 'oldTaskId'},
+            {'$set': {'status': 'SUCCESS', 'next_check': None, 'task_id': None}},
+            return_document=payout_engine.ReturnDocument.AFTER)
+        payout_engine.schedule_task.assert_not_called()
+
+    def test_check_payout_max_checks(self):
+        self.rpayout.status = 'PENDING'
+        payout_engine.PayoutWatcher()._check_payout.return_value = True
+        collection = payout_engine.get_database_connection().wstore_reportspayout
+        collection.find_one_and_update.return_value = {'checks': 200}
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        # The batch is no longer tracked, but its payments are still in progress since it is pending
+        self.assertEquals([
+            self._validate_update('oldTaskId', {'$set': {'status': 'PENDING', 'task_id': 'taskId'}, '$inc': {'checks': 1}}),
+            self._validate_update('taskId', {'$set': {'next_check': None, 'task_id': None}})
+        ], collection.find_one_and_update.call_args_list)
+        payout_engine.schedule_task.assert_not_called()
+
+    def test_check_payout_superseded_during_check(self):
+        payout_engine.PayoutWatcher()._check_payout.return_value = True
+        payout_engine.get_database_connection().wstore_reportspayout.find_one_and_update.return_value = None
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        payout_engine.schedule_task.assert_not_called()
+
+    def test_check_payout_finished(self):
+        self.rpayout.status = 'SUCCESS'
+        payout_engine.PayoutWatcher()._check_payout.return_value = False
+        collection = payout_engine.get_database_connection().wstore_reportspayout
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        collection.find_one_and_update.assert_called_once_with(
+            {'payout_id': 'batchID0', 'task_id': 'oldTaskId'},
+            {'$set': {'status': 'SUCCESS', 'next_check': None, 'task_id': None}},
+            return_document=payout_engine.ReturnDocument.AFTER)
+        payout_engine.schedule_task.assert_not_called()
+
+    @parameterized.expand([
+        ('not_found', []),
+        ('not_tracked', [MagicMock(next_check=None, task_id='oldTaskId')]),
+        ('superseded', [MagicMock(next_check=datetime(2023, 6, 1, 10, 0, 0), task_id='newTaskId')])
+    ])
+    def test_check_payout_not_tracked(self, name, rpayouts):
+        payout_engine.ReportsPayout.objects.filter.return_value = rpayouts
+
+        payout_engine.check_payout('batchID0', 'oldTaskId')
+
+        payout_engine.PayoutWatcher()._check_payout.assert_not_called()
+        payout_engine.get_database_connection().wstore_reportspayout.find_one_and_update.assert_not_called()
+        payout_engine.schedule_task.assert_not_called()
+
+    @parameterized.expand([
+        ('tracked', {'checks': 0}, True),
+        ('superseded', None, False)
+    ])
+    def test_notify_payout(self, name, tracking, rescheduled):
+        self.rpayout.next_check = datetime(2023, 6, 1, 10, 5, 0)
+        collection = payout_engine.get_database_connection().wstore_reportspayout
+        collection.find_one_and_update.return_value = tracking
+
+        tracked = payout_engine.notify_payout('batchID0')
+
+        self.assertTrue(tracked)
+
+        # The check is executed immediately and the backoff restarted, without starting a new chain of checks
+        collection.find_one_and_update.assert_called_once_with(
+            {'payout_id': 'batchID0', 'task_id': 'oldTaskId'},
+            {'$set': {'checks': 0, 'next_check': datetime(2023, 6, 1, 10, 0, 0)}},
+            return_document=payout_engine.ReturnDocument.AFTER)
+
+        self.assertEquals(rescheduled, payout_engine.reschedule_task.called)
+        if rescheduled:
+            payout_engine.reschedule_task.assert_called_once_with('oldTaskId', 0)
+
+        payout_engine.schedule_task.assert_not_called()
+
+    def test_notify_payout_due_soon(self):
+        self.rpayout.next_check = datetime(2023, 6, 1, 10, 0, 10)
+
+        tracked = payout_engine.notify_payout('batchID0')
+
+        # The backoff is not restarted by repeated notifications
+        self.assertTrue(tracked)
+        payout_engine.get_database_connection().wstore_reportspayout.find_one_and_update.assert_not_called()
+        payout_engine.reschedule_task.assert_not_called()
+
+    def test_notify_payout_not_tracked(self):
+        payout_engine.ReportsPayout.objects.filter.return_value = []
+
+        tracked = payout_engine.notify_payout('batchID0')
+
+        self.assertFalse(tracked)
+        payout_engine.reschedule_task.assert_not_called()
+        payout_engine.schedule_task.assert_not_called()
 
 
 class PayoutEngineTestCase(TestCase):
@@ -447,23 +596,26 @@ class PayoutEngineTestCase(TestCase):
         setUp()
         self.oldPayoutWatcher = payout_engine.PayoutWatcher
         payout_engine.PayoutWatcher = MagicMock()
+        self.old_uuid = payout_engine.uuid
+        payout_engine.uuid = MagicMock()
         self.reference = '__payout__engine__context__lock__'
 
     def tearDown(self):
         payout_engine.PayoutWatcher = self.oldPayoutWatcher  # Recover the original implementation
+        payout_engine.uuid = self.old_uuid
 
     def test_get_reports_not_paid(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.requests.get().status_code = 200
-        payout_engine.requests.get().json.return_value = [{'test': 'case'}]
+        payout_engine.get_session().get().status_code = 200
+        payout_engine.get_session().get().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.get.reset_mock()
+        payout_engine.get_session().get.reset_mock()
 
         result = engine._get_reports()
 
         url = "{}/rss/settlement/reports".format(RSSUrl())
 
-        payout_engine.requests.get.assert_called_once_with(
+        payout_engine.get_session().get.assert_called_once_with(
             url,
             params={'aggregatorId': None, 'providerId': None, 'productClass': None, 'onlyPaid': "true"},
             headers={
@@ -472,7 +624,7 @@ class PayoutEngineTestCase(TestCase):
                 'X-Roles': settings.ADMIN_ROLE,
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.get().json.assert_called_once_with()
+        payout_engine.get_session().get().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
@@ -502,7 +654,7 @@ class PayoutEngineTestCase(TestCase):
     def test_process_reports_simple(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         reports = [{
             'paid': False,
@@ -517,7 +669,7 @@ class PayoutEngineTestCase(TestCase):
         # Just one report
         assert new_reports == {'EUR': {'user1@email.com': [(10, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report=1)
-        payout_engine.User.objects.get.assert_called_once_with(username=createMail(1))
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1)])
 
     @parameterized.expand([
         (('EUR', 'EUR'), {'EUR': {'user1@email.com': [(10, 1), (20, 2)]}}),
@@ -526,7 +678,7 @@ class PayoutEngineTestCase(TestCase):
     def test_process_reports_multiple_pays_user(self, currencies, result):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 1)
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         reports = [{
             'paid': False,
@@ -547,12 +699,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == result
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(1))])
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1)])
 
     def test_process_reports_with_stakeholders(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3, 2, 1)
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3)
 
         reports = [{
             'paid': False,
@@ -583,12 +735,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {'EUR': {'user1@email.com': [(10, 1), (10, 2)], 'user2@email.com': [(2, 1), (20, 2)], 'user3@email.com': [(4, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(2)), call(username=createMail(3)), call(username=createMail(2)), call(username=createMail(1))])
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1), createMail(2), createMail(3)])
 
     def test_process_reports_user_in_semipaid(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1)])
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         reports = [{
             'paid': False,
@@ -603,12 +755,12 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1))])
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1)])
 
     def test_process_reports_user_in_semipaid_and_stakeholders(self):
         engine = payout_engine.PayoutEngine()
         payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1), createMail(3)])
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3)
 
         reports = [{
             'paid': False,
@@ -629,31 +781,54 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {'EUR': {'user2@email.com': [(5, 1)]}}
         payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(2))])
+        payout_engine.User.objects.filter.assert_called_once_with(username__in=[createMail(1), createMail(2), createMail(3)])
 
-    def test_process_payouts_create_lock(self):
+    def test_process_reports_in_progress(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.side_effect = [None, MagicMock(), None]
-        payout_engine.Context.objects.all()[0].payouts_n = 10
+        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2)
 
-        data = {}
-        engine._process_payouts(data)
+        # The payment of the owner is included in a batch that is being retried
+        payout_engine.get_database_connection().wstore_reportspayout.find.return_value = [{
+            'items': [{'receiver': createMail(1), 'sender_item_id': '1_10'}, {'receiver': createMail(2), 'sender_item_id': '2_11'}]
+        }]
 
-        assert payout_engine.Context.objects.all()[0].payouts_n == 10
+        reports = [{
+            'paid': False,
+            'id': 1,
+            'currency': 'EUR',
+            'ownerProviderId': createMail(1),
+            'ownerValue': 10,
+            'stakeholders': [{
+                'stakeholderId': createMail(2),
+                'modelValue': 2
+            }]
+        }]
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_called_once_with({'_id': self.reference, '_lock': False})
+        new_reports = engine._process_reports(reports)
+
+        assert new_reports == {'EUR': {'user2@email.com': [(2, 1)]}}
+        payout_engine.get_database_connection().wstore_reportspayout.find.assert_called_once_with({
+            '$or': [
+                {'status': {'$in': ['UNSUBMITTED', 'UNTRACKED', 'NEW', 'PENDING', 'PROCESSING']}},
+                {'next_check': {'$ne': None}}
+            ]
+        }, {'items': 1})
+
+    def test_process_payouts_lock(self):
+        engine = payout_engine.PayoutEngine()
+        payout_engine.Context.objects.all()[0].payouts_n = 10
+        payout_engine.DocumentLock.reset_mock()
+
+        engine._process_payouts({})
 
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.assert_has_calls([
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})])
+        payout_engine.DocumentLock.assert_called_once_with('wstore_payout', self.reference, 'payout', upsert=True)
+        payout_engine.DocumentLock().lock_document.assert_called_once_with()
+        payout_engine.DocumentLock().unlock_document.assert_called_once_with()
 
     def test_process_payouts_raise_in_lock(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.return_value = {'_lock': True}
+        payout_engine.DocumentLock().lock_document.return_value = True
         payout_engine.Context.objects.all()[0].payouts_n = 10
 
         data = {}
@@ -662,12 +837,16 @@ class PayoutEngineTestCase(TestCase):
             engine._process_payouts(data)
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 10
+        payout_engine.DocumentLock().unlock_document.assert_not_called()
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
+    def test_process_payouts_unlock_on_error(self):
+        engine = payout_engine.PayoutEngine()
+        payout_engine.Context.objects.all.side_effect = Exception('Error')
+
+        with self.assertRaisesMessage(Exception, 'Error'):
+            engine._process_payouts({})
 
-        payout_engine.get_database_connection().wstore_payout.find_one_and_update.assert_has_calls([
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}})])
+        payout_engine.DocumentLock().unlock_document.assert_called_once_with()
 
     def test_process_payouts_single_payout(self):
         engine = payout_engine.PayoutEngine()
@@ -677,17 +856,12 @@ class PayoutEngineTestCase(TestCase):
 
         result = engine._process_payouts(data)
 
-        assert len(result) == 1
-        engine.paypal.batch_payout.assert_called_once_with([{'amount': {'currency': 'EUR', 'value': '10.00'}, 'sender_item_id': '1_10', 'recipient_type': 'EMAIL', 'receiver': createMail(1)}])
+        assert result == [[{'amount': {'currency': 'EUR', 'value': '10.00'}, 'sender_item_id': '1_10', 'recipient_type': 'EMAIL', 'receiver': createMail(1)}]]
+        engine.paypal.batch_payout.assert_not_called()
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 11
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        payout_engine.DocumentLock().unlock_document.assert_called_once_with()
 
     def test_process_payouts_multiple_currencies_payouts(self):
         engine = payout_engine.PayoutEngine()
@@ -697,19 +871,13 @@ class PayoutEngineTestCase(TestCase):
 
         result = engine._process_payouts(data)
 
-        assert len(result) == 2
         expected_eur = [{'amount': {'currency': 'EUR', 'value': '10.00'}, 'sender_item_id': '1_10', 'recipient_type': 'EMAIL', 'receiver': createMail(1)}]
         expected_usd = [{'amount': {'currency': 'USD', 'value': '20.00'}, 'sender_item_id': '2_11', 'recipient_type': 'EMAIL', 'receiver': createMail(2)}]
-        engine.paypal.batch_payout.assert_has_calls([call(expected_eur), call(expected_usd)])
+        assert result == [expected_eur, expected_usd]
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 12
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        payout_engine.DocumentLock().unlock_document.assert_called_once_with()
 
     def test_process_payouts_multiple_payouts(self):
         engine = payout_engine.PayoutEngine()
@@ -719,8 +887,6 @@ class PayoutEngineTestCase(TestCase):
 
         result = engine._process_payouts(data)
 
-        assert len(result) == 1
-
         expected = [
             {'amount': {'currency': 'EUR', 'value': '10.00'}, 'sender_item_id': '1_10', 'recipient_type': 'EMAIL', 'receiver': createMail(1)},
             {'amount': {'currency': 'EUR', 'value': '4.00'}, 'sender_item_id': '2_11', 'recipient_type': 'EMAIL', 'receiver': createMail(1)},
@@ -728,16 +894,32 @@ class PayoutEngineTestCase(TestCase):
             {'amount': {'currency': 'EUR', 'value': '20.00'}, 'sender_item_id': '2_13', 'recipient_type': 'EMAIL', 'receiver': createMail(2)},
             {'amount': {'currency': 'EUR', 'value': '4.00'}, 'sender_item_id': '1_14', 'recipient_type': 'EMAIL', 'receiver': createMail(3)}
         ]
-        engine.paypal.batch_payout.assert_called_once_with(expected)
+        assert result == [expected]
 
         assert payout_engine.Context.objects.all()[0].payouts_n == 15
 
-        payout_engine.get_database_connection().wstore_payout.insert_one.assert_not_called()
-        assert payout_engine.get_database_connection().wstore_payout.find_one_and_update.call_args_list == [
-            call({'_id': self.reference},
-                 {'$set': {'_lock': True}}),
-            call({'_id': self.reference},
-                 {'$set': {'_lock': False}})]
+        payout_engine.DocumentLock().unlock_document.assert_called_once_with()
+
+    @override_settings(PAYOUT_BATCH_SIZE=2)
+    def test_process_payouts_batch_size(self):
+        engine = payout_engine.PayoutEngine()
+        payout_engine.Context.objects.all()[0].payouts_n = 10
+
+        data = {'EUR': {'user1@email.com': [(10, 1), (4, 2)], 'user2@email.com': [(2.21, 1)]}, 'USD': {'user3@email.com': [(4, 1)]}}
+
+        result = engine._process_payouts(data)
+
+        # Batches are split by size, and never mix currencies
+        assert result == [[
+            {'amount': {'currency': 'EUR', 'value': '10.00'}, 'sender_item_id': '1_10', 'recipient_type': 'EMAIL', 'receiver': createMail(1)},
+            {'amount': {'currency': 'EUR', 'value': '4.00'}, 'sender_item_id': '2_11', 'recipient_type': 'EMAIL', 'receiver': createMail(1)}
+        ], [
+            {'amount': {'currency': 'EUR', 'value': '2.21'}, 'sender_item_id': '1_12', 'recipient_type': 'EMAIL', 'receiver': createMail(2)}
+        ], [
+            {'amount': {'currency': 'USD', 'value': '4.00'}, 'sender_item_id': '1_13', 'recipient_type': 'EMAIL', 'receiver': createMail(3)}
+        ]]
+
+        assert payout_engine.Context.objects.all()[0].payouts_n == 14
 
     def test_process_reports_empty(self):
         engine = payout_engine.PayoutEngine()
@@ -748,50 +930,184 @@ class PayoutEngineTestCase(TestCase):
         engine._process_reports.assert_called_once_with([])
         engine._process_payouts.assert_called_once_with('returned')
         payout_engine.ReportsPayout.assert_not_called()
-        payout_engine.PayoutWatcher.assert_not_called()
+        engine.paypal.batch_payout.assert_not_called()
+        payout_engine.schedule_task.assert_not_called()
+
+    def _mock_batches(self, engine, created):
+        payouts = [({
+            'batch_header': {
+                'payout_batch_id': 'payoutId{}'.format(i),
+                'batch_status': 'PENDING'
+            }
+        }, batch_created) for i, batch_created in enumerate(created)]
+
+        # Batches are submitted concurrently, so the response depends on the batch
+        def _batch_payout(items, sender_batch_id):
+            if isinstance(created[items[0]], Exception):
+                raise created[items[0]]
+
+            return payouts[items[0]]
+
+        engine.paypal.batch_payout.side_effect = _batch_payout
+
+        rpayouts = [MagicMock(items=[i], sender_batch_id='batch{}'.format(i)) for i in range(len(created))]
+        payout_engine.ReportsPayout.side_effect = rpayouts
+        payout_engine.uuid.uuid4.side_effect = [MagicMock(hex='batch{}'.format(i)) for i in range(len(created))]
+        return rpayouts
 
     def test_process_reports_single_payout(self):
         engine = payout_engine.PayoutEngine()
         engine._process_reports = MagicMock()
-        payout1 = {
-            'batch_header': {
-                'payout_batch_id': 'payoutId',
-                'batch_status': 'SUCCESS'
-            }
-        }
-        payouts = [(payout1, True)]
-        engine._process_payouts = MagicMock(return_value=payouts)
-        rpayout = ReportsPayout(['report1'], 'payoutId', 'SUCCESS', MagicMock())
-        payout_engine.ReportsPayout.return_value = rpayout
+        engine._process_payouts = MagicMock(return_value=[[0]])
+        rpayouts = self._mock_batches(engine, [True])
+
         engine.process_reports(['report1'])
 
-        payout_engine.ReportsPayout.assert_called_once_with(reports=['report1'], payout_id='payoutId', status='SUCCESS')
-        rpayout.save.assert_called_once_with()
-        payout_engine.PayoutWatcher.assert_called_once_with([payout1], ['report1'])
+        payout_engine.ReportsPayout.assert_called_once_with(
+            reports=['report1'], sender_batch_id='batch0', items=[0], status=payout_engine.UNSUBMITTED)
+
+        rpayouts[0].save.assert_has_calls([call(), call()])
+        engine.paypal.batch_payout.assert_called_once_with([0], sender_batch_id='batch0')
+        self.assertEquals('payoutId0', rpayouts[0].payout_id)
+        self.assertEquals('PENDING', rpayouts[0].status)
+
+        # The payout is tracked by a scheduled task
+        payout_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.payout_engine.check_payout', settings.PAYOUT_POLL_INTERVAL,
+            task_id='taskId', payout_id='payoutId0', check_id='taskId')
+        self.assertEquals('taskId', rpayouts[0].task_id)
 
     def test_process_reports_complex(self):
         engine = payout_engine.PayoutEngine()
         engine._process_reports = MagicMock()
-        payout = {
+        engine._process_payouts = MagicMock(return_value=[[0], [1], [2]])
+        rpayouts = self._mock_batches(engine, [True, False, True])
+
+        engine.process_reports(['report1'])
+
+        self.assertEquals([
+            call(reports=['report1'], sender_batch_id='batch0', items=[0], status=payout_engine.UNSUBMITTED),
+            call(reports=['report1'], sender_batch_id='batch1', items=[1], status=payout_engine.UNSUBMITTED),
+            call(reports=['report1'], sender_batch_id='batch2', items=[2], status=payout_engine.UNSUBMITTED)
+        ], payout_engine.ReportsPayout.call_args_list)
+
+        self.assertEquals(3, engine.paypal.batch_payout.call_count)
+        for i in range(3):
+            engine.paypal.batch_payout.assert_any_call([i], sender_batch_id='batch{}'.format(i))
+
+        # The failed batch is saved unsubmitted and submitted again later
+        rpayouts[1].save.assert_called_once_with()
+        rpayouts[0].save.assert_has_calls([call(), call()])
+        rpayouts[2].save.assert_has_calls([call(), call()])
+
+        self.assertEquals(3, payout_engine.schedule_task.call_count)
+        payout_engine.schedule_task.assert_any_call(
+            'wstore.charging_engine.payout_engine.check_payout', settings.PAYOUT_POLL_INTERVAL,
+            task_id='taskId', payout_id='payoutId0', check_id='taskId')
+        payout_engine.schedule_task.assert_any_call(
+            'wstore.charging_engine.payout_engine.check_payout', settings.PAYOUT_POLL_INTERVAL,
+            task_id='taskId', payout_id='payoutId2', check_id='taskId')
+        payout_engine.schedule_task.assert_any_call(
+            'wstore.charging_engine.payout_engine.submit_payout', settings.SCHEDULER_RETRY_DELAY, sender_batch_id='batch1')
+
+    def test_process_reports_submission_error(self):
+        engine = payout_engine.PayoutEngine()
+        engine._process_reports = MagicMock()
+        engine._process_payouts = MagicMock(return_value=[[0], [1], [2]])
+        rpayouts = self._mock_batches(engine, [ConnectionError('Timeout'), True, Exception('Internal error')])
+
+        engine.process_reports(['report1'])
+
+        # A failure does not prevent the submission of the rest of batches
+        self.assertEquals(3, engine.paypal.batch_payout.call_count)
+        rpayouts[1].save.assert_has_calls([call(), call()])
+
+        # Each failed batch is submitted again by its own task
+        self.assertEquals([
+            call('wstore.charging_engine.payout_engine.check_payout', settings.PAYOUT_POLL_INTERVAL,
+            task_id='taskId', payout_id='payoutId1', check_id='taskId'),
+            call('wstore.charging_engine.payout_engine.submit_payout', settings.SCHEDULER_RETRY_DELAY, sender_batch_id='batch0'),
+            call('wstore.charging_engine.payout_engine.submit_payout', settings.SCHEDULER_RETRY_DELAY, sender_batch_id='batch2')
+        ], payout_engine.schedule_task.call_args_list)
+
+    def test_submit_payout(self):
+        rpayout = MagicMock(status=payout_engine.UNSUBMITTED, items=['item'], sender_batch_id='batch0')
+        payout_engine.ReportsPayout.objects.filter.return_value = [rpayout]
+        payout_engine.PayPalClient().batch_payout.return_value = ({
             'batch_header': {
                 'payout_batch_id': 'payoutId',
-                'batch_status': 'SUCCESS'
+                'batch_status': 'PENDING'
             }
-        }
-        err_payout = {
-            'sender_batch_header': {
-                'sender_batch_id': 'BATCHID'
-            }
-        }
-        payouts = [(payout.copy(), True), (err_payout.copy(), False), (payout.copy(), True)]
-        engine._process_payouts = MagicMock(return_value=payouts)
-        rpayout = ReportsPayout(['report1'], 'payoutId', 'SUCCESS', MagicMock())
-        payout_engine.ReportsPayout.return_value = rpayout
-        engine.process_reports(['report1'])
+        }, True)
+
+        payout_engine.submit_payout('batch0')
+
+        payout_engine.ReportsPayout.objects.filter.assert_called_once_with(sender_batch_id='batch0')
+        payout_engine.PayPalClient().batch_payout.assert_called_once_with(['item'], sender_batch_id='batch0')
+        self.assertEquals('payoutId', rpayout.payout_id)
+        payout_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.payout_engine.check_payout', settings.PAYOUT_POLL_INTERVAL,
+            task_id='taskId', payout_id='payoutId', check_id='taskId')
+
+    @parameterized.expand([
+        ('rejected', ({}, False), None),
+        ('exception', None, ConnectionError('Timeout'))
+    ])
+    def test_submit_payout_error(self, name, response, error):
+        rpayout = MagicMock(status=payout_engine.UNSUBMITTED, items=['item'], sender_batch_id='batch0')
+        payout_engine.ReportsPayout.objects.filter.return_value = [rpayout]
+        payout_engine.PayPalClient().batch_payout.return_value = response
+        payout_engine.PayPalClient().batch_payout.side_effect = error
+
+        with self.assertRaisesMessage(PayoutError, 'The payout batch batch0 could not be submitted'):
+            payout_engine.submit_payout('batch0')
+
+        rpayout.save.assert_not_called()
+        payout_engine.schedule_task.assert_not_called()
+
+    def test_submit_payout_duplicated(self):
+        # The previous submission timed out after PayPal created the batch
+        rpayout = MagicMock(status=payout_engine.UNSUBMITTED, items=['item'], sender_batch_id='batch0')
+        payout_engine.ReportsPayout.objects.filter.return_value = [rpayout]
+        payout_engine.PayPalClient().batch_payout.return_value = (MagicMock(), False)
+        payout_engine.PayPalClient().get_existing_batch.return_value = (True, 'payoutId')
+
+        payout_engine.submit_payout('batch0')
+
+        # The existing batch is tracked instead of being submitted again
+        self.assertEquals(1, payout_engine.PayPalClient().batch_payout.call_count)
+        payout_engine.PayPalClient().get_existing_batch.assert_called_once_with(
+            payout_engine.PayPalClient().batch_payout.return_value[0])
+        self.assertEquals('payoutId', rpayout.payout_id)
+        self.assertEquals('PENDING', rpayout.status)
+        payout_engine.schedule_task.assert_called_once_with(
+            'wstore.charging_engine.payout_engine.check_payout', 0,
+            task_id='taskId', payout_id='payoutId', check_id='taskId')
+
+    def test_submit_payout_duplicated_untracked(self):
+        rpayout = MagicMock(status=payout_engine.UNSUBMITTED, items=['item'], sender_batch_id='batch0')
+        payout_engine.ReportsPayout.objects.filter.return_value = [rpayout]
+        payout_engine.PayPalClient().batch_payout.return_value = (MagicMock(), False)
+        payout_engine.PayPalClient().get_existing_batch.return_value = (True, None)
+
+        payout_engine.submit_payout('batch0')
+
+        # The batch is not submitted again, and its payments are kept as in progress
+        self.assertEquals(payout_engine.UNTRACKED, rpayout.status)
+        rpayout.save.assert_called_once_with()
+        payout_engine.schedule_task.assert_not_called()
+
+    @parameterized.expand([
+        ('not_found', []),
+        ('submitted', [MagicMock(status='PENDING')])
+    ])
+    def test_submit_payout_skipped(self, name, rpayouts):
+        payout_engine.ReportsPayout.objects.filter.return_value = rpayouts
+
+        payout_engine.submit_payout('batch0')
 
-        payout_engine.ReportsPayout.assert_has_calls([call(reports=['report1'], payout_id='payoutId', status='SUCCESS'), call(reports=['report1'], payout_id='payoutId', status='SUCCESS')])
-        rpayout.save.assert_has_calls([call(), call()])
-        payout_engine.PayoutWatcher.assert_called_once_with([payout.copy(), payout.copy()], ['report1'])
+        payout_engine.PayPalClient().batch_payout.assert_not_called()
+        payout_engine.schedule_task.assert_not_called()
 
     def test_process_unpaid(self):
         # Process unpaid just ask for unpaids and process them
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from decimal import Decimal
+
+from parameterized import parameterized
+
+from django.test import TestCase
+
+from wstore.charging_engine import price_resolver
+
+
+USE_MODEL = {
+    'value': '1.20',
+    'unit': 'Call',
+    'tax_rate': '20.00',
+    'duty_free': '1.00'
+}
+
+SECOND_USE_MODEL = {
+    'value': '0.012',
+    'unit': 'megabyte',
+    'tax_rate': '20.00',
+    'duty_free': '0.010'
+}
+
+TIERS = [
+    {'up_to': '10', 'value': '1.20', 'duty_free': '1.00'},
+    {'up_to': '20', 'value': '0.60', 'duty_free': '0.50'},
+    {'up_to': None, 'value': '0.12', 'duty_free': '0.10'}
+]
+
+BLOCK_TIERS = [
+    {'up_to': '10', 'value': '10.00', 'duty_free': '8.00'},
+    {'up_to': '50', 'value': '30.00', 'duty_free': '25.00'},
+    {'up_to': None, 'value': '50.00', 'duty_free': '40.00'}
+]
+
+
+class PriceResolverTestCase(TestCase):
+
+    tags = ('price-resolver',)
+
+    def test_single_payment(self):
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price({
+            'single_payment': [{'value': '12.00', 'duty_free': '10.00'}],
+            'subscription': [{'value': '6.00', 'duty_free': '5.00'}]
+        })
+
+        self.assertEquals(('18.00', '15.00'), (price, duty_free))
+        self.assertEquals([], resolver.get_applied_sdr())
+
+    @parameterized.expand([
+        ('single_component', [USE_MODEL], '30.00', '25.00', [{
+            'model': USE_MODEL,
+            'accounting': [{
+                'usage_id': '1', 'value': '10', 'price': '12.00', 'duty_free': '10.00'
+            }, {
+                'usage_id': '3', 'value': '10', 'price': '12.00', 'duty_free': '10.00'
+            }, {
+                'usage_id': '4', 'value': '5', 'price': '6.00', 'duty_free': '5.00'
+            }],
+            'price': '30.00',
+            'duty_free': '25.00'
+        }]),
+        ('multiple_components', [USE_MODEL, SECOND_USE_MODEL], '30.02', '25.02', [{
+            'model': USE_MODEL,
+            'accounting': [{
+                'usage_id': '1', 'value': '10', 'price': '12.00', 'duty_free': '10.00'
+            }, {
+                'usage_id': '3', 'value': '10', 'price': '12.00', 'duty_free': '10.00'
+            }, {
+                'usage_id': '4', 'value': '5', 'price': '6.00', 'duty_free': '5.00'
+            }],
+            'price': '30.00',
+            'duty_free': '25.00'
+        }, {
+            'model': SECOND_USE_MODEL,
+            'accounting': [{
+                'usage_id': '2', 'value': '2', 'price': '0.024', 'duty_free': '0.020'
+            }],
+            'price': '0.024',
+            'duty_free': '0.020'
+        }]),
+        ('no_usage', [dict(USE_MODEL, unit='second')], '0.00', '0.00', [{
+            'model': dict(USE_MODEL, unit='second'),
+            'accounting': [],
+            'price': '0',
+            'duty_free': '0'
+        }])
+    ])
+    def test_pay_per_use(self, name, models, exp_price, exp_duty_free, exp_applied):
+        accounting = [
+            {'usage_id': '1', 'unit': 'call', 'value': '10'},
+            {'usage_id': '2', 'unit': 'Megabyte', 'value': '2'},
+            {'usage_id': '3', 'unit': 'CALL', 'value': '10'},
+            {'usage_id': '4', 'unit': 'call', 'value': '5'}
+        ]
+
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price({'pay_per_use': models}, accounting)
+
+        self.assertEquals((exp_price, exp_duty_free), (price, duty_free))
+        self.assertEquals(exp_applied, resolver.get_applied_sdr())
+
+    @parameterized.expand([
+        ('tiered', 'tiered', TIERS, '18.60', '15.50'),
+        ('volume', 'volume', TIERS, '3.00', '2.50'),
+        ('block', 'block', BLOCK_TIERS, '30.00', '25.00'),
+        ('first_tier', 'volume', [{'up_to': '50', 'value': '1.20', 'duty_free': '1.00'}] + TIERS[2:], '30.00', '25.00')
+    ])
+    def test_pay_per_use_tiers(self, name, tier_type, tiers, exp_price, exp_duty_free):
+        accounting = [
+            {'usage_id': '1', 'unit': 'call', 'value': '10'},
+            {'usage_id': '2', 'unit': 'call', 'value': '10'},
+            {'usage_id': '3', 'unit': 'call', 'value': '5'}
+        ]
+
+        model = dict(USE_MODEL, tier_type=tier_type, tiers=tiers)
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price({'pay_per_use': [model]}, accounting)
+
+        self.assertEquals((exp_price, exp_duty_free), (price, duty_free))
+
+        applied = resolver.get_applied_sdr()
+        self.assertEquals(1, len(applied))
+        self.assertEquals(['1', '2', '3'], [sdr['usage_id'] for sdr in applied[0]['accounting']])
+
+        # The price of the component is fully allocated to its SDRs
+        self.assertEquals(Decimal(exp_price), sum([Decimal(sdr['price']) for sdr in applied[0]['accounting']]))
+        self.assertEquals(Decimal(exp_duty_free), sum([Decimal(sdr['duty_free']) for sdr in applied[0]['accounting']]))
+
+    def test_pay_per_use_tiers_allocation(self):
+        accounting = [
+            {'usage_id': '1', 'unit': 'call', 'value': '10'},
+            {'usage_id': '2', 'unit': 'call', 'value': '10'},
+            {'usage_id': '3', 'unit': 'call', 'value': '5'}
+        ]
+
+        resolver = price_resolver.PriceResolver()
+        resolver.resolve_price({'pay_per_use': [dict(USE_MODEL, tier_type='tiered', tiers=TIERS)]}, accounting)
+
+        self.assertEquals([
+            ('7.44', '6.20'), ('7.44', '6.20'), ('3.72', '3.10')
+        ], [(sdr['price'], sdr['duty_free']) for sdr in resolver.get_applied_sdr()[0]['accounting']])
+
+    def test_pay_per_use_tiers_no_usage(self):
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price({
+            'pay_per_use': [dict(USE_MODEL, tier_type='block', tiers=BLOCK_TIERS)]
+        }, [])
+
+        self.assertEquals(('0.00', '0.00'), (price, duty_free))
@@ -34,7 +34,7 @@ from wstore.store_commons.utils.http import build_response, supported_request_mi
 from wstore.ordering.models import Order, Offering
 from wstore.ordering.errors import PaymentError
 from wstore.charging_engine.charging_engine import ChargingEngine
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.database import DocumentLock
 from wstore.asset_manager.resource_plugins.decorators import on_product_acquired
 
 
@@ -79,6 +79,7 @@ class PayPalConfirmation(Resource):
 
         order = None
         concept = None
+        lock = None
         self.ordering_client = OrderingClient()
         try:
             # Extract payment information
@@ -94,19 +95,12 @@ class PayPalConfirmation(Resource):
             if not Order.objects.filter(pk=ObjectId(reference)):
                 raise ValueError('The provided reference does not identify a valid order')
 
-            db = get_database_connection()
+            lock = DocumentLock('wstore_order', ObjectId(reference), 'payment')
 
-            # Uses an atomic operation to get and set the _lock value in the purchase
-            # document
-            pre_value = db.wstore_order.find_one_and_update(
-                {'_id': ObjectId(reference)},
-                {'$set': {'_lock': True}}
-            )
-
-            # If the value of _lock before setting it to true was true, means
-            # that the time out function has acquired it previously so the
-            # view ends
-            if not pre_value or '_lock' in pre_value and pre_value['_lock']:
+            # If the lock is held, the time out function is processing the order
+            # so the view ends
+            if lock.lock_document():
+                lock = None
                 raise PaymentError('The timeout set to process the payment has finished')
 
             order = Order.objects.get(pk=ObjectId(reference))
@@ -116,12 +110,8 @@ class PayPalConfirmation(Resource):
 
             # If the order state value is different from pending means that
             # the timeout function has completely ended before acquiring the resource
-            # so _lock is set to false and the view ends
-            if pre_value['state'] != 'pending':
-                db.wstore_order.find_one_and_update(
-                    {'_id': ObjectId(reference)},
-                    {'$set': {'_lock': False}}
-                )
+            # so the view ends
+            if lock.document['state'] != 'pending':
                 raise PaymentError('The timeout set to process the payment has finished')
 
             # Check that the request user is authorized to end the payment
@@ -140,7 +130,7 @@ class PayPalConfirmation(Resource):
             # build the payment client
             client = payment_client(order)
             order.sales_ids = client.end_redirection_payment(token, payer_id)
-            order.save()
+            order.save_changes()
 
             charging_engine = ChargingEngine(order)
             charging_engine.end_charging(transactions, pending_info['free_contracts'], concept)
@@ -157,7 +147,10 @@ class PayPalConfirmation(Resource):
                 else:
                     order.state = 'paid'
                     order.pending_payment = None
-                    order.save()
+                    order.save_changes()
+
+            if lock is not None:
+                lock.unlock_document()
 
             expl = ' due to an unexpected error'
             err_code = 500
@@ -180,13 +173,10 @@ class PayPalConfirmation(Resource):
         ext_transactions = deepcopy(transactions)
         ext_transactions.extend([{'item': contract.item_id} for contract in pending_info['free_contracts']])
 
-        states_processors[concept](ext_transactions, raw_order, order)
-
-        # _lock is set to false
-        db.wstore_order.find_one_and_update(
-            {'_id': ObjectId(reference)},
-            {'$set': {'_lock': False}}
-        )
+        try:
+            states_processors[concept](ext_transactions, raw_order, order)
+        finally:
+            lock.unlock_document()
 
         return build_response(request, 200, 'Ok')
 
@@ -248,9 +238,9 @@ class PayPalRefund(Resource):
             # Only those orders with all its order items in ack state can be refunded
             # that means that all the contracts have been refunded
             for contract in order.get_contracts():
-                if len(contract.charges) > 0:
+                charge = contract.get_last_charge()
+                if charge is not None:
                     cdr_manager = CDRManager(order, contract)
-                    charge = contract.charges[-1]
 
                     # Create a refund CDR for each contract
                     cdr_manager.refund_cdrs(charge['cost'], charge['duty_free'], charge['date'].isoformat() + 'Z')
@@ -19,11 +19,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
-
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_session
+
 
 class Command(BaseCommand):
     def handle(self, *args, **kargs):
@@ -45,7 +45,7 @@ class Command(BaseCommand):
 
         url += 'rss/settlement'
 
-        response = requests.post(url, json=data, headers=headers)
+        response = get_session(url).post(url, json=data, headers=headers)
 
         if response.status_code != 202:
             print("Some error asking to generate reports:\n{}: {}".format(response.reason, response.text))
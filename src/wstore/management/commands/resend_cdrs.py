@@ -18,51 +18,58 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from bson import ObjectId
 from datetime import datetime
 
 from django.core.management.base import BaseCommand, CommandError
 
 
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
-from wstore.store_commons.database import get_database_connection
+from wstore.charging_engine.charging.cdr_manager import reserve_correlation_numbers
+from wstore.rss_adaptor.cdr_outbox import CDRDispatcher, CDROutbox, FAILED
 from wstore.models import Context, Organization
 
 
 class Command(BaseCommand):
     def handle(self, *args, **kargs):
         """
-        Launch failed cdrs
+        Drain the CDR outbox, launching again failed cdrs
         """
         contexts = Context.objects.all()
         if len(contexts) < 1:
             raise CommandError("No context")
 
-        context = contexts[0]
-        cdrs = context.failed_cdrs
-        context.failed_cdrs = []
-        context.save()
+        outbox = CDROutbox()
 
-        if len(cdrs) == 0:
-            print("No failed cdrs to send")
-            exit(0)
+        # Move the CDRs that failed before the outbox existed
+        context = contexts[0]
+        if len(context.failed_cdrs):
+            outbox.enqueue(context.failed_cdrs, state=FAILED)
+            context.failed_cdrs = []
+            context.save()
 
-        db = get_database_connection()
+        entries = outbox.get_failed()
         time_stamp = datetime.utcnow().isoformat() + 'Z'
 
-        for cdr in cdrs:
+        # Group the CDRs by provider so correlation numbers are reserved in blocks
+        provider_entries = {}
+        for entry in entries:
             # Modify time_stamp
-            cdr['time_stamp'] = time_stamp
+            entry['cdr']['time_stamp'] = time_stamp
+            provider_entries.setdefault(entry['cdr']['provider'], []).append(entry)
 
+        for provider, p_entries in provider_entries.items():
             # Modify correlation number
-            org = Organization.objects.get(name=cdr['provider'])
+            org = Organization.objects.get(name=provider)
+            correlation_numbers = reserve_correlation_numbers(org.pk, len(p_entries))
+
+            for entry, corr_number in zip(p_entries, correlation_numbers):
+                entry['cdr']['correlation'] = corr_number
 
-            new_org = db.wstore_organization.find_and_modify(
-                query={'_id': org.pk},
-                update={'$inc': {'correlation_number': 1}}
-            )
+        if len(entries):
+            outbox.requeue(entries)
 
-            cdr['correlation'] = new_org['correlation_number']
+        sent, failed = CDRDispatcher().drain()
 
-        r = RSSAdaptor()
-        r.send_cdr(cdrs)
+        if sent == 0 and failed == 0:
+            print("No cdrs to send")
+        else:
+            print("{} cdrs sent, {} cdrs failed".format(sent, failed))
@@ -39,38 +39,33 @@ class Command(BaseCommand):
 
         # Context object is locked in order to avoid possible inconsistencies
         # in the list of pending upgrade notifications
-        lock = DocumentLock('wstore_context', context_id, 'ctx')
-        lock.wait_document()
-
-        context = Context.objects.get(pk=context_id)
-
-        # Get pending product notifications and resend them
-        pending_upgrades = context.failed_upgrades
-
-        failed_upgrades = []
-        for upgrade in pending_upgrades:
-            asset = Resource.objects.get(pk=upgrade['asset_id'])
-            upgrader = InventoryUpgrader(asset)
-
-            # Check if there is a list of products or if it is needed to upgrade all
-            missing_products = []
-            missing_off = []
-            if len(upgrade['pending_products']) > 0:
-                missing_products.extend(upgrader.upgrade_products(upgrade['pending_products'], lambda p_id: p_id))
-
-            if len(upgrade['pending_offerings']) > 0:
-                missing_off, partial_prods = upgrader.upgrade_asset_products(upgrade['pending_offerings'])
-                missing_products.extend(partial_prods)
-
-            if len(missing_products) > 0 or len(missing_off) > 0:
-                failed_upgrades.append({
-                    'asset_id': asset.pk,
-                    'pending_offerings': missing_off,
-                    'pending_products': missing_products
-                })
-
-        context.failed_upgrades = failed_upgrades
-        context.save()
-
-        # Release Context object
-        lock.unlock_document()
+        with DocumentLock('wstore_context', context_id, 'ctx'):
+            context = Context.objects.get(pk=context_id)
+
+            # Get pending product notifications and resend them
+            pending_upgrades = context.failed_upgrades
+
+            failed_upgrades = []
+            for upgrade in pending_upgrades:
+                asset = Resource.objects.get(pk=upgrade['asset_id'])
+                upgrader = InventoryUpgrader(asset)
+
+                # Check if there is a list of products or if it is needed to upgrade all
+                missing_products = []
+                missing_off = []
+                if len(upgrade['pending_products']) > 0:
+                    missing_products.extend(upgrader.upgrade_products(upgrade['pending_products'], lambda p_id: p_id))
+
+                if len(upgrade['pending_offerings']) > 0:
+                    missing_off, partial_prods = upgrader.upgrade_asset_products(upgrade['pending_offerings'])
+                    missing_products.extend(partial_prods)
+
+                if len(missing_products) > 0 or len(missing_off) > 0:
+                    failed_upgrades.append({
+                        'asset_id': asset.pk,
+                        'pending_offerings': missing_off,
+                        'pending_products': missing_products
+                    })
+
+            context.failed_upgrades = failed_upgrades
+            context.save()
@@ -133,8 +133,8 @@ class ResendUpgradeTestCase(TestCase):
         self.assertEquals(0, resend_upgrade.InventoryUpgrader.call_count)
 
         resend_upgrade.DocumentLock.assert_called_once_with('wstore_context', self._ctx_pk, 'ctx')
-        self._lock_inst.wait_document.assert_called_once_with()
-        self._lock_inst.unlock_document.assert_called_once_with()
+        self._lock_inst.__enter__.assert_called_once_with()
+        self._lock_inst.__exit__.assert_called_once_with(None, None, None)
 
     def test_resend_upgrades_pending_locked(self):
         self._ctx_inst.failed_upgrades = [{
@@ -188,8 +188,8 @@ class ResendUpgradeTestCase(TestCase):
         self.assertEquals('1', self._passed_method('1'))
 
         resend_upgrade.DocumentLock.assert_called_once_with('wstore_context', self._ctx_pk, 'ctx')
-        self._lock_inst.wait_document.assert_called_once_with()
-        self._lock_inst.unlock_document.assert_called_once_with()
+        self._lock_inst.__enter__.assert_called_once_with()
+        self._lock_inst.__exit__.assert_called_once_with(None, None, None)
 
     def test_pending_upgrades_no_context(self):
         resend_upgrade.Context.objects.all.return_value = []
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from wstore.ordering.models import Charge
+from wstore.store_commons.database import get_database_connection
+
+
+CHARGES_COLLECTION = 'wstore_charge'
+
+CHARGE_FIELDS = ('concept', 'date', 'cost', 'duty_free', 'currency', 'invoice', 'invoice_status')
+
+# Status of the invoice of a charge
+INVOICE_PENDING = 'pending'
+INVOICE_GENERATED = 'generated'
+INVOICE_FAILED = 'failed'
+
+
+def _get_collection():
+    return get_database_connection()[CHARGES_COLLECTION]
+
+
+def save_charge(order, contract, charge, details=None):
+    """
+    Stores a charge in the charge history and updates the last charge of its concept in the contract.
+    The contract is saved with the order
+    :param order: Order of the charged contract
+    :param contract: Charged contract
+    :param charge: Charge model
+    :param details: Optional dict with the info needed to generate the invoice, only stored in the history
+    :return: ID of the stored charge
+    """
+    summary = {field: charge[field] for field in CHARGE_FIELDS}
+
+    document = {
+        'order': order.pk,
+        'item_id': contract.item_id
+    }
+    document.update(summary)
+
+    if details is not None:
+        document['details'] = details
+
+    charge_id = _get_collection().insert_one(document).inserted_id
+
+    # A new dict is set, so the change is detected when the order is saved
+    contract.last_charges = dict(contract.last_charges or {}, **{charge.concept: summary})
+
+    return charge_id
+
+
+def get_charges(order, item_id=None, concept=None, offset=0, size=None):
+    """
+    Gets the charges made in an order sorted by date
+    :param order: Order whose charges are retrieved
+    :param item_id: Optional item ID used to retrieve the charges of a single contract
+    :param concept: Optional concept used to filter the charges, e.g. usage
+    :param offset: Number of charges to skip
+    :param size: Maximum number of charges to retrieve, all of them if None
+    :return: List of Charge models
+    """
+    query = {
+        'order': order.pk
+    }
+
+    if item_id is not None:
+        query['item_id'] = item_id
+
+    if concept is not None:
+        query['concept'] = concept
+
+    cursor = _get_collection().find(query).sort('date', ASCENDING).skip(offset)
+
+    if size is not None:
+        cursor = cursor.limit(size)
+
+    # Charges stored before a field was included use its default value
+    return [Charge(**{field: document[field] for field in CHARGE_FIELDS if field in document}) for document in cursor]
+
+
+def get_invoice_statuses(charge_ids):
+    """
+    Gets the status of the invoices of a set of charges
+    :param charge_ids: List of charge IDs
+    :return: Dict with the status of the invoice of each charge
+    """
+    documents = _get_collection().find({
+        '_id': {'$in': [ObjectId(charge_id) for charge_id in charge_ids]}
+    }, {'invoice_status': 1})
+
+    return {str(document['_id']): document.get('invoice_status', INVOICE_GENERATED) for document in documents}
+
+
+def get_charge_documents(charge_ids):
+    """
+    Gets the documents stored for a set of charges, including the details of the charge
+    :param charge_ids: List of charge IDs
+    :return: Dict with the document of each charge
+    """
+    documents = _get_collection().find({
+        '_id': {'$in': [ObjectId(charge_id) for charge_id in charge_ids]}
+    })
+
+    return {str(document['_id']): document for document in documents}
+
+
+def set_invoice_status(order, item_id, charge_id, concept, invoice, status):
+    """
+    Updates the status of the invoice of a charge, both in the charge history and, if it is still
+    the last charge of its concept, in the contract
+    """
+    _get_collection().update_one({'_id': ObjectId(charge_id)}, {'$set': {'invoice_status': status}})
+
+    get_database_connection().wstore_order.update_one({
+        '_id': order.pk
+    }, {
+        '$set': {'contracts.$[contract].last_charges.{}.invoice_status'.format(concept): status}
+    }, array_filters=[{
+        'contract.item_id': item_id,
+        'contract.last_charges.{}.invoice'.format(concept): invoice
+    }])
+
@@ -19,13 +19,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
 from datetime import datetime
 from urllib.parse import urljoin
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_session
+
 
 class InventoryClient:
 
@@ -39,7 +40,8 @@ class InventoryClient:
         return urljoin(site, 'charging/api/orderManagement/products')
 
     def get_hubs(self):
-        r = requests.get(self._inventory_api + '/api/productInventory/v2/hub')
+        url = self._inventory_api + '/api/productInventory/v2/hub'
+        r = get_session(url).get(url)
         r.raise_for_status()
         return r.json()
 
@@ -58,7 +60,8 @@ class InventoryClient:
                 'callback': callback_url
             }
 
-            r = requests.post(self._inventory_api + '/api/productInventory/v2/hub', json=callback)
+            url = self._inventory_api + '/api/productInventory/v2/hub'
+            r = get_session(url).post(url, json=callback)
 
             if r.status_code != 201 and r.status_code != 409:
                 msg = "It hasn't been possible to create inventory subscription, "
@@ -69,7 +72,7 @@ class InventoryClient:
     def get_product(self, product_id):
         url = self._inventory_api + '/api/productInventory/v2/product/' + str(product_id)
 
-        r = requests.get(url)
+        r = get_session(url).get(url)
         r.raise_for_status()
 
         return r.json()
@@ -87,7 +90,7 @@ class InventoryClient:
 
         url = self._inventory_api + '/api/productInventory/v2/product' + qs[:-1]
 
-        r = requests.get(url)
+        r = get_session(url).get(url)
         r.raise_for_status()
 
         return r.json()
@@ -101,7 +104,7 @@ class InventoryClient:
         # Build product url
         url = self._inventory_api + '/api/productInventory/v2/product/' + str(product_id)
 
-        r = requests.patch(url, json=patch_body)
+        r = get_session(url).patch(url, json=patch_body)
         r.raise_for_status()
 
         return r.json()
@@ -20,11 +20,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from copy import deepcopy
+from datetime import timedelta
+
 from djongo import models
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save
 
 from wstore.models import Organization, Resource
 from wstore.ordering.errors import OrderingError
+from wstore.store_commons.database import get_database_connection
+
+
+def _to_document(value):
+    # Converts the embedded models into the documents stored in the database
+    if isinstance(value, models.Model):
+        return {field.attname: _to_document(getattr(value, field.attname)) for field in value._meta.concrete_fields}
+
+    if isinstance(value, dict):
+        return {key: _to_document(val) for key, val in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_to_document(val) for val in value]
+
+    return value
 
 
 class Offering(models.Model):
@@ -48,6 +67,8 @@ class Charge(models.Model):
     duty_free = models.CharField(max_length=100)
     currency = models.CharField(max_length=3)
     invoice = models.CharField(max_length=200)
+    # Invoices are generated in background, charges made before have them generated
+    invoice_status = models.CharField(max_length=20, default='generated')
 
     class Meta:
         managed = False
@@ -67,8 +88,10 @@ class Contract(models.Model):
     pricing_model = models.JSONField(default={}) # Dict
     # Date of the last charge to the customer
     last_charge = models.DateTimeField(blank=True, null=True)
-    # List with the made charges
+    # Charges made before the charge history was moved to its own collection, emptied by migration
     charges = models.ArrayField(model_container=Charge, default=[])
+    # Last charge of each concept, the full history is stored in the charge collection
+    last_charges = models.JSONField(default={}) # Dict
 
     # Usage fields
     correlation_number = models.IntegerField(default=0)
@@ -80,12 +103,53 @@ class Contract(models.Model):
     suspended = models.BooleanField(default=False)
     terminated = models.BooleanField(default=False)
 
+    # Next date when the contract has to be renewed, used to find pending charges
+    next_due = models.DateTimeField(blank=True, null=True)
+
     class Meta:
         managed = False
 
     def __getitem__(self, name):
         return getattr(self, name)
 
+    def get_last_charge(self, concept=None):
+        """
+        Gets the last charge made in the contract
+        :param concept: Optional concept of the charge, e.g. usage
+        :return: Charge model or None if no charge has been made
+        """
+        charges = [
+            charge for charge_concept, charge in (self.last_charges or {}).items()
+            if concept is None or charge_concept == concept
+        ]
+
+        if not len(charges):
+            return None
+
+        return Charge(**max(charges, key=lambda charge: charge['date']))
+
+    def get_next_due(self, order_date):
+        """
+        Calculates the next renovation date of the contract
+        :param order_date: Date of the order, used when no usage charge has been made
+        :return: Earliest renovation date or None if the contract has nothing to be renewed
+        """
+        if self.terminated:
+            return None
+
+        due_dates = [
+            subs['renovation_date'] for subs in self.pricing_model.get('subscription', []) if 'renovation_date' in subs
+        ]
+
+        if 'pay_per_use' in self.pricing_model:
+            last_charge = self.get_last_charge('usage')
+            last_charge = last_charge.date if last_charge is not None else order_date
+
+            # Usage payments are renovated every 30 days
+            due_dates.append(last_charge + timedelta(days=30))
+
+        return min(due_dates) if len(due_dates) else None
+
 
 class Payment(models.Model):
     concept = models.CharField(max_length=20, primary_key=True)  # Workarround to prevent issues, not really a primary Key
@@ -119,6 +183,111 @@ class Order(models.Model):
 
     objects = models.DjongoManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        order._track_changes()
+        return order
+
+    def _track_changes(self):
+        # Saves a copy of the values stored in the database, used to calculate the partial updates.
+        # Charges are only appended, so the list and its length are enough to detect new ones
+        if len(self.get_deferred_fields()):
+            self._saved_values = None
+            return
+
+        self._saved_values = {
+            'fields': {
+                field.attname: deepcopy(getattr(self, field.attname))
+                for field in self._meta.concrete_fields if field.attname not in ('_id', 'contracts')
+            },
+            'items': [contract['item_id'] for contract in self.contracts],
+            'contracts': [{
+                'values': {
+                    field.attname: deepcopy(contract[field.attname])
+                    for field in Contract._meta.concrete_fields if field.attname != 'charges'
+                },
+                'charges': contract['charges'],
+                'num_charges': len(contract['charges'] or [])
+            } for contract in self.contracts]
+        }
+
+    def save(self, *args, **kwargs):
+        # Changes made in the contracts returned by the get methods are saved too
+        if getattr(self, '_contracts_index', None) is not None:
+            self.contracts = self.get_contracts()
+
+        super().save(*args, **kwargs)
+        self._track_changes()
+
+    def _get_contract_changes(self, ix, contract, saved_contract, new_values):
+        path = 'contracts.$[c{}].'.format(ix)
+        updated = False
+
+        for name, value in saved_contract['values'].items():
+            if getattr(contract, name) != value:
+                new_values['$set'][path + name] = _to_document(getattr(contract, name))
+                updated = True
+
+        charges = contract.charges
+        num_charges = saved_contract['num_charges']
+
+        if charges is not saved_contract['charges'] or len(charges or []) < num_charges:
+            # The charge history has been replaced
+            new_values['$set'][path + 'charges'] = _to_document(charges)
+            updated = True
+
+        elif charges is not None and len(charges) > num_charges:
+            new_values['$push'][path + 'charges'] = {'$each': _to_document(charges[num_charges:])}
+            updated = True
+
+        return updated
+
+    def save_changes(self):
+        """
+        Saves the fields modified since the order was loaded or saved using a partial update, so
+        only the modified contracts are written and new charges are appended to their history
+        """
+        saved_values = getattr(self, '_saved_values', None)
+
+        if saved_values is None or self._state.adding:
+            self.save()
+            return
+
+        new_values = {
+            '$set': {},
+            '$push': {}
+        }
+        array_filters = []
+
+        for name, value in saved_values['fields'].items():
+            if getattr(self, name) != value:
+                new_values['$set'][name] = _to_document(getattr(self, name))
+
+        contracts = self.get_contracts()
+
+        if [contract.item_id for contract in contracts] != saved_values['items']:
+            # Contracts have been added or removed
+            new_values['$set']['contracts'] = _to_document(contracts)
+        else:
+            for ix, (contract, saved_contract) in enumerate(zip(contracts, saved_values['contracts'])):
+                if self._get_contract_changes(ix, contract, saved_contract, new_values):
+                    array_filters.append({'c{}.item_id'.format(ix): contract.item_id})
+
+        new_values = {operator: values for operator, values in new_values.items() if len(values)}
+
+        if len(new_values):
+            get_database_connection().wstore_order.update_one(
+                {'_id': self.pk}, new_values, array_filters=array_filters or None)
+
+            # The partial update bypasses save, so receivers such as cache invalidations are notified here
+            post_save.send(
+                sender=self.__class__, instance=self, created=False, raw=False, using=self._state.db,
+                update_fields=frozenset(key.split('.')[0] for values in new_values.values() for key in values))
+
+        self.contracts = contracts
+        self._track_changes()
+
     def _build_contract(self, contract_info):
         return Contract(
             item_id=contract_info['item_id'],
@@ -127,37 +296,65 @@ class Order(models.Model):
             pricing_model=contract_info['pricing_model'],
             last_charge=contract_info['last_charge'],
             charges=contract_info['charges'],
+            last_charges=contract_info['last_charges'],
             correlation_number=contract_info['correlation_number'],
             last_usage=contract_info['last_usage'],
             revenue_class=contract_info['revenue_class'],
             suspended=contract_info['suspended'],
-            terminated=contract_info['terminated']
+            terminated=contract_info['terminated'],
+            next_due=contract_info['next_due']
         )
 
+    def _get_contracts_index(self):
+        # Contracts are indexed by item and product ID the first time they are accessed. The index
+        # is rebuilt when the list of contracts is replaced or its size changes
+        index = getattr(self, '_contracts_index', None)
+
+        if index is None or index['source'] is not self.contracts or index['size'] != len(self.contracts):
+            contracts = [
+                contract if isinstance(contract, Contract) else self._build_contract(contract)
+                for contract in self.contracts
+            ]
+
+            # Reversed so the first contract is used in case of duplicated IDs
+            index = {
+                'source': self.contracts,
+                'size': len(self.contracts),
+                'contracts': contracts,
+                'items': {contract.item_id: contract for contract in reversed(contracts)},
+                'products': {
+                    contract.product_id: contract for contract in reversed(contracts) if contract.product_id is not None
+                }
+            }
+            self._contracts_index = index
+
+        return index
+
     def get_contracts(self):
-        return [self._build_contract(contract) for contract in self.contracts]
+        return list(self._get_contracts_index()['contracts'])
 
     def get_item_contract(self, item_id):
-        # Search related contract
-        for c in self.contracts:
-            if c['item_id'] == item_id:
-                contract = c
-                break
-        else:
+        index = self._get_contracts_index()
+
+        if item_id not in index['items']:
             raise OrderingError('Invalid item id')
 
-        return self._build_contract(contract)
+        return index['items'][item_id]
 
     def get_product_contract(self, product_id):
-        # Search related contract
-        for c in self.contracts:
-            if c['product_id'] == product_id:
-                contract = c
-                break
-        else:
-            raise OrderingError('Invalid product id')
-
-        return self._build_contract(contract)
+        index = self._get_contracts_index()
+        contract = index['products'].get(product_id)
+
+        # The product ID is set in the contract once the product is created in the inventory
+        if contract is None or contract.product_id != product_id:
+            for contract in index['contracts']:
+                if contract.product_id == product_id:
+                    index['products'][product_id] = contract
+                    break
+            else:
+                raise OrderingError('Invalid product id')
+
+        return contract
 
     class Meta:
         app_label = 'wstore'
@@ -19,12 +19,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
 from urllib.parse import urljoin
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_session
+
 
 class OrderingClient:
 
@@ -44,7 +45,8 @@ class OrderingClient:
             'callback': urljoin(site, 'charging/api/orderManagement/orders')
         }
 
-        r = requests.post(self._ordering_api + '/productOrdering/v2/hub', callback)
+        url = self._ordering_api + '/productOrdering/v2/hub'
+        r = get_session(url).post(url, callback)
 
         if r.status_code != 200 and r.status_code != 409:
             msg = "It hasn't been possible to create ordering subscription, "
@@ -56,7 +58,7 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + str(order_id)
         url = urljoin(self._ordering_api, path)
 
-        r = requests.get(url)
+        r = get_session(url).get(url)
         r.raise_for_status()
 
         return r.json()
@@ -78,7 +80,7 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + str(order['id'])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_session(url).patch(url, json=patch)
 
         r.raise_for_status()
 
@@ -111,6 +113,6 @@ class OrderingClient:
         path = '/DSProductOrdering/api/productOrdering/v2/productOrder/' + str(order['id'])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_session(url).patch(url, json=patch)
 
         r.raise_for_status()
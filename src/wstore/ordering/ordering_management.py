@@ -21,10 +21,10 @@
 
 
 import re
-import requests
-from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from datetime import datetime
+from requests.exceptions import HTTPError
 from urllib.parse import urlparse
 
 from django.conf import settings
@@ -36,6 +36,8 @@ from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Order, Contract, Offering
 from wstore.asset_manager.product_validator import ProductValidator
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.store_commons.cache import download_catalog_document, get_instance
+from wstore.store_commons.http_session import get_session
 
 
 class OrderingManager:
@@ -45,21 +47,22 @@ class OrderingManager:
         self._validator = ProductValidator()
 
     def _download(self, url, element, item_id):
-        r = requests.get(url, verify=settings.VERIFY_REQUESTS)
-
-        if r.status_code != 200:
+        try:
+            return download_catalog_document(url, verify=settings.VERIFY_REQUESTS)
+        except HTTPError:
             raise OrderingError('The ' + element + ' specified in order item ' + item_id + ' does not exists')
 
-        return r.json()
-
-    def _get_offering(self, item):
-
-        # Download related product offering and product specification
+    def _get_offering_url(self, item):
         site = urlparse(settings.SITE)
         off = urlparse(item['productOffering']['href'])
 
-        offering_url = '{}://{}{}'.format(site.scheme, site.netloc, off.path)
-        offering_info = self._download(offering_url, 'product offering', item['id'])
+        return '{}://{}{}'.format(site.scheme, site.netloc, off.path)
+
+    def _get_offering(self, item, offering_info=None):
+
+        # Download related product offering if it has not been already downloaded
+        if offering_info is None:
+            offering_info = self._download(self._get_offering_url(item), 'product offering', item['id'])
 
         offering_id = offering_info['id']
 
@@ -68,7 +71,7 @@ class OrderingManager:
             offering = Offering.objects.get(off_id=offering_id)
 
             # If the offering defines a digital product, check if the customer already owns it
-            included_offerings = [Offering.objects.get(pk=ObjectId(off_pk)) for off_pk in offering.bundled_offerings]
+            included_offerings = [get_instance(Offering, off_pk) for off_pk in offering.bundled_offerings]
             included_offerings.append(offering)
 
             for off in included_offerings:
@@ -90,13 +93,24 @@ class OrderingManager:
             'usage': 'unitOfMeasure'
         }
 
-        return {
+        price_unit = {
             'value': price['price']['taxIncludedAmount'],
             'unit': price[unit_field[price['priceType'].lower()]].lower(),
             'tax_rate': price['price']['taxRate'],
             'duty_free': price['price']['dutyFreeAmount']
         }
 
+        # Usage prices may define tiers which are applied to the aggregated usage
+        if price['priceType'].lower() == 'usage' and 'priceTier' in price:
+            price_unit['tier_type'] = price['priceTierType'].lower()
+            price_unit['tiers'] = [{
+                'up_to': tier.get('upTo'),
+                'value': tier['taxIncludedAmount'],
+                'duty_free': tier['dutyFreeAmount']
+            } for tier in price['priceTier']]
+
+        return price_unit
+
     def _parse_alteration(self, alteration, type_):
         # Alterations cannot specify usage models
         if alteration['priceType'].lower() != 'one time' and alteration['priceType'].lower() != 'recurring':
@@ -164,11 +178,11 @@ class OrderingManager:
 
         return price
 
-    def _build_contract(self, item):
+    def _build_contract(self, item, offering_info=None):
         # TODO: Check that the ordering API is actually validating that the chosen pricing and characteristics are valid for the given product
 
         # Build offering
-        offering, offering_info = self._get_offering(item)
+        offering, offering_info = self._get_offering(item, offering_info)
 
         # Build pricing if included
         pricing = {}
@@ -223,17 +237,20 @@ class OrderingManager:
             offering=offering.pk
         )
 
-    def _get_billing_address(self, items):
+    def _get_billing_headers(self):
+        headers = {
+            #'Authorization': 'Bearer ' + self._customer.userprofile.access_token
+        }
 
-        def _download_asset(url):
-            headers = {
-                #'Authorization': 'Bearer ' + self._customer.userprofile.access_token
-            }
+        if not self._customer.userprofile.current_organization.private:
+            headers['x-organization'] = self._customer.userprofile.current_organization.name
 
-            if not self._customer.userprofile.current_organization.private:
-                headers['x-organization'] = self._customer.userprofile.current_organization.name
+        return headers
 
-            r = requests.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
+    def _get_billing_address(self, items, headers):
+
+        def _download_asset(url):
+            r = get_session(url).get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
 
             if r.status_code != 200:
                 raise OrderingError('There was an error at the time of retrieving the Billing Address')
@@ -271,16 +288,32 @@ class OrderingManager:
 
     def _process_add_items(self, items, order_id, description, terms_accepted):
 
-        new_contracts = [self._build_contract(item) for item in items]
+        # The offerings and the billing address are downloaded concurrently, each distinct offering
+        # once per order. Contracts are built in this thread, since they access the database
+        with ThreadPoolExecutor(max_workers=settings.ORDERING_WORKERS) as executor:
+            billing_address = executor.submit(self._get_billing_address, items, self._get_billing_headers())
+
+            offerings = {}
+            for item in items:
+                offering_url = self._get_offering_url(item)
+
+                if offering_url not in offerings:
+                    offerings[offering_url] = executor.submit(self._download, offering_url, 'product offering', item['id'])
+
+            new_contracts = [
+                self._build_contract(item, offerings[self._get_offering_url(item)].result()) for item in items
+            ]
+
+            terms_found = False
+            for c in new_contracts:
+                off = get_instance(Offering, c.offering)
+                if off.asset is not None and off.asset.has_terms:
+                    terms_found = True
 
-        terms_found = False
-        for c in new_contracts:
-            off = Offering.objects.get(pk=ObjectId(c.offering))
-            if off.asset is not None and off.asset.has_terms:
-                terms_found = True
+            if terms_found and not terms_accepted:
+                raise OrderingError('You must accept the terms and conditions of the offering to acquire it')
 
-        if terms_found and not terms_accepted:
-            raise OrderingError('You must accept the terms and conditions of the offering to acquire it')
+            tax_address = billing_address.result()
 
         current_org = self._customer.userprofile.current_organization
         order = Order.objects.create(
@@ -289,7 +322,7 @@ class OrderingManager:
             owner_organization=current_org,
             date=datetime.utcnow(),
             state='pending',
-            tax_address=self._get_billing_address(items),
+            tax_address=tax_address,
             contracts=new_contracts,
             description=description
         )
@@ -343,7 +376,7 @@ class OrderingManager:
             contract.pricing_model = new_contract.pricing_model
             contract.revenue_class = new_contract.revenue_class
 
-        order.save()
+        order.save_changes()
 
         # The modified item is treated as an initial payment
         charging_engine = ChargingEngine(order)
@@ -367,7 +400,8 @@ class OrderingManager:
             on_product_suspended(order, contract)
 
             contract.terminated = True
-            order.save()
+            contract.next_due = None
+            order.save_changes()
 
             # Terminate product in the inventory
             client.terminate_product(product['id'])
@@ -230,6 +230,30 @@ USAGE_PRICING = {
     }
 }
 
+TIERED_USAGE_PRICING = {
+    "priceType": "Usage",
+    "unitOfMeasure": "megabyte",
+    "price": {
+        "taxIncludedAmount": "12.00",
+        "dutyFreeAmount": "10.00",
+        "taxRate": "20.00",
+        "currencyCode": "EUR",
+        "percentage": 0
+    },
+    "priceTierType": "Volume",
+    "priceTier": [{
+        "upTo": "100",
+        "taxIncludedAmount": "12.00",
+        "dutyFreeAmount": "10.00"
+    }, {
+        "taxIncludedAmount": "6.00",
+        "dutyFreeAmount": "5.00"
+    }],
+    "recurringChargePeriod": "",
+    "name": "Tiered Usage Charge",
+    "description": "A volume priced usage payment"
+}
+
 FREE_ORDER = {
     "id": "12",
     "state": "Acknowledged",
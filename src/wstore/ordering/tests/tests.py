@@ -24,6 +24,7 @@ from copy import deepcopy
 from parameterized import parameterized
 from mock import MagicMock, call
 from datetime import datetime
+from requests.exceptions import HTTPError
 from urllib.parse import urlparse
 
 from django.contrib.auth.models import User
@@ -33,10 +34,10 @@ from django.test.utils import override_settings
 
 from wstore.models import Organization
 from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Order, Offering, Contract
+from wstore.ordering.models import Order, Offering, Contract, Charge
 
 from wstore.ordering.tests.test_data import *
-from wstore.ordering import ordering_client, ordering_management, inventory_client
+from wstore.ordering import ordering_client, ordering_management, inventory_client, models, charge_history
 
 
 @override_settings(SITE='http://extpath.com:8080/', VERIFY_REQUESTS=True, BILLING='http://apis.docker:8080/DSBillingManagement')
@@ -73,12 +74,34 @@ class OrderingManagementTestCase(TestCase):
         self._charging_inst.resolve_charging.return_value = 'http://redirectionurl.com/'
         ordering_management.ChargingEngine.return_value = self._charging_inst
 
-        # Mock requests
-        ordering_management.requests = MagicMock()
-        self._response = MagicMock()
-        self._response.status_code = 200
-        self._response.json.side_effect = [OFFERING, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, CUSTOMER]
-        ordering_management.requests.get.return_value = self._response
+        # Mock requests, documents are downloaded concurrently so responses are selected by URL
+        self._documents = {
+            '/productOffering/': OFFERING,
+            '/billingAccount/': BILLING_ACCOUNT,
+            '/customerAccount/': CUSTOMER_ACCOUNT,
+            '/customer/': CUSTOMER
+        }
+        self._status_codes = {}
+
+        def get(url, **kwargs):
+            response = MagicMock()
+            for path, document in self._documents.items():
+                if path in url:
+                    response.status_code = self._status_codes.get(path, 200)
+                    response.json.return_value = document
+
+            return response
+
+        def download(url, **kwargs):
+            response = get(url, **kwargs)
+            if response.status_code != 200:
+                raise HTTPError()
+
+            return response.json()
+
+        ordering_management.get_session = MagicMock()
+        ordering_management.get_session().get.side_effect = get
+        ordering_management.download_catalog_document = MagicMock(side_effect=download)
 
         # Mock organization model
         self._org_inst = MagicMock()
@@ -167,6 +190,29 @@ class OrderingManagementTestCase(TestCase):
             }]
         })
 
+    def _tiered_usage_checker(self):
+        self._check_offering_retrieving_call()
+
+        self._check_contract_call({
+            'general_currency': 'EUR',
+            'pay_per_use': [{
+                'value': '12.00',
+                'unit': 'megabyte',
+                'tax_rate': '20.00',
+                'duty_free': '10.00',
+                'tier_type': 'volume',
+                'tiers': [{
+                    'up_to': '100',
+                    'value': '12.00',
+                    'duty_free': '10.00'
+                }, {
+                    'up_to': None,
+                    'value': '6.00',
+                    'duty_free': '5.00'
+                }]
+            }]
+        })
+
     def _free_add_checker(self):
         self._check_offering_retrieving_call()
         self._check_contract_call({})
@@ -248,12 +294,7 @@ class OrderingManagementTestCase(TestCase):
         })
 
     def _invalid_billing(self):
-        valid_response = MagicMock()
-        valid_response.status_code = 200
-        valid_response.json.side_effect = [OFFERING]
-        invalid_response = MagicMock()
-        invalid_response.status_code = 400
-        ordering_management.requests.get.side_effect = [valid_response, invalid_response]
+        self._status_codes['/billingAccount/'] = 400
 
     def _non_digital_offering(self):
         self._validator_inst.parse_characteristics.return_value = (None, None, None)
@@ -261,20 +302,10 @@ class OrderingManagementTestCase(TestCase):
     def _no_offering_description(self):
         new_off = deepcopy(OFFERING)
         del(new_off['description'])
-        self._response.json.side_effect = [new_off, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, CUSTOMER]
+        self._documents['/productOffering/'] = new_off
 
     def _missing_offering(self):
-        self._response.status_code = 404
-
-    def _missing_product(self):
-        def get(url):
-            result = self._response
-            if url == "http://producturl.com/":
-                result = MagicMock()
-                result.status_code = 404
-            return result
-
-        ordering_management.requests.get = get
+        self._status_codes['/productOffering/'] = 404
 
     def _already_owned(self):
         self._offering_inst.pk = '61004aba5e05acc115f022f0'
@@ -301,7 +332,7 @@ class OrderingManagementTestCase(TestCase):
     def _missing_postal(self):
         new_cust = deepcopy(CUSTOMER)
         new_cust['contactMedium'] = []
-        self._response.json.side_effect = [OFFERING, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, new_cust]
+        self._documents['/customer/'] = new_cust
 
     def _terms_not_required(self):
         self._offering_inst.asset.has_terms = False
@@ -314,6 +345,7 @@ class OrderingManagementTestCase(TestCase):
         ('non_digital_add', BASIC_ORDER, BASIC_PRICING, _non_digital_add_checker, _non_digital_offering),
         ('recurring_add', RECURRING_ORDER, RECURRING_PRICING, _recurring_add_checker),
         ('usage_add', USAGE_ORDER, USAGE_PRICING, _usage_add_checker, _no_offering_description),
+        ('tiered_usage_add', USAGE_ORDER, TIERED_USAGE_PRICING, _tiered_usage_checker),
         ('free_add', FREE_ORDER, {}, _free_add_checker),
         ('no_product_add', NOPRODUCT_ORDER, {}, _free_add_checker),
         ('discount', USAGE_ORDER, DISCOUNT_PRICING, _basic_discount_checker, _multiple_pricing),
@@ -360,17 +392,15 @@ class OrderingManagementTestCase(TestCase):
             ordering_management.ChargingEngine.assert_called_once_with(self._order_inst)
 
             # Check offering and product downloads
-            self.assertEquals(4, ordering_management.requests.get.call_count)
+            ordering_management.download_catalog_document.assert_called_once_with(
+                'http://extpath.com:8080/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)', verify=True)
 
-            headers = {'Authorization': 'Bearer ' + self._customer.userprofile.access_token}
-            exp_url = 'http://extpath.com:8080{}'
             exp_billing = 'http://apis.docker:8080{}'
             self.assertEquals([
-                call(exp_url.format('/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)'), verify=True),
                 call(exp_billing.format(urlparse(BILLING_ACCOUNT_HREF).path), headers={}, verify=True),
                 call(exp_billing.format(urlparse(BILLING_ACCOUNT['customerAccount']['href']).path), headers={}, verify=True),
                 call(exp_billing.format(urlparse(CUSTOMER_ACCOUNT['customer']['href']).path), headers={}, verify=True)
-            ], ordering_management.requests.get.call_args_list)
+            ], ordering_management.get_session().get.call_args_list)
 
             contact_medium = CUSTOMER['contactMedium'][0]['medium']
 
@@ -396,6 +426,32 @@ class OrderingManagementTestCase(TestCase):
         else:
             self.assertEquals(err_msg, str(error))
 
+    def test_process_order_multiple_items(self):
+        OFFERING['productOfferingPrice'] = [BASIC_PRICING]
+
+        order = deepcopy(BASIC_ORDER)
+        for item_id in ['2', '3']:
+            item = deepcopy(BASIC_ORDER['orderItem'][0])
+            item['id'] = item_id
+            order['orderItem'].append(item)
+
+        ordering_manager = ordering_management.OrderingManager()
+        redirect_url = ordering_manager.process_order(self._customer, order, terms_accepted=True)
+
+        self.assertEquals('http://redirectionurl.com/', redirect_url)
+
+        # The offering is downloaded once for all the items
+        ordering_management.download_catalog_document.assert_called_once_with(
+            'http://extpath.com:8080/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)', verify=True)
+        self.assertEquals(3, ordering_management.get_session().get.call_count)
+
+        self.assertEquals(['1', '2', '3'], [
+            c[1]['item_id'] for c in ordering_management.Contract.call_args_list
+        ])
+
+        self.assertEquals(
+            [self._contract_inst] * 3, ordering_management.Order.objects.create.call_args[1]['contracts'])
+
     BASIC_MODIFY = {
         'state': 'Acknowledged',
         'orderItem': [{
@@ -513,15 +569,15 @@ class OrderingClientTestCase(TestCase):
         ordering_client.settings.LOCAL_SITE = 'http://testdomain.com'
 
         # Mock requests
-        ordering_client.requests = MagicMock()
+        ordering_client.get_session = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.return_value = {
             'id': '1'
         }
-        ordering_client.requests.post.return_value = self._response
-        ordering_client.requests.patch.return_value = self._response
-        ordering_client.requests.get.return_value = self._response
+        ordering_client.get_session().post.return_value = self._response
+        ordering_client.get_session().patch.return_value = self._response
+        ordering_client.get_session().get.return_value = self._response
 
     def test_ordering_subscription(self):
         client = ordering_client.OrderingClient()
@@ -529,7 +585,7 @@ class OrderingClientTestCase(TestCase):
         client.create_ordering_subscription()
 
         # Check calls
-        ordering_client.requests.post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
+        ordering_client.get_session().post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
             'callback': 'http://testdomain.com/charging/api/orderManagement/orders'
         })
 
@@ -584,7 +640,7 @@ class OrderingClientTestCase(TestCase):
         }
         client.update_items_state(order, 'InProgress', items)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.get_session().patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/20',
             json=expected)
 
@@ -600,7 +656,7 @@ class OrderingClientTestCase(TestCase):
 
         client.update_state(order, new_state)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.get_session().patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/' + order['id'],
             json={'state': new_state})
 
@@ -615,7 +671,7 @@ class OrderingClientTestCase(TestCase):
             'id': '1'
         }, response)
 
-        ordering_client.requests.get.assert_called_once_with(
+        ordering_client.get_session().get.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/1'
         )
         self._response.raise_for_status.assert_called_once_with()
@@ -704,6 +760,384 @@ class OrderTestCase(TestCase):
         contracts = self._order.get_contracts()
         self.assertEquals([self._contract1, self._contract2], contracts)
 
+    def test_get_contracts_cached(self):
+        contract = self._order.get_item_contract('2')
+
+        # The same instance is returned by all the lookups
+        self.assertTrue(contract is self._order.get_product_contract('4'))
+        self.assertTrue(contract is self._order.get_contracts()[1])
+
+        # Lookups by the product ID set after the index is built
+        contract.product_id = '5'
+        self.assertTrue(contract is self._order.get_product_contract('5'))
+
+        with self.assertRaises(OrderingError):
+            self._order.get_product_contract('4')
+
+    def test_get_contracts_from_db(self):
+        # Contracts loaded from the database are built once
+        self._order.contracts = [{
+            'item_id': '1',
+            'product_id': None,
+            'offering': '61004aba5e05acc115f022f0',
+            'pricing_model': {},
+            'last_charge': None,
+            'charges': [],
+            'last_charges': {},
+            'correlation_number': 0,
+            'last_usage': None,
+            'revenue_class': None,
+            'suspended': False,
+            'terminated': False,
+            'next_due': None
+        }]
+
+        contract = self._order.get_item_contract('1')
+        self.assertTrue(isinstance(contract, Contract))
+        self.assertTrue(contract is self._order.get_contracts()[0])
+
+        # The index is rebuilt when the contracts are replaced
+        self._order.contracts = [self._contract2]
+        self.assertEquals([self._contract2], self._order.get_contracts())
+
+        with self.assertRaises(OrderingError):
+            self._order.get_item_contract('1')
+
+
+class ContractTestCase(TestCase):
+
+    tags = ('ordering', )
+
+    _order_date = datetime(2016, 1, 1)
+
+    @parameterized.expand([
+        ('free', {}, {}, False, None),
+        ('single_payment', {'single_payment': [{'value': '1'}]}, {}, False, None),
+        ('subscription', {'subscription': [
+            {'renovation_date': datetime(2016, 3, 1)},
+            {'renovation_date': datetime(2016, 2, 1)}
+        ]}, {}, False, datetime(2016, 2, 1)),
+        ('subscription_not_paid', {'subscription': [{'unit': 'monthly'}]}, {}, False, None),
+        ('usage_not_charged', {'pay_per_use': []}, {}, False, datetime(2016, 1, 31)),
+        ('usage_charged', {'pay_per_use': []}, {
+            'usage': {'concept': 'usage', 'date': datetime(2016, 2, 1)},
+            'initial': {'concept': 'initial', 'date': datetime(2016, 2, 10)}
+        }, False, datetime(2016, 3, 2)),
+        ('mixed', {'pay_per_use': [], 'subscription': [{'renovation_date': datetime(2016, 3, 1)}]}, {}, False, datetime(2016, 1, 31)),
+        ('terminated', {'subscription': [{'renovation_date': datetime(2016, 3, 1)}]}, {}, True, None)
+    ])
+    def test_get_next_due(self, name, pricing, last_charges, terminated, expected):
+        contract = Contract(item_id='1', pricing_model=pricing, last_charges=last_charges, terminated=terminated)
+        self.assertEquals(expected, contract.get_next_due(self._order_date))
+
+    @parameterized.expand([
+        ('no_charges', {}, None, None),
+        ('last', {
+            'initial': {'concept': 'initial', 'date': datetime(2016, 1, 1)},
+            'recurring': {'concept': 'recurring', 'date': datetime(2016, 2, 1)}
+        }, None, datetime(2016, 2, 1)),
+        ('concept', {
+            'initial': {'concept': 'initial', 'date': datetime(2016, 1, 1)},
+            'recurring': {'concept': 'recurring', 'date': datetime(2016, 2, 1)}
+        }, 'initial', datetime(2016, 1, 1)),
+        ('missing_concept', {
+            'initial': {'concept': 'initial', 'date': datetime(2016, 1, 1)}
+        }, 'usage', None)
+    ])
+    def test_get_last_charge(self, name, last_charges, concept, expected):
+        contract = Contract(item_id='1', last_charges=last_charges)
+        charge = contract.get_last_charge(concept)
+
+        if expected is None:
+            self.assertTrue(charge is None)
+        else:
+            self.assertTrue(isinstance(charge, Charge))
+            self.assertEquals(expected, charge.date)
+
+
+class ChargeHistoryTestCase(TestCase):
+
+    tags = ('ordering', 'charges')
+
+    def setUp(self):
+        self._get_database_connection = charge_history.get_database_connection
+        charge_history.get_database_connection = MagicMock()
+        self._collection = charge_history.get_database_connection().__getitem__.return_value
+
+        self._order = MagicMock(pk=ObjectId('61004aba5e05acc115f022f2'))
+        self._charge_info = {
+            'concept': 'recurring',
+            'date': datetime(2016, 2, 1),
+            'cost': '12.00',
+            'duty_free': '10.00',
+            'currency': 'EUR',
+            'invoice': '/charging/media/bills/bill1.pdf',
+            'invoice_status': 'pending'
+        }
+
+    def tearDown(self):
+        charge_history.get_database_connection = self._get_database_connection
+
+    def test_save_charge(self):
+        initial = dict(self._charge_info, concept='initial', date=datetime(2016, 1, 1))
+        last_charges = {'initial': initial}
+        contract = Contract(item_id='1', last_charges=last_charges)
+
+        self._collection.insert_one.return_value.inserted_id = 'charge'
+        charge_id = charge_history.save_charge(self._order, contract, Charge(**self._charge_info))
+
+        self.assertEquals('charge', charge_id)
+        charge_history.get_database_connection().__getitem__.assert_called_once_with('wstore_charge')
+        self._collection.insert_one.assert_called_once_with(dict(self._charge_info, order=self._order.pk, item_id='1'))
+
+        self.assertEquals({
+            'initial': initial,
+            'recurring': self._charge_info
+        }, contract.last_charges)
+
+        # A new dict is set in the contract
+        self.assertFalse(contract.last_charges is last_charges)
+
+    def test_save_charge_details(self):
+        contract = Contract(item_id='1')
+        details = {'rating_job': '61004aba5e05acc115f022f0'}
+
+        charge_history.save_charge(self._order, contract, Charge(**self._charge_info), details=details)
+
+        # The details are only stored in the charge history
+        self._collection.insert_one.assert_called_once_with(
+            dict(self._charge_info, order=self._order.pk, item_id='1', details=details))
+        self.assertEquals({'recurring': self._charge_info}, contract.last_charges)
+
+    @parameterized.expand([
+        ('all', {}, {}),
+        ('filtered', {'item_id': '1', 'concept': 'usage'}, {'item_id': '1', 'concept': 'usage'}),
+        ('paginated', {'offset': 10, 'size': 5}, {})
+    ])
+    def test_get_charges(self, name, kwargs, exp_query):
+        cursor = self._collection.find.return_value.sort.return_value.skip.return_value
+        cursor.limit.return_value = [dict(self._charge_info, _id='1', order=self._order.pk, item_id='1')]
+        cursor.__iter__.return_value = iter(cursor.limit.return_value)
+
+        charges = charge_history.get_charges(self._order, **kwargs)
+
+        self._collection.find.assert_called_once_with(dict(exp_query, order=self._order.pk))
+        self._collection.find().sort.assert_called_once_with('date', 1)
+        self._collection.find().sort().skip.assert_called_once_with(kwargs.get('offset', 0))
+
+        if 'size' in kwargs:
+            cursor.limit.assert_called_once_with(kwargs['size'])
+        else:
+            self.assertEquals(0, cursor.limit.call_count)
+
+        self.assertEquals(1, len(charges))
+        self.assertTrue(isinstance(charges[0], Charge))
+        self.assertEquals(self._charge_info, {field: charges[0][field] for field in charge_history.CHARGE_FIELDS})
+
+    def test_get_charges_default_fields(self):
+        # Charges stored before invoices were generated in background do not include its status
+        document = dict(self._charge_info, _id='1', order=self._order.pk, item_id='1')
+        del document['invoice_status']
+
+        cursor = self._collection.find.return_value.sort.return_value.skip.return_value
+        cursor.__iter__.return_value = iter([document])
+
+        charges = charge_history.get_charges(self._order)
+
+        self.assertEquals(1, len(charges))
+        self.assertEquals('generated', charges[0].invoice_status)
+
+    def test_get_invoice_statuses(self):
+        self._collection.find.return_value = [{
+            '_id': ObjectId('61004aba5e05acc115f022f0'),
+            'invoice_status': 'pending'
+        }, {
+            '_id': ObjectId('61004aba5e05acc115f022f1')
+        }]
+
+        statuses = charge_history.get_invoice_statuses(['61004aba5e05acc115f022f0', '61004aba5e05acc115f022f1'])
+
+        self._collection.find.assert_called_once_with({
+            '_id': {'$in': [ObjectId('61004aba5e05acc115f022f0'), ObjectId('61004aba5e05acc115f022f1')]}
+        }, {'invoice_status': 1})
+
+        self.assertEquals({
+            '61004aba5e05acc115f022f0': 'pending',
+            '61004aba5e05acc115f022f1': 'generated'
+        }, statuses)
+
+    def test_get_charge_documents(self):
+        documents = [
+            dict(self._charge_info, _id=ObjectId('61004aba5e05acc115f022f0'), details={'related_model': {}}),
+            dict(self._charge_info, _id=ObjectId('61004aba5e05acc115f022f1'))
+        ]
+        self._collection.find.return_value = documents
+
+        charges = charge_history.get_charge_documents(['61004aba5e05acc115f022f0', '61004aba5e05acc115f022f1'])
+
+        self._collection.find.assert_called_once_with({
+            '_id': {'$in': [ObjectId('61004aba5e05acc115f022f0'), ObjectId('61004aba5e05acc115f022f1')]}
+        })
+        self.assertEquals({
+            '61004aba5e05acc115f022f0': documents[0],
+            '61004aba5e05acc115f022f1': documents[1]
+        }, charges)
+
+    def test_set_invoice_status(self):
+        charge_history.set_invoice_status(
+            self._order, '1', '61004aba5e05acc115f022f0', 'recurring', '/charging/media/bills/bill1.pdf', 'generated')
+
+        self._collection.update_one.assert_called_once_with(
+            {'_id': ObjectId('61004aba5e05acc115f022f0')}, {'$set': {'invoice_status': 'generated'}})
+
+        charge_history.get_database_connection().wstore_order.update_one.assert_called_once_with({
+            '_id': self._order.pk
+        }, {
+            '$set': {'contracts.$[contract].last_charges.recurring.invoice_status': 'generated'}
+        }, array_filters=[{
+            'contract.item_id': '1',
+            'contract.last_charges.recurring.invoice': '/charging/media/bills/bill1.pdf'
+        }])
+
+
+class OrderChangesTestCase(TestCase):
+
+    tags = ('ordering', )
+
+    def setUp(self):
+        self._get_database_connection = models.get_database_connection
+        models.get_database_connection = MagicMock()
+
+        self._post_save = models.post_save
+        models.post_save = MagicMock()
+
+        self._charge = {
+            'concept': 'initial',
+            'date': datetime(2016, 1, 1),
+            'cost': '10.00',
+            'duty_free': '8.00',
+            'currency': 'EUR',
+            'invoice': ''
+        }
+
+        self._order = Order(
+            pk=ObjectId('61004aba5e05acc115f022f2'),
+            order_id='1',
+            state='paid',
+            contracts=[self._build_contract('1'), self._build_contract('2')]
+        )
+
+        # Simulate that the order has been loaded from the database
+        self._order._state.adding = False
+        self._order._track_changes()
+
+    def tearDown(self):
+        models.get_database_connection = self._get_database_connection
+        models.post_save = self._post_save
+
+    def _validate_saved(self, update_fields):
+        # Receivers of the save signal, like the SDR context cache, are notified of the partial update
+        models.post_save.send.assert_called_once_with(
+            sender=Order, instance=self._order, created=False, raw=False, using=self._order._state.db,
+            update_fields=frozenset(update_fields))
+
+    def _build_contract(self, item_id):
+        return {
+            'item_id': item_id,
+            'product_id': None,
+            'offering': '61004aba5e05acc115f022f0',
+            'pricing_model': {'subscription': [{'unit': 'monthly', 'renovation_date': datetime(2016, 2, 1)}]},
+            'last_charge': datetime(2016, 1, 1),
+            'charges': [self._charge],
+            'last_charges': {},
+            'correlation_number': 0,
+            'last_usage': None,
+            'revenue_class': None,
+            'suspended': False,
+            'terminated': False,
+            'next_due': datetime(2016, 2, 1)
+        }
+
+    def test_save_no_changes(self):
+        self._order.get_contracts()
+        self._order.save_changes()
+
+        self.assertEquals(0, models.get_database_connection.call_count)
+        models.post_save.send.assert_not_called()
+
+    def test_save_order_fields(self):
+        self._order.state = 'pending'
+        self._order.pending_payment = {
+            'concept': 'recurring',
+            'transactions': [{'item': '1'}],
+            'free_contracts': []
+        }
+        self._order.save_changes()
+
+        models.get_database_connection().wstore_order.update_one.assert_called_once_with({
+            '_id': ObjectId('61004aba5e05acc115f022f2')
+        }, {
+            '$set': {
+                'state': 'pending',
+                'pending_payment': {
+                    'concept': 'recurring',
+                    'transactions': [{'item': '1'}],
+                    'free_contracts': []
+                }
+            }
+        }, array_filters=None)
+        self._validate_saved(['state', 'pending_payment'])
+
+    def test_save_contract_changes(self):
+        charge = Charge(
+            concept='recurring', date=datetime(2016, 2, 1), cost='10.00', duty_free='8.00', currency='EUR', invoice='')
+
+        contract = self._order.get_item_contract('2')
+        contract.last_charge = datetime(2016, 2, 1)
+        contract.pricing_model['subscription'][0]['renovation_date'] = datetime(2016, 3, 1)
+        contract.charges.append(charge)
+
+        self._order.save_changes()
+
+        models.get_database_connection().wstore_order.update_one.assert_called_once_with({
+            '_id': ObjectId('61004aba5e05acc115f022f2')
+        }, {
+            '$set': {
+                'contracts.$[c1].pricing_model': {
+                    'subscription': [{'unit': 'monthly', 'renovation_date': datetime(2016, 3, 1)}]
+                },
+                'contracts.$[c1].last_charge': datetime(2016, 2, 1)
+            },
+            '$push': {
+                'contracts.$[c1].charges': {'$each': [{
+                    'concept': 'recurring',
+                    'date': datetime(2016, 2, 1),
+                    'cost': '10.00',
+                    'duty_free': '8.00',
+                    'currency': 'EUR',
+                    'invoice': '',
+                    'invoice_status': 'generated'
+                }]}
+            }
+        }, array_filters=[{'c1.item_id': '2'}])
+        self._validate_saved(['contracts'])
+
+        # The saved values are updated
+        models.get_database_connection.reset_mock()
+        self._order.save_changes()
+        self.assertEquals(0, models.get_database_connection.call_count)
+
+    def test_save_contracts_replaced(self):
+        contract = self._order.get_item_contract('1')
+        contract.charges = []
+
+        self._order.contracts = [contract]
+        self._order.save_changes()
+
+        update = models.get_database_connection().wstore_order.update_one.call_args[0][1]
+        self.assertEquals(['contracts'], list(update['$set'].keys()))
+        self.assertEquals('1', update['$set']['contracts'][0]['item_id'])
+        self.assertEquals([], update['$set']['contracts'][0]['charges'])
 
 
 @override_settings(
@@ -715,11 +1149,11 @@ class InventoryClientTestCase(TestCase):
 
     def setUp(self):
         # Mock requests
-        inventory_client.requests = MagicMock()
+        inventory_client.get_session = MagicMock()
         self.response = MagicMock()
         self.response.status_code = 201
-        inventory_client.requests.post.return_value = self.response
-        inventory_client.requests.get.return_value = self.response
+        inventory_client.get_session().post.return_value = self.response
+        inventory_client.get_session().get.return_value = self.response
 
         inventory_client.settings.LOCAL_SITE = 'http://localhost:8004/'
 
@@ -746,17 +1180,17 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.create_inventory_subscription()
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
+        inventory_client.get_session().get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
 
         if created:
-            inventory_client.requests.post.assert_called_once_with(
+            inventory_client.get_session().post.assert_called_once_with(
                 'http://localhost:8080/DSProductInventory/api/productInventory/v2/hub',
                 json={
                     'callback': 'http://localhost:8004/charging/api/orderManagement/products'
                 }
             )
         else:
-            self.assertEquals(0, inventory_client.requests.post.call_count)
+            self.assertEquals(0, inventory_client.get_session().post.call_count)
 
     def test_create_subscription_error(self):
         self.response.json.return_value = []
@@ -779,20 +1213,20 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.activate_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.get_session().patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Active',
             'startDate': '2016-01-22T04:10:25.176751Z'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.get_session().patch().raise_for_status.assert_called_once_with()
 
     def test_suspend_product(self):
         client = inventory_client.InventoryClient()
         client.suspend_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.get_session().patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Suspended'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.get_session().patch().raise_for_status.assert_called_once_with()
 
     def test_terminate_product(self):
         client = inventory_client.InventoryClient()
@@ -807,16 +1241,16 @@ class InventoryClientTestCase(TestCase):
                 'status': 'Terminated',
                 'terminationDate': '2016-01-22T04:10:25.176751Z'
             })
-        ], inventory_client.requests.patch.call_args_list)
+        ], inventory_client.get_session().patch.call_args_list)
 
-        self.assertEquals([call(), call()], inventory_client.requests.patch().raise_for_status.call_args_list)
+        self.assertEquals([call(), call()], inventory_client.get_session().patch().raise_for_status.call_args_list)
 
     def test_get_product(self):
         client = inventory_client.InventoryClient()
         client.get_product('1')
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.get_session().get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
+        inventory_client.get_session().get().raise_for_status.assert_called_once_with()
 
     @parameterized.expand([
         ('all', {}, ''),
@@ -826,7 +1260,7 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         products = client.get_products(query=query)
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.get_session().get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
+        inventory_client.get_session().get().raise_for_status.assert_called_once_with()
 
-        self.assertEquals(inventory_client.requests.get().json(), products)
+        self.assertEquals(inventory_client.get_session().get().json(), products)
@@ -176,13 +176,13 @@ class InventoryCollectionTestCase(TestCase):
     _ren_date = datetime(2016, 6, 1)
 
     def _initial_charge(self):
-        self.contract.charges = [MagicMock()]
+        self.contract.last_charges = {'initial': {}}
         self.contract.pricing_model = {
             'single_payment': []
         }
 
     def _subscription_charge(self):
-        self.contract.charges = [MagicMock()]
+        self.contract.last_charges = {'initial': {}}
         self.contract.pricing_model = {
             'subscription': [{
                 'renovation_date': self._ren_date
@@ -190,12 +190,7 @@ class InventoryCollectionTestCase(TestCase):
         }
 
     def _missing_contract(self):
-        self.contract.offering= '61004aba5e05acc115f022f0'
-        offering = MagicMock()
-        offering.off_id = 26
-
-        views.Offering = MagicMock()
-        views.Offering.objects.get.return_value = offering
+        views.Offering.objects.filter.return_value = []
 
     def _activation_error(self):
         views.on_product_acquired.side_effect = Exception('Error')
@@ -229,17 +224,14 @@ class InventoryCollectionTestCase(TestCase):
         self.contract = MagicMock()
         self.contract.offering = '61004aba5e05acc115f022f0';
 
-        offering = MagicMock()
+        offering = MagicMock(pk='61004aba5e05acc115f022f0')
         offering.off_id = 10
 
         contract1 = MagicMock()
         contract1.offering = '61004aba5e05acc115f022f1';
 
-        offering2 = MagicMock()
-        offering2.off_id = 20
-
         views.Offering = MagicMock()
-        views.Offering.objects.get.side_effect = [offering2, offering]
+        views.Offering.objects.filter.return_value = [offering]
 
         order = MagicMock()
         order.get_contracts.return_value = [contract1, self.contract]
@@ -255,6 +247,8 @@ class InventoryCollectionTestCase(TestCase):
 
         if called:
             views.Order.objects.get.assert_called_once_with(order_id='23')
+            views.Offering.objects.filter.assert_called_once_with(off_id=10)
+            self.assertEquals([contract1, self.contract], order.contracts)
             views.on_product_acquired.assert_called_once_with(order, self.contract)
             views.InventoryClient.assert_called_once_with()
             views.InventoryClient().activate_product.assert_called_once_with(1)
@@ -262,8 +256,9 @@ class InventoryCollectionTestCase(TestCase):
 
         if billing_exp:
             views.BillingClient.assert_called_once_with()
+            self.contract.get_last_charge.assert_called_once_with('initial')
             views.BillingClient().create_charge.assert_called_once_with(
-                self.contract.charges[0], data['event']['product']['id'], start_date=None, end_date=exp_date)
+                self.contract.get_last_charge(), data['event']['product']['id'], start_date=None, end_date=exp_date)
         else:
             self.assertEquals(0, views.BillingClient.call_count)
 
@@ -392,4 +387,85 @@ class RenovationCollectionTestCase(TestCase):
                 type_=concept, related_contracts=[views.Order.objects.get().get_product_contract()])
 
             views.on_usage_refreshed.assert_called_once_with(
-                views.Order.objects.get(), views.Order.objects.get().get_product_contract())
\ No newline at end of file
+                views.Order.objects.get(), views.Order.objects.get().get_product_contract())
+
+class ChargeCollectionTestCase(TestCase):
+
+    tags = ('ordering', 'charges-view')
+
+    def setUp(self):
+        self.request = MagicMock()
+        self.request.META.get.return_value = 'application/json'
+        self.request.user.is_anonymous = False
+        self.request.user.is_staff = False
+        self.request.GET = {}
+
+        self._order = MagicMock()
+        self._order.owner_organization = self.request.user.userprofile.current_organization
+        self._order.get_product_contract.return_value.item_id = '2'
+
+        views.Order = MagicMock()
+        views.Order.objects.get.return_value = self._order
+
+        views.get_charges = MagicMock(return_value=[MagicMock(
+            concept='recurring',
+            date=datetime(2016, 2, 1, 10, 0, 0),
+            cost='12.00',
+            duty_free='10.00',
+            currency='EUR',
+            invoice='/charging/media/bills/bill1.pdf',
+            invoice_status='generated'
+        )])
+
+    def _not_found(self):
+        views.Order.objects.get.side_effect = Exception('Not found')
+
+    def _forbidden(self):
+        self._order.owner_organization = MagicMock()
+
+    def _admin(self):
+        self._order.owner_organization = MagicMock()
+        self.request.user.is_staff = True
+
+    def _product_not_found(self):
+        self._order.get_product_contract.side_effect = OrderingError('Invalid product id')
+
+    @parameterized.expand([
+        ('basic', {}, 200),
+        ('filtered', {'productId': '4', 'concept': 'recurring'}, 200, None, None, '2', 'recurring'),
+        ('paginated', {'offset': '10', 'size': '5'}, 200, None, None, None, None, 10, 5),
+        ('admin', {}, 200, None, _admin),
+        ('not_found', {}, 404, 'The specified order does not exist', _not_found),
+        ('forbidden', {}, 403, 'You are not authorized to access the charges of the specified order', _forbidden),
+        ('product_not_found', {'productId': '4'}, 404, 'The specified product does not exist', _product_not_found),
+        ('invalid_size', {'size': '0'}, 400, 'Invalid pagination limits'),
+        ('invalid_offset', {'offset': 'a'}, 400, 'Invalid pagination limits')
+    ])
+    def test_get_charges(self, name, params, exp_code, error=None, side_effect=None, item_id=None, concept=None, offset=0, size=None):
+        self.request.GET = params
+
+        if side_effect is not None:
+            side_effect(self)
+
+        collection = views.ChargeCollection(permitted_methods=('GET',))
+        response = collection.read(self.request, '1')
+        body = json.loads(response.content)
+
+        self.assertEquals(exp_code, response.status_code)
+
+        if error is not None:
+            self.assertEquals({'result': 'error', 'error': error}, body)
+            return
+
+        views.Order.objects.get.assert_called_once_with(order_id='1')
+        views.get_charges.assert_called_once_with(self._order, item_id=item_id, concept=concept, offset=offset, size=size)
+
+        self.assertEquals([{
+            'concept': 'recurring',
+            'date': '2016-02-01T10:00:00Z',
+            'cost': '12.00',
+            'dutyFree': '10.00',
+            'currency': 'EUR',
+            'invoice': '/charging/media/bills/bill1.pdf',
+            'invoiceStatus': 'generated'
+        }], body)
@@ -28,10 +28,12 @@ from wstore.ordering.models import Offering
 from wstore.charging_engine.charging_engine import ChargingEngine
 from wstore.ordering.errors import OrderingError
 from wstore.charging_engine.charging.billing_client import BillingClient
+from wstore.ordering.charge_history import get_charges
 from wstore.ordering.ordering_management import OrderingManager
 from wstore.ordering.ordering_client import OrderingClient
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.store_commons.resource import Resource
+from wstore.store_commons.utils.dates import format_timestamp
 from wstore.store_commons.utils.http import build_response, supported_request_mime_types, authentication_required
 from wstore.ordering.models import Order
 from wstore.asset_manager.resource_plugins.decorators import on_product_acquired, on_product_suspended, on_usage_refreshed
@@ -122,13 +124,12 @@ class InventoryCollection(Resource):
         contract = None
 
         # Search contract
-        new_contracts = []
-        for cont in order.get_contracts():
-            off = Offering.objects.get(pk=ObjectId(cont.offering))
-            if product['productOffering']['id'] == off.off_id:
-                contract = cont
+        offerings = [str(off.pk) for off in Offering.objects.filter(off_id=product['productOffering']['id'])]
+        contracts = order.get_contracts()
 
-            new_contracts.append(cont)
+        for cont in contracts:
+            if str(cont.offering) in offerings:
+                contract = cont
 
         if contract is None:
             return build_response(request, 404, 'There is not a contract for the specified product')
@@ -137,8 +138,8 @@ class InventoryCollection(Resource):
         contract.product_id = product['id']
 
         # Needed to update the contract info with new model
-        order.contracts = new_contracts
-        order.save()
+        order.contracts = contracts
+        order.save_changes()
 
         # Activate asset
         try:
@@ -151,14 +152,15 @@ class InventoryCollection(Resource):
         inventory_client.activate_product(product['id'])
 
         # Create the initial charge in the billing API
-        if contract.charges is not None and len(contract.charges) == 1:
+        if list(contract.last_charges or {}) == ['initial']:
             billing_client = BillingClient()
             valid_to = None
             # If the initial charge was a subscription is needed to determine the expiration date
             if 'subscription' in contract.pricing_model:
                 valid_to = contract.pricing_model['subscription'][0]['renovation_date']
 
-            billing_client.create_charge(contract.charges[0], contract.product_id, start_date=None, end_date=valid_to)
+            billing_client.create_charge(
+                contract.get_last_charge('initial'), contract.product_id, start_date=None, end_date=valid_to)
 
         return build_response(request, 200, 'OK')
 
@@ -216,7 +218,7 @@ def process_product_payment(self, request, task, order, contract):
 
                 # Change product state to active
                 contract.suspended = False
-                order.save()
+                order.save_changes()
 
                 inventory_client = InventoryClient()
                 inventory_client.activate_product(contract.product_id)
@@ -260,7 +262,7 @@ class UnsubscriptionCollection(Resource):
             on_product_suspended(order, contract)
 
             contract.suspended = True
-            order.save()
+            order.save_changes()
 
             client = InventoryClient()
             client.suspend_product(contract.product_id)
@@ -288,3 +290,50 @@ class RenovationCollection(Resource):
             response['X-Redirect-URL'] = redirect_url
 
         return response
+
+
+class ChargeCollection(Resource):
+
+    @authentication_required
+    def read(self, request, order_id):
+        """
+        Retrieves the charges made in an order sorted by date. Supports the productId and
+        concept filters and offset and size pagination params
+        """
+        try:
+            order = Order.objects.get(order_id=order_id)
+        except:
+            return build_response(request, 404, 'The specified order does not exist')
+
+        if order.owner_organization != request.user.userprofile.current_organization and not request.user.is_staff:
+            return build_response(request, 403, 'You are not authorized to access the charges of the specified order')
+
+        try:
+            offset = int(request.GET.get('offset', 0))
+            size = int(request.GET['size']) if 'size' in request.GET else None
+        except ValueError:
+            return build_response(request, 400, 'Invalid pagination limits')
+
+        if offset < 0 or (size is not None and size <= 0):
+            return build_response(request, 400, 'Invalid pagination limits')
+
+        item_id = None
+        if 'productId' in request.GET:
+            try:
+                item_id = order.get_product_contract(request.GET['productId']).item_id
+            except OrderingError:
+                return build_response(request, 404, 'The specified product does not exist')
+
+        charges = get_charges(order, item_id=item_id, concept=request.GET.get('concept'), offset=offset, size=size)
+
+        response = [{
+            'concept': charge.concept,
+            'date': format_timestamp(charge.date),
+            'cost': charge.cost,
+            'dutyFree': charge.duty_free,
+            'currency': charge.currency,
+            'invoice': charge.invoice,
+            'invoiceStatus': charge.invoice_status
+        } for charge in charges]
+
+        return HttpResponse(json.dumps(response), status=200, content_type='application/json; charset=utf-8')
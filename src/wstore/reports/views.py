@@ -23,7 +23,8 @@ import json
 
 from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, supported_request_mime_types
-from wstore.charging_engine.payout_engine import PayoutEngine
+from wstore.charging_engine.payment_client.paypal_client import PayPalClient
+from wstore.charging_engine.payout_engine import PayoutEngine, notify_payout
 
 
 class ReportReceiver(Resource):
@@ -52,3 +53,25 @@ class ReportReceiver(Resource):
         payouteng = PayoutEngine()
         payouteng.process_unpaid()
         return build_response(request, 200)
+
+
+class PayoutNotificationReceiver(Resource):
+
+    @supported_request_mime_types(('application/json',))
+    def create(self, request):
+        # PayPal webhook for payout events, it avoids waiting for the next status check of the batch
+        if not PayPalClient(None).verify_webhook(request.headers, request.body.decode('utf-8')):
+            return build_response(request, 403, 'The provided PayPal event is not correctly signed')
+
+        try:
+            resource = json.loads(request.body)['resource']
+
+            # Batch events include the batch header, while item events include the batch id
+            payout_id = resource.get('batch_header', {}).get('payout_batch_id', resource.get('payout_batch_id'))
+        except:
+            return build_response(request, 400, 'The provided data is not a valid PayPal event')
+
+        if payout_id is not None:
+            notify_payout(payout_id)
+
+        return build_response(request, 200)
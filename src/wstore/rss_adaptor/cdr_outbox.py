@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from django.conf import settings
+
+from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
+from wstore.store_commons.concurrency import PollingWorker, process_local
+from wstore.store_commons.database import get_database_connection
+
+
+OUTBOX_COLLECTION = 'wstore_cdr_outbox'
+
+# Batch in flight of each owner organization, so the RSS receives the CDRs of an owner in order
+OWNERS_COLLECTION = 'wstore_cdr_outbox_owner'
+
+PENDING = 'pending'
+SENDING = 'sending'
+FAILED = 'failed'
+
+
+class CDROutbox(object):
+    """
+    Persistent queue of the CDRs that have to be sent to the RSS
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[OUTBOX_COLLECTION]
+        self._owners = get_database_connection()[OWNERS_COLLECTION]
+
+    def _get_retry_delay(self, attempts):
+        delay = min(settings.CDR_OUTBOX_RETRY_DELAY * (2 ** (attempts - 1)), settings.CDR_OUTBOX_MAX_RETRY_DELAY)
+
+        # Add some jitter so retries of different batches do not synchronize
+        return delay + random.uniform(0, delay / 10.0)
+
+    def enqueue(self, cdrs, state=PENDING):
+        if not len(cdrs):
+            return
+
+        now = datetime.utcnow()
+        self._collection.insert_many([{
+            'cdr': cdr,
+            'owner': cdr['provider'],
+            'correlation': int(cdr['correlation']),
+            'state': state,
+            'attempts': 0,
+            'created': now,
+            'next_attempt': now
+        } for cdr in cdrs])
+
+    def _is_ready(self, entry, now):
+        return (entry['state'] == PENDING and entry['next_attempt'] <= now) or \
+            (entry['state'] == SENDING and entry['lease_expires'] < now)
+
+    def _lock_owner(self, owner, batch_id, now):
+        try:
+            return self._owners.find_one_and_update({
+                '_id': owner,
+                '$or': [{'batch': None}, {'lease_expires': {'$lt': now}}]
+            }, {
+                '$set': {
+                    'batch': batch_id,
+                    'lease_expires': now + timedelta(seconds=settings.CDR_OUTBOX_LEASE)
+                }
+            }, upsert=True, return_document=ReturnDocument.AFTER) is not None
+        except DuplicateKeyError:
+            # The owner already has a batch in flight
+            return False
+
+    def _release_owner(self, owner, batch_id):
+        self._owners.update_one({'_id': owner, 'batch': batch_id}, {'$set': {'batch': None, 'lease_expires': None}})
+
+    def _get_ready_head(self, owner, limit, now):
+        """
+        Gets the first CDRs of an owner that are ready to be sent, in correlation number
+        order. A CDR waiting to be retried holds back the following ones
+        """
+        entries = self._collection.find({'owner': owner, 'state': {'$in': [PENDING, SENDING]}}, {
+            'state': 1, 'next_attempt': 1, 'lease_expires': 1
+        }).sort('correlation', ASCENDING).limit(limit)
+
+        ids = []
+        for entry in entries:
+            if not self._is_ready(entry, now):
+                break
+
+            ids.append(entry['_id'])
+
+        return ids
+
+    def claim(self, limit):
+        """
+        Takes the ownership of a batch of CDRs ready to be sent. CDRs whose sender did not finish
+        in time are considered ready again. Each owner organization has at most a batch in flight,
+        and its CDRs are claimed in correlation number order
+        :param limit: Maximum number of CDRs to be claimed
+        :return: List of outbox entries, all of them of the same owner
+        """
+        now = datetime.utcnow()
+        ready = {
+            '$or': [
+                {'state': PENDING, 'next_attempt': {'$lte': now}},
+                {'state': SENDING, 'lease_expires': {'$lt': now}}
+            ]
+        }
+
+        batch_id = ObjectId()
+        for owner in sorted(self._collection.distinct('owner', ready)):
+            if not self._lock_owner(owner, batch_id, now):
+                continue
+
+            ids = self._get_ready_head(owner, limit, now)
+
+            if not len(ids):
+                self._release_owner(owner, batch_id)
+                continue
+
+            query = {'_id': {'$in': ids}}
+            query.update(ready)
+
+            # Only the entries that are still ready when updating are claimed by this batch
+            self._collection.update_many(query, {
+                '$set': {
+                    'state': SENDING,
+                    'batch': batch_id,
+                    'lease_expires': now + timedelta(seconds=settings.CDR_OUTBOX_LEASE)
+                }
+            })
+
+            entries = list(self._collection.find({'batch': batch_id}).sort('correlation', ASCENDING))
+
+            if len(entries):
+                return entries
+
+            self._release_owner(owner, batch_id)
+
+        return []
+
+    def complete(self, entries):
+        self._collection.delete_many({
+            '_id': {'$in': [entry['_id'] for entry in entries]},
+            'batch': entries[0]['batch']
+        })
+        self._release_owner(entries[0]['owner'], entries[0]['batch'])
+
+    def retry(self, entries, error):
+        now = datetime.utcnow()
+        updates = []
+
+        for entry in entries:
+            attempts = entry['attempts'] + 1
+            new_values = {
+                'attempts': attempts,
+                'last_error': error
+            }
+
+            if attempts >= settings.CDR_OUTBOX_MAX_ATTEMPTS:
+                new_values['state'] = FAILED
+            else:
+                new_values['state'] = PENDING
+                new_values['next_attempt'] = now + timedelta(seconds=self._get_retry_delay(attempts))
+
+            updates.append(UpdateOne({'_id': entry['_id'], 'batch': entry['batch']}, {
+                '$set': new_values,
+                '$unset': {'batch': '', 'lease_expires': ''}
+            }))
+
+        self._collection.bulk_write(updates, ordered=False)
+        self._release_owner(entries[0]['owner'], entries[0]['batch'])
+
+    def get_failed(self):
+        return list(self._collection.find({'state': FAILED}).sort('_id', ASCENDING))
+
+    def requeue(self, entries):
+        """
+        Makes failed CDRs ready to be sent again, the CDRs stored in the
+        entries are replaced, so its info can be updated before retrying
+        """
+        now = datetime.utcnow()
+        self._collection.bulk_write([UpdateOne({'_id': entry['_id'], 'state': FAILED}, {
+            '$set': {
+                'cdr': entry['cdr'],
+                'owner': entry['cdr']['provider'],
+                'correlation': int(entry['cdr']['correlation']),
+                'state': PENDING,
+                'attempts': 0,
+                'next_attempt': now
+            }
+        }) for entry in entries], ordered=False)
+
+    def get_stats(self):
+        stats = {
+            PENDING: 0,
+            SENDING: 0,
+            FAILED: 0,
+            'oldest_age': None
+        }
+
+        for state in self._collection.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+            stats[state['_id']] = state['count']
+
+        oldest = self._collection.find_one({'state': {'$in': [PENDING, SENDING]}}, sort=[('created', ASCENDING)])
+        if oldest is not None:
+            stats['oldest_age'] = (datetime.utcnow() - oldest['created']).total_seconds()
+
+        return stats
+
+
+class CDRDispatcher(PollingWorker):
+    """
+    Sends the CDRs stored in the outbox to the RSS, coalescing all the CDRs
+    ready to be sent in batches processed by a bounded pool of workers
+    """
+
+    name = 'cdr-dispatcher'
+
+    def __init__(self):
+        super(CDRDispatcher, self).__init__(settings.CDR_OUTBOX_WORKERS, settings.CDR_OUTBOX_POLL_INTERVAL)
+        self._outbox = CDROutbox()
+
+        self._stats = {
+            'sent': 0,
+            'failed_batches': 0,
+            'last_latency': None
+        }
+
+    def _send(self, entries):
+        error = None
+        try:
+            if not RSSAdaptor().send_cdr([entry['cdr'] for entry in entries]):
+                error = 'The RSS has rejected the CDRs'
+        except Exception as e:
+            error = str(e)
+
+        if error is None:
+            self._outbox.complete(entries)
+        else:
+            self._outbox.retry(entries, error)
+
+        with self._lock:
+            if error is None:
+                self._stats['sent'] += len(entries)
+                self._stats['last_latency'] = (datetime.utcnow() - min([entry['created'] for entry in entries])).total_seconds()
+            else:
+                self._stats['failed_batches'] += 1
+
+        return error is None
+
+    def _claim(self):
+        return self._outbox.claim(settings.CDR_OUTBOX_BATCH_SIZE)
+
+    def _process(self, entries):
+        self._send(entries)
+
+    def drain(self):
+        """
+        Synchronously sends all the CDRs ready to be sent
+        :return: Tuple with the number of CDRs sent and the number of CDRs that failed
+        """
+        sent = failed = 0
+        entries = self._outbox.claim(settings.CDR_OUTBOX_BATCH_SIZE)
+
+        while len(entries):
+            if self._send(entries):
+                sent += len(entries)
+            else:
+                failed += len(entries)
+
+            entries = self._outbox.claim(settings.CDR_OUTBOX_BATCH_SIZE)
+
+        return sent, failed
+
+    def get_stats(self):
+        stats = self._outbox.get_stats()
+
+        with self._lock:
+            stats.update(self._stats)
+
+        return stats
+
+
+@process_local
+def get_dispatcher():
+    return CDRDispatcher()
+
+
+def enqueue_cdrs(cdrs):
+    """
+    Stores the given CDRs in the outbox and wakes up the dispatcher
+    """
+    CDROutbox().enqueue(cdrs)
+
+    dispatcher = get_dispatcher()
+    dispatcher.start()
+    dispatcher.notify()
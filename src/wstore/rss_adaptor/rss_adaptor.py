@@ -19,30 +19,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
-import threading
-from bson import ObjectId
-
 from django.conf import settings
 
-from wstore.store_commons.database import get_database_connection
-from wstore.models import Context, Organization
-
-
-class RSSAdaptorThread(threading.Thread):
-
-    def __init__(self, cdr_info):
-        threading.Thread.__init__(self)
-        self.cdr = cdr_info
-
-    def run(self):
-        r = RSSAdaptor()
-        r.send_cdr(self.cdr)
+from wstore.store_commons.http_session import get_session
 
 
 class RSSAdaptor:
 
     def send_cdr(self, cdr_info):
+        """
+        Sends a batch of CDRs to the RSS
+        :return: True if the CDRs have been accepted, False otherwise
+        """
         # Build CDRs
         data = []
         for cdr in cdr_info:
@@ -78,18 +66,5 @@ class RSSAdaptor:
             'X-Email': settings.WSTOREMAIL
         }
 
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code != 201:
-            db = get_database_connection()
-            # Restore correlation numbers
-            for cdr in cdr_info:
-                org = Organization.objects.get(name=cdr['provider'])
-                db.wstore_organization.find_and_modify(
-                    query={'_id': org.pk},
-                    update={'$inc': {'correlation_number': -1}}
-                )['correlation_number']
-
-            context = Context.objects.all()[0]
-            context.failed_cdrs.extend(cdr_info)
-            context.save()
+        response = get_session(url).post(url, json=data, headers=headers)
+        return response.status_code == 201
@@ -19,10 +19,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
-
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_session
+
 
 class RSSManager(object):
 
@@ -49,12 +49,7 @@ class RSSManager(object):
             'X-Email': self._credentials['email']
         }
 
-        methods = {
-            'POST': requests.post,
-            'PUT': requests.put
-        }
-
-        response = methods[method](url, json=data, headers=headers)
+        response = get_session(url).request(method, url, json=data, headers=headers)
         response.raise_for_status()
 
         return response
@@ -21,6 +21,7 @@
 
 
 from bson import ObjectId
+from datetime import datetime, timedelta
 
 from copy import deepcopy
 from importlib import reload
@@ -29,8 +30,11 @@ from parameterized import parameterized
 
 from django.test import TestCase
 from django.conf import settings
+from django.test.utils import override_settings
 
-from wstore.rss_adaptor import rss_adaptor, rss_manager, model_manager
+from wstore.rss_adaptor import cdr_outbox, rss_adaptor, rss_manager, model_manager
+
+CDROutbox = cdr_outbox.CDROutbox
 
 
 class RSSAdaptorTestCase(TestCase):
@@ -42,15 +46,9 @@ class RSSAdaptorTestCase(TestCase):
         settings.RSS = 'http://testhost.com/rssHost/'
         settings.STORE_NAME = 'wstore'
 
-        rss_adaptor.requests = MagicMock()
+        rss_adaptor.get_session = MagicMock()
         self._response = MagicMock()
-        rss_adaptor.requests.post.return_value = self._response
-
-        # Mocks for fail responses
-        rss_adaptor.get_database_connection = MagicMock()
-        rss_adaptor.Organization = MagicMock()
-        rss_adaptor.Organization.objects.get().pk = b"111111111111"
-        rss_adaptor.Context = MagicMock()
+        rss_adaptor.get_session().post.return_value = self._response
 
     def test_rss_client(self):
         # Create mocks
@@ -58,7 +56,7 @@ class RSSAdaptorTestCase(TestCase):
 
         rss_ad = rss_adaptor.RSSAdaptor()
 
-        rss_ad.send_cdr([{
+        result = rss_ad.send_cdr([{
             'provider': 'test_provider',
             'correlation': '2',
             'order': '1234567890',
@@ -74,7 +72,7 @@ class RSSAdaptorTestCase(TestCase):
             'type': 'C'
         }])
 
-        rss_adaptor.requests.post.assert_called_once_with(
+        rss_adaptor.get_session().post.assert_called_once_with(
             'http://testhost.com/rssHost/rss/cdrs', json=[{
                 'cdrSource': 'testmail@mail.com',
                 'productClass': 'SaaS',
@@ -98,8 +96,7 @@ class RSSAdaptorTestCase(TestCase):
                 'X-Email': 'testmail@mail.com'
             })
 
-        rss_adaptor.get_database_connection.assert_not_called()
-        rss_adaptor.Context.objects.all.assert_not_called()
+        self.assertTrue(result)
 
     def test_rss_remote_error(self):
         # Create Mocks
@@ -123,15 +120,240 @@ class RSSAdaptorTestCase(TestCase):
         cdrs = [cdr, cdr]
 
         rss_ad = rss_adaptor.RSSAdaptor()
-        rss_ad.send_cdr(cdrs)
-
-        # Decrement correlation number for every cdr
-        calls = call(query={'_id': b"111111111111"}, update={'$inc': {'correlation_number': -1}})
-        rss_adaptor.get_database_connection().wstore_organization.find_and_modify.assert_has_calls([calls, calls], any_order=True)
-        # Save the failed cdrs
-        rss_adaptor.Context.objects.all.assert_called_once_with()
-        rss_adaptor.Context.objects.all()[0].failed_cdrs.extend.assert_called_once_with(cdrs)
-        rss_adaptor.Context.objects.all()[0].save.assert_called_once_with()
+        result = rss_ad.send_cdr(cdrs)
+
+        # The CDRs are not accepted
+        self.assertFalse(result)
+        self.assertEquals(2, len(rss_adaptor.get_session().post.call_args[1]['json']))
+
+
+@override_settings(CDR_OUTBOX_MAX_ATTEMPTS=3, CDR_OUTBOX_RETRY_DELAY=10, CDR_OUTBOX_MAX_RETRY_DELAY=30, CDR_OUTBOX_LEASE=300, CDR_OUTBOX_BATCH_SIZE=2)
+class CDROutboxTestCase(TestCase):
+
+    tags = ('rss-adaptor', 'cdr-outbox')
+
+    def setUp(self):
+        self._collection = MagicMock()
+        self._owners = MagicMock()
+        cdr_outbox.get_database_connection = MagicMock()
+        cdr_outbox.get_database_connection.return_value = {
+            'wstore_cdr_outbox': self._collection,
+            'wstore_cdr_outbox_owner': self._owners
+        }
+
+        self._now = datetime(2023, 3, 1, 10, 0, 0)
+        cdr_outbox.datetime = MagicMock()
+        cdr_outbox.datetime.utcnow.return_value = self._now
+
+        cdr_outbox.random = MagicMock()
+        cdr_outbox.random.uniform.return_value = 0
+
+    def tearDown(self):
+        cdr_outbox.datetime = datetime
+
+    def test_enqueue(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.enqueue([{'provider': 'provider', 'correlation': '1'}, {'provider': 'provider', 'correlation': '2'}])
+
+        self._collection.insert_many.assert_called_once_with([{
+            'cdr': {'provider': 'provider', 'correlation': '1'},
+            'owner': 'provider',
+            'correlation': 1,
+            'state': 'pending',
+            'attempts': 0,
+            'created': self._now,
+            'next_attempt': self._now
+        }, {
+            'cdr': {'provider': 'provider', 'correlation': '2'},
+            'owner': 'provider',
+            'correlation': 2,
+            'state': 'pending',
+            'attempts': 0,
+            'created': self._now,
+            'next_attempt': self._now
+        }])
+
+    def test_enqueue_empty(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.enqueue([])
+
+        self.assertEquals(0, self._collection.insert_many.call_count)
+
+    def _get_ready(self):
+        return {
+            '$or': [
+                {'state': 'pending', 'next_attempt': {'$lte': self._now}},
+                {'state': 'sending', 'lease_expires': {'$lt': self._now}}
+            ]
+        }
+
+    def _mock_owner_entries(self, owner_entries, batch_entries):
+        owner_cursor = MagicMock()
+        owner_cursor.sort.return_value.limit.return_value = owner_entries
+        batch_cursor = MagicMock()
+        batch_cursor.sort.return_value = batch_entries
+        self._collection.find.side_effect = [owner_cursor, batch_cursor]
+        return owner_cursor
+
+    def _pending(self, id_, next_attempt=None):
+        return {'_id': id_, 'state': 'pending', 'next_attempt': next_attempt or self._now}
+
+    def test_claim(self):
+        entries = [{'_id': 1, 'owner': 'provider1', 'cdr': {}}, {'_id': 2, 'owner': 'provider1', 'cdr': {}}]
+        self._collection.distinct.return_value = ['provider2', 'provider1']
+        owner_cursor = self._mock_owner_entries([
+            self._pending(1),
+            {'_id': 2, 'state': 'sending', 'lease_expires': self._now - timedelta(seconds=1)}
+        ], entries)
+
+        outbox = cdr_outbox.CDROutbox()
+        result = outbox.claim(2)
+
+        self.assertEquals(entries, result)
+        self._collection.distinct.assert_called_once_with('owner', self._get_ready())
+
+        # Owners are processed in order, and each one can only have a batch in flight
+        query, update = self._owners.find_one_and_update.call_args[0]
+        batch_id = update['$set']['batch']
+        self._owners.find_one_and_update.assert_called_once_with({
+            '_id': 'provider1',
+            '$or': [{'batch': None}, {'lease_expires': {'$lt': self._now}}]
+        }, {
+            '$set': {'batch': batch_id, 'lease_expires': self._now + timedelta(seconds=300)}
+        }, upsert=True, return_document=cdr_outbox.ReturnDocument.AFTER)
+
+        # The CDRs of the owner are claimed in correlation number order
+        self.assertEquals(call({'owner': 'provider1', 'state': {'$in': ['pending', 'sending']}}, {
+            'state': 1, 'next_attempt': 1, 'lease_expires': 1
+        }), self._collection.find.call_args_list[0])
+        owner_cursor.sort.assert_called_once_with('correlation', 1)
+        owner_cursor.sort.return_value.limit.assert_called_once_with(2)
+
+        # Only the entries that are still ready are claimed
+        query, update = self._collection.update_many.call_args[0]
+        self.assertEquals({'$in': [1, 2]}, query['_id'])
+        self.assertEquals(self._get_ready()['$or'], query['$or'])
+
+        self.assertEquals({
+            'state': 'sending',
+            'batch': batch_id,
+            'lease_expires': self._now + timedelta(seconds=300)
+        }, update['$set'])
+        self.assertEquals(call({'batch': batch_id}), self._collection.find.call_args_list[1])
+        self._owners.update_one.assert_not_called()
+
+    def test_claim_owner_in_flight(self):
+        entries = [{'_id': 3, 'owner': 'provider2', 'cdr': {}}]
+        self._collection.distinct.return_value = ['provider1', 'provider2']
+        self._owners.find_one_and_update.side_effect = [cdr_outbox.DuplicateKeyError('Duplicated'), {'_id': 'provider2'}]
+        self._mock_owner_entries([self._pending(3)], entries)
+
+        outbox = cdr_outbox.CDROutbox()
+        self.assertEquals(entries, outbox.claim(2))
+
+        # The owner with a batch in flight is skipped
+        self.assertEquals(['provider1', 'provider2'], [
+            c[0][0]['_id'] for c in self._owners.find_one_and_update.call_args_list])
+        self.assertEquals({'$in': [3]}, self._collection.update_many.call_args[0][0]['_id'])
+
+    def test_claim_held_back(self):
+        self._collection.distinct.return_value = ['provider1']
+        self._mock_owner_entries([self._pending(1, self._now + timedelta(seconds=10)), self._pending(2)], [])
+
+        outbox = cdr_outbox.CDROutbox()
+        self.assertEquals([], outbox.claim(2))
+
+        # The CDR waiting to be retried holds back the following ones, and the owner is released
+        self.assertEquals(0, self._collection.update_many.call_count)
+        batch_id = self._owners.find_one_and_update.call_args[0][1]['$set']['batch']
+        self._owners.update_one.assert_called_once_with(
+            {'_id': 'provider1', 'batch': batch_id}, {'$set': {'batch': None, 'lease_expires': None}})
+
+    def test_claim_empty(self):
+        self._collection.distinct.return_value = []
+
+        outbox = cdr_outbox.CDROutbox()
+        self.assertEquals([], outbox.claim(2))
+        self.assertEquals(0, self._collection.update_many.call_count)
+        self.assertEquals(0, self._owners.find_one_and_update.call_count)
+
+    def test_complete(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.complete([{'_id': 1, 'owner': 'provider1', 'batch': 'batch'}, {'_id': 2, 'owner': 'provider1', 'batch': 'batch'}])
+
+        self._collection.delete_many.assert_called_once_with({'_id': {'$in': [1, 2]}, 'batch': 'batch'})
+        self._owners.update_one.assert_called_once_with(
+            {'_id': 'provider1', 'batch': 'batch'}, {'$set': {'batch': None, 'lease_expires': None}})
+
+    def test_retry(self):
+        outbox = cdr_outbox.CDROutbox()
+        outbox.retry([
+            {'_id': 1, 'owner': 'provider1', 'batch': 'batch', 'attempts': 0},
+            {'_id': 2, 'owner': 'provider1', 'batch': 'batch', 'attempts': 1},
+            {'_id': 3, 'owner': 'provider1', 'batch': 'batch', 'attempts': 2}
+        ], 'error')
+
+        unset = {'batch': '', 'lease_expires': ''}
+        updates = self._collection.bulk_write.call_args[0][0]
+        self.assertEquals([
+            cdr_outbox.UpdateOne({'_id': 1, 'batch': 'batch'}, {'$set': {
+                'attempts': 1, 'last_error': 'error', 'state': 'pending', 'next_attempt': self._now + timedelta(seconds=10)
+            }, '$unset': unset}),
+            cdr_outbox.UpdateOne({'_id': 2, 'batch': 'batch'}, {'$set': {
+                'attempts': 2, 'last_error': 'error', 'state': 'pending', 'next_attempt': self._now + timedelta(seconds=20)
+            }, '$unset': unset}),
+            cdr_outbox.UpdateOne({'_id': 3, 'batch': 'batch'}, {'$set': {
+                'attempts': 3, 'last_error': 'error', 'state': 'failed'
+            }, '$unset': unset})
+        ], updates)
+
+        # The owner can send again once the failed CDRs are due
+        self._owners.update_one.assert_called_once_with(
+            {'_id': 'provider1', 'batch': 'batch'}, {'$set': {'batch': None, 'lease_expires': None}})
+
+    def test_stats(self):
+        self._collection.aggregate.return_value = [{'_id': 'pending', 'count': 5}, {'_id': 'failed', 'count': 1}]
+        self._collection.find_one.return_value = {'created': self._now - timedelta(seconds=60)}
+
+        outbox = cdr_outbox.CDROutbox()
+        self.assertEquals({
+            'pending': 5,
+            'sending': 0,
+            'failed': 1,
+            'oldest_age': 60
+        }, outbox.get_stats())
+
+    @parameterized.expand([
+        ('sent', [True, True], (3, 0)),
+        ('rejected', [True, False], (2, 1)),
+        ('error', [Exception('Connection error'), True], (1, 2))
+    ])
+    def test_drain(self, name, results, expected):
+        entries = [[{'_id': 1, 'cdr': 'cdr1', 'created': self._now}, {'_id': 2, 'cdr': 'cdr2', 'created': self._now}], [{'_id': 3, 'cdr': 'cdr3', 'created': self._now}], []]
+
+        outbox = MagicMock()
+        outbox.claim.side_effect = entries
+        adaptor = MagicMock()
+        adaptor.send_cdr.side_effect = results
+
+        cdr_outbox.CDROutbox = MagicMock(return_value=outbox)
+        cdr_outbox.RSSAdaptor = MagicMock(return_value=adaptor)
+
+        try:
+            dispatcher = cdr_outbox.CDRDispatcher()
+            self.assertEquals(expected, dispatcher.drain())
+        finally:
+            cdr_outbox.CDROutbox = CDROutbox
+            cdr_outbox.RSSAdaptor = rss_adaptor.RSSAdaptor
+
+        # Every batch is sent in a single request
+        self.assertEquals([call(['cdr1', 'cdr2']), call(['cdr3'])], adaptor.send_cdr.call_args_list)
+        self.assertEquals([call(2), call(2), call(2)], outbox.claim.call_args_list)
+
+        sent_batches = [call(batch) for batch, result in zip(entries, results) if result is True]
+        failed_batches = [batch for batch, result in zip(entries, results) if result is not True]
+        self.assertEquals(sent_batches, outbox.complete.call_args_list)
+        self.assertEquals(failed_batches, [c[0][0] for c in outbox.retry.call_args_list])
 
 
 BASIC_MODEL = {
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from bson import ObjectId
+from requests.exceptions import HTTPError
+
+from django.conf import settings
+
+from wstore.store_commons.concurrency import process_local
+from wstore.store_commons.http_session import get_session
+
+
+class TTLCache(object):
+    """
+    Thread safe LRU cache whose entries expire after a given number of seconds.
+    Expired entries are kept until evicted, so they can be revalidated
+    """
+
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key, stale):
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            value, expires = self._entries[key]
+            if not stale and expires <= time.time():
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def get(self, key):
+        return self._get_entry(key, False)
+
+    def get_stale(self, key):
+        return self._get_entry(key, True)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self._ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@process_local
+def _get_documents_cache():
+    return TTLCache(settings.CATALOG_CACHE_SIZE, settings.CATALOG_CACHE_TTL)
+
+
+def _get_document_key(url):
+    # The catalog is accessed both with its external and its internal URL
+    parsed_url = urlparse(url)
+    return parsed_url.path + ('?' + parsed_url.query if parsed_url.query else '')
+
+
+def download_catalog_document(url, **kwargs):
+    """
+    Downloads a document from the catalog API. Documents are cached, and once
+    expired they are revalidated with their ETag before being downloaded again
+    :param url: URL of the document
+    :param kwargs: Extra arguments of the request
+    :return: Parsed JSON document, a new copy in every call
+    """
+    cache = _get_documents_cache()
+    key = _get_document_key(url)
+
+    document = cache.get(key)
+    if document is None:
+        stale = cache.get_stale(key)
+
+        if stale is not None and stale['etag'] is not None:
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **{'If-None-Match': stale['etag']})
+
+        r = get_session(url).get(url, **kwargs)
+
+        if r.status_code == 304 and stale is not None:
+            document = stale
+        elif r.status_code == 200:
+            document = {
+                'etag': r.headers.get('ETag'),
+                'content': r.content
+            }
+        else:
+            raise HTTPError('Error downloading {}: {}'.format(url, r.status_code), response=r)
+
+        cache.set(key, document)
+
+    return json.loads(document['content'])
+
+
+def invalidate_catalog_document(resource, doc_id):
+    """
+    Removes from the cache all the versions of a catalog document
+    :param resource: Collection of the document, e.g. productOffering
+    :param doc_id: ID of the document
+    """
+    def _matches(key):
+        path = key.split('?')[0].rstrip('/').split('/')
+        return len(path) > 1 and path[-2] == resource and path[-1].split(':')[0] == str(doc_id)
+
+    _get_documents_cache().invalidate_matching(_matches)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def identity_map():
+    """
+    Makes each model instance retrieved with get_instance to be loaded only
+    once in the current thread until the context is exited
+    """
+    active = getattr(_local, 'instances', None) is not None
+
+    if not active:
+        _local.instances = {}
+
+    try:
+        yield
+    finally:
+        if not active:
+            _local.instances = None
+
+
+def get_instance(model, pk):
+    """
+    Gets a model instance by its primary key, using the active identity map if any
+    """
+    instances = getattr(_local, 'instances', None)
+
+    if instances is None:
+        return model.objects.get(pk=ObjectId(pk))
+
+    key = (model, str(pk))
+    if key not in instances:
+        instances[key] = model.objects.get(pk=ObjectId(pk))
+
+    return instances[key]
+
+
+def invalidate_instance(model, pk):
+    instances = getattr(_local, 'instances', None)
+
+    if instances is not None:
+        instances.pop((model, str(pk)), None)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+
+def process_local(factory):
+    """
+    Decorator that turns a factory into a getter of a lazily created instance shared by the
+    threads of a process. Threads, locks and connections are not usable after forking, so
+    a new instance is created in each process
+    """
+    state = {'instance': None, 'pid': None}
+    lock = threading.Lock()
+
+    @wraps(factory)
+    def get_instance():
+        with lock:
+            if state['instance'] is None or state['pid'] != os.getpid():
+                state['instance'] = factory()
+                state['pid'] = os.getpid()
+
+            return state['instance']
+
+    return get_instance
+
+
+class PollingWorker(object):
+    """
+    Background thread that claims pending work and processes it using a bounded pool of
+    workers. When there is no pending work it waits until notified or until the poll
+    interval expires. Subclasses implement _claim and _process
+    """
+
+    name = 'polling-worker'
+
+    def __init__(self, workers, poll_interval):
+        self._workers = threading.BoundedSemaphore(workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _claim(self):
+        """
+        :return: The claimed work, or a falsy value if there is nothing pending
+        """
+        raise NotImplementedError()
+
+    def _process(self, work):
+        raise NotImplementedError()
+
+    def _process_and_release(self, work):
+        try:
+            self._process(work)
+        finally:
+            self._workers.release()
+
+    def _run(self):
+        while True:
+            self._workers.acquire()
+
+            # Cleared before claiming, so notifications received during the claim are not lost
+            self._wakeup.clear()
+
+            try:
+                work = self._claim()
+            except Exception:
+                work = None
+
+            if not work:
+                self._workers.release()
+                self._wakeup.wait(self._poll_interval)
+                continue
+
+            self._executor.submit(self._process_and_release, work)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def notify(self):
+        self._wakeup.set()
@@ -19,87 +19,195 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
 from bson import ObjectId
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 
 
-def get_database_connection():
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = None
+
+
+def _get_client_key(client_info):
+    return tuple(sorted((key, repr(value)) for key, value in client_info.items()))
+
+
+def _build_client(client_info):
+    client_args = dict(client_info)
+
+    if 'port' in client_args:
+        client_args['port'] = int(client_args['port'])
+
+    if 'username' in client_args and 'host' not in client_args:
+        client_args['host'] = 'localhost'
+
+    # Connections are opened on first use, so the client can be created before forking
+    client_args.setdefault('connect', False)
+    return MongoClient(**client_args)
+
+
+def get_mongo_client():
     """
-    Gets a raw database connection to MongoDB
+    Gets the MongoClient shared by the current process. Clients are created lazily,
+    kept per CLIENT configuration, and discarded when the process is forked
     """
-    # Get database info from settings
-    database_info = settings.DATABASES['default']
+    global _clients_pid
 
-    # Create database connection
-    client = None
-    if 'CLIENT' in database_info:
-        client_info = database_info['CLIENT']
+    client_info = settings.DATABASES['default'].get('CLIENT', {})
+    key = _get_client_key(client_info)
+    pid = os.getpid()
 
-        if 'host' in client_info and 'port' in client_info and 'username' in client_info:
-            client = MongoClient(
-                client_info['host'],
-                int(client_info['port']),
-                user=client_info['username'],
-                password=client_info['password'])
+    with _clients_lock:
+        if _clients_pid != pid:
+            # MongoClient instances are not fork safe, the child process must create its own ones
+            _clients.clear()
+            _clients_pid = pid
 
-        elif 'host' in client_info and 'port' in client_info and 'username' not in client_info:
-            client = MongoClient(client_info['host'], int(client_info['port']))
+        if key not in _clients:
+            _clients[key] = _build_client(client_info)
 
-        elif 'host' in client_info and 'port' not in client_info and 'username' in client_info:
-            client = MongoClient(
-                client_info['host'],
-                user=client_info['username'],
-                password=client_info['password'])
+        return _clients[key]
 
-        elif 'host' in client_info and 'port' not in client_info and 'username' not in client_info:
-            client = MongoClient(client_info['host'])
 
-        elif 'host' not in client_info and 'port' in client_info and 'username' in client_info:
-            client = MongoClient(
-                'localhost',
-                int(client_info['port']),
-                user=client_info['username'],
-                password=client_info['password'])
+def close_mongo_clients():
+    """
+    Closes the clients created by the current process
+    """
+    global _clients_pid
 
-        elif 'host' not in client_info and 'port' in client_info and 'username' not in client_info:
-            client = MongoClient('localhost', int(client_info['port']))
+    with _clients_lock:
+        if _clients_pid == os.getpid():
+            for client in _clients.values():
+                client.close()
 
-        else:
-            client = MongoClient()
-    else:
-        client = MongoClient()
+        _clients.clear()
+        _clients_pid = None
 
-    db_name = database_info['NAME']
-    db = client[db_name]
 
-    return db
+def get_database_connection():
+    """
+    Gets a raw database connection to MongoDB
+    """
+    return get_mongo_client()[settings.DATABASES['default']['NAME']]
+
+
+# Initial wait of a contended lock, doubled in every attempt up to DOCUMENT_LOCK_MAX_WAIT
+_LOCK_MIN_WAIT = 0.05  # Seconds
 
 
 class DocumentLock:
+    """
+    Lock stored in a field of a MongoDB document. The lock belongs to the instance that acquires it
+    and has a lease that is renewed in background while held, so locks of crashed processes expire
+    """
 
-    def __init__(self, collection, doc_id, lock_id):
+    def __init__(self, collection, doc_id, lock_id, upsert=False):
+        """
+        :param collection: Collection of the locked document
+        :param doc_id: ID of the locked document
+        :param lock_id: Name of the lock, a document can include different locks
+        :param upsert: Whether the document is created if it does not exist
+        """
         self._collection = collection
         self._doc_id = doc_id
         self._lock_id = '_lock_{}'.format(lock_id)
+        self._upsert = upsert
+        self._owner = uuid.uuid4().hex
         self._db = get_database_connection()
+        self._stop_renewal = None
+
+        # Content of the document before acquiring the lock
+        self.document = None
+
+    def _get_expiration(self):
+        return datetime.utcnow() + timedelta(seconds=settings.DOCUMENT_LOCK_LEASE)
+
+    def _renew(self, stop):
+        # The lease is renewed before a third of it has passed, so a delayed renewal does not make it expire
+        while not stop.wait(settings.DOCUMENT_LOCK_LEASE / 3):
+            try:
+                result = self._db[self._collection].update_one(
+                    {'_id': self._doc_id, self._lock_id + '.owner': self._owner},
+                    {'$set': {self._lock_id + '.expires': self._get_expiration()}}
+                )
+            except Exception:
+                continue
+
+            if not result.matched_count:
+                # The lock has expired and has been acquired by other owner
+                return
 
     def lock_document(self):
-        prev = self._db[self._collection].find_one_and_update(
-            {'_id': self._doc_id},
-            {'$set': {self._lock_id: True}}
-        )
-        return self._lock_id in prev and prev[self._lock_id]
+        """
+        Tries to acquire the lock without waiting
+        :return: True if the lock is held by other owner
+        :raises ObjectDoesNotExist: If the document does not exist and it is not created
+        """
+        try:
+            prev = self._db[self._collection].find_one_and_update({
+                '_id': self._doc_id,
+                '$or': [
+                    {self._lock_id: None},
+                    {self._lock_id + '.expires': {'$lte': datetime.utcnow()}}
+                ]
+            }, {
+                '$set': {self._lock_id: {'owner': self._owner, 'expires': self._get_expiration()}}
+            }, upsert=self._upsert)
+        except DuplicateKeyError:
+            # The document exists, so the upsert fails when it is locked
+            return True
+
+        if prev is None and not self._upsert:
+            # Waiting for a missing document would never end
+            if not self._db[self._collection].count_documents({'_id': self._doc_id}, limit=1):
+                raise ObjectDoesNotExist('The document {} does not exist in {}'.format(self._doc_id, self._collection))
+
+            return True
+
+        self.document = prev
+        self._stop_renewal = threading.Event()
+
+        renewal = threading.Thread(target=self._renew, args=(self._stop_renewal,))
+        renewal.daemon = True
+        renewal.start()
+        return False
 
     def wait_document(self):
-        locked = self.lock_document()
+        """
+        Waits until the lock is acquired, using an exponential backoff with jitter so contending
+        processes do not retry at the same time
+        """
+        wait = _LOCK_MIN_WAIT
 
-        while locked:
-            locked = self.lock_document()
+        while self.lock_document():
+            time.sleep(random.uniform(0, wait))
+            wait = min(wait * 2, settings.DOCUMENT_LOCK_MAX_WAIT)
 
     def unlock_document(self):
-        self._db[self._collection].find_one_and_update(
-            {'_id': self._doc_id},
-            {'$set': {self._lock_id: False}}
+        if self._stop_renewal is not None:
+            self._stop_renewal.set()
+            self._stop_renewal = None
+
+        # The owner is checked, as an expired lock may have been acquired by other owner
+        self._db[self._collection].update_one(
+            {'_id': self._doc_id, self._lock_id + '.owner': self._owner},
+            {'$unset': {self._lock_id: ''}}
         )
+
+    def __enter__(self):
+        self.wait_document()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock_document()
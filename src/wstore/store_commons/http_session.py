@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import random
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+# Only idempotent requests are retried, so retrying cannot duplicate charges or usage documents
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class JitteredRetry(Retry):
+    """
+    Retry policy whose exponential backoff includes random jitter, so
+    clients failing at the same time do not retry at the same time
+    """
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(backoff / 2.0, backoff)
+
+
+class PooledSession(Session):
+    """
+    Session that keeps a pool of alive connections to an upstream host, applies default
+    timeouts and retries, and limits the number of concurrent requests to the host
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+
+        retries = JitteredRetry(
+            total=settings.HTTP_RETRIES,
+            backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False
+        )
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_SIZE, max_retries=retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        # The session is shared between requests of different users, so cookies must not be kept
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        self._slots = threading.BoundedSemaphore(settings.HTTP_MAX_CONCURRENCY)
+        self._local = threading.local()
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+
+        # Redirects are sent while processing the original request, so they use its slot
+        if getattr(self._local, 'sending', False):
+            return super(PooledSession, self).send(request, **kwargs)
+
+        with self._slots:
+            self._local.sending = True
+            try:
+                return super(PooledSession, self).send(request, **kwargs)
+            finally:
+                self._local.sending = False
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = None
+
+
+def get_session(url):
+    """
+    Gets the session shared by all the requests made to the host of the given URL
+    :param url: URL to be requested
+    :return: PooledSession instance
+    """
+    global _sessions_pid
+
+    parsed_url = urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+
+    with _sessions_lock:
+        # Pooled connections cannot be shared with forked processes
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        if key not in _sessions:
+            _sessions[key] = PooledSession()
+
+        return _sessions[key]
@@ -22,6 +22,8 @@
 
 from django.utils.functional import SimpleLazyObject
 
+from wstore.store_commons.cache import identity_map
+
 
 class AuthenticationMiddleware:
 
@@ -104,3 +106,14 @@ class AuthenticationMiddleware:
 
         response = self.get_response(request)
         return response
+
+
+class IdentityMapMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Models loaded by primary key are shared while processing the request
+        with identity_map():
+            return self.get_response(request)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import importlib
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+from django.conf import settings
+
+from wstore.store_commons.concurrency import PollingWorker, process_local
+from wstore.store_commons.database import get_database_connection
+
+
+TASKS_COLLECTION = 'wstore_scheduled_task'
+
+SCHEDULED = 'scheduled'
+RUNNING = 'running'
+FAILED = 'failed'
+
+
+# Task being executed by each worker thread, so handlers can renew its lease
+_current = threading.local()
+
+
+def _get_collection():
+    return get_database_connection()[TASKS_COLLECTION]
+
+
+def schedule_task(handler, delay, task_id=None, **kwargs):
+    """
+    Schedules the execution of a task, tasks are persisted, so they are
+    executed even if the process that scheduled them is restarted
+    :param handler: Dotted path of the function to be executed
+    :param delay: Seconds to wait before executing the task
+    :param task_id: ID of the task, it can be provided so the handler receives it as an argument
+    :param kwargs: Arguments of the handler, they must be BSON serializable
+    :return: ID of the scheduled task
+    """
+    now = datetime.utcnow()
+    task = {} if task_id is None else {'_id': ObjectId(task_id)}
+    task.update({
+        'handler': handler,
+        'args': kwargs,
+        'state': SCHEDULED,
+        'attempts': 0,
+        'created': now,
+        'due': now + timedelta(seconds=delay)
+    })
+    task_id = _get_collection().insert_one(task).inserted_id
+
+    scheduler = get_scheduler()
+    scheduler.start()
+
+    if delay <= 0:
+        scheduler.notify()
+
+    return task_id
+
+
+def cancel_task(task_id):
+    _get_collection().delete_one({'_id': ObjectId(task_id), 'state': SCHEDULED})
+
+
+def reschedule_task(task_id, delay):
+    """
+    Moves forward the execution of a scheduled task
+    :return: True if the task was still waiting to be executed
+    """
+    result = _get_collection().update_one({
+        '_id': ObjectId(task_id),
+        'state': SCHEDULED
+    }, {
+        '$set': {'due': datetime.utcnow() + timedelta(seconds=delay)}
+    })
+
+    if result.modified_count and delay <= 0:
+        scheduler = get_scheduler()
+        scheduler.start()
+        scheduler.notify()
+
+    return result.modified_count > 0
+
+
+def renew_task_lease():
+    """
+    Extends the lease of the task being executed by the current thread, so long running
+    handlers are not considered abandoned and executed again by other process
+    :return: False if the lease has expired and the task has been claimed again
+    """
+    task = getattr(_current, 'task', None)
+
+    if task is None:
+        return True
+
+    result = _get_collection().update_one({
+        '_id': task['_id'],
+        'state': RUNNING,
+        'attempts': task['attempts']
+    }, {
+        '$set': {'lease_expires': datetime.utcnow() + timedelta(seconds=settings.SCHEDULER_TASK_LEASE)}
+    })
+
+    return result.modified_count > 0
+
+
+class TaskScheduler(PollingWorker):
+    """
+    Executes the scheduled tasks once they are due. Tasks are claimed atomically,
+    so each task is executed by a single process even if many are polling
+    """
+
+    name = 'task-scheduler'
+
+    def __init__(self):
+        super(TaskScheduler, self).__init__(settings.SCHEDULER_WORKERS, settings.SCHEDULER_POLL_INTERVAL)
+
+    def _load_handler(self, handler):
+        module, function = handler.rsplit('.', 1)
+        return getattr(importlib.import_module(module), function)
+
+    def claim_task(self):
+        now = datetime.utcnow()
+
+        # Tasks whose executor has not finished in time are considered abandoned
+        return _get_collection().find_one_and_update({
+            '$or': [
+                {'state': SCHEDULED, 'due': {'$lte': now}},
+                {'state': RUNNING, 'lease_expires': {'$lt': now}}
+            ]
+        }, {
+            '$set': {
+                'state': RUNNING,
+                'lease_expires': now + timedelta(seconds=settings.SCHEDULER_TASK_LEASE)
+            },
+            '$inc': {'attempts': 1}
+        }, sort=[('due', ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    def run_task(self, task):
+        collection = _get_collection()
+
+        # The attempt identifies the claim, so a task claimed again once its lease expired is not modified
+        claim = {'_id': task['_id'], 'state': RUNNING, 'attempts': task['attempts']}
+        _current.task = task
+
+        try:
+            self._load_handler(task['handler'])(**task['args'])
+        except Exception as e:
+            if task['attempts'] < settings.SCHEDULER_MAX_ATTEMPTS:
+                update = {
+                    'state': SCHEDULED,
+                    'due': datetime.utcnow() + timedelta(seconds=settings.SCHEDULER_RETRY_DELAY * task['attempts']),
+                    'last_error': str(e)
+                }
+            else:
+                update = {
+                    'state': FAILED,
+                    'last_error': str(e)
+                }
+
+            collection.update_one(claim, {'$set': update})
+        else:
+            collection.delete_one(claim)
+        finally:
+            _current.task = None
+
+    def _claim(self):
+        return self.claim_task()
+
+    def _process(self, task):
+        self.run_task(task)
+
+
+@process_local
+def get_scheduler():
+    return TaskScheduler()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bson import ObjectId
+from mock import MagicMock, call
+from requests.exceptions import HTTPError
+
+from django.test.utils import override_settings
+from django.test import TestCase
+
+from wstore.store_commons import cache
+
+
+class CacheTestCase(TestCase):
+    tags = ('cache',)
+
+    def setUp(self):
+        self._time = cache.time.time
+        self._get_session = cache.get_session
+
+        cache.time.time = MagicMock(return_value=1000)
+        cache.get_session = MagicMock()
+        cache._get_documents_cache().clear()
+
+    def tearDown(self):
+        cache.time.time = self._time
+        cache.get_session = self._get_session
+        cache._get_documents_cache().clear()
+
+    def _mock_response(self, status_code, content=None, etag=None):
+        response = MagicMock(status_code=status_code, content=content, headers={})
+        if etag is not None:
+            response.headers['ETag'] = etag
+
+        return response
+
+    def test_ttl_cache(self):
+        ttl_cache = cache.TTLCache(2, 60)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+
+        self.assertEquals(1, ttl_cache.get('a'))
+
+        # The least recently used entry is evicted
+        ttl_cache.set('c', 3)
+        self.assertEquals(2, len(ttl_cache))
+        self.assertEquals(None, ttl_cache.get('b'))
+        self.assertEquals(1, ttl_cache.get('a'))
+        self.assertEquals(3, ttl_cache.get('c'))
+
+        # Expired entries are only returned as stale
+        cache.time.time.return_value = 1060
+        self.assertEquals(None, ttl_cache.get('a'))
+        self.assertEquals(1, ttl_cache.get_stale('a'))
+
+        ttl_cache.invalidate('a')
+        self.assertEquals(None, ttl_cache.get_stale('a'))
+
+    @override_settings(CATALOG_CACHE_SIZE=10, CATALOG_CACHE_TTL=60)
+    def test_download_catalog_document(self):
+        cache.get_session().get.return_value = self._mock_response(200, b'{"id": "1"}', etag='"v1"')
+
+        doc1 = cache.download_catalog_document('http://catalog.com/api/productOffering/1', verify=True)
+        doc1['id'] = '2'
+        doc2 = cache.download_catalog_document('http://localhost:8004/api/productOffering/1', verify=True)
+
+        # The document is downloaded once, and each call gets its own copy
+        self.assertEquals({'id': '1'}, doc2)
+        cache.get_session().get.assert_called_once_with('http://catalog.com/api/productOffering/1', verify=True)
+
+    @override_settings(CATALOG_CACHE_SIZE=10, CATALOG_CACHE_TTL=60)
+    def test_download_catalog_document_revalidated(self):
+        cache.get_session().get.side_effect = [
+            self._mock_response(200, b'{"id": "1"}', etag='"v1"'),
+            self._mock_response(304),
+            self._mock_response(200, b'{"id": "1", "name": "new"}')
+        ]
+
+        url = 'http://catalog.com/api/productOffering/1'
+        cache.download_catalog_document(url)
+
+        cache.time.time.return_value = 1061
+        self.assertEquals({'id': '1'}, cache.download_catalog_document(url))
+
+        cache.time.time.return_value = 1122
+        self.assertEquals({'id': '1', 'name': 'new'}, cache.download_catalog_document(url))
+
+        self.assertEquals([
+            call(url),
+            call(url, headers={'If-None-Match': '"v1"'}),
+            call(url, headers={'If-None-Match': '"v1"'})
+        ], cache.get_session().get.call_args_list)
+
+    @override_settings(CATALOG_CACHE_SIZE=10, CATALOG_CACHE_TTL=60)
+    def test_download_catalog_document_error(self):
+        cache.get_session().get.return_value = self._mock_response(404)
+
+        with self.assertRaises(HTTPError):
+            cache.download_catalog_document('http://catalog.com/api/productOffering/1')
+
+        with self.assertRaises(HTTPError):
+            cache.download_catalog_document('http://catalog.com/api/productOffering/1')
+
+        self.assertEquals(2, cache.get_session().get.call_count)
+
+    @override_settings(CATALOG_CACHE_SIZE=10, CATALOG_CACHE_TTL=60)
+    def test_invalidate_catalog_document(self):
+        cache.get_session().get.return_value = self._mock_response(200, b'{}')
+
+        urls = [
+            'http://catalog.com/api/productOffering/1:(1.0)',
+            'http://catalog.com/api/productOffering/1',
+            'http://catalog.com/api/productOffering/10',
+            'http://catalog.com/api/productSpecification/1?fields=name'
+        ]
+        for url in urls:
+            cache.download_catalog_document(url)
+
+        cache.invalidate_catalog_document('productOffering', '1')
+
+        for url in urls:
+            cache.download_catalog_document(url)
+
+        self.assertEquals(6, cache.get_session().get.call_count)
+
+    def test_identity_map(self):
+        model = MagicMock()
+        model.objects.get.side_effect = lambda pk: MagicMock(pk=pk)
+
+        pk = '61004aba5e05acc115f022f0'
+
+        # Without identity map instances are always loaded
+        self.assertFalse(cache.get_instance(model, pk) is cache.get_instance(model, pk))
+
+        model.objects.get.reset_mock()
+        with cache.identity_map():
+            instance = cache.get_instance(model, pk)
+            self.assertTrue(instance is cache.get_instance(model, ObjectId(pk)))
+
+            with cache.identity_map():
+                self.assertTrue(instance is cache.get_instance(model, pk))
+
+            self.assertTrue(instance is cache.get_instance(model, pk))
+
+            cache.invalidate_instance(model, pk)
+            self.assertFalse(instance is cache.get_instance(model, pk))
+
+        self.assertEquals([call(pk=ObjectId(pk)), call(pk=ObjectId(pk))], model.objects.get.call_args_list)
+        self.assertFalse(cache.get_instance(model, pk) is cache.get_instance(model, pk))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+from mock import MagicMock, patch
+
+from django.test import TestCase
+
+from wstore.store_commons import concurrency
+
+
+class ProcessLocalTestCase(TestCase):
+
+    tags = ('concurrency',)
+
+    def test_process_local(self):
+        factory = MagicMock(side_effect=[1, 2])
+        factory.__name__ = 'factory'
+        get_instance = concurrency.process_local(factory)
+
+        self.assertEquals(1, get_instance())
+        self.assertEquals(1, get_instance())
+        factory.assert_called_once_with()
+
+    def test_process_local_forked(self):
+        factory = MagicMock(side_effect=[1, 2])
+        factory.__name__ = 'factory'
+        get_instance = concurrency.process_local(factory)
+
+        with patch.object(concurrency.os, 'getpid', side_effect=[100, 200, 200]):
+            self.assertEquals(1, get_instance())
+
+            # Forked processes do not reuse the instance of their parent
+            self.assertEquals(2, get_instance())
+
+
+class ListWorker(concurrency.PollingWorker):
+
+    def __init__(self, claims):
+        super(ListWorker, self).__init__(1, 60)
+        self.claims = claims
+        self.processed = []
+        self.done = threading.Event()
+
+    def _claim(self):
+        claim = self.claims.pop(0) if len(self.claims) else None
+        return claim() if callable(claim) else claim
+
+    def _process(self, work):
+        self.processed.append(work)
+
+        if not len(self.claims):
+            self.done.set()
+
+
+class PollingWorkerTestCase(TestCase):
+
+    tags = ('concurrency',)
+
+    def test_process_claimed_work(self):
+        worker = ListWorker(['work1', 'work2'])
+        worker.start()
+
+        self.assertTrue(worker.done.wait(5))
+        self.assertEquals(['work1', 'work2'], worker.processed)
+
+    def test_notify_when_idle(self):
+        worker = ListWorker([])
+        idle = threading.Event()
+
+        def claim():
+            idle.set()
+            return None
+
+        worker.claims.extend([claim, 'work1'])
+        worker.start()
+
+        # The worker does not wait the whole poll interval once notified
+        self.assertTrue(idle.wait(5))
+        worker.notify()
+
+        self.assertTrue(worker.done.wait(5))
+        self.assertEquals(['work1'], worker.processed)
+
+    def test_notify_during_claim(self):
+        worker = ListWorker([])
+
+        def claim():
+            # Work stored while the worker is claiming, it must not wait the whole poll interval
+            worker.notify()
+            return None
+
+        worker.claims.extend([claim, 'work1'])
+        worker.start()
+
+        self.assertTrue(worker.done.wait(5))
+        self.assertEquals(['work1'], worker.processed)
+
+    def test_claim_error(self):
+        worker = ListWorker([])
+
+        def claim():
+            worker.notify()
+            raise Exception('Database error')
+
+        # Claim errors are handled as no pending work
+        worker.claims.extend([claim, 'work1'])
+        worker.start()
+
+        self.assertTrue(worker.done.wait(5))
+        self.assertEquals(['work1'], worker.processed)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime, timedelta
+from importlib import reload
+from mock import MagicMock, call
+from parameterized import parameterized
+
+from django.test.utils import override_settings
+from django.test import TestCase
+from django.core.exceptions import ObjectDoesNotExist
+
+from wstore.store_commons import database
+
+
+class MongoClientTestCase(TestCase):
+    tags = ('database',)
+
+    def setUp(self):
+        self._mongo_client = database.MongoClient
+        self._getpid = database.os.getpid
+
+        database.MongoClient = MagicMock(side_effect=lambda **kwargs: MagicMock())
+        database.os.getpid = MagicMock(return_value=1)
+        database.close_mongo_clients()
+
+    def tearDown(self):
+        database.close_mongo_clients()
+        database.MongoClient = self._mongo_client
+        database.os.getpid = self._getpid
+
+    @parameterized.expand([
+        ('host', {'host': 'localhost'}, {'host': 'localhost', 'connect': False}),
+        ('port', {'host': 'mongo', 'port': '27017'}, {'host': 'mongo', 'port': 27017, 'connect': False}),
+        ('credentials', {'port': 27017, 'username': 'user', 'password': 'pass', 'authSource': 'wstore_db'}, {
+            'host': 'localhost',
+            'port': 27017,
+            'username': 'user',
+            'password': 'pass',
+            'authSource': 'wstore_db',
+            'connect': False
+        }),
+        ('pool', {'host': 'localhost', 'maxPoolSize': 50, 'serverSelectionTimeoutMS': 5000}, {
+            'host': 'localhost',
+            'maxPoolSize': 50,
+            'serverSelectionTimeoutMS': 5000,
+            'connect': False
+        })
+    ])
+    def test_get_mongo_client(self, name, client_info, expected_args):
+        with override_settings(DATABASES={'default': {'NAME': 'wstore_db', 'CLIENT': client_info}}):
+            client = database.get_mongo_client()
+            self.assertTrue(client is database.get_mongo_client())
+            db = database.get_database_connection()
+
+        database.MongoClient.assert_called_once_with(**expected_args)
+        self.assertEquals(client['wstore_db'], db)
+
+    def test_get_mongo_client_settings_changed(self):
+        with override_settings(DATABASES={'default': {'NAME': 'wstore_db', 'CLIENT': {'host': 'host1'}}}):
+            client1 = database.get_mongo_client()
+
+        with override_settings(DATABASES={'default': {'NAME': 'wstore_db', 'CLIENT': {'host': 'host2'}}}):
+            client2 = database.get_mongo_client()
+
+        self.assertFalse(client1 is client2)
+        self.assertEquals(2, database.MongoClient.call_count)
+
+    def test_get_mongo_client_forked(self):
+        with override_settings(DATABASES={'default': {'NAME': 'wstore_db', 'CLIENT': {'host': 'localhost'}}}):
+            client1 = database.get_mongo_client()
+
+            database.os.getpid.return_value = 2
+            client2 = database.get_mongo_client()
+
+        self.assertFalse(client1 is client2)
+        # The client of the parent process is not closed from the child
+        self.assertEquals(0, client1.close.call_count)
+
+
+@override_settings(DOCUMENT_LOCK_LEASE=60, DOCUMENT_LOCK_MAX_WAIT=2)
+class DocumentLockTestCase(TestCase):
+    tags = ('lock',)
+
+    _id = '59f76ace051eb500613cbbc7'
+    _collection = 'test_collection'
+    _lock_id = '_lock_test'
+    _owner = 'owner'
+    _now = datetime(2023, 7, 15, 12, 0, 0)
+
+    def setUp(self):
+        self._connection = MagicMock()
+        database.get_database_connection = MagicMock(return_value=self._connection)
+
+        database.uuid = MagicMock()
+        database.uuid.uuid4.return_value.hex = self._owner
+
+        database.datetime = MagicMock()
+        database.datetime.utcnow.return_value = self._now
+
+        database.time = MagicMock()
+        database.random = MagicMock()
+        database.random.uniform.side_effect = lambda low, high: high
+
+        database.threading = MagicMock()
+
+    def tearDown(self):
+        reload(database)
+
+    def _get_acquire_call(self, upsert=False):
+        return call({
+            '_id': self._id,
+            '$or': [
+                {self._lock_id: None},
+                {self._lock_id + '.expires': {'$lte': self._now}}
+            ]
+        }, {
+            '$set': {self._lock_id: {'owner': self._owner, 'expires': self._now + timedelta(seconds=60)}}
+        }, upsert=upsert)
+
+    def test_lock_document(self):
+        self._connection[self._collection].find_one_and_update.return_value = {'_id': self._id, 'state': 'pending'}
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+
+        self.assertFalse(lock.lock_document())
+        self.assertEquals({'_id': self._id, 'state': 'pending'}, lock.document)
+        self.assertEquals([self._get_acquire_call()], self._connection[self._collection].find_one_and_update.call_args_list)
+
+        # The lease is renewed in background
+        database.threading.Thread.assert_called_once_with(target=lock._renew, args=(database.threading.Event(),))
+        self.assertTrue(database.threading.Thread().daemon)
+        database.threading.Thread().start.assert_called_once_with()
+
+    def test_lock_document_locked(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+
+        self.assertTrue(lock.lock_document())
+        self._connection[self._collection].count_documents.assert_called_once_with({'_id': self._id}, limit=1)
+        self.assertIsNone(lock.document)
+        database.threading.Thread.assert_not_called()
+
+    def test_lock_document_not_found(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        self._connection[self._collection].count_documents.return_value = 0
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+
+        with self.assertRaisesMessage(ObjectDoesNotExist, 'The document {} does not exist in {}'.format(self._id, self._collection)):
+            lock.wait_document()
+
+        # The lock is not waited
+        database.time.sleep.assert_not_called()
+        database.threading.Thread.assert_not_called()
+
+    def test_lock_document_upsert(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+
+        lock = database.DocumentLock(self._collection, self._id, 'test', upsert=True)
+
+        # The document has been created
+        self.assertFalse(lock.lock_document())
+        self.assertEquals([self._get_acquire_call(True)], self._connection[self._collection].find_one_and_update.call_args_list)
+
+    def test_lock_document_upsert_locked(self):
+        self._connection[self._collection].find_one_and_update.side_effect = database.DuplicateKeyError('duplicated')
+
+        lock = database.DocumentLock(self._collection, self._id, 'test', upsert=True)
+
+        self.assertTrue(lock.lock_document())
+        database.threading.Thread.assert_not_called()
+
+    def test_wait_for_document(self):
+        self._connection[self._collection].find_one_and_update.side_effect = [None, None, None, None, None, None, {}]
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.wait_document()
+
+        # Check database calls
+        self.assertEquals([self._get_acquire_call()] * 7, self._connection[self._collection].find_one_and_update.call_args_list)
+
+        # The wait is doubled in every attempt up to the max
+        self.assertEquals([call(0, 0.05), call(0, 0.1), call(0, 0.2), call(0, 0.4), call(0, 0.8), call(0, 1.6)],
+                          database.random.uniform.call_args_list)
+        self.assertEquals([call(0.05), call(0.1), call(0.2), call(0.4), call(0.8), call(1.6)], database.time.sleep.call_args_list)
+
+    @override_settings(DOCUMENT_LOCK_MAX_WAIT=0.1)
+    def test_wait_for_document_max_wait(self):
+        self._connection[self._collection].find_one_and_update.side_effect = [None, None, None, {}]
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.wait_document()
+
+        self.assertEquals([call(0.05), call(0.1), call(0.1)], database.time.sleep.call_args_list)
+
+    def test_unlock_document(self):
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock.lock_document()
+        lock.unlock_document()
+
+        # Check database calls
+        database.threading.Event().set.assert_called_once_with()
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': self._id, self._lock_id + '.owner': self._owner}, {'$unset': {self._lock_id: ''}})
+
+    def test_context_manager(self):
+        self._connection[self._collection].find_one_and_update.return_value = {}
+
+        with database.DocumentLock(self._collection, self._id, 'test') as lock:
+            self.assertEquals({}, lock.document)
+            self._connection[self._collection].update_one.assert_not_called()
+
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {'_id': self._id, self._lock_id + '.owner': self._owner}, {'$unset': {self._lock_id: ''}})
+
+    @parameterized.expand([
+        ('renewed', [False, False, True], [1, 1], 2),
+        ('error', [False, False, True], [Exception('Error'), 1], 2),
+        ('lost', [False, False, True], [0], 1)
+    ])
+    def test_renew_lease(self, name, stopped, results, calls):
+        self._connection[self._collection].update_one.side_effect = [
+            result if isinstance(result, Exception) else MagicMock(matched_count=result) for result in results]
+
+        stop = MagicMock()
+        stop.wait.side_effect = stopped
+
+        lock = database.DocumentLock(self._collection, self._id, 'test')
+        lock._renew(stop)
+
+        self.assertEquals([call({'_id': self._id, self._lock_id + '.owner': self._owner},
+                                {'$set': {self._lock_id + '.expires': self._now + timedelta(seconds=60)}})] * calls,
+                          self._connection[self._collection].update_one.call_args_list)
+        stop.wait.assert_called_with(20)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from mock import MagicMock
+from parameterized import parameterized
+from requests import Response
+
+from django.test.utils import override_settings
+from django.test import TestCase
+
+from wstore.store_commons import http_session
+
+
+class HTTPSessionTestCase(TestCase):
+    tags = ('http-session',)
+
+    def setUp(self):
+        self._getpid = http_session.os.getpid
+        http_session.os.getpid = MagicMock(return_value=1)
+        http_session._sessions.clear()
+
+    def tearDown(self):
+        http_session._sessions.clear()
+        http_session.os.getpid = self._getpid
+
+    def test_get_session(self):
+        session = http_session.get_session('http://catalog.com:8080/api/productOffering/1')
+
+        self.assertTrue(session is http_session.get_session('http://catalog.com:8080/api/productSpecification/2'))
+        self.assertFalse(session is http_session.get_session('http://inventory.com:8080/api/product/1'))
+        self.assertFalse(session is http_session.get_session('https://catalog.com:8080/api/productOffering/1'))
+
+    def test_get_session_forked(self):
+        session = http_session.get_session('http://catalog.com:8080/api/productOffering/1')
+
+        http_session.os.getpid.return_value = 2
+        self.assertFalse(session is http_session.get_session('http://catalog.com:8080/api/productOffering/1'))
+
+    @override_settings(HTTP_RETRIES=2, HTTP_POOL_SIZE=10)
+    def test_session_retries(self):
+        session = http_session.PooledSession()
+        adapter = session.get_adapter('http://catalog.com:8080/')
+
+        self.assertEquals(10, adapter._pool_maxsize)
+        self.assertEquals(2, adapter.max_retries.total)
+        self.assertEquals((502, 503, 504), adapter.max_retries.status_forcelist)
+        self.assertTrue('GET' in adapter.max_retries.allowed_methods)
+        self.assertFalse('POST' in adapter.max_retries.allowed_methods)
+        self.assertFalse('PATCH' in adapter.max_retries.allowed_methods)
+
+    def test_retry_backoff_jitter(self):
+        retries = http_session.JitteredRetry(total=5, backoff_factor=1)
+        retries = retries.increment(method='GET', url='/').increment(method='GET', url='/').increment(method='GET', url='/')
+
+        for i in range(10):
+            backoff = retries.get_backoff_time()
+            self.assertTrue(2 <= backoff <= 4)
+
+    @parameterized.expand([
+        ('default', {}, (5, 60)),
+        ('explicit', {'timeout': 10}, 10)
+    ])
+    @override_settings(HTTP_CONNECT_TIMEOUT=5, HTTP_READ_TIMEOUT=60)
+    def test_session_timeout(self, name, kwargs, exp_timeout):
+        response = Response()
+        response.status_code = 200
+
+        adapter = MagicMock()
+        adapter.send.return_value = response
+
+        session = http_session.PooledSession()
+        session.mount('http://', adapter)
+
+        self.assertTrue(session.get('http://catalog.com:8080/api/productOffering/1', **kwargs) is response)
+        self.assertEquals(exp_timeout, adapter.send.call_args[1]['timeout'])
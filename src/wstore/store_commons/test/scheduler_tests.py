@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+from mock import MagicMock
+from parameterized import parameterized
+
+from django.test.utils import override_settings
+from django.test import TestCase
+
+from wstore.store_commons import scheduler
+
+
+def scheduled_handler(**kwargs):
+    scheduled_handler.calls.append(kwargs)
+
+    if scheduled_handler.error is not None:
+        raise scheduled_handler.error
+
+
+def renewing_handler(**kwargs):
+    renewing_handler.renewed.append(scheduler.renew_task_lease())
+
+
+@override_settings(SCHEDULER_TASK_LEASE=300, SCHEDULER_MAX_ATTEMPTS=3, SCHEDULER_RETRY_DELAY=30)
+class SchedulerTestCase(TestCase):
+    tags = ('scheduler',)
+
+    def setUp(self):
+        self._collection = MagicMock()
+        self._get_scheduler = scheduler.get_scheduler
+        self._get_database_connection = scheduler.get_database_connection
+
+        scheduler.get_database_connection = MagicMock(return_value={'wstore_scheduled_task': self._collection})
+        scheduler.get_scheduler = MagicMock()
+
+        self._now = datetime(2023, 3, 15, 10, 0, 0)
+        scheduler.datetime = MagicMock()
+        scheduler.datetime.utcnow.return_value = self._now
+
+        scheduled_handler.calls = []
+        scheduled_handler.error = None
+
+    def tearDown(self):
+        scheduler.datetime = datetime
+        scheduler.get_scheduler = self._get_scheduler
+        scheduler.get_database_connection = self._get_database_connection
+
+    @parameterized.expand([
+        ('delayed', 300, False),
+        ('immediate', 0, True)
+    ])
+    def test_schedule_task(self, name, delay, notified):
+        self._collection.insert_one.return_value.inserted_id = 'task_id'
+
+        task_id = scheduler.schedule_task('wstore.module.handler', delay, order_id='1', concept='initial')
+
+        self.assertEquals('task_id', task_id)
+        self._collection.insert_one.assert_called_once_with({
+            'handler': 'wstore.module.handler',
+            'args': {'order_id': '1', 'concept': 'initial'},
+            'state': 'scheduled',
+            'attempts': 0,
+            'created': self._now,
+            'due': self._now + timedelta(seconds=delay)
+        })
+
+        scheduler.get_scheduler().start.assert_called_once_with()
+        self.assertEquals(notified, scheduler.get_scheduler().notify.called)
+
+    def test_schedule_task_id(self):
+        task_id = '59f76ace051eb500613cbbc7'
+        self._collection.insert_one.return_value.inserted_id = ObjectId(task_id)
+
+        self.assertEquals(ObjectId(task_id), scheduler.schedule_task('wstore.module.handler', 10, task_id=task_id, check_id=task_id))
+
+        self._collection.insert_one.assert_called_once_with({
+            '_id': ObjectId(task_id),
+            'handler': 'wstore.module.handler',
+            'args': {'check_id': task_id},
+            'state': 'scheduled',
+            'attempts': 0,
+            'created': self._now,
+            'due': self._now + timedelta(seconds=10)
+        })
+
+    @parameterized.expand([
+        ('immediate', 0, 1, True, True),
+        ('delayed', 60, 1, True, False),
+        ('not_scheduled', 0, 0, False, False)
+    ])
+    def test_reschedule_task(self, name, delay, modified, exp_result, notified):
+        task_id = '59f76ace051eb500613cbbc7'
+        self._collection.update_one.return_value.modified_count = modified
+
+        self.assertEquals(exp_result, scheduler.reschedule_task(task_id, delay))
+
+        self._collection.update_one.assert_called_once_with({
+            '_id': ObjectId(task_id),
+            'state': 'scheduled'
+        }, {
+            '$set': {'due': self._now + timedelta(seconds=delay)}
+        })
+        self.assertEquals(notified, scheduler.get_scheduler().notify.called)
+
+    def test_cancel_task(self):
+        task_id = '59f76ace051eb500613cbbc7'
+        scheduler.cancel_task(task_id)
+
+        self._collection.delete_one.assert_called_once_with({'_id': ObjectId(task_id), 'state': 'scheduled'})
+
+    @override_settings(SCHEDULER_WORKERS=1)
+    def test_claim_task(self):
+        task = {'_id': 'task_id'}
+        self._collection.find_one_and_update.return_value = task
+
+        self.assertEquals(task, scheduler.TaskScheduler().claim_task())
+
+        self._collection.find_one_and_update.assert_called_once_with({
+            '$or': [
+                {'state': 'scheduled', 'due': {'$lte': self._now}},
+                {'state': 'running', 'lease_expires': {'$lt': self._now}}
+            ]
+        }, {
+            '$set': {
+                'state': 'running',
+                'lease_expires': self._now + timedelta(seconds=300)
+            },
+            '$inc': {'attempts': 1}
+        }, sort=[('due', 1)], return_document=scheduler.ReturnDocument.AFTER)
+
+    def _get_task(self, attempts=1):
+        return {
+            '_id': 'task_id',
+            'handler': __name__ + '.scheduled_handler',
+            'args': {'asset_id': '1'},
+            'attempts': attempts
+        }
+
+    @override_settings(SCHEDULER_WORKERS=1)
+    def test_run_task(self):
+        scheduler.TaskScheduler().run_task(self._get_task())
+
+        self.assertEquals([{'asset_id': '1'}], scheduled_handler.calls)
+        self._collection.delete_one.assert_called_once_with({'_id': 'task_id', 'state': 'running', 'attempts': 1})
+
+    @parameterized.expand([
+        ('owned', 1, True),
+        ('claimed_again', 0, False)
+    ])
+    @override_settings(SCHEDULER_WORKERS=1)
+    def test_renew_task_lease(self, name, modified, expected):
+        renewing_handler.renewed = []
+        self._collection.update_one.return_value.modified_count = modified
+        task = self._get_task(2)
+        task['handler'] = __name__ + '.renewing_handler'
+
+        scheduler.TaskScheduler().run_task(task)
+
+        self.assertEquals([expected], renewing_handler.renewed)
+        self._collection.update_one.assert_called_once_with({
+            '_id': 'task_id',
+            'state': 'running',
+            'attempts': 2
+        }, {
+            '$set': {'lease_expires': self._now + timedelta(seconds=300)}
+        })
+
+    def test_renew_task_lease_no_task(self):
+        # Handlers executed out of the scheduler do not have a lease
+        self.assertTrue(scheduler.renew_task_lease())
+        self._collection.update_one.assert_not_called()
+
+    @parameterized.expand([
+        ('retry', 2, {
+            'state': 'scheduled',
+            'due': datetime(2023, 3, 15, 10, 1, 0),
+            'last_error': 'Handler error'
+        }),
+        ('failed', 3, {
+            'state': 'failed',
+            'last_error': 'Handler error'
+        })
+    ])
+    @override_settings(SCHEDULER_WORKERS=1)
+    def test_run_task_error(self, name, attempts, expected):
+        scheduled_handler.error = ValueError('Handler error')
+
+        scheduler.TaskScheduler().run_task(self._get_task(attempts))
+
+        self.assertEquals(0, self._collection.delete_one.call_count)
+        self._collection.update_one.assert_called_once_with(
+            {'_id': 'task_id', 'state': 'running', 'attempts': attempts}, {'$set': expected})
@@ -22,14 +22,14 @@
 
 from bson import ObjectId
 from importlib import reload
-from mock import MagicMock, call
+from mock import MagicMock
 from parameterized import parameterized
 
 from django.contrib.auth.models import AnonymousUser
 from django.test.utils import override_settings
 from django.test import TestCase
 
-from wstore.store_commons import middleware, rollback, database
+from wstore.store_commons import middleware, rollback
 from wstore.store_commons.utils.url import is_valid_url
 
 __test__ = False
@@ -338,37 +338,6 @@ class RollbackTestCase(TestCase):
         rollback.downgrade_asset_pa(manager())
 
 
-class DocumentLockTestCase(TestCase):
-    tags = ('lock',)
-
-    _id = '59f76ace051eb500613cbbc7'
-    _collection = 'test_collection'
-    _lock_id = '_lock_test'
-
-    def setUp(self):
-        self._connection = MagicMock()
-        database.get_database_connection = MagicMock(return_value=self._connection)
-
-    def test_wait_for_document(self):
-        self._connection[self._collection].find_one_and_update.side_effect = [{self._lock_id: True}, {self._lock_id: False}]
-
-        lock = database.DocumentLock(self._collection, self._id, 'test')
-        lock.wait_document()
-
-        # Check database calls
-        self.assertEquals([
-            call({'_id': self._id}, {'$set': {self._lock_id: True}}),
-            call({'_id': self._id}, {'$set': {self._lock_id: True}})
-        ], self._connection[self._collection].find_one_and_update.call_args_list)
-
-    def test_unlock_document(self):
-        lock = database.DocumentLock(self._collection, self._id, 'test')
-        lock.unlock_document()
-
-        # Check database calls
-        self._connection[self._collection].find_one_and_update.assert_called_once_with({'_id': self._id}, {'$set': {self._lock_id: False}})
-
-
 class URLUtilsTestCase(TestCase):
 
     tags = ('utils', 'url-utils')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+from datetime import datetime, timedelta, timezone
+
+
+INVALID_FORMAT = 'Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm'
+
+_TIMESTAMP = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+# Lengths of the timestamps without offset that can be parsed with fromisoformat, i.e., with 0, 3, or 6 decimals
+_ISO_LENGTHS = (19, 23, 26)
+
+# Agents send SDRs with a few distinct offsets, so they are parsed once
+_offsets = {}
+_MAX_OFFSETS = 64
+
+
+def _get_offset(raw_offset):
+    offset = _offsets.get(raw_offset)
+
+    if offset is None:
+        digits = raw_offset[1:].replace(':', '')
+        offset = timedelta(hours=int(digits[:2]), minutes=int(digits[2:4] or '0'))
+
+        if raw_offset[0] == '-':
+            offset = -offset
+
+        if len(_offsets) < _MAX_OFFSETS:
+            _offsets[raw_offset] = offset
+
+    return offset
+
+
+def parse_timestamp(raw_time):
+    """
+    Parses an ISO 8601 timestamp, with T or space separator, optional decimals, and optional Z or
+    numeric offset. Timestamps with offset are converted to UTC, timestamps without it are considered UTC
+    :param raw_time: String with the timestamp
+    :return: Naive UTC datetime truncated to milliseconds (database supported)
+    """
+    if not isinstance(raw_time, str):
+        raise ValueError(INVALID_FORMAT)
+
+    # Fast path for the timestamps without offset
+    if len(raw_time) in _ISO_LENGTHS and raw_time[10:11] in ('T', ' ') and raw_time[4:5] == '-':
+        try:
+            time_stamp = datetime.fromisoformat(raw_time)
+        except ValueError:
+            pass
+        else:
+            if time_stamp.tzinfo is None:
+                return time_stamp.replace(microsecond=time_stamp.microsecond // 1000 * 1000)
+
+    match = _TIMESTAMP.match(raw_time)
+    if match is None:
+        raise ValueError(INVALID_FORMAT)
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+
+    try:
+        time_stamp = datetime(
+            int(year), int(month), int(day), int(hour), int(minute), int(second),
+            int(fraction[:3].ljust(3, '0')) * 1000 if fraction else 0)
+    except ValueError:
+        raise ValueError(INVALID_FORMAT)
+
+    if offset is not None and offset != 'Z':
+        time_stamp -= _get_offset(offset)
+
+    return time_stamp
+
+
+def format_timestamp(time_stamp):
+    """
+    Serializes a timestamp as an ISO 8601 UTC string
+    :param time_stamp: datetime, naive ones are considered UTC, or string to be normalized
+    :return: String with the format YYYY-MM-ddTHH:mm:ss.ffffffZ
+    """
+    if isinstance(time_stamp, str):
+        time_stamp = parse_timestamp(time_stamp)
+
+    if time_stamp.tzinfo is not None:
+        time_stamp = time_stamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return time_stamp.isoformat() + 'Z'
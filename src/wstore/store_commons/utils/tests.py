@@ -19,12 +19,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from datetime import datetime, timedelta, timezone
+
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from parameterized import parameterized
 
+from wstore.store_commons.utils.dates import format_timestamp, parse_timestamp
 from wstore.store_commons.utils.units import ChargePeriod, CurrencyCode
 
 
@@ -114,3 +117,46 @@ class CurrencyCodeUnitsTestCase(TestCase):
             self.valid,
         ]
         self.assertEqual(CurrencyCode.to_json(), dict_expected)
+
+
+class DatesTestCase(TestCase):
+
+    tags = ('dates',)
+
+    @parameterized.expand([
+        ("space_separator", '2015-10-20 17:31:57.100000', datetime(2015, 10, 20, 17, 31, 57, 100000)),
+        ("t_separator", '2015-10-20T17:31:57.838123', datetime(2015, 10, 20, 17, 31, 57, 838000)),
+        ("milliseconds", '2015-10-20T17:31:57.838', datetime(2015, 10, 20, 17, 31, 57, 838000)),
+        ("no_decimals", '2015-10-20T17:31:57', datetime(2015, 10, 20, 17, 31, 57)),
+        ("one_decimal", '2015-10-20T17:31:57.8', datetime(2015, 10, 20, 17, 31, 57, 800000)),
+        ("nanoseconds", '2015-10-20T17:31:57.838123456Z', datetime(2015, 10, 20, 17, 31, 57, 838000)),
+        ("utc", '2015-10-20T17:31:57.838Z', datetime(2015, 10, 20, 17, 31, 57, 838000)),
+        ("positive_offset", '2015-10-20T17:31:57+02:00', datetime(2015, 10, 20, 15, 31, 57)),
+        ("negative_offset", '2015-10-20T23:31:57.5-0530', datetime(2015, 10, 21, 5, 1, 57, 500000)),
+        ("hours_offset", '2015-10-20T17:31:57+01', datetime(2015, 10, 20, 16, 31, 57))
+    ])
+    def test_parse_timestamp(self, name, raw_time, expected):
+        self.assertEqual(expected, parse_timestamp(raw_time))
+
+    @parameterized.expand([
+        ("date", '2015-10-20'),
+        ("invalid_month", '2015-13-20T17:31:57.100'),
+        ("invalid_offset", '2015-10-20T17:31:57+2'),
+        ("text", 'invalid'),
+        ("not_string", None)
+    ])
+    def test_parse_timestamp_invalid(self, name, raw_time):
+        with self.assertRaises(ValueError) as e:
+            parse_timestamp(raw_time)
+
+        self.assertEqual(
+            'Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm',
+            str(e.exception))
+
+    @parameterized.expand([
+        ("naive", datetime(2016, 4, 15, 10, 12, 13, 123456), '2016-04-15T10:12:13.123456Z'),
+        ("aware", datetime(2016, 4, 15, 10, 12, 13, tzinfo=timezone(timedelta(hours=2))), '2016-04-15T08:12:13Z'),
+        ("string", '2016-04-15 10:12:13.123456', '2016-04-15T10:12:13.123000Z')
+    ])
+    def test_format_timestamp(self, name, time_stamp, expected):
+        self.assertEqual(expected, format_timestamp(time_stamp))
@@ -47,10 +47,13 @@ urlpatterns = [
     url(r'^charging/api/orderManagement/orders/accept/?$', charging_views.PayPalConfirmation(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/orders/cancel/?$', charging_views.PayPalCancellation(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/orders/refund/?$', charging_views.PayPalRefund(permitted_methods=('POST',))),
+    url(r'^charging/api/orderManagement/orders/(?P<order_id>[\w-]+)/charges/?$', ordering_views.ChargeCollection(permitted_methods=('GET',))),
     url(r'^charging/api/orderManagement/products/?$', ordering_views.InventoryCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/products/renewJob/?$', ordering_views.RenovationCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/products/unsubscribeJob/?$', ordering_views.UnsubscriptionCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/accounting/?$', accounting_views.ServiceRecordCollection(permitted_methods=('POST',))),
+    url(r'^charging/api/orderManagement/accounting/batch/?$', accounting_views.ServiceRecordBatchCollection(permitted_methods=('POST',))),
     url(r'^charging/api/orderManagement/accounting/refresh/?$', accounting_views.SDRRefreshCollection(permitted_methods=('POST',))),
-    url(r'^charging/api/reportManagement/created/?$', reports_views.ReportReceiver(permitted_methods=('POST',)))
+    url(r'^charging/api/reportManagement/created/?$', reports_views.ReportReceiver(permitted_methods=('POST',))),
+    url(r'^charging/api/reportManagement/payoutNotification/?$', reports_views.PayoutNotificationReceiver(permitted_methods=('POST',)))
 ]